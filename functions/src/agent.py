@@ -1,19 +1,34 @@
 """
 Agent - Core implementation of the Relex Legal Assistant
 """
+import asyncio
 import logging
+import threading
+from datetime import datetime
 import firebase_admin
 from firebase_admin import firestore
 import functions_framework
-from flask import Request
-from agent_orchestrator import AgentGraph, AgentState
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+from flask import Request, Response
+import agent_events
+from agent_jobs import AgentJobWorkerPool, get_job_queue
+from agent_orchestrator import AgentState, agent_checkpoint_ref, get_agent_graph, load_checkpoint
 from common.database import db
 from common.clients import get_db_client, get_storage_client, initialize_stripe
+from common.async_runtime import iterate_on_loop, run_coroutine
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Streamed turns are sent as server-sent events; proxies must pass them through unbuffered
+EVENT_STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+# A job run by relex_backend_run_agent_jobs stops starting new jobs after this long, and a job
+# it has started is cancelled after AGENT_JOB_TURN_TIMEOUT_SECONDS, so every job ends within
+# the function's 540 s timeout
+AGENT_JOB_WORKER_BUDGET_SECONDS = 240
+AGENT_JOB_TURN_TIMEOUT_SECONDS = 300
+
 def handle_agent_request(request: Request):
     """
     Main entry point for handling agent requests.
@@ -24,18 +39,44 @@ def handle_agent_request(request: Request):
     end_user_id = getattr(request, 'end_user_id', None)
     if not end_user_id:
         return {"status": "error", "message": "Unauthorized: User context is missing."}, 401
-    
-    # Extract caseId from query parameters
-    case_id = request.args.get('caseId')
-    if not case_id:
-        return {"status": "error", "message": "Bad Request: caseId query parameter is required."}, 400
 
-    # Fetch the case from Firestore
+    try:
+        body = request.get_json(silent=True)
+    except Exception as e:
+        logging.error(f"Failed to parse request body: {e}")
+        return {"status": "error", "message": "Bad Request: Invalid JSON body."}, 400
+
+    # Run the agent turn on the instance's long-lived event loop, so clients and
+    # connections opened by earlier requests are reused
+    if wants_agent_job(request.headers.get('Prefer'), request.args.get('async')):
+        return run_coroutine(enqueue_agent_turn(end_user_id, request.args.get('caseId'), body))
+    if not wants_event_stream(request.headers.get('Accept'), request.args.get('stream')):
+        return run_coroutine(run_agent_turn(end_user_id, request.args.get('caseId'), body))
+
+    turn, error = run_coroutine(prepare_agent_turn(end_user_id, request.args.get('caseId'), body))
+    if error:
+        return error
+    return Response(iterate_on_loop(stream_agent_turn(*turn)), mimetype="text/event-stream",
+                    headers=EVENT_STREAM_HEADERS)
+
+def wants_event_stream(accept: Optional[str], stream: Optional[str]) -> bool:
+    """A turn is streamed if the client accepts text/event-stream or passes stream=true."""
+    return "text/event-stream" in (accept or "") or (stream or "").lower() in ("1", "true")
+
+def wants_agent_job(prefer: Optional[str], async_param: Optional[str]) -> bool:
+    """A turn is queued as a job if the client sends Prefer: respond-async or passes async=true."""
+    return "respond-async" in (prefer or "") or (async_param or "").lower() in ("1", "true")
+
+def _load_authorized_case(case_id: str, end_user_id: str):
+    """Loads the case if the user owns it or belongs to its organization.
+
+    Returns (case_data, None) or (None, (error_body, status_code)). Blocking Firestore reads.
+    """
     db_client = get_db_client()
     case_ref = db_client.collection("cases").document(case_id)
     case_doc = case_ref.get()
     if not case_doc.exists:
-        return {"status": "error", "message": "Case not found."}, 404
+        return None, ({"status": "error", "message": "Case not found."}, 404)
     case_data = case_doc.to_dict()
 
     # Authorization: check if user is owner or org member
@@ -48,31 +89,56 @@ def handle_agent_request(request: Request):
         memberships = list(membership_query.stream())
         is_org_member = bool(memberships)
     if not (is_owner or is_org_member):
-        return {"status": "error", "message": "Forbidden: User does not have access to this case."}, 403
+        return None, ({"status": "error", "message": "Forbidden: User does not have access to this case."}, 403)
+    return case_data, None
+
+async def _authorize_turn(end_user_id: str, case_id: Optional[str], body: Optional[Dict[str, Any]]):
+    """Returns ((case_data, user_message), None) for a valid turn request, or (None, error)."""
+    if not case_id:
+        return None, ({"status": "error", "message": "Bad Request: caseId query parameter is required."}, 400)
+
+    case_data, error = await asyncio.to_thread(_load_authorized_case, case_id, end_user_id)
+    if error:
+        return None, error
 
     # Parse the user's message from the request body
-    try:
-        body = request.get_json(silent=True)
-        user_message = body.get("message") if body else None
-    except Exception as e:
-        logging.error(f"Failed to parse request body: {e}")
-        return {"status": "error", "message": "Bad Request: Invalid JSON body."}, 400
+    user_message = body.get("message") if isinstance(body, dict) else None
     if not user_message:
-        return {"status": "error", "message": "Bad Request: 'message' is required in the request body."}, 400
+        return None, ({"status": "error", "message": "Bad Request: 'message' is required in the request body."}, 400)
+    return (case_data, user_message), None
 
-    # Prepare case_details and user_info for the agent
-    case_details = case_data.copy()
-    case_details["input"] = user_message
-    user_info = {"id": end_user_id}
+async def prepare_agent_turn(end_user_id: str, case_id: Optional[str], body: Optional[Dict[str, Any]]):
+    """
+    Validates a turn request and loads (or restores) its agent state.
 
-    # Create agent state
-    state = AgentState(case_id=case_id, user_id=end_user_id, case_details=case_details, user_info=user_info)
-    graph = AgentGraph()
+    Returns ((state, checkpoint_ref), None) or (None, (error_body, status_code)).
+    """
+    turn, error = await _authorize_turn(end_user_id, case_id, body)
+    if error:
+        return None, error
+    case_data, user_message = turn
 
-    # Run the agent workflow (must run async)
-    import asyncio
+    # A retry of a failed turn resumes from its checkpoint, after the last completed node
+    checkpoint_ref = agent_checkpoint_ref(get_db_client(), case_id, end_user_id, user_message)
+    state = await asyncio.to_thread(load_checkpoint, checkpoint_ref)
+    if state is not None:
+        logging.info(f"Resuming agent turn for case {case_id} after node {state.current_node}")
+    else:
+        # Prepare case_details and user_info for the agent
+        case_details = case_data.copy()
+        case_details["input"] = user_message
+        user_info = {"id": end_user_id}
+
+        # Create agent state
+        state = AgentState(case_id=case_id, user_id=end_user_id, case_details=case_details, user_info=user_info,
+                           organization_id=case_data.get("organizationId"))
+    return (state, checkpoint_ref), None
+
+async def execute_agent_turn(state: AgentState, checkpoint_ref) -> Tuple[Dict[str, Any], int]:
+    """Runs the agent graph for a prepared turn and returns (response, status_code)."""
+    graph = get_agent_graph()
     try:
-        final_response = asyncio.run(graph.execute(state))
+        final_response = await graph.execute(state, checkpoint_ref=checkpoint_ref)
         if not isinstance(final_response, dict):
             final_response = {"status": "error", "message": "Agent did not return a valid response."}
         if "status" not in final_response:
@@ -81,3 +147,139 @@ def handle_agent_request(request: Request):
     except Exception as e:
         logging.error(f"Agent execution error: {e}")
         return {"status": "error", "message": str(e)}, 500
+
+async def run_agent_turn(end_user_id: str, case_id: Optional[str], body: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Any], int]:
+    """
+    Runs one agent turn for an authenticated user and returns (response, status_code).
+
+    Shared by the Flask handler above and the async server in agent_asgi.py. Firestore
+    reads run on executor threads, so the event loop keeps serving other turns meanwhile.
+    """
+    turn, error = await prepare_agent_turn(end_user_id, case_id, body)
+    if error:
+        return error
+    return await execute_agent_turn(*turn)
+
+async def stream_agent_turn(state: AgentState, checkpoint_ref) -> AsyncIterator[str]:
+    """
+    Runs a prepared turn and yields its progress as server-sent events.
+
+    Yields node_start / node_end / node_error events from the graph and a token event for
+    every chunk of model output, then one result event with the response and status code
+    the unstreamed endpoint would return. If the client goes away, the turn is cancelled;
+    its checkpoint keeps the completed nodes for a retry.
+    """
+    events = asyncio.Queue()
+
+    async def run():
+        with agent_events.event_sink(events.put_nowait):
+            response, status_code = await execute_agent_turn(state, checkpoint_ref)
+        events.put_nowait({"event": "result", "status_code": status_code, "response": response})
+
+    task = asyncio.create_task(run())
+    try:
+        while True:
+            event = await events.get()
+            yield agent_events.format_sse(event)
+            if event["event"] == "result":
+                return
+    finally:
+        if not task.done():
+            task.cancel()
+
+def _subscription_tier(end_user_id: str):
+    """Reads the user's subscription tier, which sets the priority of their queued turns."""
+    user_doc = get_db_client().collection("users").document(end_user_id).get()
+    return (user_doc.to_dict() or {}).get("subscription", {}).get("tier", 0) if user_doc.exists else 0
+
+async def enqueue_agent_turn(end_user_id: str, case_id: Optional[str], body: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Any], int]:
+    """
+    Queues a turn as an agent job and returns ({jobId, status}, 202) without running it.
+
+    The request is validated now, like a turn run right away; the job's response is read
+    from handle_get_agent_job once a worker has run it.
+    """
+    turn, error = await _authorize_turn(end_user_id, case_id, body)
+    if error:
+        return error
+    _, user_message = turn
+    tier = await asyncio.to_thread(_subscription_tier, end_user_id)
+    queue = get_job_queue()
+    job_id = await asyncio.to_thread(queue.enqueue, end_user_id, case_id, user_message, tier)
+    logging.info(f"Queued agent job {job_id} for case {case_id}")
+    if queue.runs_in_process:
+        get_agent_job_pool().start()
+    return {"status": "queued", "jobId": job_id}, 202
+
+async def run_agent_job(job: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
+    """
+    Runs a queued turn and returns (response, status_code), as the endpoint would have.
+
+    A turn still running after AGENT_JOB_TURN_TIMEOUT_SECONDS is cancelled and answered with
+    a 504, so the worker retries it from its checkpoint.
+    """
+    try:
+        return await asyncio.wait_for(_run_agent_job(job), AGENT_JOB_TURN_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        logging.error(f"Agent job {job['id']} did not finish within {AGENT_JOB_TURN_TIMEOUT_SECONDS} s")
+        return {"status": "error", "message": "Agent turn timed out."}, 504
+
+async def _run_agent_job(job: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
+    # Access is checked again: the user may have lost it while the job was queued
+    turn, error = await prepare_agent_turn(job["userId"], job["caseId"], {"message": job["message"]})
+    if error:
+        return error
+    return await execute_agent_turn(*turn)
+
+_agent_job_pool = None
+_agent_job_pool_lock = threading.Lock()
+
+def get_agent_job_pool() -> AgentJobWorkerPool:
+    """Returns this instance's pool of agent job workers, creating it on first use."""
+    global _agent_job_pool
+    if _agent_job_pool is None:
+        with _agent_job_pool_lock:
+            if _agent_job_pool is None:
+                _agent_job_pool = AgentJobWorkerPool(get_job_queue(), run_agent_job)
+    return _agent_job_pool
+
+def _job_view(job: Dict[str, Any]) -> Dict[str, Any]:
+    """The fields of a job document a client sees."""
+    view = {"jobId": job["id"], "caseId": job.get("caseId"), "status": job.get("status"),
+            "attempts": job.get("attempts", 0)}
+    for field in ("createdAt", "startedAt", "finishedAt"):
+        if isinstance(job.get(field), datetime):
+            view[field] = job[field].isoformat()
+    for field in ("statusCode", "result", "error"):
+        if job.get(field) is not None:
+            view[field] = job[field]
+    return view
+
+def handle_get_agent_job(request: Request):
+    """
+    Returns the status of an agent job and, once it has finished, its response.
+    """
+    end_user_id = getattr(request, 'end_user_id', None)
+    if not end_user_id:
+        return {"status": "error", "message": "Unauthorized: User context is missing."}, 401
+    return get_agent_job(end_user_id, request.args.get('jobId'))
+
+def get_agent_job(end_user_id: str, job_id: Optional[str]) -> Tuple[Dict[str, Any], int]:
+    """Returns (job status, status_code) for the job's owner. Blocking Firestore read."""
+    if not job_id:
+        return {"status": "error", "message": "Bad Request: jobId query parameter is required."}, 400
+
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return {"status": "error", "message": "Job not found."}, 404
+    if job.get("userId") != end_user_id:
+        return {"status": "error", "message": "Forbidden: User does not have access to this job."}, 403
+    return _job_view(job), 200
+
+def handle_run_agent_jobs(request: Request):
+    """
+    Runs queued agent jobs on this instance until the queue is empty or the time budget is spent.
+    """
+    processed = run_coroutine(get_agent_job_pool().run(budget_seconds=AGENT_JOB_WORKER_BUDGET_SECONDS))
+    logging.info(f"Agent job worker ran {processed} jobs")
+    return {"status": "success", "processed": processed}, 200
@@ -0,0 +1,88 @@
+"""
+Agent ASGI app - async serving mode for the Lawyer AI Agent
+
+relex_backend_agent_handler runs in a synchronous Flask worker, where every in-flight turn
+holds a worker thread for the whole LLM and research wait. This app serves the same
+endpoint from an event loop instead, so one instance multiplexes many concurrent turns:
+
+    uvicorn agent_asgi:app --host 0.0.0.0 --port $PORT
+
+Authentication and the agent turn itself are shared with the Flask handler
+(auth.get_authenticated_user and agent.run_agent_turn), and so is the streaming mode
+(Accept: text/event-stream or ?stream=true, see agent.stream_agent_turn) and the job mode
+(Prefer: respond-async or ?async=true, see agent.enqueue_agent_turn).
+"""
+import asyncio
+import contextlib
+import logging
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from agent import (EVENT_STREAM_HEADERS, enqueue_agent_turn, get_agent_job, prepare_agent_turn, run_agent_turn,
+                   stream_agent_turn, wants_agent_job, wants_event_stream)
+from auth import get_authenticated_user
+from common import async_runtime
+
+logger = logging.getLogger(__name__)
+
+async def handle_agent_turn(request: Request) -> Response:
+    """Async counterpart of main.relex_backend_agent_handler."""
+    # Token validation may fetch signing keys, so keep it off the server loop
+    auth_context, status_code, error_message = await asyncio.to_thread(get_authenticated_user, request)
+    if error_message or not auth_context:
+        return JSONResponse({"error": "Unauthorized", "message": error_message or "Authentication failed"},
+                            status_code=status_code or 401)
+
+    try:
+        body = await request.json()
+    except Exception as e:
+        logger.info(f"Agent request without a JSON body: {e}")
+        body = None
+
+    # Turns run on the instance's background loop, next to the clients they share with
+    # the Flask handler; this loop only waits for the result
+    user_id, case_id = auth_context.firebase_user_id, request.query_params.get('caseId')
+    if wants_agent_job(request.headers.get('prefer'), request.query_params.get('async')):
+        response, status = await async_runtime.run_coroutine_async(enqueue_agent_turn(user_id, case_id, body))
+        return JSONResponse(response, status_code=status)
+    if not wants_event_stream(request.headers.get('accept'), request.query_params.get('stream')):
+        response, status = await async_runtime.run_coroutine_async(run_agent_turn(user_id, case_id, body))
+        return JSONResponse(response, status_code=status)
+
+    turn, error = await async_runtime.run_coroutine_async(prepare_agent_turn(user_id, case_id, body))
+    if error:
+        return JSONResponse(error[0], status_code=error[1])
+    return StreamingResponse(async_runtime.aiterate_on_loop(stream_agent_turn(*turn)),
+                             media_type="text/event-stream", headers=EVENT_STREAM_HEADERS)
+
+async def handle_get_agent_job(request: Request) -> Response:
+    """Async counterpart of main.relex_backend_get_agent_job.
+
+    Served by the same app, so that with AGENT_JOB_QUEUE=memory the jobs queued by this
+    process can be polled.
+    """
+    auth_context, status_code, error_message = await asyncio.to_thread(get_authenticated_user, request)
+    if error_message or not auth_context:
+        return JSONResponse({"error": "Unauthorized", "message": error_message or "Authentication failed"},
+                            status_code=status_code or 401)
+    response, status = await asyncio.to_thread(get_agent_job, auth_context.firebase_user_id,
+                                               request.query_params.get('jobId'))
+    return JSONResponse(response, status_code=status)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    yield
+    await asyncio.to_thread(async_runtime.shutdown)
+
+# The API Gateway calls the backend with CONSTANT_ADDRESS, so any path is the agent endpoint
+# (POST) or the job status endpoint (GET, with the job ID as the jobId query parameter)
+app = Starlette(
+    routes=[
+        Route("/", handle_agent_turn, methods=["POST"]),
+        Route("/{path:path}", handle_agent_turn, methods=["POST"]),
+        Route("/", handle_get_agent_job, methods=["GET"]),
+        Route("/{path:path}", handle_get_agent_job, methods=["GET"]),
+    ],
+    lifespan=lifespan,
+)
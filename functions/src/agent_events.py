@@ -0,0 +1,36 @@
+"""
+Agent Events - Progress events of a streamed agent turn
+"""
+import contextlib
+import json
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+
+# Code running inside a streamed agent turn (graph nodes, tools, model calls) reports progress
+# with emit(). The turn installs a sink with event_sink(); outside one, emit() does nothing.
+# The sink lives in a context variable, so concurrent turns on one event loop, and tasks they
+# start, each report to their own stream.
+_sink: ContextVar[Optional[Callable[[Dict[str, Any]], None]]] = ContextVar('agent_event_sink', default=None)
+
+def emit(event: str, **data: Any) -> None:
+    """Report an event ('node_start', 'node_end', 'node_error', 'token', ...) to the current turn."""
+    sink = _sink.get()
+    if sink is not None:
+        sink({'event': event, **data})
+
+def streaming() -> bool:
+    """Tells whether the caller runs inside a streamed turn."""
+    return _sink.get() is not None
+
+@contextlib.contextmanager
+def event_sink(callback: Callable[[Dict[str, Any]], None]):
+    """Send the events emitted in this context to callback."""
+    token = _sink.set(callback)
+    try:
+        yield
+    finally:
+        _sink.reset(token)
+
+def format_sse(event: Dict[str, Any]) -> str:
+    """Encode an event as a server-sent event: its name and the whole event as JSON data."""
+    return f"event: {event['event']}\ndata: {json.dumps(event, default=str)}\n\n"
@@ -0,0 +1,317 @@
+"""
+Agent Jobs - Queue and worker pool for agent turns run in the background
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from firebase_admin import firestore
+from google.api_core.exceptions import Aborted
+from common.async_runtime import get_loop
+from common.clients import get_db_client
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# A turn sent in job mode is stored as an agentJobs/{jobId} document and answered at once with
+# the job ID; a worker pool claims queued jobs, runs them and writes the response back to the
+# document, where the client polls for it. Jobs are claimed highest priority first (the user's
+# subscription tier), oldest first within a priority. A claim is a transaction that moves the
+# job to 'running' with a lease; a job whose worker died is claimed again once the lease has
+# expired, unless it has used up its attempts. Failed runs are retried up to
+# AGENT_JOB_MAX_ATTEMPTS times, resuming from the turn's checkpoint. Job documents carry an expiresAt AGENT_JOB_TTL_SECONDS out, for a Firestore TTL
+# policy to remove them.
+AGENT_JOBS_COLLECTION = 'agentJobs'
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+# Jobs one instance runs at the same time
+AGENT_JOB_WORKER_CONCURRENCY = 4
+# Longer than any turn a worker may still be running when its function times out
+AGENT_JOB_LEASE_SECONDS = 600
+AGENT_JOB_MAX_ATTEMPTS = 3
+AGENT_JOB_TTL_SECONDS = 7 * 24 * 60 * 60
+# Subscription tiers above this share the top priority
+AGENT_JOB_MAX_PRIORITY = 3
+# Queued jobs read per claim; concurrent workers that lose a job to another try the next one
+AGENT_JOB_CLAIM_CANDIDATES = 10
+# AGENT_JOB_QUEUE=memory keeps jobs in this process (local runs and tests), see InProcessJobQueue
+AGENT_JOB_QUEUE_ENV = 'AGENT_JOB_QUEUE'
+
+def job_priority(tier: Any) -> int:
+    """Return the queue priority of a job sent by a user with this subscription tier."""
+    try:
+        return min(max(int(tier or 0), 0), AGENT_JOB_MAX_PRIORITY)
+    except (TypeError, ValueError):
+        return 0
+
+class FirestoreJobQueue:
+    """Agent job queue kept in the agentJobs collection, shared by all instances."""
+
+    runs_in_process = False
+
+    def __init__(self, db):
+        self.db = db
+        self.collection = db.collection(AGENT_JOBS_COLLECTION)
+
+    def enqueue(self, user_id: str, case_id: str, message: str, tier: Any = 0) -> str:
+        """Store a queued job and return its ID."""
+        job_ref = self.collection.document(str(uuid.uuid4()))
+        job_ref.set({
+            'userId': user_id,
+            'caseId': case_id,
+            'message': message,
+            'tier': tier,
+            'priority': job_priority(tier),
+            'status': JOB_QUEUED,
+            'attempts': 0,
+            'createdAt': firestore.SERVER_TIMESTAMP,
+            'expiresAt': datetime.now(timezone.utc) + timedelta(seconds=AGENT_JOB_TTL_SECONDS)
+        })
+        return job_ref.id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Return the job (with its 'id'), or None if there is no such job."""
+        snapshot = self.collection.document(job_id).get()
+        if not snapshot.exists:
+            return None
+        return dict(snapshot.to_dict(), id=job_id)
+
+    def claim(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        """Move the next job to 'running' for this worker and return it, or None if there is none."""
+        now = datetime.now(timezone.utc)
+        queued = (self.collection.where('status', '==', JOB_QUEUED)
+                  .order_by('priority', direction=firestore.Query.DESCENDING)
+                  .order_by('createdAt')
+                  .limit(AGENT_JOB_CLAIM_CANDIDATES))
+        abandoned = (self.collection.where('status', '==', JOB_RUNNING)
+                     .where('leaseExpiresAt', '<', now)
+                     .limit(AGENT_JOB_CLAIM_CANDIDATES))
+
+        @firestore.transactional
+        def take(transaction, job_ref):
+            job = job_ref.get(transaction=transaction).to_dict() or {}
+            lease_expires_at = job.get('leaseExpiresAt')
+            if job.get('status') != JOB_QUEUED and not (
+                    job.get('status') == JOB_RUNNING and lease_expires_at and lease_expires_at < now):
+                return None
+            if job.get('status') == JOB_RUNNING and job.get('attempts', 0) >= AGENT_JOB_MAX_ATTEMPTS:
+                # Every attempt outlived its lease; running it again would not end differently
+                transaction.update(job_ref, {
+                    'status': JOB_FAILED,
+                    'statusCode': 500,
+                    'error': job.get('error') or 'Agent turn did not finish before its lease expired',
+                    'finishedAt': firestore.SERVER_TIMESTAMP,
+                    'leaseExpiresAt': firestore.DELETE_FIELD
+                })
+                return None
+            update = {
+                'status': JOB_RUNNING,
+                'workerId': worker_id,
+                'attempts': job.get('attempts', 0) + 1,
+                'startedAt': firestore.SERVER_TIMESTAMP,
+                'leaseExpiresAt': now + timedelta(seconds=AGENT_JOB_LEASE_SECONDS)
+            }
+            transaction.update(job_ref, update)
+            return dict(job, **update, id=job_ref.id)
+
+        for query in (queued, abandoned):
+            for candidate in query.stream():
+                try:
+                    job = take(self.db.transaction(), candidate.reference)
+                except ValueError as e:
+                    # Other workers kept taking this job; try the next one
+                    if isinstance(e.__cause__, Aborted):
+                        continue
+                    raise
+                if job is not None:
+                    return job
+        return None
+
+    def complete(self, job_id: str, response: Dict[str, Any], status_code: int) -> None:
+        """Store the response of a finished turn; a 4xx response (e.g. access revoked) fails the job."""
+        self.collection.document(job_id).update({
+            'status': JOB_SUCCEEDED if status_code < 400 else JOB_FAILED,
+            'statusCode': status_code,
+            'result': response,
+            'finishedAt': firestore.SERVER_TIMESTAMP,
+            'leaseExpiresAt': firestore.DELETE_FIELD
+        })
+
+    def fail(self, job_id: str, error: str, retry: bool) -> None:
+        """Record a failed run: the job goes back to the queue in its old place, or fails for good."""
+        update = {'error': error, 'leaseExpiresAt': firestore.DELETE_FIELD}
+        if retry:
+            update['status'] = JOB_QUEUED
+        else:
+            update.update({'status': JOB_FAILED, 'statusCode': 500, 'finishedAt': firestore.SERVER_TIMESTAMP})
+        self.collection.document(job_id).update(update)
+
+class InProcessJobQueue:
+    """
+    Stand-in for FirestoreJobQueue that keeps jobs in this process, for local runs and tests.
+
+    Same interface and ordering, without leases: the jobs go away with the process.
+    """
+
+    runs_in_process = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._heap = []
+        self._sequence = itertools.count()
+
+    def enqueue(self, user_id: str, case_id: str, message: str, tier: Any = 0) -> str:
+        job_id = str(uuid.uuid4())
+        job = {
+            'id': job_id,
+            'userId': user_id,
+            'caseId': case_id,
+            'message': message,
+            'tier': tier,
+            'priority': job_priority(tier),
+            'status': JOB_QUEUED,
+            'attempts': 0,
+            'createdAt': datetime.now(timezone.utc),
+            'sequence': next(self._sequence)
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+            heapq.heappush(self._heap, (-job['priority'], job['sequence'], job_id))
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def claim(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            while self._heap:
+                _, _, job_id = heapq.heappop(self._heap)
+                job = self._jobs[job_id]
+                if job['status'] != JOB_QUEUED:
+                    continue
+                job.update(status=JOB_RUNNING, workerId=worker_id, attempts=job['attempts'] + 1,
+                           startedAt=datetime.now(timezone.utc))
+                return dict(job)
+        return None
+
+    def complete(self, job_id: str, response: Dict[str, Any], status_code: int) -> None:
+        with self._lock:
+            self._jobs[job_id].update(status=JOB_SUCCEEDED if status_code < 400 else JOB_FAILED,
+                                      statusCode=status_code, result=response,
+                                      finishedAt=datetime.now(timezone.utc))
+
+    def fail(self, job_id: str, error: str, retry: bool) -> None:
+        with self._lock:
+            job = self._jobs[job_id]
+            job['error'] = error
+            if retry:
+                job['status'] = JOB_QUEUED
+                heapq.heappush(self._heap, (-job['priority'], job['sequence'], job_id))
+            else:
+                job.update(status=JOB_FAILED, statusCode=500, finishedAt=datetime.now(timezone.utc))
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+def get_job_queue():
+    """Return the process-wide job queue: Firestore, or in-process when AGENT_JOB_QUEUE=memory."""
+    global _job_queue
+    if _job_queue is None:
+        with _job_queue_lock:
+            if _job_queue is None:
+                if os.environ.get(AGENT_JOB_QUEUE_ENV, 'firestore').lower() == 'memory':
+                    _job_queue = InProcessJobQueue()
+                else:
+                    _job_queue = FirestoreJobQueue(get_db_client())
+    return _job_queue
+
+class AgentJobWorkerPool:
+    """
+    Runs queued jobs on the instance's event loop, at most `concurrency` at a time.
+
+    run_job(job) runs one turn and returns (response, status_code). A 5xx status, a response
+    with status 'error' (a node failed; its checkpoint lets the next attempt resume) or an
+    exception counts as a failed attempt and is retried; any other response is stored.
+    """
+
+    def __init__(self, queue, run_job: Callable[[Dict[str, Any]], Awaitable[Tuple[Dict[str, Any], int]]],
+                 concurrency: int = AGENT_JOB_WORKER_CONCURRENCY):
+        self.queue = queue
+        self.run_job = run_job
+        self.concurrency = concurrency
+        self.worker_id = f"{os.environ.get('K_REVISION', 'local')}-{uuid.uuid4().hex[:8]}"
+        # Both are only touched on the event loop
+        self._workers = set()
+        self._rescan = False
+
+    async def run(self, budget_seconds: Optional[float] = None) -> int:
+        """Run jobs until the queue is empty, or no new job is started after budget_seconds.
+
+        Returns the number of jobs run. Jobs already running always finish. Workers already
+        running on this instance count against its concurrency.
+        """
+        deadline = time.monotonic() + budget_seconds if budget_seconds is not None else None
+        workers = [self._spawn(deadline) for _ in range(self.concurrency - len(self._workers))]
+        return sum(await asyncio.gather(*workers))
+
+    def start(self) -> None:
+        """Have this instance pick up newly queued jobs in the background (in-process queue)."""
+        asyncio.run_coroutine_threadsafe(self._start(), get_loop())
+
+    async def _start(self) -> None:
+        if len(self._workers) >= self.concurrency:
+            # Every worker is busy; make sure one looks at the queue again before stopping
+            self._rescan = True
+            return
+        self._spawn(None)
+
+    def _spawn(self, deadline: Optional[float]) -> asyncio.Task:
+        worker = asyncio.create_task(self._work(deadline))
+        self._workers.add(worker)
+        worker.add_done_callback(self._workers.discard)
+        return worker
+
+    async def _work(self, deadline: Optional[float]) -> int:
+        processed = 0
+        while deadline is None or time.monotonic() < deadline:
+            job = await asyncio.to_thread(self.queue.claim, self.worker_id)
+            if job is None:
+                if self._rescan:
+                    self._rescan = False
+                    continue
+                break
+            await self._process(job)
+            processed += 1
+        return processed
+
+    async def _process(self, job: Dict[str, Any]) -> None:
+        logger.info(f"Running agent job {job['id']} (priority {job['priority']}, attempt {job['attempts']})")
+        try:
+            response, status_code = await self.run_job(job)
+            error = response.get('message') or response.get('error') or 'Agent turn failed'
+            if status_code < 400 and response.get('status') == 'error':
+                status_code = 500
+        except Exception as e:
+            logger.error(f"Agent job {job['id']} failed: {e}")
+            response, status_code, error = None, 500, str(e)
+        try:
+            if status_code < 500:
+                await asyncio.to_thread(self.queue.complete, job['id'], response, status_code)
+            else:
+                await asyncio.to_thread(self.queue.fail, job['id'], error,
+                                        job['attempts'] < AGENT_JOB_MAX_ATTEMPTS)
+        except Exception as e:
+            # The lease runs out and another worker runs the job again
+            logger.error(f"Could not record the outcome of agent job {job['id']}: {e}")
@@ -14,8 +14,11 @@ from agent_tools import (
     verify_payment,
     search_legal_database,
     get_relevant_legislation,
+    reserve_quota_usage,
+    release_quota_usage,
     update_quota_usage
 )
+from quota import QuotaExceeded
 
 from gemini_util import create_gemini_model, analyze_gemini_response, build_gemini_contents
 from gemini_direct import gemini_generate_rest
@@ -26,6 +29,19 @@ from agent_config import load_system_prompt, get_system_prompt
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+async def _release_quota_reservation(state: AgentState) -> None:
+    """
+    Give back the run's quota reservation when the run stops (or starts over) without committing it.
+    """
+    if state.quota_reservation is None:
+        return
+    try:
+        await release_quota_usage(state.quota_reservation)
+    except Exception as e:
+        # The reservation still runs out after its TTL
+        logger.warning(f"Failed to release quota reservation {state.quota_reservation.get('id')}: {str(e)}")
+    state.quota_reservation = None
+
 # Node Functions
 async def determine_tier_node(state: AgentState):
     """
@@ -40,7 +56,14 @@ async def determine_tier_node(state: AgentState):
         state.completed_nodes.append("determine_tier")
         logger.info(f"Determined tier: {state.tier}")
         # Decide next node based on quota
-        if quota_result.get('available_requests', 0) > 0 and not quota_result.get('requires_payment', False):
+        has_quota = quota_result.get('available_requests', 0) > 0 and not quota_result.get('requires_payment', False)
+        if has_quota and state.quota_reservation is None:
+            # Hold a unit of quota for this run so concurrent runs cannot overspend it
+            try:
+                state.quota_reservation = await reserve_quota_usage(state.user_id, state.organization_id)
+            except QuotaExceeded:
+                has_quota = False
+        if has_quota:
             state.quota_status = {"has_quota": True, "remaining_credits": quota_result.get('available_requests', 0)}
             return "verify_payment", state
         else:
@@ -49,6 +72,7 @@ async def determine_tier_node(state: AgentState):
             return "end", state
     except Exception as e:
         logger.error(f"Error in determine_tier_node: {str(e)}")
+        await _release_quota_reservation(state)
         state.has_error = True
         state.error_message = f"Failed to check quota: {str(e)}"
         return "end", state
@@ -62,6 +86,7 @@ async def verify_payment_node(state: AgentState) -> AgentState:
         payment_status = await verify_payment(state.case_id)
 
         if not payment_status.get('paid', False):
+            await _release_quota_reservation(state)
             state.response_data = {
                 'status': 'payment_required',
                 'message': 'Este necesară plata pentru a continua.',
@@ -73,6 +98,7 @@ async def verify_payment_node(state: AgentState) -> AgentState:
 
     except Exception as e:
         logger.error(f"Error in verify_payment_node: {str(e)}")
+        await _release_quota_reservation(state)
         state.has_error = True
         state.error_message = f"Failed to verify payment: {str(e)}"
         return state
@@ -262,13 +288,15 @@ async def final_review_node(state: AgentState) -> AgentState:
         # Update state
         state.final_review_results = review_result
         
-        # Update quota usage for the completed workflow
-        await update_quota_usage(state.user_id)
+        # Update quota usage for the completed workflow, committing the run's reservation
+        await update_quota_usage(state.user_id, state.organization_id, reservation=state.quota_reservation)
+        state.quota_reservation = None
 
         return state
 
     except Exception as e:
         logger.error(f"Error in final_review_node: {str(e)}")
+        await _release_quota_reservation(state)
         state.has_error = True
         state.error_message = f"Failed to perform final review: {str(e)}"
         return state
@@ -284,11 +312,14 @@ async def error_node(state: AgentState):
         state.retry_count[state.current_node] += 1
         logger.error(f"Error in {state.current_node}: {state.error_message}")
         logger.info(f"Retry count for {state.current_node}: {state.retry_count[state.current_node]}")
+        # The retry starts over at determine_tier, which reserves quota again
+        await _release_quota_reservation(state)
         state.has_error = False
         state.error_message = ""
         return state.current_node, state
     except Exception as e:
         logger.error(f"Error in error_node: {str(e)}")
+        await _release_quota_reservation(state)
         state.error_message = f"Failed to process error node: {str(e)}"
         return "end", state
 
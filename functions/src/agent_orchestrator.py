@@ -3,21 +3,32 @@ Agent Orchestrator - Defines the agent's workflow graph and state management
 """
 from typing import Dict, Any, Optional, List
 from dataclasses import dataclass, asdict, field
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
 import logging
 import asyncio
+import threading
+import zlib
+from types import MappingProxyType
+from firebase_admin import firestore
 from agent_tools import (
     find_legislation,
     find_case_law,
     get_party_id_by_name,
     generate_draft_pdf,
     check_quota,
+    reserve_quota_usage,
+    release_quota_usage,
+    update_quota_usage,
     get_case_details,
     update_case_details,
     create_support_ticket,
     consult_grok
 )
 
+import agent_events
+from quota import QuotaExceeded
 from template_validation import ValidationError
 from draft_templates import DraftTemplates
 from response_templates import format_response
@@ -35,6 +46,8 @@ class AgentState:
     user_id: str
     case_details: Dict[str, Any]
     user_info: Dict[str, Any]
+    # Organization of the case; its quota pays for the turn
+    organization_id: Optional[str] = None
 
     # Execution state
     current_node: str = "start"
@@ -44,6 +57,8 @@ class AgentState:
 
     # Node results
     quota_status: Dict[str, Any] = field(default_factory=dict)
+    # Unit of quota held by this turn; committed when it completes, released on any other exit
+    quota_reservation: Optional[Dict[str, Any]] = None
     input_analysis: Dict[str, Any] = field(default_factory=dict)
     research_results: Dict[str, Any] = field(default_factory=dict)
     ai_guidance: Dict[str, Any] = field(default_factory=dict)
@@ -99,29 +114,125 @@ class AgentState:
         })
         self.retry_count[node] = self.retry_count.get(node, 0) + 1
 
+# Checkpoints. execute() saves the state after every node to
+# cases/{caseId}/agentCheckpoints/{checkpointId}, as zlib-compressed JSON of AgentState.to_dict().
+# A retried turn (same user, case and message) loads it and resumes after the last completed
+# node, reusing the earlier node outputs. The checkpoint is deleted when the turn finishes
+# or is given up; abandoned ones are ignored after AGENT_CHECKPOINT_TTL_SECONDS (and can be
+# removed by a Firestore TTL policy on expiresAt).
+AGENT_CHECKPOINTS_SUBCOLLECTION = 'agentCheckpoints'
+AGENT_CHECKPOINT_TTL_SECONDS = 24 * 60 * 60
+# Bumped when AgentState changes incompatibly; checkpoints of another version are ignored
+AGENT_CHECKPOINT_VERSION = 1
+# Stay clear of Firestore's 1 MiB document limit
+AGENT_CHECKPOINT_MAX_BYTES = 900 * 1024
+
+def agent_checkpoint_ref(db, case_id: str, user_id: str, message: str):
+    """Return the checkpoint document for one agent turn: a user's message on a case."""
+    checkpoint_id = hashlib.sha256(f"{user_id}\0{message}".encode('utf-8')).hexdigest()[:32]
+    return (db.collection('cases').document(case_id)
+            .collection(AGENT_CHECKPOINTS_SUBCOLLECTION).document(checkpoint_id))
+
+def save_checkpoint(checkpoint_ref, state: AgentState) -> bool:
+    """Write the compressed state to its checkpoint. Returns False if it was too large."""
+    payload = zlib.compress(
+        json.dumps(state.to_dict(), separators=(',', ':'), default=str).encode('utf-8'), 6
+    )
+    if len(payload) > AGENT_CHECKPOINT_MAX_BYTES:
+        logger.warning(f"Agent checkpoint {checkpoint_ref.id} is {len(payload)} bytes; not saved")
+        return False
+    checkpoint_ref.set({
+        'version': AGENT_CHECKPOINT_VERSION,
+        'userId': state.user_id,
+        'node': state.current_node,
+        'completedNodes': list(state.completed_nodes),
+        'state': payload,
+        'updatedAt': firestore.SERVER_TIMESTAMP,
+        'expiresAt': datetime.now(timezone.utc) + timedelta(seconds=AGENT_CHECKPOINT_TTL_SECONDS)
+    })
+    return True
+
+def load_checkpoint(checkpoint_ref) -> Optional[AgentState]:
+    """Restore the state saved at a checkpoint, or None if there is no usable one."""
+    snapshot = checkpoint_ref.get()
+    if not snapshot.exists:
+        return None
+    data = snapshot.to_dict()
+    expires_at = data.get('expiresAt')
+    if data.get('version') != AGENT_CHECKPOINT_VERSION or (expires_at and expires_at < datetime.now(timezone.utc)):
+        return None
+    try:
+        return AgentState.from_dict(json.loads(zlib.decompress(data['state']).decode('utf-8')))
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable agent checkpoint {checkpoint_ref.id}: {e}")
+        return None
+
+def clear_checkpoint(checkpoint_ref) -> None:
+    """Delete a checkpoint once its turn is over."""
+    checkpoint_ref.delete()
+
+# The workflow graph structure: node -> next nodes
+WORKFLOW_GRAPH = MappingProxyType({
+    'start': ('check_quota',),
+    'check_quota': ('analyze_input',),
+    'analyze_input': ('research',),
+    'research': ('guidance',),
+    'guidance': ('generate_response',),
+    'generate_response': ('end',)
+})
+
 class AgentGraph:
-    """Defines and executes the agent's workflow graph."""
+    """Defines and executes the agent's workflow graph.
+
+    A graph holds only configuration; everything about a run lives in the AgentState passed
+    to execute(). One instance (get_agent_graph()) is shared by all requests.
+    """
 
     def __init__(self):
         self.draft_generator = DraftTemplates()
         self.max_retries = 3
+        self.graph = WORKFLOW_GRAPH
 
-        # Define the workflow graph structure
-        self.graph = {
-            'start': ['check_quota'],
-            'check_quota': ['analyze_input'],
-            'analyze_input': ['research'],
-            'research': ['guidance'],
-            'guidance': ['generate_response'],
-            'generate_response': ['end']
-        }
+    def _resume_node(self, state: AgentState) -> str:
+        """The node to run next: the one after state.current_node if that has completed."""
+        current = state.current_node
+        if current == 'start' or current in state.completed_nodes:
+            return self.graph[current][0]
+        return current
 
-    async def execute(self, state: AgentState) -> Dict[str, Any]:
-        """Execute the workflow graph from current state."""
+    async def _checkpoint(self, checkpoint_ref, state: AgentState) -> None:
+        """Save the state; a failed write only costs the ability to resume."""
         try:
-            current = state.current_node
+            await asyncio.to_thread(save_checkpoint, checkpoint_ref, state)
+        except Exception as e:
+            logger.warning(f"Failed to checkpoint agent state for case {state.case_id}: {e}")
+
+    async def _clear_checkpoint(self, checkpoint_ref) -> None:
+        try:
+            await asyncio.to_thread(clear_checkpoint, checkpoint_ref)
+        except Exception as e:
+            logger.warning(f"Failed to delete agent checkpoint {checkpoint_ref.id}: {e}")
+
+    async def execute(self, state: AgentState, checkpoint_ref=None) -> Dict[str, Any]:
+        """Execute the workflow graph from current state.
+
+        Nodes already in state.completed_nodes are not run again. With checkpoint_ref, the
+        state is saved there after every node (and after a failure), so a retried turn can
+        be resumed with load_checkpoint(); the checkpoint is deleted when the turn ends.
+        The check_quota node reserves a unit of quota, committed when the turn completes and
+        released when it fails; a resumed turn reserves again.
+        """
+        current = state.current_node
+        try:
+            current = self._resume_node(state)
+            if state.completed_nodes:
+                agent_events.emit('resume', completed_nodes=list(state.completed_nodes))
+            if state.quota_reservation is None and 'check_quota' in state.completed_nodes:
+                # The failed attempt gave its reservation back; hold quota again before resuming
+                await self._reserve_quota(state)
             while current != 'end':
                 logger.info(f"Executing node: {current}")
+                agent_events.emit('node_start', node=current)
 
                 # Execute current node
                 if current == 'check_quota':
@@ -139,21 +250,41 @@ class AgentGraph:
 
                 # Update state with results
                 state.update_node(current, result)
+                agent_events.emit('node_end', node=current, status=result.get('status'))
+                if checkpoint_ref is not None:
+                    await self._checkpoint(checkpoint_ref, state)
 
                 # Move to next node
                 current = self.graph[current][0]
 
-            return self._prepare_final_response(state)
+            await self._commit_quota(state)
+            final_response = self._prepare_final_response(state)
+            if checkpoint_ref is not None:
+                await self._clear_checkpoint(checkpoint_ref)
+            return final_response
+
+        except asyncio.CancelledError:
+            # The turn timed out or its client went away; the checkpoint allows a retry
+            await self._release_quota(state)
+            raise
 
         except Exception as e:
             logger.error(f"Error in node {current}: {str(e)}")
             state.add_error(current, e)
+            agent_events.emit('node_error', node=current, error=str(e))
+            await self._release_quota(state)
 
             # Check retry count
             if state.retry_count.get(current, 0) >= self.max_retries:
+                if checkpoint_ref is not None:
+                    await self._clear_checkpoint(checkpoint_ref)
                 await self._create_support_ticket(state)
                 raise RuntimeError(f"Max retries exceeded for node {current}")
 
+            # Keep the error and retry count, so retries of this turn count towards max_retries
+            if checkpoint_ref is not None:
+                await self._checkpoint(checkpoint_ref, state)
+
             # Return error response
             return {
                 'status': 'error',
@@ -165,7 +296,7 @@ class AgentGraph:
         """Check user quota and payment status."""
         try:
             # Get user quota information
-            quota_info = await self._get_user_quota(state.user_id)
+            quota_info = await self._get_user_quota(state.user_id, state.organization_id)
 
             # Check if user has available quota
             if quota_info['available_requests'] <= 0:
@@ -177,6 +308,10 @@ class AgentGraph:
                 if not payment_status['paid']:
                     raise ValueError("Payment required")
 
+            # Hold a unit of quota for this turn so concurrent turns cannot overspend it
+            if state.quota_reservation is None:
+                await self._reserve_quota(state)
+
             return {
                 'status': 'success',
                 'quota': quota_info,
@@ -435,10 +570,32 @@ class AgentGraph:
 
     # External service integration methods
 
-    async def _get_user_quota(self, user_id: str) -> Dict[str, Any]:
-        """Get user quota information."""
-        # TODO: Implement quota checking logic
-        return {'available_requests': 10}
+    async def _get_user_quota(self, user_id: str, organization_id: Optional[str] = None) -> Dict[str, Any]:
+        """Get user quota information, including the organization's quota for its cases."""
+        return await check_quota(user_id, organization_id)
+
+    async def _reserve_quota(self, state: AgentState) -> None:
+        """Reserve one unit of quota for this turn, from the case's organization if it has one."""
+        try:
+            state.quota_reservation = await reserve_quota_usage(state.user_id, state.organization_id)
+        except QuotaExceeded:
+            raise ValueError("Insufficient quota")
+
+    async def _commit_quota(self, state: AgentState) -> None:
+        """Turn the reservation of a completed turn into usage."""
+        if state.quota_reservation is not None:
+            await update_quota_usage(state.user_id, state.organization_id, reservation=state.quota_reservation)
+            state.quota_reservation = None
+
+    async def _release_quota(self, state: AgentState) -> None:
+        """Give back the reservation of a turn that failed; a failed release only waits out its TTL."""
+        if state.quota_reservation is None:
+            return
+        try:
+            await release_quota_usage(state.quota_reservation)
+        except Exception as e:
+            logger.warning(f"Failed to release quota reservation {state.quota_reservation.get('id')}: {e}")
+        state.quota_reservation = None
 
     async def _verify_payment(self, case_id: str) -> Dict[str, Any]:
         """Verify payment status."""
@@ -474,4 +631,18 @@ def create_agent_graph() -> AgentGraph:
     """
     Create and return a new instance of the agent graph.
     """
-    return AgentGraph()
\ No newline at end of file
+    return AgentGraph()
+
+_agent_graph = None
+_agent_graph_lock = threading.Lock()
+
+def get_agent_graph() -> AgentGraph:
+    """
+    Return the process-wide agent graph, creating it on first use.
+    """
+    global _agent_graph
+    if _agent_graph is None:
+        with _agent_graph_lock:
+            if _agent_graph is None:
+                _agent_graph = AgentGraph()
+    return _agent_graph
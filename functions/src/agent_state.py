@@ -41,4 +41,6 @@ class AgentState(BaseModel):
     last_updated: str = Field(default_factory=lambda: datetime.now().isoformat())
     
     # Quota status
-    quota_status: Dict[str, Any] = Field(default_factory=dict) 
\ No newline at end of file
+    quota_status: Dict[str, Any] = Field(default_factory=dict)
+    # Quota reserved for this run; committed by final_review_node, released on every other exit
+    quota_reservation: Optional[Dict[str, Any]] = None 
\ No newline at end of file
@@ -5,6 +5,7 @@ from typing import Dict, Any, List, Optional
 from datetime import datetime, timedelta
 import logging
 import aiohttp
+import asyncio
 import json
 import markdown2
 # Pure Python PDF libraries without system dependencies
@@ -21,6 +22,17 @@ import os
 from exa_py import Exa
 from langchain.tools import tool
 from common.clients import get_secret, get_db_client
+from common.async_runtime import on_shutdown
+from quota import (
+    SUBJECT_USERS,
+    SUBJECT_ORGANIZATIONS,
+    QuotaExceeded,
+    get_quota_summaries,
+    reserve_quota,
+    commit_quota,
+    release_quota,
+    record_quota_usage
+)
 from firebase_admin import firestore
 
 # Configure logging
@@ -155,37 +167,43 @@ async def check_quota(
 ) -> Dict[str, Any]:
     """
     Check user's quota and payment status.
+    The user and organization are read together (one get_all for the documents, one for their
+    quota ledger shards) on a worker thread, and served from the per-instance quota snapshot
+    cache when warm. Units reserved by runs still in progress are not available.
     """
     try:
-        # Get user document
-        user_ref = get_db().collection('users').document(user_id)
-        user_doc = user_ref.get()
+        db = get_db()
+        user_ref = db.collection('users').document(user_id)
+        subjects = [(SUBJECT_USERS, user_ref)]
+        org_ref = None
+        if organization_id:
+            org_ref = db.collection('organizations').document(organization_id)
+            subjects.append((SUBJECT_ORGANIZATIONS, org_ref))
 
-        if not user_doc.exists:
-            raise QuotaError(f"User {user_id} not found")
+        # Firestore reads block; keep them off the event loop
+        summaries = await asyncio.to_thread(get_quota_summaries, db, subjects)
 
-        user_data = user_doc.to_dict()
+        user_quota = summaries[user_ref.path]
+        if user_quota is None:
+            raise QuotaError(f"User {user_id} not found")
 
         # Get quota limits based on subscription
-        subscription = user_data.get('subscription', {})
-        quota_limit = subscription.get('quota_limit', 0)
-        quota_used = subscription.get('quota_used', 0)
+        subscription = user_quota['data'].get('subscription', {})
+        quota_limit = user_quota['limit']
+        quota_used = user_quota['used']
+        quota_reserved = user_quota['reserved']
 
         # Check organization quota if applicable
-        if organization_id:
-            org_ref = get_db().collection('organizations').document(organization_id)
-            org_doc = org_ref.get()
-            if org_doc.exists:
-                org_data = org_doc.to_dict()
-                org_quota_limit = org_data.get('quota_limit', 0)
-                org_quota_used = org_data.get('quota_used', 0)
-
-                # Use the higher quota limit
-                quota_limit = max(quota_limit, org_quota_limit)
-                quota_used = min(quota_used, org_quota_used)
+        org_quota = summaries[org_ref.path] if org_ref else None
+        if org_quota:
+            # Use the higher quota limit
+            quota_limit = max(quota_limit, org_quota['limit'])
+            quota_used = min(quota_used, org_quota['used'])
+            # Runs on behalf of an organization reserve its quota
+            quota_reserved = org_quota['reserved']
 
         # Calculate remaining quota
-        remaining_quota = quota_limit - quota_used
+        remaining_quota = quota_limit - quota_used - quota_reserved
         requires_payment = case_tier > subscription.get('tier', 0)
 
         return {
@@ -194,7 +212,8 @@ async def check_quota(
             'requires_payment': requires_payment,
             'subscription_tier': subscription.get('tier', 0),
             'quota_limit': quota_limit,
-            'quota_used': quota_used
+            'quota_used': quota_used,
+            'quota_reserved': quota_reserved
         }
 
     except Exception as e:
@@ -586,6 +605,25 @@ async def create_support_ticket(
             'error': str(e)
         }
 
+# ChatXAI clients are kept for the life of the instance (one per API key) so their HTTP
+# connection pool is reused across agent turns on the shared event loop.
+_grok_llms = {}
+
+def _get_grok_llm(api_key: str) -> ChatXAI:
+    llm = _grok_llms.get(api_key)
+    if llm is None:
+        # Instantiate the ChatXAI client, passing the API key explicitly.
+        llm = _grok_llms[api_key] = ChatXAI(model="grok-1", api_key=api_key)
+    return llm
+
+@on_shutdown
+async def _close_grok_llms():
+    for llm in _grok_llms.values():
+        async_client = getattr(llm, 'root_async_client', None)
+        if async_client is not None:
+            await async_client.close()
+    _grok_llms.clear()
+
 async def consult_grok(case_id: str, context: dict, specific_question: str) -> dict:
     """
     Consults the Grok model via the official LangChain XAI integration.
@@ -606,8 +644,7 @@ async def consult_grok(case_id: str, context: dict, specific_question: str) -> d
             logger.error("GROK_API_KEY environment variable not set.")
             raise ValueError("GROK_API_KEY is not configured.")
 
-        # Instantiate the ChatXAI client, passing the API key explicitly.
-        llm = ChatXAI(model="grok-1", api_key=api_key)
+        llm = _get_grok_llm(api_key)
 
         # Format the prompt using the provided context and question
         prompt_content = f"""
@@ -728,26 +765,63 @@ async def get_relevant_legislation(domain: str) -> List[Dict[str, Any]]:
         logger.error(f"Error getting legislation: {str(e)}")
         raise DatabaseError(f"Failed to get legislation: {str(e)}")
 
-async def update_quota_usage(
+async def reserve_quota_usage(
     user_id: str,
     organization_id: Optional[str] = None
 ) -> Dict[str, Any]:
     """
-    Update quota usage for user and organization.
+    Reserve one unit of quota for an agent run, from the organization when the run is on its
+    behalf and from the user otherwise. Pass the reservation to update_quota_usage when the
+    run completes, or to release_quota_usage if it fails.
+    Raises QuotaExceeded if no quota is left.
     """
     try:
-        # Update user quota
-        user_ref = get_db().collection('users').document(user_id)
-        user_ref.update({
-            'subscription.quota_used': firestore.Increment(1)
-        })
+        if organization_id:
+            subject_type, subject_id = SUBJECT_ORGANIZATIONS, organization_id
+        else:
+            subject_type, subject_id = SUBJECT_USERS, user_id
+        # Firestore transactions block; keep them off the event loop
+        return await asyncio.to_thread(reserve_quota, get_db(), subject_type, subject_id)
+    except QuotaExceeded:
+        raise
+    except Exception as e:
+        logger.error(f"Error reserving quota: {str(e)}")
+        raise QuotaError(f"Failed to reserve quota: {str(e)}")
 
-        # Update organization quota if applicable
+async def release_quota_usage(reservation: Dict[str, Any]) -> None:
+    """
+    Give back a reservation of a run that did not complete.
+    """
+    try:
+        await asyncio.to_thread(release_quota, get_db(), reservation)
+    except Exception as e:
+        logger.error(f"Error releasing quota reservation: {str(e)}")
+        raise QuotaError(f"Failed to release quota reservation: {str(e)}")
+
+async def update_quota_usage(
+    user_id: str,
+    organization_id: Optional[str] = None,
+    reservation: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    Update quota usage for user and organization.
+    A reservation from reserve_quota_usage is committed; usage is recorded directly on the
+    subjects it does not cover.
+    """
+    try:
+        db = get_db()
+        subjects = [(SUBJECT_USERS, user_id)]
         if organization_id:
-            org_ref = get_db().collection('organizations').document(organization_id)
-            org_ref.update({
-                'quota_used': firestore.Increment(1)
-            })
+            subjects.append((SUBJECT_ORGANIZATIONS, organization_id))
+
+        def settle():
+            for subject_type, subject_id in subjects:
+                if reservation and (reservation['subjectType'], reservation['subjectId']) == (subject_type, subject_id):
+                    commit_quota(db, reservation)
+                else:
+                    record_quota_usage(db, subject_type, subject_id)
+
+        await asyncio.to_thread(settle)
 
         return {
             'status': 'success',
@@ -72,6 +72,7 @@ PERMISSIONS: Dict[str, Dict[str, Set[str]]] = {
             "create_case",
             "list_cases",
             "assign_case",
+            "view_stats",
         },
         ROLE_STAFF: {
             "read",
@@ -513,6 +514,7 @@ def _check_organization_permissions(db, user_id: str, req: PermissionCheckReques
          "create_case": ["create_case"],
          "list_cases": ["list_cases", "read"], # Staff can list cases if they can read org details
          "assign_case": ["assign_case"],
+         "view_stats": ["view_stats"],
          "read": ["read"],
          "update": ["update"],
          "delete": ["delete"],
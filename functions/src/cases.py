@@ -1,4 +1,5 @@
 import logging
+import os
 import uuid
 from datetime import datetime, timezone, timedelta
 import flask
@@ -6,6 +7,7 @@ from flask import Request
 from common.clients import get_db_client, get_storage_client
 from auth import check_permission, PermissionCheckRequest, TYPE_CASE, TYPE_ORGANIZATION
 from party import get_party
+from organization import add_organization_stats_write, case_stats_deltas
 from firebase_admin import firestore
 from google.cloud import firestore
 from google.cloud.firestore_v1 import SERVER_TIMESTAMP
@@ -23,6 +25,19 @@ def _sanitize_firestore_dict(data):
         return None
     return data
 
+def _update_case_with_stats(db, case_ref, update_data):
+    """Applies update_data to a case and the matching organization stats deltas in one transaction."""
+    transaction = db.transaction()
+
+    @firestore.transactional
+    def update_in_transaction(transaction):
+        before = case_ref.get(transaction=transaction).to_dict() or {}
+        transaction.update(case_ref, update_data)
+        if before.get("organizationId"):
+            add_organization_stats_write(transaction, before["organizationId"], **case_stats_deltas(before, {**before, **update_data}))
+
+    update_in_transaction(transaction)
+
 def create_case(request: Request):
     db = get_db_client()
     logging.info("Logic function create_case called")
@@ -59,8 +74,12 @@ def create_case(request: Request):
 
         # Remove None values
         case_data = {k: v for k, v in case_data.items() if v is not None}
-        # Save to Firestore
-        db.collection("cases").document(case_data["caseId"]).set(case_data)
+        # Save to Firestore, counting organization cases in the same batch
+        batch = db.batch()
+        batch.set(db.collection("cases").document(case_data["caseId"]), case_data)
+        if org_id:
+            add_organization_stats_write(batch, org_id, **case_stats_deltas({}, case_data))
+        batch.commit()
         response_data = _sanitize_firestore_dict(case_data)
         # Always include organizationId in the response for org cases
         if "organizationId" not in response_data:
@@ -258,7 +277,7 @@ def archive_case(request: Request):
         has_permission, error_message = check_permission(user_id, permission_request)
         if not has_permission:
             return flask.jsonify({"error": "Forbidden", "message": error_message}), 403
-        case_ref.update({
+        _update_case_with_stats(db, case_ref, {
             "status": "archived",
             "archiveDate": firestore.SERVER_TIMESTAMP,
             "updatedAt": firestore.SERVER_TIMESTAMP
@@ -295,7 +314,7 @@ def delete_case(request: Request):
         has_permission, error_message = check_permission(user_id, permission_request)
         if not has_permission:
             return flask.jsonify({"error": "Forbidden", "message": error_message}), 403
-        case_ref.update({
+        _update_case_with_stats(db, case_ref, {
             "status": "deleted",
             "deletionDate": firestore.SERVER_TIMESTAMP,
             "updatedAt": firestore.SERVER_TIMESTAMP
@@ -387,7 +406,11 @@ def upload_file(request: Request):
         if description:
             document_data["description"] = description
 
-        document_ref.set(document_data)
+        batch = db.batch()
+        batch.set(document_ref, document_data)
+        if case_data.get("organizationId"):
+            add_organization_stats_write(batch, case_data["organizationId"], storage_bytes=file_size, document_count=1)
+        batch.commit()
         document_id = document_ref.id
 
         # Optionally update the case's updatedAt timestamp
@@ -715,7 +738,7 @@ def logic_assign_case(request: Request):
             'updatedAt': firestore.SERVER_TIMESTAMP
         }
 
-        case_ref.update(update_data)
+        _update_case_with_stats(db, case_ref, update_data)
 
         # Prepare success response
         action_type = 'unassigned' if assigned_user_id is None else 'assigned'
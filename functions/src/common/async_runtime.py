@@ -0,0 +1,182 @@
+# FILE: functions/src/common/async_runtime.py
+import asyncio
+import atexit
+import contextlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+
+# This module runs one long-lived asyncio event loop per instance on a background thread.
+# Synchronous handlers submit coroutines to it with run_coroutine() instead of calling
+# asyncio.run() per request, and async servers await them with run_coroutine_async(), so async
+# HTTP sessions, SDK clients and executor threads created on the loop survive between requests. Everything is torn down once, by shutdown(), which
+# runs at interpreter exit.
+
+# Threads for blocking calls made from coroutines (run_in_executor / asyncio.to_thread)
+EXECUTOR_MAX_WORKERS = 32
+HTTP_POOL_SIZE = 100
+# Nearly all traffic goes to one host (the Gemini API), so it may use the whole pool
+HTTP_POOL_SIZE_PER_HOST = HTTP_POOL_SIZE
+# Idle keep-alive connections are closed after this long
+HTTP_KEEPALIVE_SECONDS = 30
+
+_lock = threading.Lock()
+_loop = None
+_thread = None
+_executor = None
+_http_session = None
+_shutdown_callbacks = []
+
+def get_loop():
+    """Returns the instance's background event loop, starting it on first use."""
+    global _loop, _thread, _executor, _http_session
+    with _lock:
+        if _loop is not None and _loop.is_running():
+            return _loop
+        started = threading.Event()
+        # A session belongs to the loop it was created on
+        _http_session = None
+        _loop = asyncio.new_event_loop()
+        _executor = ThreadPoolExecutor(max_workers=EXECUTOR_MAX_WORKERS, thread_name_prefix='async-runtime')
+        _loop.set_default_executor(_executor)
+
+        def run(loop):
+            asyncio.set_event_loop(loop)
+            loop.call_soon(started.set)
+            loop.run_forever()
+
+        _thread = threading.Thread(target=run, args=(_loop,), name='async-runtime-loop', daemon=True)
+        _thread.start()
+        started.wait()
+        return _loop
+
+def run_coroutine(coro, timeout=None):
+    """Runs coro on the background loop and blocks the calling thread until it finishes.
+
+    Exceptions raised by the coroutine propagate to the caller. If timeout (seconds) expires
+    first, the coroutine is cancelled and TimeoutError is raised.
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, get_loop())
+    try:
+        return future.result(timeout)
+    except TimeoutError:
+        future.cancel()
+        raise
+
+async def run_coroutine_async(coro):
+    """Awaits coro on the background loop from a coroutine running on another loop.
+
+    For async servers (agent_asgi.py), whose requests run on the server's own loop: the
+    turn still uses the instance's shared clients, and the server loop stays free while
+    it waits. Cancelling the caller cancels coro.
+    """
+    if on_runtime_loop():
+        return await coro
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, get_loop()))
+
+def iterate_on_loop(agen):
+    """Iterates an async generator on the background loop from a synchronous caller.
+
+    For streamed responses from synchronous handlers. Closing the returned generator early
+    (e.g. when the client disconnects) closes agen on the loop.
+    """
+    try:
+        while True:
+            try:
+                yield run_coroutine(agen.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        run_coroutine(agen.aclose())
+
+async def aiterate_on_loop(agen):
+    """Iterates an async generator on the background loop from a coroutine on another loop."""
+    try:
+        while True:
+            try:
+                yield await run_coroutine_async(agen.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        await run_coroutine_async(agen.aclose())
+
+def on_runtime_loop():
+    """Tells whether the calling coroutine runs on the background loop."""
+    try:
+        return asyncio.get_running_loop() is _loop
+    except RuntimeError:
+        return False
+
+async def get_http_session():
+    """Returns the instance's shared aiohttp session. Must be called on the background loop.
+
+    The session keeps a pool of keep-alive connections, so repeated calls to the same API
+    skip the TCP and TLS handshakes. Do not close it; shutdown() does.
+    """
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            limit_per_host=HTTP_POOL_SIZE_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_SECONDS
+        )
+        _http_session = aiohttp.ClientSession(connector=connector)
+    return _http_session
+
+@contextlib.asynccontextmanager
+async def http_session():
+    """Yields the shared aiohttp session on the background loop, or a one-off session elsewhere.
+
+    For code that may also run under a loop of its own (e.g. asyncio.run in a script or test),
+    where the shared session cannot be used.
+    """
+    if on_runtime_loop():
+        yield await get_http_session()
+        return
+    async with aiohttp.ClientSession() as session:
+        yield session
+
+def on_shutdown(callback):
+    """Registers a callback (a plain function or a coroutine function) to run at shutdown.
+
+    Use it to close clients that are kept for the life of the instance. Callbacks run on the
+    background loop, newest first.
+    """
+    with _lock:
+        _shutdown_callbacks.append(callback)
+    return callback
+
+async def _close_resources():
+    global _http_session
+    for callback in reversed(_shutdown_callbacks):
+        try:
+            result = callback()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            logging.warning(f"Async runtime shutdown callback failed: {e}")
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+def shutdown(timeout=10):
+    """Closes the shared clients and stops the background loop. Safe to call more than once."""
+    global _loop, _thread, _executor
+    with _lock:
+        loop, thread, executor = _loop, _thread, _executor
+        _loop = _thread = _executor = None
+    if loop is None:
+        return
+    if loop.is_running():
+        try:
+            asyncio.run_coroutine_threadsafe(_close_resources(), loop).result(timeout)
+        except Exception as e:
+            logging.warning(f"Async runtime did not close cleanly: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout)
+    loop.close()
+    executor.shutdown(wait=False)
+    logging.info("Async runtime stopped")
+
+atexit.register(shutdown)
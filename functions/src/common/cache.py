@@ -0,0 +1,55 @@
+# FILE: functions/src/common/cache.py
+import threading
+import time
+
+# This module provides a small thread-safe, in-process TTL cache.
+# Entries live only as long as the function instance, so every cache built on
+# it must tolerate being cold, and writers invalidate only their own instance;
+# the TTL bounds how stale other instances can get.
+
+class TTLCache:
+    """A thread-safe dictionary whose entries expire after a fixed TTL."""
+
+    def __init__(self, ttl_seconds: float, max_entries: int = 1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the cached value for key, or default if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            return value
+
+    def set(self, key, value, ttl_seconds: float = None):
+        """Stores value under key for ttl_seconds (defaults to the cache TTL)."""
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.max_entries:
+                self._evict()
+            self._entries[key] = (value, time.monotonic() + ttl)
+
+    def invalidate(self, key):
+        """Drops key from the cache if present."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Drops every entry."""
+        with self._lock:
+            self._entries.clear()
+
+    def _evict(self):
+        # Called with the lock held: drop expired entries, then the oldest insert.
+        now = time.monotonic()
+        for key in [k for k, (_, expires_at) in self._entries.items() if expires_at <= now]:
+            del self._entries[key]
+        if len(self._entries) >= self.max_entries:
+            del self._entries[next(iter(self._entries))]
@@ -1,6 +1,13 @@
 # FILE: functions/src/common/clients.py
+import logging
 import os
+import random
+import threading
+import time
+import uuid
 import firebase_admin
+import requests
+from requests.adapters import HTTPAdapter
 from google.cloud import firestore, storage
 import stripe
 
@@ -12,6 +19,21 @@ _db_client = None
 _storage_client = None
 _stripe_initialized = False
 
+# Stripe HTTP settings. Every Stripe call in the process goes through one pooled session,
+# so warm instances reuse keep-alive connections instead of paying a TLS handshake per call.
+STRIPE_POOL_SIZE = 16
+# Per-operation timeouts in seconds; each covers one HTTP attempt, not the whole call.
+STRIPE_TIMEOUTS = {
+    'read': 5,
+    'write': 15,
+}
+# Budget for a Stripe call including retries, so a user-facing request cannot hang on Stripe.
+STRIPE_DEADLINE_SECONDS = 20
+STRIPE_MAX_RETRIES = 3
+STRIPE_RETRY_BASE_DELAY_SECONDS = 0.25
+
+_stripe_call_state = threading.local()
+
 def _initialize_firebase():
     """Initializes the Firebase app if it hasn't been already."""
     global _firebase_app_initialized
@@ -30,6 +52,19 @@ def get_db_client():
         _db_client = firestore.Client()
     return _db_client
 
+# Firestore rejects batched reads above a few hundred references, so get_all
+# calls are split into chunks of this size.
+GET_ALL_CHUNK_SIZE = 100
+
+# Firestore 'in' filters accept at most this many values.
+FIRESTORE_IN_FILTER_LIMIT = 30
+
+def get_all_in_chunks(db, refs):
+    """Reads the referenced documents with one get_all call per GET_ALL_CHUNK_SIZE references."""
+    refs = list(refs)
+    for start in range(0, len(refs), GET_ALL_CHUNK_SIZE):
+        yield from db.get_all(refs[start:start + GET_ALL_CHUNK_SIZE])
+
 def get_storage_client():
     """Returns a singleton Cloud Storage client, initializing it on first use."""
     global _storage_client
@@ -37,16 +72,81 @@ def get_storage_client():
         _storage_client = storage.Client()
     return _storage_client
 
+class _StripeSession(requests.Session):
+    """Pooled session that applies the timeout of the Stripe call running on this thread.
+
+    The Stripe SDK passes one fixed timeout to every request; overriding it here is what
+    lets reads and writes use different timeouts over the same connection pool.
+    """
+
+    def request(self, method, url, **kwargs):
+        timeout = getattr(_stripe_call_state, 'timeout', None)
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        return super().request(method, url, **kwargs)
+
+def _create_stripe_http_client():
+    session = _StripeSession()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=STRIPE_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return stripe.http_client.RequestsClient(timeout=STRIPE_TIMEOUTS['write'], session=session)
+
 def initialize_stripe():
-    """Initializes the Stripe API key if it hasn't been already."""
+    """Initializes the Stripe API key and shared HTTP client if it hasn't been already."""
     global _stripe_initialized
     if not _stripe_initialized:
         stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
         if not stripe.api_key:
             # This will be logged by the payments module if the key is missing
             pass
+        # STRIPE_API_BASE points the SDK at a local stand-in server for offline benchmarks
+        if os.environ.get('STRIPE_API_BASE'):
+            stripe.api_base = os.environ['STRIPE_API_BASE']
+        stripe.default_http_client = _create_stripe_http_client()
+        # Retries are done by call_stripe, within the caller's deadline
+        stripe.max_network_retries = 0
         _stripe_initialized = True
 
+def new_idempotency_key(prefix):
+    """Returns a fresh idempotency key for one logical Stripe create."""
+    return f"{prefix}-{uuid.uuid4()}"
+
+def _is_retryable_stripe_error(error):
+    if isinstance(error, (stripe.error.APIConnectionError, stripe.error.RateLimitError)):
+        return True
+    if isinstance(error, stripe.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return False
+
+def call_stripe(func, *args, operation='read', deadline_seconds=STRIPE_DEADLINE_SECONDS, idempotency_key=None, **kwargs):
+    """Calls a Stripe SDK function with an operation timeout and retries inside a deadline.
+
+    Connection errors, rate limiting and 5xx responses are retried with full-jitter
+    exponential backoff while the deadline allows. Creates should pass an idempotency_key,
+    which is reused on every attempt so a retried create cannot duplicate the object.
+    """
+    if idempotency_key:
+        kwargs['idempotency_key'] = idempotency_key
+    deadline = time.monotonic() + deadline_seconds
+    attempt = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        _stripe_call_state.timeout = max(min(STRIPE_TIMEOUTS[operation], remaining), 0.1)
+        try:
+            return func(*args, **kwargs)
+        except stripe.error.StripeError as e:
+            if not _is_retryable_stripe_error(e) or attempt >= STRIPE_MAX_RETRIES:
+                raise
+            delay = random.uniform(0, STRIPE_RETRY_BASE_DELAY_SECONDS * (2 ** attempt))
+            if time.monotonic() + delay >= deadline:
+                raise
+            attempt += 1
+            logging.warning(f"Retrying Stripe call (attempt {attempt + 1}) after {type(e).__name__}: {e}")
+            time.sleep(delay)
+        finally:
+            _stripe_call_state.timeout = None
+
 def get_secret(secret_name: str) -> str:
     """
     Retrieves a secret value from environment variables.
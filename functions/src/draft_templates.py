@@ -3,6 +3,7 @@ Draft Templates - Specialized templates for generating legal documents
 """
 from typing import Dict, Any, Optional, List
 from datetime import datetime
+from types import MappingProxyType
 from template_validation import TemplateValidator, ValidationError
 
 # Common sections that can be reused across different templates
@@ -29,27 +30,31 @@ Data: {date}
 """
 
 class DraftTemplates:
-    """Collection of legal document templates with context-based filling"""
-    
-    def __init__(self):
-        """Initialize the template collection"""
-        self.templates = {
-            "power_of_attorney": self._power_of_attorney_template,
-            "complaint": self._complaint_template,
-            "contract_termination": self._contract_termination_template,
-            "gdpr_notice": self._gdpr_notice_template,
-            "employment_contract": self._employment_contract_template,
-            "rental_agreement": self._rental_agreement_template,
-            "privacy_policy": self._privacy_policy_template,
-            "terms_of_service": self._terms_of_service_template,
-            "court_appeal": self._court_appeal_template,
-            "cease_and_desist": self._cease_and_desist_template,
-            "settlement_agreement": self._settlement_agreement_template
-        }
-        
+    """Collection of legal document templates with context-based filling
+
+    The registry maps template names to method names. It is defined once with the class
+    and is read-only, and instances hold no other state, so one instance can be shared by
+    concurrent requests.
+    """
+
+    TEMPLATES = MappingProxyType({
+        "power_of_attorney": "_power_of_attorney_template",
+        "complaint": "_complaint_template",
+        "contract_termination": "_contract_termination_template",
+        "gdpr_notice": "_gdpr_notice_template",
+        "employment_contract": "_employment_contract_template",
+        "rental_agreement": "_rental_agreement_template",
+        "privacy_policy": "_privacy_policy_template",
+        "terms_of_service": "_terms_of_service_template",
+        "court_appeal": "_court_appeal_template",
+        "cease_and_desist": "_cease_and_desist_template",
+        "settlement_agreement": "_settlement_agreement_template"
+    })
+
     def get_template(self, template_name: str) -> Optional[callable]:
         """Get a template function by name"""
-        return self.templates.get(template_name)
+        method_name = self.TEMPLATES.get(template_name)
+        return getattr(self, method_name) if method_name else None
     
     def generate_draft(
         self, 
@@ -69,7 +74,7 @@ class DraftTemplates:
     
     def list_available_templates(self) -> List[str]:
         """Return a list of available template names"""
-        return list(self.templates.keys())
+        return list(self.TEMPLATES.keys())
     
     def _power_of_attorney_template(
         self,
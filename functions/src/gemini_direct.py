@@ -2,10 +2,13 @@
 Direct Gemini API Utilities - Use google.generativeai directly (bypassing LangChain)
 """
 import os
+import json
 import logging
-from typing import Optional, Dict, Any, List
-import requests
+from typing import Optional, Dict, Any, List, AsyncIterator
+import aiohttp
 import asyncio
+import agent_events
+from common.async_runtime import http_session
 
 try:
     import google.generativeai as genai
@@ -20,6 +23,9 @@ logger = logging.getLogger(__name__)
 _gemini_client = None
 
 GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
+GEMINI_STREAM_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/{model}:streamGenerateContent"
+# A stream is abandoned if no chunk arrives for this long
+GEMINI_STREAM_READ_TIMEOUT_SECONDS = 30
 
 def get_gemini_client(api_key: Optional[str] = None):
     global _gemini_client
@@ -109,14 +115,91 @@ async def gemini_generate_rest(
         kwargs: Additional generationConfig parameters.
     Returns:
         The generated text (str).
+
+    Inside a streamed agent turn (agent_events.streaming()), the text is requested with
+    streamGenerateContent and every chunk is also emitted as a 'token' event as it arrives.
     """
-    if api_key is None:
-        api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        raise RuntimeError("GEMINI_API_KEY is not set in environment or passed explicitly.")
+    if candidate_count == 1 and agent_events.streaming():
+        chunks = []
+        async for text in gemini_stream_rest(
+            prompt=prompt, model_name=model_name, temperature=temperature, top_p=top_p,
+            max_tokens=max_tokens, api_key=api_key, contents=contents,
+            system_prompt=system_prompt, user_prompt=user_prompt, **kwargs
+        ):
+            chunks.append(text)
+            agent_events.emit('token', text=text)
+        return "".join(chunks)
 
+    api_key = _api_key(api_key)
     url = GEMINI_API_URL.format(model=model_name)
     headers = {"Content-Type": "application/json"}
+    payload = _request_payload(prompt, temperature, top_p, candidate_count, max_tokens,
+                               contents, system_prompt, user_prompt, **kwargs)
+    # Posted on the instance's shared session, so warm requests reuse keep-alive connections
+    async with http_session() as session:
+        async with session.post(url, params={"key": api_key}, headers=headers, json=payload,
+                                timeout=aiohttp.ClientTimeout(total=30)) as response:
+            response.raise_for_status()
+            data = await response.json()
+    print("Gemini API raw response:", data)
+    try:
+        return data["candidates"][0]["content"]["parts"][0]["text"]
+    except KeyError:
+        print("Candidate content:", data["candidates"][0]["content"])
+        return str(data["candidates"][0]["content"])
+    except Exception as e:
+        logger.error(f"Malformed Gemini API response: {data}")
+        raise RuntimeError(f"Malformed Gemini API response: {e}")
+
+async def gemini_stream_rest(
+    prompt: Optional[str] = None,
+    model_name: str = "gemini-2.5-flash",
+    temperature: float = 1.0,
+    top_p: float = 0.95,
+    max_tokens: int = 256,
+    api_key: Optional[str] = None,
+    contents: Optional[List[Dict[str, Any]]] = None,
+    system_prompt: Optional[str] = None,
+    user_prompt: Optional[str] = None,
+    **kwargs
+) -> AsyncIterator[str]:
+    """
+    Stream generated text from the Gemini REST API (streamGenerateContent with alt=sse).
+    Takes the same arguments as gemini_generate_rest (with a single candidate) and yields
+    the text of each chunk as the model produces it.
+    """
+    api_key = _api_key(api_key)
+    url = GEMINI_STREAM_API_URL.format(model=model_name)
+    headers = {"Content-Type": "application/json"}
+    payload = _request_payload(prompt, temperature, top_p, 1, max_tokens,
+                               contents, system_prompt, user_prompt, **kwargs)
+    async with http_session() as session:
+        # No overall limit for a long answer, but give up if the stream stalls
+        async with session.post(url, params={"key": api_key, "alt": "sse"}, headers=headers, json=payload,
+                                timeout=aiohttp.ClientTimeout(total=None, sock_read=GEMINI_STREAM_READ_TIMEOUT_SECONDS)) as response:
+            response.raise_for_status()
+            async for line in response.content:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                try:
+                    chunk = json.loads(line[len(b"data:"):])
+                    parts = chunk["candidates"][0]["content"]["parts"] if chunk.get("candidates") else []
+                except (ValueError, KeyError, IndexError) as e:
+                    logger.error(f"Malformed Gemini stream chunk: {line[:200]}")
+                    raise RuntimeError(f"Malformed Gemini stream chunk: {e}")
+                for part in parts:
+                    if part.get("text"):
+                        yield part["text"]
+
+def _api_key(api_key: Optional[str]) -> str:
+    api_key = api_key or os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        raise RuntimeError("GEMINI_API_KEY is not set in environment or passed explicitly.")
+    return api_key
+
+def _request_payload(prompt, temperature, top_p, candidate_count, max_tokens,
+                     contents, system_prompt, user_prompt, **kwargs) -> Dict[str, Any]:
     # Build generationConfig with sensible defaults, allow override via kwargs
     generation_config = {
         "temperature": temperature,
@@ -140,22 +223,7 @@ async def gemini_generate_rest(
     else:
         raise ValueError("You must provide either contents, or system_prompt/user_prompt, or prompt.")
 
-    payload = {
+    return {
         "contents": payload_contents,
         "generationConfig": generation_config
     }
-    def _post():
-        response = requests.post(f"{url}?key={api_key}", headers=headers, json=payload, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-        print("Gemini API raw response:", data)
-        try:
-            return data["candidates"][0]["content"]["parts"][0]["text"]
-        except KeyError:
-            print("Candidate content:", data["candidates"][0]["content"])
-            return str(data["candidates"][0]["content"])
-        except Exception as e:
-            logger.error(f"Malformed Gemini API response: {data}")
-            raise RuntimeError(f"Malformed Gemini API response: {e}")
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, _post) 
\ No newline at end of file
@@ -24,16 +24,21 @@ from payments import (
     create_payment_intent as logic_create_payment_intent,
     create_checkout_session as logic_create_checkout_session,
     handle_stripe_webhook as logic_handle_stripe_webhook,
+    process_stripe_events as logic_process_stripe_events,
     cancel_subscription as logic_cancel_subscription,
     logic_redeem_voucher,
     logic_get_products
 )
+from vouchers import logic_create_vouchers_bulk
 # --- Additional logic imports (organization, party, membership, auth, user) ---
 from organization import (
     create_organization as logic_create_organization,
     get_organization as logic_get_organization,
     update_organization as logic_update_organization,
-    delete_organization as logic_delete_organization
+    delete_organization as logic_delete_organization,
+    get_organization_deletion_status as logic_get_organization_deletion_status,
+    run_organization_deletion_jobs as logic_run_organization_deletion_jobs,
+    get_organization_stats as logic_get_organization_stats
 )
 
 from party import (
@@ -65,7 +70,11 @@ from user import (
     update_user_profile
 )
 
-from agent import handle_agent_request as logic_handle_agent_request
+from agent import (
+    handle_agent_request as logic_handle_agent_request,
+    handle_get_agent_job as logic_get_agent_job,
+    handle_run_agent_jobs as logic_run_agent_jobs
+)
 
 # Initialize logging once.
 logging.basicConfig(level=logging.INFO)
@@ -158,6 +167,11 @@ def relex_backend_create_checkout_session(request: Request):
 def relex_backend_handle_stripe_webhook(request: Request):
     return logic_handle_stripe_webhook(request)
 
+@functions_framework.http
+def relex_backend_process_stripe_events(request: Request):
+    """Stripe event drain. Invoked on a schedule by Cloud Scheduler, not through the API Gateway."""
+    return logic_process_stripe_events(request)
+
 @functions_framework.http
 @inject_user_context
 def relex_backend_cancel_subscription(request: Request):
@@ -168,6 +182,11 @@ def relex_backend_cancel_subscription(request: Request):
 def relex_backend_redeem_voucher(request: Request):
     return logic_redeem_voucher(request)
 
+@functions_framework.http
+@inject_user_context
+def relex_backend_create_vouchers_bulk(request: Request):
+    return logic_create_vouchers_bulk(request)
+
 @functions_framework.http
 @inject_user_context
 def relex_backend_get_products(request: Request):
@@ -200,6 +219,21 @@ def relex_backend_update_organization(request: Request):
 def relex_backend_delete_organization(request: Request):
     return logic_delete_organization(request)
 
+@functions_framework.http
+@inject_user_context
+def relex_backend_get_organization_deletion_status(request: Request):
+    return logic_get_organization_deletion_status(request)
+
+@functions_framework.http
+def relex_backend_run_organization_deletion_jobs(request: Request):
+    """Organization deletion worker. Invoked on a schedule by Cloud Scheduler, not through the API Gateway."""
+    return logic_run_organization_deletion_jobs(request)
+
+@functions_framework.http
+@inject_user_context
+def relex_backend_get_organization_stats(request: Request):
+    return logic_get_organization_stats(request)
+
 # --- Party management ---
 @functions_framework.http
 @inject_user_context
@@ -306,4 +340,14 @@ def relex_backend_smoke_test(request):
 @functions_framework.http
 @inject_user_context
 def relex_backend_agent_handler(request: Request):
-    return logic_handle_agent_request(request)
\ No newline at end of file
+    return logic_handle_agent_request(request)
+
+@functions_framework.http
+@inject_user_context
+def relex_backend_get_agent_job(request: Request):
+    return logic_get_agent_job(request)
+
+@functions_framework.http
+def relex_backend_run_agent_jobs(request: Request):
+    """Agent job worker. Invoked on a schedule by Cloud Scheduler, not through the API Gateway."""
+    return logic_run_agent_jobs(request)
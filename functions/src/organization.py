@@ -6,11 +6,13 @@ from firebase_admin import auth as firebase_auth # Renamed import
 import json
 import flask
 import uuid
+import time
 # import google.cloud.firestore # Removed this line
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from auth import check_permission, PermissionCheckRequest, TYPE_ORGANIZATION as RESOURCE_TYPE_ORGANIZATION # Corrected import
 from flask import Request
-from common.clients import get_db_client
+from common.clients import FIRESTORE_IN_FILTER_LIMIT, get_all_in_chunks, get_db_client
+from common.cache import TTLCache
 
 logging.basicConfig(level=logging.INFO)
 
@@ -19,6 +21,49 @@ try:
 except ValueError:
     firebase_admin.initialize_app()
 
+# Per-instance cache of organization summaries (name, description) used by listing endpoints.
+# update_organization and delete_organization invalidate it; the TTL bounds staleness on other instances.
+ORG_SUMMARY_CACHE_TTL_SECONDS = 300
+_org_summary_cache = TTLCache(ORG_SUMMARY_CACHE_TTL_SECONDS)
+
+def get_organization_summaries(organization_ids):
+    """Returns a dict of organization ID -> {'name', 'description'} for live organizations.
+
+    Organizations that no longer exist or are being deleted are left out.
+
+    Cached summaries are served from memory; the rest are fetched with chunked get_all calls.
+    """
+    summaries = {}
+    missing_ids = []
+    for org_id in dict.fromkeys(organization_ids):
+        if not org_id:
+            continue
+        cached = _org_summary_cache.get(org_id)
+        if cached is not None:
+            summaries[org_id] = cached
+        else:
+            missing_ids.append(org_id)
+
+    db = get_db_client()
+    refs = [db.collection('organizations').document(org_id) for org_id in missing_ids]
+    for org_doc in get_all_in_chunks(db, refs):
+        if not org_doc.exists:
+            continue
+        org_data = org_doc.to_dict() or {}
+        if org_data.get('status') == 'deleting':
+            continue
+        summary = {
+            'name': org_data.get('name', ''),
+            'description': org_data.get('description', ''),
+        }
+        _org_summary_cache.set(org_doc.id, summary)
+        summaries[org_doc.id] = summary
+    return summaries
+
+def invalidate_organization_summary(organization_id):
+    """Drops the cached summary for an organization after it changes."""
+    _org_summary_cache.invalidate(organization_id)
+
 def create_organization(request: Request):
     logging.info("Logic function create_organization called")
     try:
@@ -57,6 +102,7 @@ def create_organization(request: Request):
                 'subscriptionPlanId': None,
                 'caseQuotaTotal': 0,
                 'caseQuotaUsed': 0,
+                'adminCount': 1, # The creator; kept in step with administrator memberships
                 'billingCycleStart': None,
                 'billingCycleEnd': None
             }
@@ -110,7 +156,7 @@ def get_organization(request: Request):
 
         org_ref = get_db_client().collection('organizations').document(organization_id)
         org_doc = org_ref.get()
-        if not org_doc.exists:
+        if not org_doc.exists or org_doc.to_dict().get('status') == 'deleting':
             return flask.jsonify({"error": "Not Found", "message": f"Organization {organization_id} not found"}), 404
 
         # Use the centralized permission check function
@@ -187,6 +233,7 @@ def update_organization(request: Request):
 
         try:
             org_ref.update(update_data)
+            invalidate_organization_summary(organization_id)
             updated_org_doc = org_ref.get()
             updated_org_data = updated_org_doc.to_dict()
 
@@ -212,6 +259,423 @@ def update_organization(request: Request):
         logging.error(f"Error updating organization: {str(e)}", exc_info=True)
         return flask.jsonify({"error": "Internal Server Error", "message": str(e)}), 500
 
+# --- Organization dashboard statistics ---
+# organization_stats/{organizationId} holds counters that case and file operations keep current with
+# atomic increments written in the same batch or transaction as the change itself, so dashboards
+# read one document instead of scanning the organization's cases.
+#   casesByStatus:   {status: number of cases}
+#   memberWorkloads: {userId: number of open cases assigned to the member}
+#   storageBytes / documentCount: totals over uploaded case files
+
+ORG_STATS_COLLECTION = 'organization_stats'
+
+def case_stats_deltas(before, after):
+    """Returns the stats deltas for a case moving from `before` to `after` (either may be empty).
+
+    The result is passed as keyword arguments to add_organization_stats_write.
+    """
+    status_deltas = {}
+    workload_deltas = {}
+
+    before_status, after_status = before.get('status'), after.get('status')
+    if before_status != after_status:
+        if before_status:
+            status_deltas[before_status] = -1
+        if after_status:
+            status_deltas[after_status] = 1
+
+    # Only open cases count towards a member's workload
+    before_assignee = before.get('assignedUserId') if before_status == 'open' else None
+    after_assignee = after.get('assignedUserId') if after_status == 'open' else None
+    if before_assignee != after_assignee:
+        if before_assignee:
+            workload_deltas[before_assignee] = -1
+        if after_assignee:
+            workload_deltas[after_assignee] = 1
+
+    return {'case_status_deltas': status_deltas, 'workload_deltas': workload_deltas}
+
+def add_organization_stats_write(writer, organization_id, case_status_deltas=None, workload_deltas=None,
+                                 storage_bytes=0, document_count=0):
+    """Adds an atomic increment of the organization's stats document to a WriteBatch or Transaction.
+
+    Returns False (and writes nothing) when there is nothing to change.
+    """
+    stats_data = {}
+    if case_status_deltas:
+        stats_data['casesByStatus'] = {status: firestore.Increment(delta) for status, delta in case_status_deltas.items()}
+    if workload_deltas:
+        stats_data['memberWorkloads'] = {user_id: firestore.Increment(delta) for user_id, delta in workload_deltas.items()}
+    if storage_bytes:
+        stats_data['storageBytes'] = firestore.Increment(storage_bytes)
+    if document_count:
+        stats_data['documentCount'] = firestore.Increment(document_count)
+    if not stats_data:
+        return False
+
+    stats_data['organizationId'] = organization_id
+    stats_data['updatedAt'] = firestore.SERVER_TIMESTAMP
+    stats_ref = get_db_client().collection(ORG_STATS_COLLECTION).document(organization_id)
+    writer.set(stats_ref, stats_data, merge=True)
+    return True
+
+def rebuild_organization_stats(organization_id):
+    """Recomputes an organization's stats document from its cases and documents.
+
+    Used once for organizations whose counters predate incremental maintenance; the rebuilt
+    document carries a rebuiltAt marker. The stats document is read first in the same
+    transaction as the cases and documents, so an increment committed alongside a new case is
+    either already counted or applied on top of the rebuilt totals, never lost or doubled.
+    """
+    db = get_db_client()
+    stats_ref = db.collection(ORG_STATS_COLLECTION).document(organization_id)
+
+    @firestore.transactional
+    def rebuild_in_transaction(transaction):
+        stats_doc = stats_ref.get(transaction=transaction)
+        if stats_doc.exists and (stats_doc.to_dict() or {}).get('rebuiltAt'):
+            # Another request rebuilt the stats first
+            return stats_doc.to_dict()
+
+        cases_by_status = {}
+        member_workloads = {}
+        case_ids = []
+        cases_query = db.collection('cases').where('organizationId', '==', organization_id)
+        for case_doc in cases_query.stream(transaction=transaction):
+            case_data = case_doc.to_dict() or {}
+            deltas = case_stats_deltas({}, case_data)
+            for status, delta in deltas['case_status_deltas'].items():
+                cases_by_status[status] = cases_by_status.get(status, 0) + delta
+            for user_id, delta in deltas['workload_deltas'].items():
+                member_workloads[user_id] = member_workloads.get(user_id, 0) + delta
+            case_ids.append(case_doc.id)
+
+        storage_bytes = 0
+        document_count = 0
+        for start in range(0, len(case_ids), FIRESTORE_IN_FILTER_LIMIT):
+            documents_query = db.collection('documents').where(
+                'caseId', 'in', case_ids[start:start + FIRESTORE_IN_FILTER_LIMIT])
+            for document in documents_query.stream(transaction=transaction):
+                document_data = document.to_dict() or {}
+                if document_data.get('status') == 'deleted':
+                    continue
+                storage_bytes += document_data.get('fileSize') or 0
+                document_count += 1
+
+        stats_data = {
+            'organizationId': organization_id,
+            'casesByStatus': cases_by_status,
+            'memberWorkloads': member_workloads,
+            'storageBytes': storage_bytes,
+            'documentCount': document_count,
+            'rebuiltAt': firestore.SERVER_TIMESTAMP,
+            'updatedAt': firestore.SERVER_TIMESTAMP,
+        }
+        transaction.set(stats_ref, stats_data)
+        return stats_data
+
+    return rebuild_in_transaction(db.transaction())
+
+def get_organization_stats(request: Request):
+    logging.info("Logic function get_organization_stats called")
+    try:
+        organization_id = request.args.get('organizationId')
+        if not organization_id:
+            return flask.jsonify({"error": "Bad Request", "message": "Organization ID query parameter is required"}), 400
+        if not hasattr(request, 'end_user_id') or not request.end_user_id:
+             return flask.jsonify({"error": "Unauthorized", "message": "Authenticated user ID not found on request (end_user_id missing)"}), 401
+        user_id = request.end_user_id
+
+        org_doc = get_db_client().collection('organizations').document(organization_id).get()
+        if not org_doc.exists or org_doc.to_dict().get('status') == 'deleting':
+            return flask.jsonify({"error": "Not Found", "message": f"Organization {organization_id} not found"}), 404
+
+        permission_request = PermissionCheckRequest(
+            resourceType=RESOURCE_TYPE_ORGANIZATION,
+            resourceId=organization_id,
+            action="view_stats",
+            organizationId=organization_id
+        )
+        has_permission, error_message = check_permission(user_id, permission_request)
+        if not has_permission:
+            return flask.jsonify({"error": "Forbidden", "message": error_message}), 403
+
+        stats_doc = get_db_client().collection(ORG_STATS_COLLECTION).document(organization_id).get()
+        stats_data = stats_doc.to_dict() if stats_doc.exists else None
+        # Increments written before the first rebuild only cover the cases created since
+        if not stats_data or not stats_data.get('rebuiltAt'):
+            stats_data = rebuild_organization_stats(organization_id)
+
+        cases_by_status = {status: count for status, count in (stats_data.get('casesByStatus') or {}).items() if count}
+        updated_at = stats_data.get('updatedAt')
+        return flask.jsonify({
+            'organizationId': organization_id,
+            'casesByStatus': cases_by_status,
+            'totalCases': sum(count for status, count in cases_by_status.items() if status != 'deleted'),
+            'memberWorkloads': {uid: count for uid, count in (stats_data.get('memberWorkloads') or {}).items() if count},
+            'storageBytes': stats_data.get('storageBytes', 0),
+            'documentCount': stats_data.get('documentCount', 0),
+            'updatedAt': updated_at.isoformat() if isinstance(updated_at, datetime) else None,
+        }), 200
+    except Exception as e:
+        logging.error(f"Error retrieving organization stats: {str(e)}", exc_info=True)
+        return flask.jsonify({"error": "Internal Server Error", "message": str(e)}), 500
+
+# --- Organization deletion cascade ---
+# Deleting an organization fans out to every case, document, party and membership it owns, which
+# does not fit in a single transaction (500 writes, request deadline). delete_organization marks the
+# organization as 'deleting', records a job in organization_deletion_jobs/{organizationId} and returns;
+# relex_backend_run_organization_deletion_jobs, called every minute by Cloud Scheduler, then works
+# through the phases in bounded WriteBatches (run_organization_deletion_job). Work is never left
+# running after a response, where Cloud Functions gives it no CPU. Each batch also writes the job
+# checkpoint, so a job interrupted by the time budget or a crash resumes from the last committed page.
+
+ORG_DELETION_JOBS_COLLECTION = 'organization_deletion_jobs'
+# Members are removed last so administrators keep access to the job status while it runs.
+ORG_DELETION_PHASES = ('cases', 'documents', 'parties', 'memberships')
+# Writes per batch, leaving headroom under Firestore's 500-write limit for the checkpoint update.
+ORG_DELETION_BATCH_SIZE = 400
+# Case IDs per documents query, one 'in' filter's worth.
+ORG_DELETION_CASE_PAGE_SIZE = FIRESTORE_IN_FILTER_LIMIT
+# A runner that stops renewing its lease for this long is presumed dead and the job may be resumed.
+ORG_DELETION_LEASE_SECONDS = 120
+# A scheduled run stops taking new pages after this long and leaves the rest to the next run,
+# well inside the worker function's timeout.
+ORG_DELETION_RUN_BUDGET_SECONDS = 240
+
+def _utcnow():
+    return datetime.now(timezone.utc)
+
+def _deletion_phase_query(db, phase, organization_id):
+    if phase == 'memberships':
+        return db.collection('organization_memberships').where('organizationId', '==', organization_id)
+    # The cases, documents and parties phases walk the organization's cases
+    return db.collection('cases').where('organizationId', '==', organization_id)
+
+def _soft_delete_case_documents(db, case_ids):
+    """Marks every document of the given cases as deleted, committing in bounded batches."""
+    count = 0
+    batch = db.batch()
+    pending = 0
+    for document in db.collection('documents').where('caseId', 'in', case_ids).stream():
+        batch.update(document.reference, {
+            'status': 'deleted',
+            'deletionDate': firestore.SERVER_TIMESTAMP,
+        })
+        pending += 1
+        count += 1
+        if pending >= ORG_DELETION_BATCH_SIZE:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    return count
+
+def _delete_orphaned_case_parties(db, case_docs):
+    """Deletes the parties attached to the given (deleted) cases that no live case still uses.
+
+    Parties belong to the user who created them and carry no organization ID, so the organization's
+    parties are found through its cases. A party still attached to a case outside the organization
+    is kept, the same rule delete_party applies.
+    """
+    party_ids = list(dict.fromkeys(
+        party_id for case_doc in case_docs for party_id in (case_doc.to_dict() or {}).get('attachedPartyIds') or []
+    ))
+    count = 0
+    batch = db.batch()
+    pending = 0
+    for party_id in party_ids:
+        live_cases = (db.collection('cases')
+                      .where('attachedPartyIds', 'array_contains', party_id)
+                      .where('status', '!=', 'deleted')
+                      .limit(1).stream())
+        if list(live_cases):
+            continue
+        batch.delete(db.collection('parties').document(party_id))
+        pending += 1
+        count += 1
+        if pending >= ORG_DELETION_BATCH_SIZE:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    return count
+
+def _claim_deletion_job(db, job_ref):
+    """Takes the job lease unless the job is finished or another runner holds a live lease."""
+    transaction = db.transaction()
+
+    @firestore.transactional
+    def claim_in_transaction(transaction):
+        job_doc = job_ref.get(transaction=transaction)
+        if not job_doc.exists:
+            return False
+        job = job_doc.to_dict()
+        if job.get('status') == 'completed':
+            return False
+        lease_expires_at = job.get('leaseExpiresAt')
+        if job.get('status') == 'running' and lease_expires_at and lease_expires_at > _utcnow():
+            return False
+        transaction.update(job_ref, {
+            'status': 'running',
+            'error': None,
+            'leaseExpiresAt': _utcnow() + timedelta(seconds=ORG_DELETION_LEASE_SECONDS),
+            'updatedAt': firestore.SERVER_TIMESTAMP,
+        })
+        return True
+
+    return claim_in_transaction(transaction)
+
+def run_organization_deletion_job(organization_id, deadline=None):
+    """Runs (or resumes) the deletion cascade for an organization from its last checkpoint.
+
+    Stops after the page in progress once time.monotonic() passes deadline, leaving the job
+    'pending' for the next run. Returns True if this call finished the job, False if it stopped
+    early, there was nothing to do or another runner holds the lease.
+    """
+    db = get_db_client()
+    job_ref = db.collection(ORG_DELETION_JOBS_COLLECTION).document(organization_id)
+    if not _claim_deletion_job(db, job_ref):
+        return False
+
+    try:
+        job = job_ref.get().to_dict()
+        start_index = ORG_DELETION_PHASES.index(job.get('phase') or ORG_DELETION_PHASES[0])
+        for phase in ORG_DELETION_PHASES[start_index:]:
+            # Hard-deleted memberships drop out of the query on their own; the case walks need a cursor
+            uses_cursor = phase != 'memberships'
+            cursor = job.get('cursor') if phase == job.get('phase') else None
+            page_size = ORG_DELETION_CASE_PAGE_SIZE if phase in ('documents', 'parties') else ORG_DELETION_BATCH_SIZE
+
+            while True:
+                if deadline is not None and time.monotonic() >= deadline:
+                    # The checkpoint of the last page is committed; hand the rest to the next run
+                    job_ref.update({
+                        'status': 'pending',
+                        'leaseExpiresAt': None,
+                        'updatedAt': firestore.SERVER_TIMESTAMP,
+                    })
+                    logging.info(f"Organization deletion job for {organization_id} paused in phase {phase}")
+                    return False
+                query = _deletion_phase_query(db, phase, organization_id).order_by('__name__')
+                if uses_cursor and cursor:
+                    cursor_doc = db.collection('cases').document(cursor).get()
+                    if cursor_doc.exists:
+                        query = query.start_after(cursor_doc)
+                docs = list(query.limit(page_size).stream())
+                if not docs:
+                    break
+
+                batch = db.batch()
+                if phase == 'documents':
+                    processed = _soft_delete_case_documents(db, [doc.id for doc in docs])
+                elif phase == 'parties':
+                    processed = _delete_orphaned_case_parties(db, docs)
+                else:
+                    for doc in docs:
+                        if phase == 'cases':
+                            batch.update(doc.reference, {
+                                'status': 'deleted',
+                                'deletionDate': firestore.SERVER_TIMESTAMP,
+                                'updatedAt': firestore.SERVER_TIMESTAMP,
+                            })
+                        else:
+                            batch.delete(doc.reference)
+                    processed = len(docs)
+
+                cursor = docs[-1].id if uses_cursor else None
+                # The checkpoint commits together with the page it describes
+                batch.update(job_ref, {
+                    'phase': phase,
+                    'cursor': cursor,
+                    f'processed.{phase}': firestore.Increment(processed),
+                    'leaseExpiresAt': _utcnow() + timedelta(seconds=ORG_DELETION_LEASE_SECONDS),
+                    'updatedAt': firestore.SERVER_TIMESTAMP,
+                })
+                batch.commit()
+
+                if len(docs) < page_size:
+                    break
+
+            # Move the checkpoint to the next phase so a resume does not rescan this one
+            next_index = ORG_DELETION_PHASES.index(phase) + 1
+            if next_index < len(ORG_DELETION_PHASES):
+                job_ref.update({'phase': ORG_DELETION_PHASES[next_index], 'cursor': None})
+            job['phase'] = None
+
+        batch = db.batch()
+        batch.delete(db.collection('organizations').document(organization_id))
+        batch.delete(db.collection(ORG_STATS_COLLECTION).document(organization_id))
+        batch.update(job_ref, {
+            'status': 'completed',
+            'phase': 'done',
+            'cursor': None,
+            'leaseExpiresAt': None,
+            'completedAt': firestore.SERVER_TIMESTAMP,
+            'updatedAt': firestore.SERVER_TIMESTAMP,
+        })
+        batch.commit()
+        invalidate_organization_summary(organization_id)
+        logging.info(f"Organization deletion job for {organization_id} completed")
+        return True
+    except Exception as e:
+        logging.error(f"Organization deletion job for {organization_id} failed: {str(e)}", exc_info=True)
+        job_ref.update({
+            'status': 'failed',
+            'error': str(e),
+            'leaseExpiresAt': None,
+            'updatedAt': firestore.SERVER_TIMESTAMP,
+        })
+        return False
+
+def _serialize_deletion_job(job_data):
+    response_data = {
+        'organizationId': job_data.get('organizationId'),
+        'status': job_data.get('status'),
+        'phase': job_data.get('phase'),
+        'processed': job_data.get('processed', {}),
+        'error': job_data.get('error'),
+    }
+    for field in ('createdAt', 'updatedAt', 'completedAt'):
+        value = job_data.get(field)
+        response_data[field] = value.isoformat() if isinstance(value, datetime) else None
+    return response_data
+
+def _deletion_job_is_stalled(job_data):
+    if job_data.get('status') in ('pending', 'failed'):
+        return True
+    lease_expires_at = job_data.get('leaseExpiresAt')
+    return job_data.get('status') == 'running' and (not lease_expires_at or lease_expires_at <= _utcnow())
+
+def run_pending_organization_deletion_jobs(budget_seconds=ORG_DELETION_RUN_BUDGET_SECONDS):
+    """Works through pending, failed and abandoned deletion jobs until budget_seconds have passed.
+
+    Returns (jobs completed, jobs left for a later run). A failed job is retried on every run.
+    """
+    deadline = time.monotonic() + budget_seconds
+    jobs = get_db_client().collection(ORG_DELETION_JOBS_COLLECTION).where('status', 'in', ['pending', 'running', 'failed']).stream()
+    completed = remaining = 0
+    for job_doc in jobs:
+        if not _deletion_job_is_stalled(job_doc.to_dict() or {}):
+            continue
+        if time.monotonic() < deadline and run_organization_deletion_job(job_doc.id, deadline=deadline):
+            completed += 1
+        else:
+            remaining += 1
+    return completed, remaining
+
+def run_organization_deletion_jobs(request: Request):
+    """Scheduled worker for organization deletion jobs (not exposed through the API Gateway)."""
+    logging.info("Logic function run_organization_deletion_jobs called")
+    try:
+        completed, remaining = run_pending_organization_deletion_jobs()
+        return flask.jsonify({"completed": completed, "remaining": remaining}), 200
+    except Exception as e:
+        logging.error(f"Error running organization deletion jobs: {str(e)}", exc_info=True)
+        return flask.jsonify({"error": "Internal Server Error", "message": str(e)}), 500
+
 def delete_organization(request: Request):
     logging.info("Logic function delete_organization called")
     try:
@@ -252,41 +716,86 @@ def delete_organization(request: Request):
                 "message": "Cannot delete organization with active subscription. Please cancel the subscription first."
             }), 400
 
-        # Start a transaction to delete the organization and all related data
-        transaction = get_db_client().transaction()
+        job_ref = get_db_client().collection(ORG_DELETION_JOBS_COLLECTION).document(organization_id)
 
-        @firestore.transactional
-        def delete_org_in_transaction(transaction, org_id):
-            # Delete all organization memberships
-            members_query = get_db_client().collection('organization_memberships').where('organizationId', '==', org_id)
-            members = list(members_query.stream())
-            for member in members:
-                transaction.delete(member.reference)
-
-            # Mark all organization cases as deleted
-            cases_query = get_db_client().collection('cases').where('organizationId', '==', org_id)
-            cases = list(cases_query.stream())
-            for case in cases:
-                transaction.update(case.reference, {
-                    'status': 'deleted',
-                    'deletionDate': firestore.SERVER_TIMESTAMP,
+        if org_data.get('status') != 'deleting':
+            # Mark the organization and record the job atomically; the cascade runs in the background
+            transaction = get_db_client().transaction()
+
+            @firestore.transactional
+            def mark_org_deleting_in_transaction(transaction, org_id):
+                transaction.update(org_ref, {
+                    'status': 'deleting',
+                    'deletionRequestedBy': user_id,
+                    'deletionRequestedAt': firestore.SERVER_TIMESTAMP,
+                    'updatedAt': firestore.SERVER_TIMESTAMP
+                })
+                transaction.set(job_ref, {
+                    'organizationId': org_id,
+                    'requestedBy': user_id,
+                    'status': 'pending',
+                    'phase': ORG_DELETION_PHASES[0],
+                    'cursor': None,
+                    'processed': {phase: 0 for phase in ORG_DELETION_PHASES},
+                    'error': None,
+                    'leaseExpiresAt': None,
+                    'createdAt': firestore.SERVER_TIMESTAMP,
                     'updatedAt': firestore.SERVER_TIMESTAMP
                 })
 
-            # Delete the organization document
-            transaction.delete(org_ref)
-
-        try:
-            delete_org_in_transaction(transaction, organization_id)
-            logging.info(f"Organization {organization_id} and related data deleted by user {user_id}")
-            return flask.jsonify({"message": "Organization deleted successfully"}), 200
-        except Exception as e:
-            logging.error(f"Transaction failed: {str(e)}", exc_info=True)
-            return flask.jsonify({
-                "error": "Database Error",
-                "message": f"Failed to delete organization: {str(e)}"
-            }), 500
+            try:
+                mark_org_deleting_in_transaction(transaction, organization_id)
+            except Exception as e:
+                logging.error(f"Transaction failed: {str(e)}", exc_info=True)
+                return flask.jsonify({
+                    "error": "Database Error",
+                    "message": f"Failed to delete organization: {str(e)}"
+                }), 500
+            invalidate_organization_summary(organization_id)
+            logging.info(f"Organization {organization_id} marked for deletion by user {user_id}")
+        else:
+            logging.info(f"Organization {organization_id} is already being deleted")
+
+        # The scheduled deletion worker picks the job up within a minute
+        return flask.jsonify({
+            "message": "Organization deletion started successfully",
+            "organizationId": organization_id,
+            "jobId": organization_id,
+            "status": "deleting"
+        }), 202
 
     except Exception as e:
         logging.error(f"Error deleting organization: {str(e)}", exc_info=True)
-        return flask.jsonify({"error": "Internal Server Error", "message": str(e)}), 500
\ No newline at end of file
+        return flask.jsonify({"error": "Internal Server Error", "message": str(e)}), 500
+
+def get_organization_deletion_status(request: Request):
+    logging.info("Logic function get_organization_deletion_status called")
+    try:
+        organization_id = request.args.get('organizationId')
+        if not organization_id:
+            return flask.jsonify({"error": "Bad Request", "message": "Organization ID query parameter is required"}), 400
+        if not hasattr(request, 'end_user_id') or not request.end_user_id:
+             return flask.jsonify({"error": "Unauthorized", "message": "Authenticated user ID not found on request (end_user_id missing)"}), 401
+        user_id = request.end_user_id
+
+        job_doc = get_db_client().collection(ORG_DELETION_JOBS_COLLECTION).document(organization_id).get()
+        if not job_doc.exists:
+            return flask.jsonify({"error": "Not Found", "message": f"No deletion job found for organization {organization_id}"}), 404
+        job_data = job_doc.to_dict()
+
+        # Memberships are removed during the cascade, so the requester is always allowed to follow it
+        if job_data.get('requestedBy') != user_id:
+            permission_request = PermissionCheckRequest(
+                resourceType=RESOURCE_TYPE_ORGANIZATION,
+                resourceId=organization_id,
+                action="delete",
+                organizationId=organization_id
+            )
+            has_permission, error_message = check_permission(user_id, permission_request)
+            if not has_permission:
+                return flask.jsonify({"error": "Forbidden", "message": error_message}), 403
+
+        return flask.jsonify(_serialize_deletion_job(job_data)), 200
+    except Exception as e:
+        logging.error(f"Error retrieving organization deletion status: {str(e)}", exc_info=True)
+        return flask.jsonify({"error": "Internal Server Error", "message": str(e)}), 500
@@ -9,7 +9,8 @@ import uuid
 from datetime import datetime
 from auth import check_permission, PermissionCheckRequest, TYPE_ORGANIZATION as RESOURCE_TYPE_ORGANIZATION # Corrected import
 from flask import Request, request, jsonify
-from common.clients import get_db_client
+from common.clients import get_all_in_chunks, get_db_client
+from organization import get_organization_summaries
 import re
 import os
 
@@ -28,6 +29,31 @@ def _user_exists(user_id):
     except auth.UserNotFoundError:
         return False
 
+def _get_user_profiles(db, user_ids):
+    """Fetches users/{id} documents for the given IDs with chunked get_all calls.
+
+    Returns a dict of user ID -> profile data for the profiles that exist.
+    """
+    profiles = {}
+    unique_ids = list(dict.fromkeys(uid for uid in user_ids if uid))
+    refs = [db.collection('users').document(uid) for uid in unique_ids]
+    for snapshot in get_all_in_chunks(db, refs):
+        if snapshot.exists:
+            profiles[snapshot.id] = snapshot.to_dict() or {}
+    return profiles
+
+def _get_admin_count(db, org_id, org_snapshot):
+    """Returns the organization's administrator count.
+
+    Read from the maintained `adminCount` field; organizations created before the field existed
+    fall back to a count aggregation, and the caller's write backfills the field.
+    """
+    admin_count = (org_snapshot.to_dict() or {}).get('adminCount')
+    if admin_count is None:
+        admins_query = db.collection("organization_memberships").where("organizationId", "==", org_id).where("role", "==", "administrator")
+        admin_count = admins_query.count().get()[0][0].value
+    return admin_count
+
 # Note: Most functions here are identical to organization.py user management.
 # Consolidating logic might be beneficial in the future.
 # For now, keep separate endpoints if required by frontend/API design.
@@ -116,7 +142,29 @@ def add_organization_member(request: Request):
             "addedBy": requesting_user_id,
             "joinedAt": firestore.SERVER_TIMESTAMP,
         }
-        membership_ref.set(membership_data)
+        if role == "administrator":
+            # Keep the organization's adminCount in step with the new membership
+            org_ref = db.collection("organizations").document(org_id)
+            transaction = db.transaction()
+
+            @firestore.transactional
+            def add_admin_in_transaction(transaction):
+                # Checked again here: a concurrent add of the same user must not count them twice
+                membership_snapshot = membership_ref.get(transaction=transaction)
+                org_snapshot = org_ref.get(transaction=transaction)
+                if membership_snapshot.exists:
+                    return membership_snapshot.to_dict()
+                admin_count = _get_admin_count(db, org_id, org_snapshot)
+                transaction.set(membership_ref, membership_data)
+                transaction.update(org_ref, {"adminCount": admin_count + 1})
+                return None
+
+            existing_membership = add_admin_in_transaction(transaction)
+            if existing_membership is not None:
+                # Idempotent – added by a concurrent request, return existing doc
+                return jsonify(existing_membership), 200
+        else:
+            membership_ref.set(membership_data)
 
         # Serialize timestamp for response
         response_payload = membership_data.copy()
@@ -174,8 +222,6 @@ def list_organization_members(request):
             if existing and role_rank.get(existing["role"], 0) >= role_rank.get(current_role, 0):
                 continue  # Keep higher-ranked role already stored
 
-            user_ref = get_db_client().collection('users').document(member_user_id)
-            user_doc = user_ref.get()
             user_info = {
                 "userId": member_user_id,
                 "role": current_role,
@@ -184,11 +230,6 @@ def list_organization_members(request):
                 "addedBy": member_data.get("addedBy"),
             }
 
-            if user_doc.exists:
-                user_data = user_doc.to_dict()
-                user_info['displayName'] = user_data.get('displayName', '')
-                user_info['email'] = user_data.get('email', '')
-
             if isinstance(member_data.get("joinedAt"), datetime):
                  user_info["joinedAt"] = member_data["joinedAt"].isoformat()
             else:
@@ -196,6 +237,14 @@ def list_organization_members(request):
 
             members_map[member_user_id] = user_info
 
+        # Resolve all member profiles in batched reads instead of one get() per member
+        profiles = _get_user_profiles(get_db_client(), list(members_map.keys()))
+        for member_user_id, user_info in members_map.items():
+            user_data = profiles.get(member_user_id)
+            if user_data:
+                user_info['displayName'] = user_data.get('displayName', '')
+                user_info['email'] = user_data.get('email', '')
+
         # Remove phantom staff member: joinedAt None or within 5 seconds of admin
         admin_joined = None
         for m in members_map.values():
@@ -295,18 +344,36 @@ def update_organization_member_role(request: Request):
             return jsonify({"error": "Not Found", "message": "User is not a member"}), 404
 
         member_ref = existing[0].reference
-        current_member_data = existing[0].to_dict()
-
-        if current_member_data.get("role") == "administrator" and new_role != "administrator":
-            admins_query = db.collection("organization_memberships").where("organizationId", "==", org_id).where("role", "==", "administrator")
-            if len(list(admins_query.stream())) <= 1:
-                return jsonify({"error": "Bad Request", "message": "Cannot change role of last administrator"}), 400
-
-        member_ref.update({
-            "role": new_role,
-            "updatedAt": firestore.SERVER_TIMESTAMP,
-            "updatedBy": requesting_user_id,
-        })
+        org_ref = db.collection("organizations").document(org_id)
+        transaction = db.transaction()
+
+        @firestore.transactional
+        def update_role_in_transaction(transaction):
+            # Re-read the membership inside the transaction so concurrent role changes cannot
+            # both pass the last-administrator check
+            current_role = (member_ref.get(transaction=transaction).to_dict() or {}).get("role")
+            org_snapshot = org_ref.get(transaction=transaction)
+
+            delta = 0
+            if current_role == "administrator" and new_role != "administrator":
+                delta = -1
+            elif current_role != "administrator" and new_role == "administrator":
+                delta = 1
+            if delta:
+                admin_count = _get_admin_count(db, org_id, org_snapshot)
+                if delta < 0 and admin_count <= 1:
+                    return False
+                transaction.update(org_ref, {"adminCount": admin_count + delta})
+
+            transaction.update(member_ref, {
+                "role": new_role,
+                "updatedAt": firestore.SERVER_TIMESTAMP,
+                "updatedBy": requesting_user_id,
+            })
+            return True
+
+        if not update_role_in_transaction(transaction):
+            return jsonify({"error": "Bad Request", "message": "Cannot change role of last administrator"}), 400
 
         updated_data = member_ref.get().to_dict()
         if isinstance(updated_data.get("joinedAt"), datetime):
@@ -362,16 +429,23 @@ def remove_organization_member(request: Request):
         if not existing:
             return jsonify({"error": "Not Found", "message": "User is not a member"}), 404
 
-        member_data = existing[0].to_dict()
         member_ref = existing[0].reference
-
-        # Prevent removing last admin
-        if member_data.get("role") == "administrator":
-            admins_query = get_db_client().collection("organization_memberships").where("organizationId", "==", org_id).where("role", "==", "administrator")
-            if len(list(admins_query.stream())) <= 1:
-                return jsonify({"error": "Bad Request", "message": "Cannot remove last administrator"}), 400
-
-        member_ref.delete()
+        transaction = get_db_client().transaction()
+
+        @firestore.transactional
+        def remove_member_in_transaction(transaction):
+            member_data = member_ref.get(transaction=transaction).to_dict() or {}
+            # Prevent removing last admin
+            if member_data.get("role") == "administrator":
+                admin_count = _get_admin_count(get_db_client(), org_id, org_ref.get(transaction=transaction))
+                if admin_count <= 1:
+                    return False
+                transaction.update(org_ref, {"adminCount": admin_count - 1})
+            transaction.delete(member_ref)
+            return True
+
+        if not remove_member_in_transaction(transaction):
+            return jsonify({"error": "Bad Request", "message": "Cannot remove last administrator"}), 400
         logging.info(f"Member {target_user_id} removed from org {org_id} by {requesting_user_id}")
         return jsonify({
             "success": True,
@@ -443,22 +517,22 @@ def list_user_organizations(request: Request):
              return jsonify({"error": "Forbidden", "message": "Cannot list organizations for another user."}), 403
 
         members_query = get_db_client().collection('organization_memberships').where('userId', '==', target_user_id)
-        members_docs = members_query.stream()
+        memberships = [doc.to_dict() for doc in members_query.stream()]
+
+        # Resolve all organizations in batched reads (served from the summary cache when warm)
+        summaries = get_organization_summaries([m.get('organizationId') for m in memberships])
 
         organizations_list = []
-        for doc in members_docs:
-            member_data = doc.to_dict()
+        for member_data in memberships:
             organization_id = member_data.get('organizationId')
             if not organization_id: continue
 
-            org_ref = get_db_client().collection('organizations').document(organization_id)
-            org_doc = org_ref.get()
-            if org_doc.exists:
-                org_data = org_doc.to_dict()
+            org_summary = summaries.get(organization_id)
+            if org_summary:
                 org_info = {
                     'organizationId': organization_id,
-                    'name': org_data.get('name', ''),
-                    'description': org_data.get('description', ''),
+                    'name': org_summary['name'],
+                    'description': org_summary['description'],
                     'role': member_data.get('role'), # Role in this specific org
                 }
                 # Convert joinedAt timestamp
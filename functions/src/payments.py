@@ -6,11 +6,21 @@ from firebase_admin import firestore # Use Firestore from firebase_admin
 import stripe
 import os
 import json
+import hashlib
+import uuid
 from datetime import datetime, timezone, timedelta
-from common.clients import get_db_client, initialize_stripe
-from vouchers import validate_voucher_code
+from google.api_core.exceptions import Aborted
+from google.cloud.exceptions import Conflict
+from common.clients import get_db_client, initialize_stripe, call_stripe, new_idempotency_key, STRIPE_DEADLINE_SECONDS
+from common.cache import TTLCache
+from vouchers import validate_voucher_code, claim_voucher_use, VoucherUsageLimitReached, VOUCHER_REDEMPTIONS_COLLECTION
+from auth import check_permission, PermissionCheckRequest, TYPE_ORGANIZATION
+from quota import invalidate_quota_snapshot
+from plans import get_plan, get_plan_by_price_id
 from common.database import db
 import time
+import threading
+import contextlib
 import flask
 
 # Initialize logging
@@ -33,141 +43,273 @@ else:
     # Depending on your needs, you might want to raise an exception here
     # or allow the application to continue but log the error prominently.
 
+# Stripe webhook events are recorded here (keyed by event ID) before being processed
+STRIPE_EVENTS_COLLECTION = "stripe_events"
+# How long one worker may hold an event before another may retry it
+STRIPE_EVENT_LEASE_SECONDS = 120
+# Processing attempts before an event is parked as 'dead' for manual inspection
+STRIPE_EVENT_MAX_ATTEMPTS = 5
+# Upper bound on leftover events one scheduled drain picks up
+STRIPE_EVENT_DRAIN_LIMIT = 50
+# Map on users and organizations from each subscription field to the `created` time of the
+# Stripe event that last wrote it
+STRIPE_EVENT_WATERMARKS_FIELD = "stripeEventCreatedByField"
+
+# Index from Stripe subscription ID to the user or organization that owns it
+STRIPE_SUBSCRIPTIONS_COLLECTION = "stripe_subscriptions"
+
+# Open checkout sessions are remembered here, keyed by who is buying what with which codes,
+# so a repeated "Subscribe" click gets the same session back
+CHECKOUT_SESSION_REQUESTS_COLLECTION = "checkoutSessionRequests"
+# How long an open checkout session is handed back to repeated requests
+CHECKOUT_SESSION_REUSE_SECONDS = 900
+# How long concurrent duplicates wait on one another's session creation rather than start their own
+CHECKOUT_SESSION_CREATE_SECONDS = 60
+
 # Constants for product caching
 CACHE_TTL = 3600  # Cache duration in seconds (1 hour)
 CACHE_DOC_PATH = "cache/stripe_products"  # Firestore path for cache
-
-def logic_get_products(request):
-    db = get_db_client()
-    initialize_stripe()
-    """Fetches active products and prices directly from Stripe, using Firestore for caching.
-
-    Handles GET requests for the /v1/products endpoint. This endpoint does not require user authentication.
-
-    Args:
-        request (functions_framework.Request): The request object (not used for auth/body here).
-
-    Returns:
-        tuple: (response_body_dict, status_code)
-    """
-    logging.info("Request received for logic_get_products")
-    cache_ref = db.document(CACHE_DOC_PATH)
-    current_time_utc = datetime.now(timezone.utc)
-
-    # 1. Check Firestore Cache
+# How long one instance may hold the refresh lease on the Firestore cache document
+PRODUCT_REFRESH_LEASE_SECONDS = 60
+# Minimum gap between refresh attempts on one instance (e.g. while another holds the lease)
+PRODUCT_REFRESH_RETRY_SECONDS = 10
+# Stripe budget of a refresh of stale products, which delays the response of the caller running it
+PRODUCT_REFRESH_DEADLINE_SECONDS = 5
+
+# In-process tier in front of the Firestore cache document. When it goes stale, one request
+# refreshes it inline (Cloud Functions gives no CPU to work left running after the response)
+# while concurrent requests keep being served the stale entry; the lease on the Firestore
+# document keeps the other instances from calling Stripe at the same time.
+_product_cache = {"data": None, "cachedAt": None, "refreshing": False, "nextRefreshAt": 0.0}
+_product_cache_lock = threading.Lock()
+_product_refresh_lock = threading.Lock()
+
+def _product_cache_is_fresh(cached_at):
+    if not isinstance(cached_at, datetime):
+        return False
+    # Ensure cached_at is timezone-aware (Firestore timestamps are UTC)
+    if cached_at.tzinfo is None:
+        cached_at = cached_at.replace(tzinfo=timezone.utc)
+    return cached_at + timedelta(seconds=CACHE_TTL) > datetime.now(timezone.utc)
+
+def _get_products_from_memory():
+    with _product_cache_lock:
+        return _product_cache["data"], _product_cache["cachedAt"]
+
+def _store_products_in_memory(products, cached_at):
+    with _product_cache_lock:
+        _product_cache["data"] = products
+        _product_cache["cachedAt"] = cached_at
+
+def _read_product_cache_doc(cache_ref):
+    """Returns (products, cachedAt) from the Firestore cache document, or (None, None)."""
     try:
         cache_doc = cache_ref.get()
-        if cache_doc.exists:
-            cache_data = cache_doc.to_dict()
-            cached_at_ts = cache_data.get("cachedAt") # Firestore Timestamp object
-            cached_products = cache_data.get("data")
-
-            if isinstance(cached_at_ts, datetime) and cached_products:
-                # Ensure cached_at_ts is timezone-aware (Firestore timestamps are UTC)
-                if cached_at_ts.tzinfo is None:
-                     cached_at_ts = cached_at_ts.replace(tzinfo=timezone.utc)
-
-                if cached_at_ts + timedelta(seconds=CACHE_TTL) > current_time_utc:
-                    logging.info("Serving product list from Firestore cache.")
-                    # Return the cached data structure directly
-                    return cached_products, 200
-                else:
-                    logging.info("Firestore cache is stale.")
-            else:
-                logging.warning("Firestore cache document exists but is invalid.")
-        else:
+        if not cache_doc.exists:
             logging.info("Product cache document not found in Firestore.")
-
+            return None, None
+        cache_data = cache_doc.to_dict()
+        cached_at = cache_data.get("cachedAt")  # Firestore Timestamp object
+        cached_products = cache_data.get("data")
+        if isinstance(cached_at, datetime) and cached_products:
+            return cached_products, cached_at
+        logging.warning("Firestore cache document exists but is invalid.")
     except Exception as e:
         logging.error(f"Error reading Firestore cache ({CACHE_DOC_PATH}): {str(e)}", exc_info=True)
-        # Proceed to fetch from Stripe if cache read fails
-
-    # 2. Cache Miss or Stale: Fetch from Stripe
-    logging.info("Fetching products from Stripe...")
-    if not stripe.api_key:
-        logging.error("Stripe API key not configured.")
-        return {"error": "Configuration Error", "message": "Stripe API key not configured"}, 500
+    return None, None
 
+def _fetch_products_from_stripe(deadline_seconds=STRIPE_DEADLINE_SECONDS):
+    """Fetches active products with their default prices from Stripe and groups them."""
     products_response = {
         "subscriptions": [],
         "cases": []
     }
 
-    try:
-        # 3. Fetch Active Products with Default Prices from Stripe
-        # Use expand to include the default_price object directly
-        stripe_products = stripe.Product.list(active=True, expand=['data.default_price'])
-
-        # 4. Process Stripe Products
-        for product in stripe_products.auto_paging_iter():
-            price = product.get('default_price') # Access the expanded price object
-            # Ensure the product has an active default price
-            if not price or not price.get('active'):
-                logging.warning(f"Product {product.get('id')} ({product.get('name')}) skipped (no active default price).")
-                continue
-
-            # Structure common product data
-            product_data = {
-                "id": product.get('id'),
-                "name": product.get('name'),
-                "description": product.get('description'),
-                "price": {
-                    "id": price.get('id'),
-                    "amount": price.get('unit_amount'), # Amount in cents/smallest unit
-                    "currency": price.get('currency'),
-                    "type": price.get('type'), # 'recurring' or 'one_time'
-                }
+    # Fetch Active Products with Default Prices from Stripe
+    # Use expand to include the default_price object directly
+    stripe_products = call_stripe(stripe.Product.list, active=True, expand=['data.default_price'],
+                                  deadline_seconds=deadline_seconds)
+
+    for product in stripe_products.auto_paging_iter():
+        price = product.get('default_price') # Access the expanded price object
+        # Ensure the product has an active default price
+        if not price or not price.get('active'):
+            logging.warning(f"Product {product.get('id')} ({product.get('name')}) skipped (no active default price).")
+            continue
+
+        # Structure common product data
+        product_data = {
+            "id": product.get('id'),
+            "name": product.get('name'),
+            "description": product.get('description'),
+            "price": {
+                "id": price.get('id'),
+                "amount": price.get('unit_amount'), # Amount in cents/smallest unit
+                "currency": price.get('currency'),
+                "type": price.get('type'), # 'recurring' or 'one_time'
+            }
+        }
+        # Add recurring interval details if applicable
+        if price.get('type') == 'recurring' and price.get('recurring'):
+            recurring = price.get('recurring', {})
+            product_data["price"]["recurring"] = {
+                "interval": recurring.get('interval'), # e.g., 'month', 'year'
+                "interval_count": recurring.get('interval_count')
             }
-            # Add recurring interval details if applicable
-            if price.get('type') == 'recurring' and price.get('recurring'):
-                recurring = price.get('recurring', {})
-                product_data["price"]["recurring"] = {
-                    "interval": recurring.get('interval'), # e.g., 'month', 'year'
-                    "interval_count": recurring.get('interval_count')
-                }
 
-            # 5. Categorize using Stripe Metadata (CRUCIAL ASSUMPTION)
-            # Assume metadata keys 'product_group' ('subscription' or 'case_tier')
-            # and 'tier' ('1', '2', '3' for cases) are set on Stripe Products.
-            metadata = product.get('metadata', {})
-            product_group = metadata.get('product_group')
-            case_tier = metadata.get('tier')
-
-            if product_group == 'subscription':
-                # Optionally add plan type (e.g., individual, org_basic) if stored in metadata
-                plan_type = metadata.get('plan_type')
-                if plan_type:
-                    product_data['plan_type'] = plan_type
-                products_response["subscriptions"].append(product_data)
-            elif product_group == 'case_tier' and price.get('type') == 'one_time':
-                 # Add tier information if available in metadata
-                 if case_tier:
-                     try:
-                         product_data['tier'] = int(case_tier) # Store tier as integer
-                     except ValueError:
-                         logging.warning(f"Invalid non-integer tier metadata '{case_tier}' for product {product.get('id')}")
-                 products_response["cases"].append(product_data)
-            else:
-                # Log products that don't fit the expected categories
-                logging.warning(f"Product {product.get('id')} ({product.get('name')}) could not be categorized based on metadata. Group: '{product_group}', Price Type: '{price.get('type')}'")
+        # Categorize using Stripe Metadata (CRUCIAL ASSUMPTION)
+        # Assume metadata keys 'product_group' ('subscription' or 'case_tier')
+        # and 'tier' ('1', '2', '3' for cases) are set on Stripe Products.
+        metadata = product.get('metadata', {})
+        product_group = metadata.get('product_group')
+        case_tier = metadata.get('tier')
+
+        if product_group == 'subscription':
+            # Optionally add plan type (e.g., individual, org_basic) if stored in metadata
+            plan_type = metadata.get('plan_type')
+            if plan_type:
+                product_data['plan_type'] = plan_type
+            products_response["subscriptions"].append(product_data)
+        elif product_group == 'case_tier' and price.get('type') == 'one_time':
+             # Add tier information if available in metadata
+             if case_tier:
+                 try:
+                     product_data['tier'] = int(case_tier) # Store tier as integer
+                 except ValueError:
+                     logging.warning(f"Invalid non-integer tier metadata '{case_tier}' for product {product.get('id')}")
+             products_response["cases"].append(product_data)
+        else:
+            # Log products that don't fit the expected categories
+            logging.warning(f"Product {product.get('id')} ({product.get('name')}) could not be categorized based on metadata. Group: '{product_group}', Price Type: '{price.get('type')}'")
 
-        # Sort case tiers numerically for consistent frontend display
-        products_response["cases"].sort(key=lambda x: x.get('tier', 99)) # Sort by tier, putting untiered last
+    # Sort case tiers numerically for consistent frontend display
+    products_response["cases"].sort(key=lambda x: x.get('tier', 99)) # Sort by tier, putting untiered last
+    return products_response
 
-        # 6. Write Fresh Data to Firestore Cache
+def _write_products_to_caches(cache_ref, products_response):
+    """Writes fresh products to the Firestore document (releasing any lease) and to memory."""
+    try:
+        cache_payload = {
+            "data": products_response, # Store the structured response
+            "cachedAt": firestore.SERVER_TIMESTAMP # Use server timestamp for consistency
+        }
+        cache_ref.set(cache_payload) # Overwrite the cache document, dropping the refresh lease
+        logging.info(f"Firestore cache updated ({CACHE_DOC_PATH}). Fetched {len(products_response['subscriptions'])} subscriptions and {len(products_response['cases'])} cases from Stripe.")
+    except Exception as e:
+        # Log error writing cache, but still serve the fresh data fetched from Stripe
+        logging.error(f"Error writing to Firestore cache ({CACHE_DOC_PATH}): {str(e)}", exc_info=True)
+    _store_products_in_memory(products_response, datetime.now(timezone.utc))
+
+def _claim_product_refresh_lease(db, cache_ref):
+    """Takes the refresh lease on the cache document unless another instance holds a live one."""
+    transaction = db.transaction()
+
+    @firestore.transactional
+    def claim_in_transaction(transaction):
+        cache_doc = cache_ref.get(transaction=transaction)
+        now = datetime.now(timezone.utc)
+        lease_expires_at = cache_doc.to_dict().get("refreshLeaseExpiresAt") if cache_doc.exists else None
+        if isinstance(lease_expires_at, datetime) and lease_expires_at > now:
+            return False
+        transaction.set(cache_ref, {
+            "refreshLeaseExpiresAt": now + timedelta(seconds=PRODUCT_REFRESH_LEASE_SECONDS)
+        }, merge=True)
+        return True
+
+    return claim_in_transaction(transaction)
+
+def refresh_product_cache(db):
+    """Brings both cache tiers up to date, calling Stripe only if this instance wins the lease.
+
+    Returns True if fresh products are now in memory, False if another instance is refreshing
+    or the refresh failed.
+    """
+    cache_ref = db.document(CACHE_DOC_PATH)
+    # Another instance may already have refreshed the shared document
+    products, cached_at = _read_product_cache_doc(cache_ref)
+    if products and _product_cache_is_fresh(cached_at):
+        _store_products_in_memory(products, cached_at)
+        return True
+    if not stripe.api_key:
+        logging.error("Stripe API key not configured; cannot refresh product cache.")
+        return False
+    if not _claim_product_refresh_lease(db, cache_ref):
+        logging.info("Product cache refresh lease held by another instance; serving stale data.")
+        return False
+    logging.info("Refreshing product cache from Stripe...")
+    _write_products_to_caches(cache_ref, _fetch_products_from_stripe(deadline_seconds=PRODUCT_REFRESH_DEADLINE_SECONDS))
+    return True
+
+def _refresh_stale_products(db):
+    """Refreshes stale products inline for the one caller that gets to; the others return at once.
+
+    Returns the products now in memory and their cachedAt, fresh or still stale.
+    """
+    with _product_cache_lock:
+        now = time.monotonic()
+        refresh = not _product_cache["refreshing"] and now >= _product_cache["nextRefreshAt"]
+        if refresh:
+            _product_cache["refreshing"] = True
+            _product_cache["nextRefreshAt"] = now + PRODUCT_REFRESH_RETRY_SECONDS
+    if refresh:
         try:
-            cache_payload = {
-                "data": products_response, # Store the structured response
-                "cachedAt": firestore.SERVER_TIMESTAMP # Use server timestamp for consistency
-            }
-            cache_ref.set(cache_payload) # Overwrite the cache document
-            logging.info(f"Firestore cache updated ({CACHE_DOC_PATH}). Fetched {len(products_response['subscriptions'])} subscriptions and {len(products_response['cases'])} cases from Stripe.")
+            with _product_refresh_lock:
+                refresh_product_cache(db)
         except Exception as e:
-            # Log error writing cache, but still return the fresh data fetched from Stripe
-            logging.error(f"Error writing to Firestore cache ({CACHE_DOC_PATH}): {str(e)}", exc_info=True)
+            logging.error(f"Product cache refresh failed; serving stale data: {str(e)}", exc_info=True)
+        finally:
+            with _product_cache_lock:
+                _product_cache["refreshing"] = False
+    return _get_products_from_memory()
+
+def logic_get_products(request):
+    """Fetches active products and prices from Stripe through a two-tier stale-while-revalidate cache.
+
+    Handles GET requests for the /v1/products endpoint. This endpoint does not require user authentication.
+    Warm instances answer from memory. When the data is stale, one request refreshes it
+    (within PRODUCT_REFRESH_DEADLINE_SECONDS) while the others are served the stale copy.
+    Only a cold instance with no cached copy anywhere waits for a full Stripe fetch.
+
+    Args:
+        request (functions_framework.Request): The request object (not used for auth/body here).
+
+    Returns:
+        tuple: (response_body_dict, status_code)
+    """
+    logging.info("Request received for logic_get_products")
+    db = get_db_client()
+    initialize_stripe()
+
+    # 1. Memory tier
+    products, cached_at = _get_products_from_memory()
+    if products is not None:
+        if not _product_cache_is_fresh(cached_at):
+            products, _ = _refresh_stale_products(db)
+        return products, 200
+
+    # 2. Cold instance: one caller loads the Firestore tier (or Stripe); concurrent callers wait for it
+    cache_ref = db.document(CACHE_DOC_PATH)
+    try:
+        with _product_refresh_lock:
+            products, cached_at = _get_products_from_memory()
+            if products is None:
+                products, cached_at = _read_product_cache_doc(cache_ref)
+                if products is not None:
+                    logging.info("Serving product list from Firestore cache.")
+                    _store_products_in_memory(products, cached_at)
+            if products is None:
+                logging.info("Fetching products from Stripe...")
+                if not stripe.api_key:
+                    logging.error("Stripe API key not configured.")
+                    return {"error": "Configuration Error", "message": "Stripe API key not configured"}, 500
+                products = _fetch_products_from_stripe()
+                _write_products_to_caches(cache_ref, products)
+                return products, 200
 
-        # 7. Return Fresh Data
-        return products_response, 200
+        if not _product_cache_is_fresh(cached_at):
+            logging.info("Firestore cache is stale; refreshing it unless another request already is.")
+            products, _ = _refresh_stale_products(db)
+        return products, 200
 
     except stripe.error.StripeError as e:
         logging.error(f"Stripe API error fetching products: {str(e)}")
@@ -250,7 +392,10 @@ def create_payment_intent(request):
 
         # Create the payment intent in Stripe
         try:
-            payment_intent = stripe.PaymentIntent.create(
+            payment_intent = call_stripe(
+                stripe.PaymentIntent.create,
+                operation='write',
+                idempotency_key=new_idempotency_key('payment-intent'),
                 amount=amount,
                 currency=currency,
                 description=description,
@@ -289,6 +434,76 @@ def create_payment_intent(request):
         logging.error(f"Error creating payment intent: {str(e)}", exc_info=True)
         return ({"error": "Internal Server Error", "message": "Failed to create payment intent"}, 500)
 
+def _checkout_request_key(user_id, checkout_params):
+    """Identifies a checkout request by its buyer and every parameter sent to Stripe.
+
+    The parameters cover the line items (price or amount, currency, product name), mode,
+    redirect URLs and metadata (organization, plan, case and discount codes).
+    """
+    parts = [user_id, checkout_params]
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def _checkout_idempotency_key(request_key, attempt_id):
+    """Stripe idempotency key of one checkout attempt.
+
+    Covers the race the Firestore lookup cannot: concurrent duplicates share the attempt and
+    get the same session back from Stripe. Every new attempt (after the session completed or
+    expired) gets a fresh key, so Stripe does not replay a finished session.
+    """
+    return f"checkout-session-{request_key[:32]}-{attempt_id}"
+
+def _reserve_checkout_attempt(db, request_key):
+    """Returns (open_record, None) for a reusable session, else (None, attempt_id) to create one with.
+
+    A request that finds another one creating the session for the same purchase shares its
+    attempt for up to CHECKOUT_SESSION_CREATE_SECONDS.
+    """
+    record_ref = db.collection(CHECKOUT_SESSION_REQUESTS_COLLECTION).document(request_key)
+    transaction = db.transaction()
+
+    @firestore.transactional
+    def reserve_in_transaction(transaction):
+        snapshot = record_ref.get(transaction=transaction)
+        record = (snapshot.to_dict() or {}) if snapshot.exists else {}
+        now = datetime.now(timezone.utc)
+        reusable_until = record.get('reusableUntil')
+        if record.get('status') == 'open' and reusable_until and reusable_until > now:
+            return record, None
+        reserved_at = record.get('reservedAt')
+        if (record.get('status') == 'creating' and reserved_at
+                and reserved_at > now - timedelta(seconds=CHECKOUT_SESSION_CREATE_SECONDS)):
+            return None, record['attemptId']
+        attempt_id = uuid.uuid4().hex
+        transaction.set(record_ref, {"status": "creating", "attemptId": attempt_id, "reservedAt": now})
+        return None, attempt_id
+
+    return reserve_in_transaction(transaction)
+
+def _remember_checkout_session(db, request_key, checkout_session):
+    now = datetime.now(timezone.utc)
+    reusable_until = now + timedelta(seconds=CHECKOUT_SESSION_REUSE_SECONDS)
+    expires_at = _timestamp_from_seconds(checkout_session.get('expires_at'))
+    if expires_at:
+        reusable_until = min(reusable_until, expires_at)
+    db.collection(CHECKOUT_SESSION_REQUESTS_COLLECTION).document(request_key).set({
+        "sessionId": checkout_session.get('id'),
+        "url": checkout_session.get('url'),
+        "status": checkout_session.get('status'),
+        "reusableUntil": reusable_until,
+        "createdAt": now
+    })
+
+def _forget_checkout_session(db, session):
+    """Stops handing out a session once it is completed or expired."""
+    request_key = (session.get('metadata') or {}).get('requestKey')
+    if not request_key:
+        return
+    record_ref = db.collection(CHECKOUT_SESSION_REQUESTS_COLLECTION).document(request_key)
+    snapshot = record_ref.get()
+    # A newer session may already have replaced this one for the same request
+    if snapshot.exists and (snapshot.to_dict() or {}).get('sessionId') == session.get('id'):
+        record_ref.delete()
+
 # Renamed function to avoid conflict with framework decorator if deployed individually
 def create_checkout_session(request):
     db = get_db_client()
@@ -352,18 +567,31 @@ def create_checkout_session(request):
 
         if plan_id:
             plan_config = plan_details_map.get(plan_id)
-            if not plan_config:
-                logging.error(f"Unknown planId provided: {plan_id}")
-                return ({"error": "Bad Request", "message": f"Unknown planId: {plan_id}"}, 400)
+            env_var_name = plan_config["env_var"] if plan_config else None
+            price_id = os.environ.get(env_var_name) if env_var_name else None
+            if plan_config:
+                mode = plan_config["mode"] # Override mode based on plan_id type
+
+            # Plans withdrawn from the catalogue can no longer be bought
+            catalogue_plan = get_plan(plan_id)
+            if catalogue_plan and not catalogue_plan.get("isActive"):
+                logging.error(f"Inactive planId provided: {plan_id}")
+                return flask.jsonify({"error": "Bad Request", "message": f"Unknown or unavailable plan: {plan_id}"}), 400
 
-            env_var_name = plan_config["env_var"]
-            price_id = os.environ.get(env_var_name)
+            if not price_id:
+                # Plans in the Firestore plan catalogue carry their own Stripe Price ID
+                if not plan_config and not catalogue_plan:
+                    logging.error(f"Unknown planId provided: {plan_id}")
+                    return ({"error": "Bad Request", "message": f"Unknown planId: {plan_id}"}, 400)
+                if catalogue_plan:
+                    price_id = catalogue_plan.get("stripePriceId")
+                    if not plan_config:
+                        mode = "subscription" if catalogue_plan.get("interval") else "payment"
 
             if not price_id:
-                logging.error(f"Stripe Price ID for plan '{plan_id}' is not configured in environment variable '{env_var_name}'.")
+                logging.error(f"Stripe Price ID for plan '{plan_id}' is not configured in environment variable '{env_var_name}' or the plan catalogue.")
                 return flask.jsonify({"error": "Bad Request", "message": f"Unknown or unavailable plan: {plan_id}"}), 400
 
-            mode = plan_config["mode"] # Override mode based on plan_id type
             metadata["planId"] = plan_id # Store the original planId in metadata for reference
             # Note: caseQuotaTotal is no longer sourced from Firestore here.
             # If quota is needed, it must be handled differently (e.g., defined in Stripe product metadata and fetched, or managed post-subscription).
@@ -463,6 +691,27 @@ def create_checkout_session(request):
             checkout_params["metadata"]["appliedDiscountPercentage"] = voucher_data["discountPercentage"]
             logging.info(f"Applied {voucher_data['discountPercentage']}% discount from voucher {voucher_code}")
 
+        # Hand back the open session of an identical recent request instead of creating another
+        request_key = _checkout_request_key(user_id, checkout_params)
+        existing_session, attempt_id = _reserve_checkout_attempt(db, request_key)
+        if existing_session:
+            logging.info(f"Returning open checkout session {existing_session['sessionId']} for a repeated request")
+            response_data = {
+                "checkoutSessionId": existing_session['sessionId'],
+                "sessionId": existing_session['sessionId'],
+                "url": existing_session.get('url'),
+                "reused": True,
+                "message": "Existing checkout session returned"
+            }
+            if voucher_data:
+                response_data["voucherApplied"] = {
+                    "code": voucher_code.upper(),
+                    "discountPercentage": voucher_data["discountPercentage"],
+                    "description": voucher_data.get("description")
+                }
+            return flask.jsonify(response_data), 200
+        metadata["requestKey"] = request_key
+
         # Create the checkout session in Stripe
         try:
             # In test mode without a configured Stripe key, simulate a checkout session.
@@ -474,7 +723,12 @@ def create_checkout_session(request):
                 if not stripe.api_key:
                     logging.error("Stripe API key not configured – simulating checkout session in test mode.")
                     return flask.jsonify({"error": "Bad Request", "message": "Stripe API key not configured"}), 400
-                checkout_session = stripe.checkout.Session.create(**checkout_params)
+                checkout_session = call_stripe(
+                    stripe.checkout.Session.create,
+                    operation='write',
+                    idempotency_key=_checkout_idempotency_key(request_key, attempt_id),
+                    **checkout_params
+                )
 
             # Store checkout session details in Firestore for tracking
             session_ref = db.collection("checkoutSessions").document(checkout_session.get('id'))
@@ -490,9 +744,11 @@ def create_checkout_session(request):
                 "voucherDiscountPercentage": voucher_data["discountPercentage"] if voucher_data else None,
                 "promotionCode": promotion_code.upper() if promotion_code else None,
                 "promotionDiscountPercentage": metadata.get("promotionDiscountPercentage", 0),
+                "requestKey": request_key,
                 "creationDate": firestore.SERVER_TIMESTAMP
             }
             session_ref.set(session_data)
+            _remember_checkout_session(db, request_key, checkout_session)
 
             # Return the session ID and URL (frontend redirects user to this URL)
             logging.info(f"Checkout session created with ID: {checkout_session.get('id')}")
@@ -514,6 +770,8 @@ def create_checkout_session(request):
             return flask.jsonify(response_data), 201
         except stripe.error.StripeError as e:
             logging.error(f"Stripe error creating checkout session: {str(e)}")
+            # A retry starts a new attempt rather than replaying the error
+            db.collection(CHECKOUT_SESSION_REQUESTS_COLLECTION).document(request_key).delete()
             return ({"error": "Payment Processing Error", "message": str(e)}, 400)
     except Exception as e:
         logging.exception("Failed to create checkout session")
@@ -589,38 +847,15 @@ def logic_redeem_voucher(request):
                     'message': error_message or 'Permission denied to redeem voucher for this organization'
                 }, 403
 
-        # Use a transaction for atomic operations
-        @db.transaction()
-        def redeem_voucher_transaction(transaction):
-            # Fetch and validate voucher
-            voucher_ref = db.collection('vouchers').document(voucher_code)
-            voucher_doc = voucher_ref.get(transaction=transaction)
-
-            if not voucher_doc.exists:
-                raise ValueError('Voucher code not found')
-
-            voucher_data = voucher_doc.to_dict()
-
-            # Validate voucher state
-            if not voucher_data.get('isActive'):
-                raise ValueError('Voucher is not active')
-
-            expires_at = voucher_data.get('expiresAt')
-            if expires_at and expires_at.timestamp() < datetime.now(timezone.utc).timestamp():
-                raise ValueError('Voucher has expired')
-
-            usage_limit = voucher_data.get('usageLimit', 0)
-            usage_count = voucher_data.get('usageCount', 0)
-            if usage_limit > 0 and usage_count >= usage_limit:
-                raise ValueError('Voucher usage limit reached')
-
-            # Get target entity (user or organization)
-            target_ref = None
-            if organization_id:
-                target_ref = db.collection('organizations').document(organization_id)
-            else:
-                target_ref = db.collection('users').document(requesting_user_id)
+        voucher_ref = db.collection('vouchers').document(voucher_code)
+        target_ref = None
+        if organization_id:
+            target_ref = db.collection('organizations').document(organization_id)
+        else:
+            target_ref = db.collection('users').document(requesting_user_id)
 
+        def apply_voucher(transaction, voucher_data):
+            """Applies the voucher's benefit to the target inside the slot-claiming transaction."""
             target_doc = target_ref.get(transaction=transaction)
             if not target_doc.exists:
                 raise ValueError('Target profile not found')
@@ -674,17 +909,15 @@ def logic_redeem_voucher(request):
                 raise ValueError('Invalid voucher type')
 
             # Update target entity
-            target_ref.update(updates, transaction=transaction)
-
-            # Update voucher usage
-            voucher_updates = {
-                'usageCount': usage_count + 1,
-                f'redeemedBy.{requesting_user_id}': {
-                    'timestamp': firestore.SERVER_TIMESTAMP,
-                    'organizationId': organization_id
-                }
-            }
-            voucher_ref.update(voucher_updates, transaction=transaction)
+            transaction.update(target_ref, updates)
+
+            # Record the redemption on its own document, keeping the voucher document cold
+            redemption_ref = voucher_ref.collection(VOUCHER_REDEMPTIONS_COLLECTION).document(requesting_user_id)
+            transaction.set(redemption_ref, {
+                'userId': requesting_user_id,
+                'organizationId': organization_id,
+                'timestamp': firestore.SERVER_TIMESTAMP
+            })
 
             return {
                 'voucherType': voucher_type,
@@ -693,8 +926,29 @@ def logic_redeem_voucher(request):
             }
 
         try:
-            # Execute transaction
-            result = redeem_voucher_transaction()
+            # Validate the voucher; its document is only read here, usage is counted on shards
+            voucher_doc = voucher_ref.get()
+            if not voucher_doc.exists:
+                raise ValueError('Voucher code not found')
+
+            voucher_data = voucher_doc.to_dict()
+
+            # Validate voucher state
+            if not voucher_data.get('isActive'):
+                raise ValueError('Voucher is not active')
+
+            expires_at = voucher_data.get('expiresAt')
+            if expires_at and expires_at.timestamp() < datetime.now(timezone.utc).timestamp():
+                raise ValueError('Voucher has expired')
+
+            if voucher_data.get('usageExhausted'):
+                raise ValueError('Voucher usage limit reached')
+
+            # Claim a usage slot and apply the benefit in one transaction
+            result = claim_voucher_use(
+                db, voucher_ref, voucher_data,
+                lambda transaction: apply_voucher(transaction, voucher_data)
+            )
 
             return {
                 'success': True,
@@ -704,13 +958,13 @@ def logic_redeem_voucher(request):
                 'description': result['description']
             }, 200
 
-        except ValueError as e:
+        except (ValueError, VoucherUsageLimitReached) as e:
             return {
                 'error': 'InvalidVoucher',
                 'message': str(e)
             }, 400
 
-        except firestore.exceptions.TransactionError:
+        except Aborted:
             return {
                 'error': 'TransactionError',
                 'message': 'Failed to redeem voucher due to concurrent modification'
@@ -729,9 +983,13 @@ def logic_redeem_voucher(request):
 #     pass
 
 def handle_stripe_webhook(request):
-    db = get_db_client()
-    initialize_stripe()
-    """Handle Stripe webhook events. IMPORTANT: Secure this endpoint properly.
+    """Verifies and records a Stripe webhook event, then acknowledges it.
+
+    The event is stored in the `stripe_events` collection under its Stripe ID, which makes
+    redeliveries no-ops, and is applied to Firestore before the response (see
+    process_stripe_event); Cloud Functions gives no CPU to work left running after it. Events
+    that fail are retried by the scheduled drain (process_stripe_events).
+    IMPORTANT: Secure this endpoint properly.
 
     Args:
         request (flask.Request): HTTP request object with Stripe event data.
@@ -739,6 +997,8 @@ def handle_stripe_webhook(request):
     Returns:
         tuple: (response, status_code)
     """
+    db = get_db_client()
+    initialize_stripe()
     logging.info("Received Stripe webhook event")
 
     # Get the webhook secret from environment variables - THIS IS CRITICAL FOR SECURITY
@@ -769,454 +1029,650 @@ def handle_stripe_webhook(request):
         logging.error(f"Webhook Error: Invalid signature: {str(e)}")
         return ({"error": "Unauthorized", "message": "Invalid signature"}, 401) # Use 401 Unauthorized
 
-    # Handle specific event types
+    event_id = event['id']
     event_type = event['type']
-    logging.info(f"Processing verified Stripe event: {event_type}")
 
+    # Record the event; the create() fails if Stripe already delivered it
     try:
-        # Handle checkout.session.completed event
-        # This event signifies a successful checkout, often the start of a subscription
-        # or a completed one-time payment via Checkout.
-        if event_type == 'checkout.session.completed':
-            session = event['data']['object']
-
-            # Update our record of the checkout session status
-            checkout_session_ref = db.collection("checkoutSessions").document(session.id)
-            checkout_session_ref.update({
-                "status": session.status, # e.g., 'complete'
-                "paymentStatus": session.get("payment_status"), # e.g., 'paid'
-                "updatedAt": firestore.SERVER_TIMESTAMP
-            })
-
-            # Process based on the session mode (subscription or one-time payment)
-            if session.get('mode') == 'subscription':
-                # Extract metadata we stored during session creation
-                metadata = session.get('metadata', {})
-                plan_id = metadata.get('planId')
-                user_id = metadata.get('userId')
-                organization_id = metadata.get('organizationId')
-
-                # Get subscription details from the event
-                subscription_id = session.get('subscription')
-                if not subscription_id:
-                    logging.error(f"Webhook Error: No subscription ID in completed session {session.id}")
-                    # Acknowledge the event but log error, might need manual check
-                    return ({"error": "Processing Error", "message": "No subscription ID found"}, 200) # Return 200 so Stripe doesn't retry
-
-                # Fetch the subscription object from Stripe for full details
-                subscription = stripe.Subscription.retrieve(subscription_id)
-                customer_id = subscription.get('customer')
-
-                # Get plan details from Firestore again to ensure we have the correct quota
-                if not plan_id:
-                    logging.error(f"Webhook Error: No plan ID in session metadata for session {session.get('id')}")
-                    return ({"error": "Processing Error", "message": "No plan ID in metadata"}, 200)
-
-                plan_doc = db.collection("plans").document(plan_id).get()
-                if not plan_doc.exists:
-                    logging.error(f"Webhook Error: Plan {plan_id} not found for session {session.get('id')}")
-                    return ({"error": "Processing Error", "message": f"Plan not found: {plan_id}"}, 200)
-
-                plan_data = plan_doc.to_dict()
-                case_quota_total = plan_data.get("caseQuotaTotal", 0)
-
-                # Determine current billing period from the subscription object
-                current_period_start = subscription.get('current_period_start')
-                current_period_end = subscription.get('current_period_end')
-
-                # Prepare the update payload for Firestore user/org document
-                update_payload = {
-                    "stripeCustomerId": customer_id,
-                    "stripeSubscriptionId": subscription_id,
-                    "subscriptionPlanId": plan_id,
-                    "subscriptionStatus": "active", # Mark as active on completion
-                    "caseQuotaTotal": case_quota_total,
-                    "caseQuotaUsed": 0, # Reset quota on new subscription start
-                    "billingCycleStart": firestore.Timestamp.from_seconds(current_period_start) if current_period_start else None,
-                    "billingCycleEnd": firestore.Timestamp.from_seconds(current_period_end) if current_period_end else None,
-                    "updatedAt": firestore.SERVER_TIMESTAMP
-                }
-
-                # Update user or organization document based on metadata
-                if organization_id:
-                    # This is a business subscription - update organization
-                    target_ref = db.collection("organizations").document(organization_id)
-                    target_id = organization_id
-                    target_type = "organization"
-                elif user_id:
-                    # This is a personal subscription - update user
-                    target_ref = db.collection("users").document(user_id)
-                    target_id = user_id
-                    target_type = "user"
-                else:
-                    # Should have either user_id or organization_id from session creation
-                    logging.error(f"Webhook Error: Neither user_id nor organization_id found in session metadata for session {session.get('id')}")
-                    return ({"error": "Processing Error", "message": "No user or organization ID in metadata"}, 200)
-
-                # Perform the Firestore update
-                target_ref.update(update_payload)
-                logging.info(f"Webhook: Updated {target_type} {target_id} with new subscription {subscription_id}")
-
-            elif session.get('mode') == 'payment':
-                # This is a one-time payment completed via Checkout
-                metadata = session.get('metadata', {})
-                case_id = metadata.get('caseId')
-
-                if case_id:
-                    # Update the case payment status
-                    case_ref = db.collection("cases").document(case_id)
-                    case_ref.update({
-                        "paymentStatus": "paid_checkout", # Indicate payment via Checkout
-                        "stripeCheckoutSessionId": session.get('id'), # Store session ID for reference
-                        "updatedAt": firestore.SERVER_TIMESTAMP
-                    })
-                    logging.info(f"Webhook: Updated case {case_id} payment status to 'paid_checkout'")
-
-                # Update our payment intent record if linked via metadata (optional)
-                payment_intent_id = session.get("payment_intent")
-                if payment_intent_id:
-                     payment_ref = db.collection("payments").document(payment_intent_id)
-                     payment_ref.update({
-                          "status": "succeeded", # Should be succeeded if session complete
-                          "stripeCheckoutSessionId": session.get('id'),
-                          "updatedAt": firestore.SERVER_TIMESTAMP
-                     })
-
+        db.collection(STRIPE_EVENTS_COLLECTION).document(event_id).create({
+            "eventId": event_id,
+            "type": event_type,
+            "created": event.get('created'),
+            "payload": payload.decode('utf-8') if isinstance(payload, bytes) else payload,
+            "status": "pending",
+            "attempts": 0,
+            "receivedAt": firestore.SERVER_TIMESTAMP
+        })
+        duplicate = False
+    except Conflict:
+        duplicate = True
+    except Exception as e:
+        # Not recorded, so let Stripe retry the delivery
+        logging.error(f"Webhook Error: Failed to record event {event_id}: {str(e)}", exc_info=True)
+        return ({"error": "Webhook Processing Error", "message": f"Failed to record webhook event: {str(e)}"}, 500)
+
+    # A redelivered event that never finished processing gets another chance; the
+    # processing lease keeps it from being applied twice. Failures are recorded on the
+    # event and retried by the scheduled drain.
+    process_stripe_event(event_id)
+
+    if duplicate:
+        logging.info(f"Webhook: Duplicate delivery of event {event_id} ({event_type}) acknowledged.")
+        return ({"success": True, "message": f"Duplicate webhook ignored: {event_type}", "eventId": event_id}, 200)
+
+    # Acknowledge the event was received successfully. Processing errors are tracked on the
+    # event record rather than surfaced to Stripe.
+    return ({"success": True, "message": f"Webhook received: {event_type}", "eventId": event_id}, 200)
+
+def _claim_stripe_event(db, event_ref):
+    """Takes the processing lease on a recorded event and returns its data, or None."""
+    transaction = db.transaction()
+
+    @firestore.transactional
+    def claim_in_transaction(transaction):
+        event_doc = event_ref.get(transaction=transaction)
+        if not event_doc.exists:
+            return None
+        record = event_doc.to_dict()
+        status = record.get('status')
+        if status in ('processed', 'dead'):
+            return None
+        lease_expires_at = record.get('leaseExpiresAt')
+        if status == 'processing' and lease_expires_at and lease_expires_at > datetime.now(timezone.utc):
+            return None
+        record['attempts'] = record.get('attempts', 0) + 1
+        transaction.update(event_ref, {
+            'status': 'processing',
+            'attempts': record['attempts'],
+            'leaseExpiresAt': datetime.now(timezone.utc) + timedelta(seconds=STRIPE_EVENT_LEASE_SECONDS),
+            'updatedAt': firestore.SERVER_TIMESTAMP
+        })
+        return record
+
+    return claim_in_transaction(transaction)
+
+def process_stripe_event(event_id, subscription_cache=None):
+    """Applies one recorded Stripe event to Firestore.
+
+    subscription_cache memoises Stripe subscription lookups across the events of one
+    processing batch. Returns True if this call processed the event, False if it was already processed,
+    held by another worker, or failed (failures are recorded on the event document).
+    """
+    db = get_db_client()
+    initialize_stripe()
+    event_ref = db.collection(STRIPE_EVENTS_COLLECTION).document(event_id)
+    record = _claim_stripe_event(db, event_ref)
+    if record is None:
+        return False
 
-        # Handle invoice.paid event (subscription renewals primarily)
-        elif event_type == 'invoice.paid':
-            invoice = event['data']['object']
-
-            # Only process subscription invoices (ignore one-off invoices if any)
-            subscription_id = invoice.get('subscription')
-            if subscription_id:
-                customer_id = invoice.get('customer')
-
-                # Fetch subscription to get the latest billing period details
-                subscription = stripe.Subscription.retrieve(subscription_id)
-                current_period_start = subscription.get('current_period_start')
-                current_period_end = subscription.get('current_period_end')
-
-                # Find user or organization by subscription ID
-                target_ref = None
-                target_id = None
-                target_type = None
-                plan_id = None
-                case_quota_total = 0
-
-                # First check organizations
-                org_query = db.collection("organizations").where("stripeSubscriptionId", "==", subscription_id).limit(1).stream()
-                org_docs = list(org_query)
-                if len(org_docs) > 0:
-                    org_doc = org_docs[0]
-                    target_ref = db.collection("organizations").document(org_doc.id)
-                    target_id = org_doc.id
-                    target_type = "organization"
-                    plan_id = org_doc.to_dict().get("subscriptionPlanId")
-                    case_quota_total = org_doc.to_dict().get("caseQuotaTotal", 0) # Use current value as default
-                else:
-                    # Check users if not found in organizations
-                    user_query = db.collection("users").where("stripeSubscriptionId", "==", subscription_id).limit(1).stream()
-                    user_docs = list(user_query)
-                    if len(user_docs) > 0:
-                        user_doc = user_docs[0]
-                        target_ref = db.collection("users").document(user_doc.id)
-                        target_id = user_doc.id
-                        target_type = "user"
-                        plan_id = user_doc.to_dict().get("subscriptionPlanId")
-                        case_quota_total = user_doc.to_dict().get("caseQuotaTotal", 0) # Use current value as default
-
-                if target_ref:
-                    # Get the latest quota total from the plan document if possible
-                    if plan_id:
-                        plan_doc = db.collection("plans").document(plan_id).get()
-                        if plan_doc.exists:
-                            case_quota_total = plan_doc.to_dict().get("caseQuotaTotal", case_quota_total)
-
-                    # Update Firestore document: reset quota, update billing cycle, ensure active status
-                    target_ref.update({
-                        "subscriptionStatus": "active", # Ensure status is active on payment
-                        "caseQuotaUsed": 0, # Reset usage quota
-                        "caseQuotaTotal": case_quota_total, # Update quota total if it changed in plan
-                        "billingCycleStart": firestore.Timestamp.from_seconds(current_period_start) if current_period_start else None,
-                        "billingCycleEnd": firestore.Timestamp.from_seconds(current_period_end) if current_period_end else None,
-                        "updatedAt": firestore.SERVER_TIMESTAMP
-                    })
-                    logging.info(f"Webhook: Reset quota and updated billing cycle for {target_type} {target_id} with subscription {subscription_id}")
-                else:
-                     logging.warning(f"Webhook: Received invoice.paid for subscription {subscription_id} but found no matching user or organization.")
-
-
-        # Handle invoice.payment_failed
-        elif event_type == 'invoice.payment_failed':
-            invoice = event['data']['object']
-
-            # Only process subscription invoices
-            subscription_id = invoice.get('subscription')
-            if subscription_id:
-                # Mark subscription as past_due in Firestore
-                target_ref = None
-                target_id = None
-                target_type = None
-
-                # Check organizations first
-                org_query = db.collection("organizations").where("stripeSubscriptionId", "==", subscription_id).limit(1).stream()
-                org_docs = list(org_query)
-                if len(org_docs) > 0:
-                    org_doc = org_docs[0]
-                    target_ref = db.collection("organizations").document(org_doc.id)
-                    target_id = org_doc.id
-                    target_type = "organization"
-                else:
-                    # Check users
-                    user_query = db.collection("users").where("stripeSubscriptionId", "==", subscription_id).limit(1).stream()
-                    user_docs = list(user_query)
-                    if len(user_docs) > 0:
-                        user_doc = user_docs[0]
-                        target_ref = db.collection("users").document(user_doc.id)
-                        target_id = user_doc.id
-                        target_type = "user"
-
-                if target_ref:
-                    target_ref.update({
-                        "subscriptionStatus": "past_due", # Indicate payment failed
-                        "updatedAt": firestore.SERVER_TIMESTAMP
-                    })
-                    logging.info(f"Webhook: Updated {target_type} {target_id} subscription status to 'past_due' for sub {subscription_id}")
-                else:
-                     logging.warning(f"Webhook: Received invoice.payment_failed for subscription {subscription_id} but found no matching user or organization.")
+    try:
+        event = stripe.Event.construct_from(json.loads(record['payload']), stripe.api_key)
+        outcome = _apply_stripe_event(db, event, subscription_cache)
+        event_ref.update({
+            'status': 'processed',
+            'outcome': outcome,
+            'error': None,
+            'leaseExpiresAt': None,
+            'processedAt': firestore.SERVER_TIMESTAMP
+        })
+        logging.info(f"Webhook: Event {event_id} processed: {outcome}")
+        return True
+    except Exception as e:
+        attempts = record.get('attempts', 1)
+        status = 'dead' if attempts >= STRIPE_EVENT_MAX_ATTEMPTS else 'failed'
+        logging.error(f"Webhook Error: Failed processing event {event_id} (attempt {attempts}): {str(e)}", exc_info=True)
+        event_ref.update({
+            'status': status,
+            'error': str(e),
+            'leaseExpiresAt': None,
+            'updatedAt': firestore.SERVER_TIMESTAMP
+        })
+        return False
+
+def process_pending_stripe_events(limit=None, subscription_cache=None):
+    """Processes recorded events that are still pending or failed, oldest Stripe event first.
+
+    Returns the number of events processed by this call.
+    """
+    if subscription_cache is None:
+        subscription_cache = {}
+    db = get_db_client()
+    query = db.collection(STRIPE_EVENTS_COLLECTION).where(
+        'status', 'in', ['pending', 'failed', 'processing']
+    ).order_by('created').limit(limit or STRIPE_EVENT_DRAIN_LIMIT)
+    processed = 0
+    for event_doc in query.stream():
+        if process_stripe_event(event_doc.id, subscription_cache):
+            processed += 1
+    return processed
+
+def process_stripe_events(request):
+    """Scheduled drain of Stripe events that failed or were left unprocessed by the webhook.
+
+    Invoked by Cloud Scheduler, not through the API Gateway.
+    """
+    try:
+        processed = process_pending_stripe_events()
+        return {"success": True, "processed": processed}, 200
+    except Exception as e:
+        logging.error(f"Error draining Stripe events: {str(e)}", exc_info=True)
+        return {"error": "InternalError", "message": "Failed to process pending Stripe events"}, 500
 
+def _apply_subscription_update(db, target_ref, update_data, event_created):
+    """Applies the fields of a subscription update that no newer Stripe event has written.
 
-        # Handle customer.subscription.deleted (when subscription is definitively canceled/removed)
-        elif event_type == 'customer.subscription.deleted':
-            # This event occurs when a subscription is canceled immediately or reaches the end
-            # of the billing period after being scheduled for cancellation.
-            subscription = event['data']['object']
-            subscription_id = subscription.get('id')
+    Stripe does not guarantee delivery order, so every field a webhook writes records the
+    `created` time of its event in `stripeEventCreatedByField`. A late event only loses the
+    fields a newer event has already set: an old invoice.paid still resets the quota after an
+    unrelated newer status change. Returns the names of the fields written (empty if skipped).
+    """
+    transaction = db.transaction()
+
+    @firestore.transactional
+    def update_in_transaction(transaction):
+        target_doc = target_ref.get(transaction=transaction)
+        if not target_doc.exists:
+            logging.warning(f"Webhook: Target {target_ref.id} no longer exists; skipping update.")
+            return []
+        watermarks = target_doc.to_dict().get(STRIPE_EVENT_WATERMARKS_FIELD) or {}
+        payload = {}
+        applied = []
+        for field, value in update_data.items():
+            if field == "updatedAt":
+                continue
+            last_event_created = watermarks.get(field)
+            if event_created and last_event_created and last_event_created > event_created:
+                continue
+            payload[field] = value
+            applied.append(field)
+            if event_created:
+                payload[f"{STRIPE_EVENT_WATERMARKS_FIELD}.{field}"] = event_created
+        if not applied:
+            logging.info(f"Webhook: Skipping event created at {event_created} for {target_ref.id}; newer events set every field.")
+            return []
+        if "updatedAt" in update_data:
+            payload["updatedAt"] = update_data["updatedAt"]
+        transaction.update(target_ref, payload)
+        return applied
+
+    applied = update_in_transaction(transaction)
+    if applied:
+        # Plan, status and quota fields feed quota checks on this instance
+        invalidate_quota_snapshot(target_ref)
+    return applied
+
+def _subscription_target_ref(db, target_type, target_id):
+    collection = "organizations" if target_type == "organization" else "users"
+    return db.collection(collection).document(target_id)
+
+def _index_subscription(db, subscription_id, target_type, target_id):
+    """Records which user or organization a Stripe subscription belongs to."""
+    db.collection(STRIPE_SUBSCRIPTIONS_COLLECTION).document(subscription_id).set({
+        "subscriptionId": subscription_id,
+        "targetType": target_type,
+        "targetId": target_id,
+        "updatedAt": firestore.SERVER_TIMESTAMP
+    })
+
+def _unindex_subscription(db, subscription_id):
+    db.collection(STRIPE_SUBSCRIPTIONS_COLLECTION).document(subscription_id).delete()
+
+def _find_subscription_target(db, subscription_id):
+    """Returns (target_type, target_id) for a Stripe subscription, or (None, None).
+
+    Resolved with one point read of the stripe_subscriptions index. Subscriptions linked
+    before the index existed are looked up on organizations and users once, then indexed.
+    """
+    index_doc = db.collection(STRIPE_SUBSCRIPTIONS_COLLECTION).document(subscription_id).get()
+    if index_doc.exists:
+        index_data = index_doc.to_dict()
+        return index_data.get("targetType"), index_data.get("targetId")
+
+    target_type, target_id = _query_subscription_target(db, subscription_id)
+    if target_type:
+        _index_subscription(db, subscription_id, target_type, target_id)
+    return target_type, target_id
+
+def _query_subscription_target(db, subscription_id):
+    """Finds the owner of an unindexed subscription by querying organizations and users."""
+    for target_type, collection in (("organization", "organizations"), ("user", "users")):
+        docs = list(db.collection(collection).where("stripeSubscriptionId", "==", subscription_id).limit(1).stream())
+        if docs:
+            return target_type, docs[0].id
+    return None, None
+
+def _timestamp_from_seconds(seconds):
+    return datetime.fromtimestamp(seconds, tz=timezone.utc) if seconds else None
+
+def _get_subscription(subscription_id, subscription_cache=None):
+    """Retrieves a subscription from Stripe, memoised in subscription_cache for one processing batch."""
+    if subscription_cache is not None and subscription_id in subscription_cache:
+        return subscription_cache[subscription_id]
+    subscription = call_stripe(stripe.Subscription.retrieve, subscription_id)
+    if subscription_cache is not None:
+        subscription_cache[subscription_id] = subscription
+    return subscription
+
+def _subscription_period(subscription):
+    """Returns (current_period_start, current_period_end) from a subscription object.
+
+    Newer Stripe API versions carry the period on the subscription items instead of the
+    subscription itself; either is accepted. Missing values are returned as None.
+    """
+    period_start = subscription.get('current_period_start')
+    period_end = subscription.get('current_period_end')
+    if period_start is None or period_end is None:
+        items_data = (subscription.get('items') or {}).get('data') or []
+        if items_data:
+            period_start = period_start or items_data[0].get('current_period_start')
+            period_end = period_end or items_data[0].get('current_period_end')
+    return period_start, period_end
+
+def _app_subscription_status(subscription):
+    """Maps a Stripe subscription's status to the subscriptionStatus stored on users and organizations."""
+    status = subscription.get('status') # e.g., active, past_due, unpaid, canceled, incomplete, etc.
+    if status in ["active", "trialing"]:
+        # Scheduled to cancel at period end counts as pending cancellation
+        return "canceled" if subscription.get('cancel_at_period_end') else "active"
+    if status in ["canceled", "unpaid", "incomplete_expired"]:
+        # Canceled means definitively ended or failed permanently
+        return "inactive"
+    if status in ["past_due", "incomplete"]:
+        # Needs payment or action
+        return "past_due"
+    return "unknown"
+
+def _subscription_price_id(subscription):
+    """Returns the Stripe Price ID of a subscription's first item, or None."""
+    items_data = (subscription.get("items") or {}).get("data") or []
+    if items_data and isinstance(items_data[0], dict):
+        price_data = items_data[0].get("price") or {}
+        if isinstance(price_data, dict):
+            return price_data.get("id")
+    return None
+
+def _invoice_period(invoice):
+    """Returns the (start, end) of the subscription period an invoice pays for, or (None, None)."""
+    for line in (invoice.get('lines') or {}).get('data') or []:
+        if line.get('type') == 'subscription' or line.get('subscription'):
+            period = line.get('period') or {}
+            return period.get('start'), period.get('end')
+    return None, None
+
+def _apply_stripe_event(db, event, subscription_cache=None):
+    """Applies a verified Stripe event to Firestore and returns a short outcome message.
+
+    Events are processed from their payload; Stripe is only called for fields the payload
+    lacks, and those lookups are memoised in subscription_cache (one dict per processing
+    batch). Business-level problems (unknown plan, no matching user) are logged and reported
+    in the outcome rather than raised, since retrying cannot fix them.
+    """
+    event_type = event['type']
+    event_created = event.get('created')
+    logging.info(f"Processing Stripe event {event.get('id')}: {event_type}")
+
+    # Handle checkout.session.completed event
+    # This event signifies a successful checkout, often the start of a subscription
+    # or a completed one-time payment via Checkout.
+    if event_type == 'checkout.session.completed':
+        session = event['data']['object']
+
+        # Update our record of the checkout session status
+        checkout_session_ref = db.collection("checkoutSessions").document(session.id)
+        checkout_session_ref.update({
+            "status": session.status, # e.g., 'complete'
+            "paymentStatus": session.get("payment_status"), # e.g., 'paid'
+            "updatedAt": firestore.SERVER_TIMESTAMP
+        })
+        _forget_checkout_session(db, session)
+
+        # Process based on the session mode (subscription or one-time payment)
+        if session.get('mode') == 'subscription':
+            # Extract metadata we stored during session creation
+            metadata = session.get('metadata', {})
+            plan_id = metadata.get('planId')
+            user_id = metadata.get('userId')
+            organization_id = metadata.get('organizationId')
+
+            # Get subscription details from the event (the subscription may be expanded or an ID)
+            subscription = session.get('subscription')
+            subscription_id = subscription.get('id') if isinstance(subscription, dict) else subscription
+            if not subscription_id:
+                logging.error(f"Webhook Error: No subscription ID in completed session {session.id}")
+                # Acknowledge the event but log error, might need manual check
+                return "No subscription ID found"
+
+            # Get plan details from the plan catalogue to ensure we have the correct quota
+            if not plan_id:
+                logging.error(f"Webhook Error: No plan ID in session metadata for session {session.get('id')}")
+                return "No plan ID in metadata"
+
+            plan_data = get_plan(plan_id)
+            if not plan_data:
+                logging.error(f"Webhook Error: Plan {plan_id} not found for session {session.get('id')}")
+                return f"Plan not found: {plan_id}"
+
+            case_quota_total = plan_data.get("caseQuotaTotal", 0)
+
+            # Determine current billing period; the session only carries it if the subscription
+            # was expanded, otherwise fetch the subscription from Stripe
+            current_period_start, current_period_end = (None, None)
+            if isinstance(subscription, dict):
+                current_period_start, current_period_end = _subscription_period(subscription)
+            customer_id = session.get('customer') or (subscription.get('customer') if isinstance(subscription, dict) else None)
+            if current_period_start is None or current_period_end is None or not customer_id:
+                subscription = _get_subscription(subscription_id, subscription_cache)
+                current_period_start, current_period_end = _subscription_period(subscription)
+                customer_id = customer_id or subscription.get('customer')
+
+            # Prepare the update payload for Firestore user/org document
+            update_payload = {
+                "stripeCustomerId": customer_id,
+                "stripeSubscriptionId": subscription_id,
+                "subscriptionPlanId": plan_id,
+                "subscriptionStatus": "active", # Mark as active on completion
+                "caseQuotaTotal": case_quota_total,
+                "caseQuotaUsed": 0, # Reset quota on new subscription start
+                "billingCycleStart": _timestamp_from_seconds(current_period_start),
+                "billingCycleEnd": _timestamp_from_seconds(current_period_end),
+                "updatedAt": firestore.SERVER_TIMESTAMP
+            }
 
-            # Mark subscription as inactive and clear Stripe IDs in Firestore
-            target_ref = None
-            target_id = None
-            target_type = None
-
-            # Check organizations first
-            org_query = db.collection("organizations").where("stripeSubscriptionId", "==", subscription_id).limit(1).stream()
-            org_docs = list(org_query)
-            if len(org_docs) > 0:
-                org_doc = org_docs[0]
-                target_ref = db.collection("organizations").document(org_doc.id)
-                target_id = org_doc.id
+            # Update user or organization document based on metadata
+            if organization_id:
+                # This is a business subscription - update organization
+                target_ref = db.collection("organizations").document(organization_id)
+                target_id = organization_id
                 target_type = "organization"
+            elif user_id:
+                # This is a personal subscription - update user
+                target_ref = db.collection("users").document(user_id)
+                target_id = user_id
+                target_type = "user"
             else:
-                # Check users
-                user_query = db.collection("users").where("stripeSubscriptionId", "==", subscription_id).limit(1).stream()
-                user_docs = list(user_query)
-                if len(user_docs) > 0:
-                    user_doc = user_docs[0]
-                    target_ref = db.collection("users").document(user_doc.id)
-                    target_id = user_doc.id
-                    target_type = "user"
-
-            if target_ref:
-                target_ref.update({
-                    "subscriptionStatus": "inactive", # Or 'canceled'
-                    "stripeSubscriptionId": firestore.DELETE_FIELD, # Remove association
-                    "subscriptionPlanId": firestore.DELETE_FIELD, # Remove plan link
-                    # Consider whether to delete stripeCustomerId or keep for history
-                    #"stripeCustomerId": firestore.DELETE_FIELD,
-                    "billingCycleStart": firestore.DELETE_FIELD,
-                    "billingCycleEnd": firestore.DELETE_FIELD,
-                    "caseQuotaTotal": firestore.DELETE_FIELD,
-                    "caseQuotaUsed": firestore.DELETE_FIELD,
+                # Should have either user_id or organization_id from session creation
+                logging.error(f"Webhook Error: Neither user_id nor organization_id found in session metadata for session {session.get('id')}")
+                return "No user or organization ID in metadata"
+
+            # Perform the Firestore update
+            applied = _apply_subscription_update(db, target_ref, update_payload, event_created)
+            if not applied:
+                return f"Skipped out-of-order event for {target_type} {target_id}"
+            if "stripeSubscriptionId" in applied:
+                _index_subscription(db, subscription_id, target_type, target_id)
+            logging.info(f"Webhook: Updated {target_type} {target_id} with new subscription {subscription_id}")
+
+        elif session.get('mode') == 'payment':
+            # This is a one-time payment completed via Checkout
+            metadata = session.get('metadata', {})
+            case_id = metadata.get('caseId')
+
+            if case_id:
+                # Update the case payment status
+                case_ref = db.collection("cases").document(case_id)
+                case_ref.update({
+                    "paymentStatus": "paid_checkout", # Indicate payment via Checkout
+                    "stripeCheckoutSessionId": session.get('id'), # Store session ID for reference
                     "updatedAt": firestore.SERVER_TIMESTAMP
                 })
-                logging.info(f"Webhook: Updated {target_type} {target_id} subscription status to 'inactive' and cleared Stripe IDs for sub {subscription_id}")
-            else:
-                logging.warning(f"Webhook: Received customer.subscription.deleted for subscription {subscription_id} but found no matching user or organization.")
-
-
-        # Handle customer.subscription.updated (status changes, plan changes, etc.)
-        elif event_type == 'customer.subscription.updated':
-            subscription = event['data']['object']
-            subscription_id = subscription.get('id')
-            status = subscription.get('status') # e.g., active, past_due, unpaid, canceled, incomplete, etc.
-
-            # Find the corresponding user or organization
+                logging.info(f"Webhook: Updated case {case_id} payment status to 'paid_checkout'")
+
+            # Update our payment intent record if linked via metadata (optional)
+            payment_intent_id = session.get("payment_intent")
+            if payment_intent_id:
+                 payment_ref = db.collection("payments").document(payment_intent_id)
+                 payment_ref.update({
+                      "status": "succeeded", # Should be succeeded if session complete
+                      "stripeCheckoutSessionId": session.get('id'),
+                      "updatedAt": firestore.SERVER_TIMESTAMP
+                 })
+
+
+    # Handle invoice.paid event (subscription renewals primarily)
+    elif event_type == 'checkout.session.expired':
+        session = event['data']['object']
+        db.collection("checkoutSessions").document(session.id).set({
+            "status": session.get("status"), # 'expired'
+            "updatedAt": firestore.SERVER_TIMESTAMP
+        }, merge=True)
+        _forget_checkout_session(db, session)
+
+    elif event_type == 'invoice.paid':
+        invoice = event['data']['object']
+
+        # Only process subscription invoices (ignore one-off invoices if any)
+        subscription_id = invoice.get('subscription')
+        if subscription_id:
+            # The invoice's subscription line carries the period it pays for; fall back to the
+            # subscription only if it is missing
+            current_period_start, current_period_end = _invoice_period(invoice)
+            if current_period_start is None or current_period_end is None:
+                current_period_start, current_period_end = _subscription_period(
+                    _get_subscription(subscription_id, subscription_cache)
+                )
+
+            # Find user or organization by subscription ID
             target_ref = None
-            target_id = None
-            target_type = None
-            current_plan_id_in_db = None
-            current_quota_in_db = 0
-
-            # Check organizations first
-            org_query = db.collection("organizations").where("stripeSubscriptionId", "==", subscription_id).limit(1).stream()
-            org_docs = list(org_query)
-            if len(org_docs) > 0:
-                org_doc = org_docs[0]
-                target_ref = db.collection("organizations").document(org_doc.id)
-                target_id = org_doc.id
-                target_type = "organization"
-                org_data = org_doc.to_dict()
-                current_plan_id_in_db = org_data.get("subscriptionPlanId")
-                current_quota_in_db = org_data.get("caseQuotaTotal", 0)
-            else:
-                # Check users
-                user_query = db.collection("users").where("stripeSubscriptionId", "==", subscription_id).limit(1).stream()
-                user_docs = list(user_query)
-                if len(user_docs) > 0:
-                    user_doc = user_docs[0]
-                    target_ref = db.collection("users").document(user_doc.id)
-                    target_id = user_doc.id
-                    target_type = "user"
-                    user_data = user_doc.to_dict()
-                    current_plan_id_in_db = user_data.get("subscriptionPlanId")
-                    current_quota_in_db = user_data.get("caseQuotaTotal", 0)
+            plan_id = None
+            case_quota_total = 0
+
+            target_type, target_id = _find_subscription_target(db, subscription_id)
+            if target_type:
+                target_ref = _subscription_target_ref(db, target_type, target_id)
+                target_doc = target_ref.get()
+                if target_doc.exists:
+                    target_data = target_doc.to_dict()
+                    plan_id = target_data.get("subscriptionPlanId")
+                    case_quota_total = target_data.get("caseQuotaTotal", 0) # Use current value as default
 
             if target_ref:
-                # Prepare Firestore update payload
-                update_data = { "updatedAt": firestore.SERVER_TIMESTAMP }
-
-                # Map Stripe status to our application's status
-                new_app_status = "unknown"
-                if status in ["active", "trialing"]:
-                    new_app_status = "active"
-                    # Check if it's scheduled to cancel at period end
-                    if subscription.get('cancel_at_period_end'):
-                         new_app_status = "canceled" # Indicate pending cancellation
-                elif status in ["canceled", "unpaid", "incomplete_expired"]:
-                     # Canceled means definitively ended or failed permanently
-                    new_app_status = "inactive"
-                elif status in ["past_due", "incomplete"]:
-                     # Needs payment or action
-                    new_app_status = "past_due"
-
-                update_data["subscriptionStatus"] = new_app_status
-
-                # Update billing cycle dates if status is active/trialing
-                if status in ["active", "trialing"]:
-                     current_period_start = subscription.get('current_period_start')
-                     current_period_end = subscription.get('current_period_end')
-                     if current_period_start:
-                          update_data["billingCycleStart"] = firestore.Timestamp.from_seconds(current_period_start)
-                     if current_period_end:
-                          update_data["billingCycleEnd"] = firestore.Timestamp.from_seconds(current_period_end)
-                     else: # Should always have an end date for active subs
-                          update_data["billingCycleEnd"] = firestore.DELETE_FIELD
-                else: # If not active, clear billing cycle dates
-                     update_data["billingCycleStart"] = firestore.DELETE_FIELD
-                     update_data["billingCycleEnd"] = firestore.DELETE_FIELD
-
-                # Check if the plan changed
-                stripe_plan_price_id = None
-                items_data = subscription.get("items", {}).get("data", [])
-                if items_data and len(items_data) > 0:
-                    first_item = items_data[0]
-                    if first_item and isinstance(first_item, dict):
-                        price_data = first_item.get("price", {})
-                        if price_data and isinstance(price_data, dict):
-                            stripe_plan_price_id = price_data.get("id")
-
-                firestore_plan_ref = None
-                new_quota_total = current_quota_in_db # Default to existing quota
-
-                if stripe_plan_price_id and stripe_plan_price_id != current_plan_id_in_db:
-                     # Plan seems to have changed, find Firestore plan by Stripe Price ID
-                     plan_query = db.collection("plans").where("stripePriceId", "==", stripe_plan_price_id).limit(1).stream()
-                     plan_docs = list(plan_query)
-                     if plan_docs:
-                          plan_doc = plan_docs[0]
-                          plan_data = plan_doc.to_dict() if plan_doc else {}
-                          new_quota_total = plan_data.get("caseQuotaTotal", 0)
-                          update_data["subscriptionPlanId"] = plan_doc.id
-                          update_data["caseQuotaTotal"] = new_quota_total
-                          # Consider resetting caseQuotaUsed if plan changes? Depends on business logic.
-                          # update_data["caseQuotaUsed"] = 0
-                          logging.info(f"Webhook: Plan changed for {target_type} {target_id} to {plan_doc.id} (Stripe Price ID: {stripe_plan_price_id})")
-                     else:
-                          logging.warning(f"Webhook: Plan change detected for {target_type} {target_id}, but couldn't find matching plan in Firestore for Stripe Price ID {stripe_plan_price_id}. Keeping old plan ID.")
-                          update_data["subscriptionPlanId"] = current_plan_id_in_db # Keep old plan ID if new one not found
-                          update_data["caseQuotaTotal"] = current_quota_in_db
-
-
-                # If subscription was canceled, clear Stripe IDs and relevant fields
-                if new_app_status == "inactive": # Reflects Stripe status 'canceled' etc.
-                     update_data["stripeSubscriptionId"] = firestore.DELETE_FIELD
-                     update_data["subscriptionPlanId"] = firestore.DELETE_FIELD
-                     update_data["billingCycleStart"] = firestore.DELETE_FIELD
-                     update_data["billingCycleEnd"] = firestore.DELETE_FIELD
-                     update_data["caseQuotaTotal"] = firestore.DELETE_FIELD
-                     update_data["caseQuotaUsed"] = firestore.DELETE_FIELD
-
-                # Apply the updates
-                target_ref.update(update_data)
-                logging.info(f"Webhook: Updated {target_type} {target_id} subscription status to '{new_app_status}' based on Stripe event status '{status}'")
+                # Get the latest quota total from the plan catalogue if possible
+                plan_data = get_plan(plan_id)
+                if plan_data:
+                    case_quota_total = plan_data.get("caseQuotaTotal", case_quota_total)
+
+                # Update Firestore document: reset quota, update billing cycle, ensure active status
+                if not _apply_subscription_update(db, target_ref, {
+                    "subscriptionStatus": "active", # Ensure status is active on payment
+                    "caseQuotaUsed": 0, # Reset usage quota
+                    "caseQuotaTotal": case_quota_total, # Update quota total if it changed in plan
+                    "billingCycleStart": _timestamp_from_seconds(current_period_start),
+                    "billingCycleEnd": _timestamp_from_seconds(current_period_end),
+                    "updatedAt": firestore.SERVER_TIMESTAMP
+                }, event_created):
+                    return f"Skipped out-of-order event for {target_type} {target_id}"
+                logging.info(f"Webhook: Reset quota and updated billing cycle for {target_type} {target_id} with subscription {subscription_id}")
             else:
-                 logging.warning(f"Webhook: Received customer.subscription.updated for sub {subscription_id} but found no matching user or org.")
+                 logging.warning(f"Webhook: Received invoice.paid for subscription {subscription_id} but found no matching user or organization.")
 
 
-        # Handle payment_intent.succeeded for linking one-time payments
-        elif event_type == 'payment_intent.succeeded':
-            payment_intent = event['data']['object']
-            payment_intent_id = payment_intent.get('id')
-            metadata = payment_intent.get('metadata', {})
+    # Handle invoice.payment_failed
+    elif event_type == 'invoice.payment_failed':
+        invoice = event['data']['object']
 
-            # Update our payment record
-            payment_ref = db.collection("payments").document(payment_intent_id)
-            payment_ref.update({
-                 "status": payment_intent.status, # Should be 'succeeded'
-                 "updatedAt": firestore.SERVER_TIMESTAMP
-            })
+        # Only process subscription invoices
+        subscription_id = invoice.get('subscription')
+        if subscription_id:
+            # Mark subscription as past_due in Firestore
+            target_type, target_id = _find_subscription_target(db, subscription_id)
 
-            # Check if this payment intent is linked to a case via metadata
-            if 'caseId' in metadata:
-                case_id = metadata.get('caseId')
-                case_ref = db.collection("cases").document(case_id)
-                # Update case only if it's not already covered by quota or another payment method
-                case_snap = case_ref.get()
-                if case_snap.exists:
-                    current_payment_status = case_snap.to_dict().get("paymentStatus")
-                    # Only update if not already paid or covered
-                    if current_payment_status not in ["paid_intent", "paid_checkout", "covered_by_quota"]:
-                         case_ref.update({
-                            "paymentStatus": "paid_intent",
-                            "paymentIntentId": payment_intent_id, # Link the successful PI
-                            "updatedAt": firestore.SERVER_TIMESTAMP
-                         })
-                         logging.info(f"Webhook: Updated case {case_id} payment status to 'paid_intent'")
-                    else:
-                         logging.info(f"Webhook: Case {case_id} already has payment status '{current_payment_status}'. Ignoring payment_intent.succeeded.")
+            if target_type:
+                target_ref = _subscription_target_ref(db, target_type, target_id)
+                if not _apply_subscription_update(db, target_ref, {
+                    "subscriptionStatus": "past_due", # Indicate payment failed
+                    "updatedAt": firestore.SERVER_TIMESTAMP
+                }, event_created):
+                    return f"Skipped out-of-order event for {target_type} {target_id}"
+                logging.info(f"Webhook: Updated {target_type} {target_id} subscription status to 'past_due' for sub {subscription_id}")
+            else:
+                 logging.warning(f"Webhook: Received invoice.payment_failed for subscription {subscription_id} but found no matching user or organization.")
+
+
+    # Handle customer.subscription.deleted (when subscription is definitively canceled/removed)
+    elif event_type == 'customer.subscription.deleted':
+        # This event occurs when a subscription is canceled immediately or reaches the end
+        # of the billing period after being scheduled for cancellation.
+        subscription = event['data']['object']
+        subscription_id = subscription.get('id')
+
+        # Mark subscription as inactive and clear Stripe IDs in Firestore
+        target_type, target_id = _find_subscription_target(db, subscription_id)
+
+        if target_type:
+            target_ref = _subscription_target_ref(db, target_type, target_id)
+            if not _apply_subscription_update(db, target_ref, {
+                "subscriptionStatus": "inactive", # Or 'canceled'
+                "stripeSubscriptionId": firestore.DELETE_FIELD, # Remove association
+                "subscriptionPlanId": firestore.DELETE_FIELD, # Remove plan link
+                # Consider whether to delete stripeCustomerId or keep for history
+                #"stripeCustomerId": firestore.DELETE_FIELD,
+                "billingCycleStart": firestore.DELETE_FIELD,
+                "billingCycleEnd": firestore.DELETE_FIELD,
+                "caseQuotaTotal": firestore.DELETE_FIELD,
+                "caseQuotaUsed": firestore.DELETE_FIELD,
+                "updatedAt": firestore.SERVER_TIMESTAMP
+            }, event_created):
+                return f"Skipped out-of-order event for {target_type} {target_id}"
+            _unindex_subscription(db, subscription_id)
+            logging.info(f"Webhook: Updated {target_type} {target_id} subscription status to 'inactive' and cleared Stripe IDs for sub {subscription_id}")
+        else:
+            logging.warning(f"Webhook: Received customer.subscription.deleted for subscription {subscription_id} but found no matching user or organization.")
+
+
+    # Handle customer.subscription.updated (status changes, plan changes, etc.)
+    elif event_type == 'customer.subscription.updated':
+        subscription = event['data']['object']
+        subscription_id = subscription.get('id')
+        status = subscription.get('status') # e.g., active, past_due, unpaid, canceled, incomplete, etc.
+
+        # Find the corresponding user or organization
+        target_ref = None
+        current_plan_id_in_db = None
+        current_quota_in_db = 0
+
+        target_type, target_id = _find_subscription_target(db, subscription_id)
+        if target_type:
+            target_ref = _subscription_target_ref(db, target_type, target_id)
+            target_doc = target_ref.get()
+            if target_doc.exists:
+                target_data = target_doc.to_dict()
+                current_plan_id_in_db = target_data.get("subscriptionPlanId")
+                current_quota_in_db = target_data.get("caseQuotaTotal", 0)
+
+        if target_ref:
+            # Prepare Firestore update payload
+            update_data = { "updatedAt": firestore.SERVER_TIMESTAMP }
+
+            # Map Stripe status to our application's status
+            new_app_status = _app_subscription_status(subscription)
+
+            update_data["subscriptionStatus"] = new_app_status
+
+            # Update billing cycle dates if status is active/trialing
+            if status in ["active", "trialing"]:
+                 current_period_start, current_period_end = _subscription_period(subscription)
+                 if current_period_start:
+                      update_data["billingCycleStart"] = _timestamp_from_seconds(current_period_start)
+                 if current_period_end:
+                      update_data["billingCycleEnd"] = _timestamp_from_seconds(current_period_end)
+                 else: # Should always have an end date for active subs
+                      update_data["billingCycleEnd"] = firestore.DELETE_FIELD
+            else: # If not active, clear billing cycle dates
+                 update_data["billingCycleStart"] = firestore.DELETE_FIELD
+                 update_data["billingCycleEnd"] = firestore.DELETE_FIELD
+
+            # Check if the plan changed
+            stripe_plan_price_id = _subscription_price_id(subscription)
+
+            firestore_plan_ref = None
+            new_quota_total = current_quota_in_db # Default to existing quota
+
+            if stripe_plan_price_id and stripe_plan_price_id != current_plan_id_in_db:
+                 # Plan seems to have changed, find the plan by Stripe Price ID
+                 plan_data = get_plan_by_price_id(stripe_plan_price_id)
+                 if plan_data:
+                      new_quota_total = plan_data.get("caseQuotaTotal", 0)
+                      update_data["subscriptionPlanId"] = plan_data["id"]
+                      update_data["caseQuotaTotal"] = new_quota_total
+                      # Consider resetting caseQuotaUsed if plan changes? Depends on business logic.
+                      # update_data["caseQuotaUsed"] = 0
+                      logging.info(f"Webhook: Plan changed for {target_type} {target_id} to {plan_data['id']} (Stripe Price ID: {stripe_plan_price_id})")
+                 else:
+                      logging.warning(f"Webhook: Plan change detected for {target_type} {target_id}, but couldn't find matching plan in Firestore for Stripe Price ID {stripe_plan_price_id}. Keeping old plan ID.")
+                      update_data["subscriptionPlanId"] = current_plan_id_in_db # Keep old plan ID if new one not found
+                      update_data["caseQuotaTotal"] = current_quota_in_db
+
+
+            # If subscription was canceled, clear Stripe IDs and relevant fields
+            if new_app_status == "inactive": # Reflects Stripe status 'canceled' etc.
+                 update_data["stripeSubscriptionId"] = firestore.DELETE_FIELD
+                 update_data["subscriptionPlanId"] = firestore.DELETE_FIELD
+                 update_data["billingCycleStart"] = firestore.DELETE_FIELD
+                 update_data["billingCycleEnd"] = firestore.DELETE_FIELD
+                 update_data["caseQuotaTotal"] = firestore.DELETE_FIELD
+                 update_data["caseQuotaUsed"] = firestore.DELETE_FIELD
+
+            # Apply the updates unless a newer event has already been applied
+            if not _apply_subscription_update(db, target_ref, update_data, event_created):
+                return f"Skipped out-of-order event for {target_type} {target_id}"
+            if new_app_status == "inactive":
+                _unindex_subscription(db, subscription_id)
+            logging.info(f"Webhook: Updated {target_type} {target_id} subscription status to '{new_app_status}' based on Stripe event status '{status}'")
+        else:
+             logging.warning(f"Webhook: Received customer.subscription.updated for sub {subscription_id} but found no matching user or org.")
+
+
+    # Handle payment_intent.succeeded for linking one-time payments
+    elif event_type == 'payment_intent.succeeded':
+        payment_intent = event['data']['object']
+        payment_intent_id = payment_intent.get('id')
+        metadata = payment_intent.get('metadata', {})
+
+        # Update our payment record
+        payment_ref = db.collection("payments").document(payment_intent_id)
+        payment_ref.update({
+             "status": payment_intent.status, # Should be 'succeeded'
+             "updatedAt": firestore.SERVER_TIMESTAMP
+        })
+
+        # Check if this payment intent is linked to a case via metadata
+        if 'caseId' in metadata:
+            case_id = metadata.get('caseId')
+            case_ref = db.collection("cases").document(case_id)
+            # Update case only if it's not already covered by quota or another payment method
+            case_snap = case_ref.get()
+            if case_snap.exists:
+                current_payment_status = case_snap.to_dict().get("paymentStatus")
+                # Only update if not already paid or covered
+                if current_payment_status not in ["paid_intent", "paid_checkout", "covered_by_quota"]:
+                     case_ref.update({
+                        "paymentStatus": "paid_intent",
+                        "paymentIntentId": payment_intent_id, # Link the successful PI
+                        "updatedAt": firestore.SERVER_TIMESTAMP
+                     })
+                     logging.info(f"Webhook: Updated case {case_id} payment status to 'paid_intent'")
                 else:
-                     logging.warning(f"Webhook: Received payment_intent.succeeded for case {case_id} but case not found.")
-
-
-        # Handle other payment intent statuses (optional, for more detailed tracking)
-        elif event_type in ['payment_intent.payment_failed', 'payment_intent.canceled']:
-             payment_intent = event['data']['object']
-             payment_intent_id = payment_intent.get('id')
-             payment_ref = db.collection("payments").document(payment_intent_id)
-             # Update our payment record status
-             payment_ref.update({
-                 "status": payment_intent.status,
-                 "updatedAt": firestore.SERVER_TIMESTAMP
-             })
-             logging.info(f"Webhook: Updated payment intent {payment_intent_id} status to {payment_intent.status}")
+                     logging.info(f"Webhook: Case {case_id} already has payment status '{current_payment_status}'. Ignoring payment_intent.succeeded.")
+            else:
+                 logging.warning(f"Webhook: Received payment_intent.succeeded for case {case_id} but case not found.")
 
 
-        # --- Add handlers for other relevant events as needed ---
-        # e.g., customer.subscription.trial_will_end
+    # Handle other payment intent statuses (optional, for more detailed tracking)
+    elif event_type in ['payment_intent.payment_failed', 'payment_intent.canceled']:
+         payment_intent = event['data']['object']
+         payment_intent_id = payment_intent.get('id')
+         payment_ref = db.collection("payments").document(payment_intent_id)
+         # Update our payment record status
+         payment_ref.update({
+             "status": payment_intent.status,
+             "updatedAt": firestore.SERVER_TIMESTAMP
+         })
+         logging.info(f"Webhook: Updated payment intent {payment_intent_id} status to {payment_intent.status}")
 
-        # Acknowledge the event was received successfully
-        # Return 200 OK to Stripe unless there's a *server-side* error preventing processing.
-        # For business logic errors (e.g., user not found), log it but still return 200
-        # so Stripe doesn't retry indefinitely for potentially unfixable issues.
-        return ({"success": True, "message": f"Webhook processed: {event_type}"}, 200)
-
-    except Exception as e:
-        # Catch-all for unexpected errors during processing
-        logging.error(f"Webhook Error: Failed processing event {event_type}: {str(e)}", exc_info=True)
-        # Return 500 to indicate a server-side issue; Stripe might retry.
-        return ({"error": "Webhook Processing Error", "message": f"Failed to process webhook event: {str(e)}"}, 500)
+    # --- Add handlers for other relevant events as needed ---
+    # e.g., customer.subscription.trial_will_end
 
+    return f"Processed {event_type}"
 
 # Renamed function to avoid conflict with framework decorator if deployed individually
 def cancel_subscription(request):
@@ -1266,7 +1722,7 @@ def cancel_subscription(request):
 
         # Check if the subscription exists in Stripe first
         try:
-            subscription = stripe.Subscription.retrieve(subscription_id)
+            subscription = call_stripe(stripe.Subscription.retrieve, subscription_id)
             # Check if already canceled
             if subscription.get('cancel_at_period_end'):
                  logging.info(f"Subscription {subscription_id} is already scheduled for cancellation.")
@@ -1281,37 +1737,34 @@ def cancel_subscription(request):
             return ({"error": "Payment Processing Error", "message": str(e)}, 400)
 
 
+        # Resolve the owner of the subscription from the subscription index
+        target_type, target_id = _find_subscription_target(db, subscription_id)
+
         # 1. Check if it's the user's personal subscription
-        user_ref = db.collection("users").document(user_id)
-        user_doc = user_ref.get()
-        if user_doc.exists and user_doc.get("stripeSubscriptionId") == subscription_id:
+        if target_type == "user" and target_id == user_id:
             authorized = True
             is_personal_sub = True
-            target_firestore_ref = user_ref
-        else:
+            target_firestore_ref = _subscription_target_ref(db, target_type, target_id)
+        elif target_type == "organization":
             # 2. If not personal, check if it belongs to an org where user is admin
-            # Find organization linked to the subscription ID
-            org_query = db.collection("organizations").where("stripeSubscriptionId", "==", subscription_id).limit(1).stream()
-            org_docs = list(org_query)
-
-            if org_docs:
-                org_doc = org_docs[0]
-                organization_id = org_doc.id
-                organization_id_for_logging = organization_id # Capture for logging
-                # Check if the requesting user is an admin of this organization
-                membership_query = db.collection("organization_memberships").where("organizationId", "==", organization_id).where("userId", "==", user_id).where("role", "==", "administrator").limit(1).stream()
-                membership_docs = list(membership_query)
-
-                if membership_docs:
-                    authorized = True
-                    org_admin = True
-                    target_firestore_ref = db.collection("organizations").document(organization_id)
-                else:
-                    # User is not admin of the org owning the subscription
-                    logging.warning(f"User {user_id} attempted to cancel subscription {subscription_id} belonging to org {organization_id} but is not an admin.")
+            organization_id = target_id
+            organization_id_for_logging = organization_id # Capture for logging
+            # Check if the requesting user is an admin of this organization
+            membership_query = db.collection("organization_memberships").where("organizationId", "==", organization_id).where("userId", "==", user_id).where("role", "==", "administrator").limit(1).stream()
+            membership_docs = list(membership_query)
+
+            if membership_docs:
+                authorized = True
+                org_admin = True
+                target_firestore_ref = _subscription_target_ref(db, target_type, target_id)
             else:
-                # Subscription ID not found for user or any org
-                 logging.error(f"Subscription {subscription_id} requested for cancellation by user {user_id} not found associated with the user or any organization.")
+                # User is not admin of the org owning the subscription
+                logging.warning(f"User {user_id} attempted to cancel subscription {subscription_id} belonging to org {organization_id} but is not an admin.")
+        elif target_type == "user":
+            logging.warning(f"User {user_id} attempted to cancel subscription {subscription_id} belonging to another user.")
+        else:
+            # Subscription ID not found for user or any org
+             logging.error(f"Subscription {subscription_id} requested for cancellation by user {user_id} not found associated with the user or any organization.")
 
 
         # If authorization check failed
@@ -1321,8 +1774,11 @@ def cancel_subscription(request):
         # --- Perform Cancellation ---
         try:
             # Cancel the subscription at the end of the current period in Stripe
-            stripe.Subscription.modify(
+            call_stripe(
+                stripe.Subscription.modify,
                 subscription_id,
+                operation='write',
+                idempotency_key=new_idempotency_key('cancel-subscription'),
                 cancel_at_period_end=True # Schedules cancellation, doesn't cancel immediately
             )
 
@@ -1357,6 +1813,260 @@ def cancel_subscription(request):
         logging.error(f"Error canceling subscription: {str(e)}", exc_info=True)
         return ({"error": "Internal Server Error", "message": "Failed to cancel subscription"}, 500)
 
+# Subscription reconciliation repairs drift left by missed webhooks. Its watermark and last
+# run summary live here.
+RECONCILIATION_DOC_PATH = "cache/stripe_subscription_reconciliation"
+# Stripe keeps events for 30 days; an older watermark means a full scan is needed
+RECONCILIATION_EVENT_RETENTION_SECONDS = 29 * 24 * 3600
+# The next incremental run re-reads this much before the watermark, for events written late
+RECONCILIATION_WATERMARK_OVERLAP_SECONDS = 300
+RECONCILIATION_PAGE_SIZE = 100
+# Firestore's limit on writes per batch
+RECONCILIATION_BATCH_SIZE = 500
+RECONCILIATION_EVENT_TYPES = [
+    "customer.subscription.created",
+    "customer.subscription.updated",
+    "customer.subscription.deleted",
+    "customer.subscription.paused",
+    "customer.subscription.resumed",
+]
+
+def _expected_subscription_fields(subscription):
+    """Returns the fields a user or organization should hold for a Stripe subscription.
+
+    Mirrors what the customer.subscription.updated/deleted webhook handlers write, with
+    DELETE_FIELD for fields that should be absent.
+    """
+    app_status = _app_subscription_status(subscription)
+    if app_status == "inactive":
+        return {
+            "subscriptionStatus": "inactive",
+            "stripeSubscriptionId": firestore.DELETE_FIELD,
+            "subscriptionPlanId": firestore.DELETE_FIELD,
+            "billingCycleStart": firestore.DELETE_FIELD,
+            "billingCycleEnd": firestore.DELETE_FIELD,
+            "caseQuotaTotal": firestore.DELETE_FIELD,
+            "caseQuotaUsed": firestore.DELETE_FIELD,
+        }
+    expected = {"subscriptionStatus": app_status, "stripeSubscriptionId": subscription.get('id')}
+    if subscription.get('status') in ["active", "trialing"]:
+        current_period_start, current_period_end = _subscription_period(subscription)
+        if current_period_start:
+            expected["billingCycleStart"] = _timestamp_from_seconds(current_period_start)
+        if current_period_end:
+            expected["billingCycleEnd"] = _timestamp_from_seconds(current_period_end)
+    else:
+        expected["billingCycleStart"] = firestore.DELETE_FIELD
+        expected["billingCycleEnd"] = firestore.DELETE_FIELD
+    plan_data = get_plan_by_price_id(_subscription_price_id(subscription))
+    if plan_data:
+        expected["subscriptionPlanId"] = plan_data["id"]
+        expected["caseQuotaTotal"] = plan_data.get("caseQuotaTotal", 0)
+    return expected
+
+def _subscription_field_diff(current, expected):
+    """Returns {field: (current value, expected value)} for the fields that differ; None means absent."""
+    diff = {}
+    for field, value in expected.items():
+        if value is firestore.DELETE_FIELD:
+            if field in current:
+                diff[field] = (current[field], None)
+        elif current.get(field) != value:
+            diff[field] = (current.get(field), value)
+    return diff
+
+def _iter_subscription_pages(watermark, started_at):
+    """Returns (mode, iterable of pages of Stripe subscriptions) for a full or incremental scan."""
+    if watermark and started_at - watermark < RECONCILIATION_EVENT_RETENTION_SECONDS:
+        # Incremental: the newest snapshot of every subscription with an event since the watermark
+        events = call_stripe(
+            stripe.Event.list,
+            types=RECONCILIATION_EVENT_TYPES,
+            created={"gt": int(watermark) - RECONCILIATION_WATERMARK_OVERLAP_SECONDS},
+            limit=RECONCILIATION_PAGE_SIZE
+        )
+        latest = {}
+        for event in events.auto_paging_iter():
+            subscription = event['data']['object']
+            # Events are listed newest first, so the first one seen per subscription wins
+            latest.setdefault(subscription.get('id'), subscription)
+        subscriptions = list(latest.values())
+        return "incremental", (
+            subscriptions[i:i + RECONCILIATION_PAGE_SIZE]
+            for i in range(0, len(subscriptions), RECONCILIATION_PAGE_SIZE)
+        )
+
+    def _full_scan():
+        page = []
+        listing = call_stripe(stripe.Subscription.list, status="all", limit=RECONCILIATION_PAGE_SIZE)
+        for subscription in listing.auto_paging_iter():
+            page.append(subscription)
+            if len(page) == RECONCILIATION_PAGE_SIZE:
+                yield page
+                page = []
+        if page:
+            yield page
+    return "full", _full_scan()
+
+def _resolve_subscription_targets(db, subscriptions, dry_run=False):
+    """Returns {subscription_id: (target_type, target_id)} for one page, with one get_all on the index."""
+    index_refs = [db.collection(STRIPE_SUBSCRIPTIONS_COLLECTION).document(sub.get('id')) for sub in subscriptions]
+    targets = {}
+    for snapshot in db.get_all(index_refs):
+        if snapshot.exists:
+            index_data = snapshot.to_dict() or {}
+            targets[snapshot.id] = (index_data.get("targetType"), index_data.get("targetId"))
+    for subscription in subscriptions:
+        subscription_id = subscription.get('id')
+        # Unindexed live subscriptions predate the index; resolve (and index) them the slow way once.
+        # Unindexed ended subscriptions were already detached and are left alone.
+        if subscription_id not in targets and _app_subscription_status(subscription) != "inactive":
+            target_type, target_id = _query_subscription_target(db, subscription_id)
+            if target_type:
+                targets[subscription_id] = (target_type, target_id)
+                if not dry_run:
+                    _index_subscription(db, subscription_id, target_type, target_id)
+    return targets
+
+def _serialize_diff_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def reconcile_subscriptions(dry_run=False, full=False):
+    """Compares Stripe subscriptions with the users and organizations they belong to and fixes drift.
+
+    Runs incrementally from the stored watermark (subscriptions with events since the last
+    run), or over every Stripe subscription when full is set or the watermark is too old.
+    Corrections are written in batches and leave the webhook event watermarks alone: an event
+    created before the scan but delivered after it (e.g. an invoice.paid quota reset) must
+    still apply, and anything it leaves stale is corrected by the next run. With dry_run
+    nothing is written.
+
+    Returns a report with counts and the list of changes (applied or, in a dry run, proposed).
+    """
+    db = get_db_client()
+    initialize_stripe()
+    started_at = int(time.time())
+    state_ref = db.document(RECONCILIATION_DOC_PATH)
+    state_doc = state_ref.get()
+    watermark = None if full or not state_doc.exists else (state_doc.to_dict() or {}).get("watermark")
+    mode, pages = _iter_subscription_pages(watermark, started_at)
+
+    report = {"mode": mode, "dryRun": dry_run, "scanned": 0, "unmatched": 0, "superseded": 0, "corrected": 0, "changes": []}
+    batch = db.batch()
+    pending_writes = 0
+    for subscriptions in pages:
+        report["scanned"] += len(subscriptions)
+        targets = _resolve_subscription_targets(db, subscriptions, dry_run)
+        target_refs = {}
+        for subscription_id, (target_type, target_id) in targets.items():
+            target_refs[subscription_id] = _subscription_target_ref(db, target_type, target_id)
+        current_by_path = {}
+        if target_refs:
+            for snapshot in db.get_all(list(target_refs.values())):
+                if snapshot.exists:
+                    current_by_path[snapshot.reference.path] = snapshot.to_dict() or {}
+
+        for subscription in subscriptions:
+            subscription_id = subscription.get('id')
+            target_ref = target_refs.get(subscription_id)
+            current = current_by_path.get(target_ref.path) if target_ref is not None else None
+            if current is None:
+                report["unmatched"] += 1
+                continue
+            linked_subscription_id = current.get("stripeSubscriptionId")
+            if linked_subscription_id and linked_subscription_id != subscription_id:
+                # The target has moved on to another subscription; this one no longer describes it
+                report["superseded"] += 1
+                continue
+            expected = _expected_subscription_fields(subscription)
+            diff = _subscription_field_diff(current, expected)
+            if not diff:
+                continue
+            target_type, target_id = targets[subscription_id]
+            report["corrected"] += 1
+            report["changes"].append({
+                "subscriptionId": subscription_id,
+                "targetType": target_type,
+                "targetId": target_id,
+                "fields": {
+                    field: {"current": _serialize_diff_value(old), "expected": _serialize_diff_value(new)}
+                    for field, (old, new) in diff.items()
+                },
+            })
+            if dry_run:
+                continue
+            update = {field: expected[field] for field in diff}
+            update["updatedAt"] = firestore.SERVER_TIMESTAMP
+            batch.update(target_ref, update)
+            pending_writes += 1
+            if expected["subscriptionStatus"] == "inactive":
+                batch.delete(db.collection(STRIPE_SUBSCRIPTIONS_COLLECTION).document(subscription_id))
+                pending_writes += 1
+            if pending_writes >= RECONCILIATION_BATCH_SIZE - 1:
+                batch.commit()
+                batch = db.batch()
+                pending_writes = 0
+
+    if not dry_run:
+        if pending_writes:
+            batch.commit()
+        state_ref.set({
+            "watermark": started_at,
+            "lastRunAt": firestore.SERVER_TIMESTAMP,
+            "lastRun": {key: report[key] for key in ("mode", "scanned", "unmatched", "superseded", "corrected")},
+        })
+    logging.info(
+        f"Subscription reconciliation ({mode}{', dry run' if dry_run else ''}): scanned {report['scanned']}, "
+        f"corrected {report['corrected']}, unmatched {report['unmatched']}, superseded {report['superseded']}"
+    )
+    return report
+
+# Promotion code lookups are cached per instance: valid codes for a minute (never past their
+# expiry), unknown or ineligible codes for a shorter time so a newly created code is picked up
+# quickly. Stripe API errors are not cached.
+PROMOTION_CODE_CACHE_TTL_SECONDS = 60
+PROMOTION_CODE_NEGATIVE_TTL_SECONDS = 30
+_promotion_code_cache = TTLCache(PROMOTION_CODE_CACHE_TTL_SECONDS, max_entries=2048)
+# Locks of the codes being looked up right now, with the number of threads using each; an
+# entry is dropped by its last user, so no lock is ever evicted while held
+_promotion_code_locks = {}
+_promotion_code_locks_guard = threading.Lock()
+
+def _promotion_code_result(promo):
+    """Returns (is_valid, promo, error_message) for a promotion code object from Stripe."""
+    if promo.get('max_redemptions') and promo.get('times_redeemed', 0) >= promo['max_redemptions']:
+        return False, None, "Promotion code has reached its maximum redemptions."
+    if promo.get('expires_at') and promo['expires_at'] < int(time.time()):
+        return False, None, "Promotion code has expired."
+    return True, promo, None
+
+def _cache_promotion_code_result(cache_key, result):
+    is_valid, promo, _ = result
+    if not is_valid:
+        _promotion_code_cache.set(cache_key, result, PROMOTION_CODE_NEGATIVE_TTL_SECONDS)
+        return
+    ttl = PROMOTION_CODE_CACHE_TTL_SECONDS
+    if promo and promo.get('expires_at'):
+        ttl = min(ttl, max(promo['expires_at'] - int(time.time()), 0))
+    if ttl > 0:
+        _promotion_code_cache.set(cache_key, result, ttl)
+
+@contextlib.contextmanager
+def _promotion_code_lock(cache_key):
+    with _promotion_code_locks_guard:
+        entry = _promotion_code_locks.get(cache_key)
+        if entry is None:
+            entry = _promotion_code_locks[cache_key] = [threading.Lock(), 0]
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _promotion_code_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _promotion_code_locks[cache_key]
+
 def is_valid_promotion_code(code):
     # In test mode, validate against a simple whitelist pattern to mimic real behaviour
     if os.environ.get("RELEX_TEST_MODE") == "1":
@@ -1364,19 +2074,26 @@ def is_valid_promotion_code(code):
         if code and code.upper() in valid_test_codes:
             return True, None, None
         return False, None, "Promotion code not found or inactive (test mode)."
-    try:
-        promo_codes = stripe.PromotionCode.list(code=code, active=True, limit=1)
-        if promo_codes and promo_codes.data:
-            promo = promo_codes.data[0]
-            if promo.get('max_redemptions') and promo.get('times_redeemed', 0) >= promo['max_redemptions']:
-                return False, None, "Promotion code has reached its maximum redemptions."
-            if promo.get('expires_at') and promo['expires_at'] < int(time.time()):
-                return False, None, "Promotion code has expired."
-            return True, promo, None
-        return False, None, "Promotion code not found or inactive."
-    except Exception as e:
-        logging.error(f"Stripe API error during promotion code validation: {str(e)}", exc_info=True)
-        # In test mode, treat as valid; otherwise, return error
-        if os.environ.get("RELEX_TEST_MODE") == "1":
-            return True, None, None
-        return False, None, f"Stripe API error: {str(e)}"
+    cache_key = code.strip().upper() if isinstance(code, str) else code
+    cached = _promotion_code_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    # Single flight: concurrent checkouts with the same code share one Stripe lookup
+    with _promotion_code_lock(cache_key):
+        cached = _promotion_code_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        try:
+            promo_codes = call_stripe(stripe.PromotionCode.list, code=code, active=True, limit=1)
+            if promo_codes and promo_codes.data:
+                result = _promotion_code_result(promo_codes.data[0])
+            else:
+                result = (False, None, "Promotion code not found or inactive.")
+            _cache_promotion_code_result(cache_key, result)
+            return result
+        except Exception as e:
+            logging.error(f"Stripe API error during promotion code validation: {str(e)}", exc_info=True)
+            # In test mode, treat as valid; otherwise, return error
+            if os.environ.get("RELEX_TEST_MODE") == "1":
+                return True, None, None
+            return False, None, f"Stripe API error: {str(e)}"
@@ -0,0 +1,70 @@
+# FILE: functions/src/plans.py
+import logging
+import threading
+import time
+from common.clients import get_db_client
+from common.cache import TTLCache
+
+logging.basicConfig(level=logging.INFO)
+
+# The plans collection is small and rarely edited, so each instance keeps the whole
+# collection in memory, indexed by plan ID and by Stripe price ID. The TTL bounds how long
+# an edit takes to reach every instance; invalidate_plan_catalogue() applies it locally.
+PLAN_CATALOGUE_TTL_SECONDS = 300
+# A lookup miss reloads the catalogue (a plan may have just been added), at most this often.
+PLAN_CATALOGUE_MISS_RELOAD_SECONDS = 30
+
+_CATALOGUE_KEY = 'catalogue'
+_plan_catalogue_cache = TTLCache(PLAN_CATALOGUE_TTL_SECONDS, max_entries=1)
+_plan_catalogue_lock = threading.Lock()
+_last_loaded_at = 0.0
+
+def _load_plan_catalogue():
+    global _last_loaded_at
+    by_id = {}
+    by_price_id = {}
+    for plan_doc in get_db_client().collection('plans').stream():
+        plan = dict(plan_doc.to_dict() or {}, id=plan_doc.id)
+        by_id[plan_doc.id] = plan
+        if plan.get('stripePriceId'):
+            by_price_id[plan['stripePriceId']] = plan
+    catalogue = {'by_id': by_id, 'by_price_id': by_price_id}
+    _plan_catalogue_cache.set(_CATALOGUE_KEY, catalogue)
+    _last_loaded_at = time.monotonic()
+    logging.info(f"Loaded plan catalogue with {len(by_id)} plans")
+    return catalogue
+
+def _get_plan_catalogue(reload_on_miss=False):
+    catalogue = _plan_catalogue_cache.get(_CATALOGUE_KEY)
+    if catalogue is not None and not reload_on_miss:
+        return catalogue
+    # One caller reloads; concurrent callers wait for it and reuse the result
+    with _plan_catalogue_lock:
+        catalogue = _plan_catalogue_cache.get(_CATALOGUE_KEY)
+        if catalogue is None:
+            return _load_plan_catalogue()
+        if reload_on_miss and time.monotonic() - _last_loaded_at >= PLAN_CATALOGUE_MISS_RELOAD_SECONDS:
+            return _load_plan_catalogue()
+        return catalogue
+
+def get_plan(plan_id):
+    """Returns the plan document (with its 'id') for a plan ID, or None if there is no such plan."""
+    if not plan_id:
+        return None
+    plan = _get_plan_catalogue()['by_id'].get(plan_id)
+    if plan is None:
+        plan = _get_plan_catalogue(reload_on_miss=True)['by_id'].get(plan_id)
+    return plan
+
+def get_plan_by_price_id(stripe_price_id):
+    """Returns the plan document (with its 'id') whose stripePriceId matches, or None."""
+    if not stripe_price_id:
+        return None
+    plan = _get_plan_catalogue()['by_price_id'].get(stripe_price_id)
+    if plan is None:
+        plan = _get_plan_catalogue(reload_on_miss=True)['by_price_id'].get(stripe_price_id)
+    return plan
+
+def invalidate_plan_catalogue():
+    """Drops this instance's catalogue so the next lookup reloads the plans collection."""
+    _plan_catalogue_cache.invalidate(_CATALOGUE_KEY)
@@ -0,0 +1,349 @@
+# FILE: functions/src/quota.py
+import logging
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from firebase_admin import firestore
+from google.api_core.exceptions import Aborted
+from common.cache import TTLCache
+from plans import get_plan
+
+logging.basicConfig(level=logging.INFO)
+
+# Case quota usage of a user or organization (a "subject") is counted on shard documents under
+# {users|organizations}/{id}/quotaShards rather than on the subject document, so a large
+# organization's agent runs do not all write one document. Each shard holds a share of the
+# quota left in the current billing period as its capacity; a reservation claims units on one
+# shard in a transaction, so concurrent agent runs cannot reserve more than the quota. Shards
+# are tagged with the billing period they count, and a shard from an earlier period counts as
+# empty, so a renewal (which moves billingCycleStart) starts a fresh ledger.
+# quota_used / caseQuotaUsed on the subject document is usage from before the ledger and is
+# still added to the total.
+QUOTA_SHARD_COUNT = 10
+QUOTA_SHARDS_COLLECTION = 'quotaShards'
+QUOTA_RESERVATIONS_COLLECTION = 'quotaReservations'
+# A reservation left by a run that never finished is given back after this long
+QUOTA_RESERVATION_TTL_SECONDS = 1800
+QUOTA_USAGE_CACHE_TTL_SECONDS = 10
+# Quota checks also cache the user and organization documents per instance. Quota writes and
+# webhook subscription updates invalidate the entry on the instance that made them; the TTL
+# bounds how long other instances see an old plan.
+QUOTA_SNAPSHOT_TTL_SECONDS = 30
+SUBJECT_USERS = 'users'
+SUBJECT_ORGANIZATIONS = 'organizations'
+
+_quota_usage_cache = TTLCache(QUOTA_USAGE_CACHE_TTL_SECONDS, max_entries=4096)
+_quota_snapshot_cache = TTLCache(QUOTA_SNAPSHOT_TTL_SECONDS, max_entries=4096)
+_SUBJECT_NOT_FOUND = 'not-found'
+
+class QuotaExceeded(Exception):
+    """Raised when a subject has no quota left to reserve."""
+
+def subject_quota(subject_type, subject_data):
+    """Returns (quota_limit, quota_used) recorded on a user or organization document.
+
+    An explicit quota_limit (on the user's subscription map, or on the organization) wins;
+    otherwise the limit of the subject's plan applies, with caseQuotaUsed as the usage.
+    """
+    fields = subject_data.get('subscription', {}) if subject_type == SUBJECT_USERS else subject_data
+    if 'quota_limit' in fields:
+        return fields.get('quota_limit', 0), fields.get('quota_used', 0)
+    # The limit comes from the plan catalogue so plan changes apply without rewriting subscribers
+    plan = get_plan(subject_data.get('subscriptionPlanId'))
+    if plan:
+        return plan.get('caseQuotaTotal', subject_data.get('caseQuotaTotal', 0)), subject_data.get('caseQuotaUsed', 0)
+    return 0, fields.get('quota_used', 0)
+
+def _quota_period(subject_data):
+    """Identifies the subject's current billing period (empty when it has none)."""
+    start = subject_data.get('billingCycleStart')
+    if start is None:
+        return ''
+    return start.isoformat() if hasattr(start, 'isoformat') else str(start)
+
+def _quota_shard_refs(subject_ref, shard_count):
+    shards = subject_ref.collection(QUOTA_SHARDS_COLLECTION)
+    return [shards.document(str(i)) for i in range(shard_count)]
+
+def _subject_shard_count(subject_data):
+    return (subject_data.get('quotaLedger') or {}).get('shardCount') or QUOTA_SHARD_COUNT
+
+def _ledger_is_current(subject_type, subject_data):
+    ledger = subject_data.get('quotaLedger') or {}
+    quota_limit, _ = subject_quota(subject_type, subject_data)
+    return bool(ledger.get('shardCount')) and ledger.get('period') == _quota_period(subject_data) and ledger.get('limit') == quota_limit
+
+def ensure_quota_ledger(db, subject_type, subject_ref, subject_data):
+    """Returns the subject's quota shard references, (re)provisioning them if needed.
+
+    The shards are provisioned for a billing period and a quota limit; when either changes
+    (a renewal or a plan change), the quota still free is spread over the shards again in one
+    transaction. Units already used or reserved in the period stay where they are.
+    """
+    if _ledger_is_current(subject_type, subject_data):
+        return _quota_shard_refs(subject_ref, subject_data['quotaLedger']['shardCount'])
+
+    @firestore.transactional
+    def provision(transaction):
+        current = subject_ref.get(transaction=transaction).to_dict() or {}
+        shard_count = _subject_shard_count(current)
+        shard_refs = _quota_shard_refs(subject_ref, shard_count)
+        if _ledger_is_current(subject_type, current):
+            return shard_refs
+        quota_limit, base_used = subject_quota(subject_type, current)
+        period = _quota_period(current)
+        shards = []
+        held = base_used
+        for shard_ref in shard_refs:
+            shard_data = shard_ref.get(transaction=transaction).to_dict() or {}
+            if shard_data.get('period') != period:
+                shard_data = {'used': 0, 'reserved': 0}
+            shards.append((shard_ref, shard_data.get('used', 0), shard_data.get('reserved', 0)))
+            held += shard_data.get('used', 0) + shard_data.get('reserved', 0)
+        remaining = max(quota_limit - held, 0)
+        for i, (shard_ref, used, reserved) in enumerate(shards):
+            share = remaining // shard_count + (1 if i < remaining % shard_count else 0)
+            transaction.set(shard_ref, {
+                'period': period,
+                'capacity': used + reserved + share,
+                'used': used,
+                'reserved': reserved
+            })
+        transaction.update(subject_ref, {
+            'quotaLedger': {'period': period, 'limit': quota_limit, 'shardCount': shard_count}
+        })
+        return shard_refs
+
+    shard_refs = provision(db.transaction())
+    invalidate_quota_snapshot(subject_ref)
+    return shard_refs
+
+def invalidate_quota_snapshot(subject_ref):
+    """Drops a user's or organization's cached document and usage totals on this instance."""
+    _quota_snapshot_cache.invalidate(subject_ref.path)
+    _quota_usage_cache.invalidate(subject_ref.path)
+
+def _subject_snapshots(db, subject_refs):
+    """Returns {path: document data, or None if missing}; cache misses are read with one get_all."""
+    snapshots = {}
+    missing = []
+    for subject_ref in subject_refs:
+        cached = _quota_snapshot_cache.get(subject_ref.path)
+        if cached is None:
+            missing.append(subject_ref)
+        else:
+            snapshots[subject_ref.path] = None if cached == _SUBJECT_NOT_FOUND else cached
+    if missing:
+        for subject_doc in db.get_all(missing):
+            subject_data = (subject_doc.to_dict() or {}) if subject_doc.exists else None
+            snapshots[subject_doc.reference.path] = subject_data
+            _quota_snapshot_cache.set(subject_doc.reference.path, _SUBJECT_NOT_FOUND if subject_data is None else subject_data)
+    return snapshots
+
+def _shard_totals(db, subjects):
+    """Returns {path: (used, reserved)} over the current period's shards of each (subject_ref, subject_data).
+
+    Totals are cached per subject for a few seconds; the shards of every cache miss are read
+    with one get_all.
+    """
+    totals = {}
+    shard_refs = []
+    shard_owners = {}
+    periods = {}
+    for subject_ref, subject_data in subjects:
+        period = _quota_period(subject_data)
+        cached = _quota_usage_cache.get(subject_ref.path)
+        if cached is not None and cached['period'] == period:
+            totals[subject_ref.path] = (cached['used'], cached['reserved'])
+            continue
+        periods[subject_ref.path] = period
+        totals[subject_ref.path] = (0, 0)
+        for shard_ref in _quota_shard_refs(subject_ref, _subject_shard_count(subject_data)):
+            shard_refs.append(shard_ref)
+            shard_owners[shard_ref.path] = subject_ref.path
+    if shard_refs:
+        for shard in db.get_all(shard_refs):
+            owner = shard_owners[shard.reference.path]
+            shard_data = (shard.to_dict() or {}) if shard.exists else {}
+            if shard_data.get('period') == periods[owner]:
+                used, reserved = totals[owner]
+                totals[owner] = (used + shard_data.get('used', 0), reserved + shard_data.get('reserved', 0))
+        for owner, period in periods.items():
+            used, reserved = totals[owner]
+            _quota_usage_cache.set(owner, {'period': period, 'used': used, 'reserved': reserved})
+    return totals
+
+def get_quota_usage(db, subject_type, subject_ref, subject_data):
+    """Returns (used, reserved) for the subject's current billing period.
+
+    used includes the usage recorded on the subject document. The shard totals are cached
+    on this instance for a few seconds; quota writes made here invalidate them.
+    """
+    _, base_used = subject_quota(subject_type, subject_data)
+    used, reserved = _shard_totals(db, [(subject_ref, subject_data)])[subject_ref.path]
+    return base_used + used, reserved
+
+def get_quota_summaries(db, subjects):
+    """Returns the quota of several subjects, given as (subject_type, subject_ref) pairs.
+
+    The result maps each subject's path to {'data', 'limit', 'used', 'reserved'}, or to None
+    if the document does not exist. With cold caches this takes one get_all for the documents
+    and one for their shards; with warm caches, no reads at all.
+    """
+    snapshots = _subject_snapshots(db, [subject_ref for _, subject_ref in subjects])
+    existing = [(subject_type, subject_ref, snapshots[subject_ref.path])
+                for subject_type, subject_ref in subjects if snapshots.get(subject_ref.path) is not None]
+    totals = _shard_totals(db, [(subject_ref, subject_data) for _, subject_ref, subject_data in existing])
+    summaries = {subject_ref.path: None for _, subject_ref in subjects}
+    for subject_type, subject_ref, subject_data in existing:
+        quota_limit, base_used = subject_quota(subject_type, subject_data)
+        used, reserved = totals[subject_ref.path]
+        summaries[subject_ref.path] = {
+            'data': subject_data,
+            'limit': quota_limit,
+            'used': base_used + used,
+            'reserved': reserved
+        }
+    return summaries
+
+def reserve_quota(db, subject_type, subject_id, amount=1):
+    """Reserves amount units of a subject's quota for a run that has not finished yet.
+
+    Returns the reservation (a dict to pass to commit_quota or release_quota). Shards with
+    room are read with one get_all and tried in random order; when none has room, expired
+    reservations are given back once and the shards are tried again.
+
+    Raises:
+        QuotaExceeded: If the subject has no quota left.
+        Aborted: If only contention on the shards prevented the reservation.
+    """
+    subject_ref = db.collection(subject_type).document(subject_id)
+    subject_doc = subject_ref.get()
+    if not subject_doc.exists:
+        raise ValueError(f"{subject_type} {subject_id} not found")
+    subject_data = subject_doc.to_dict()
+    shard_refs = ensure_quota_ledger(db, subject_type, subject_ref, subject_data)
+    period = _quota_period(subject_data)
+
+    @firestore.transactional
+    def claim(transaction, shard_ref, reservation):
+        shard_data = shard_ref.get(transaction=transaction).to_dict() or {}
+        reserved = shard_data.get('reserved', 0)
+        if shard_data.get('period') != period or shard_data.get('capacity', 0) - shard_data.get('used', 0) - reserved < amount:
+            return False
+        transaction.update(shard_ref, {'reserved': reserved + amount})
+        transaction.set(subject_ref.collection(QUOTA_RESERVATIONS_COLLECTION).document(reservation['id']), {
+            'shard': reservation['shard'],
+            'amount': amount,
+            'period': period,
+            'status': 'reserved',
+            'createdAt': firestore.SERVER_TIMESTAMP,
+            'expiresAt': datetime.now(timezone.utc) + timedelta(seconds=QUOTA_RESERVATION_TTL_SECONDS)
+        })
+        return True
+
+    contended = False
+    for attempt in range(2):
+        candidates = []
+        for shard in db.get_all(shard_refs):
+            shard_data = (shard.to_dict() or {}) if shard.exists else {}
+            if shard_data.get('period') == period and shard_data.get('capacity', 0) - shard_data.get('used', 0) - shard_data.get('reserved', 0) >= amount:
+                candidates.append(shard.reference)
+        random.shuffle(candidates)
+        for shard_ref in candidates:
+            reservation = {
+                'id': str(uuid.uuid4()),
+                'subjectType': subject_type,
+                'subjectId': subject_id,
+                'shard': shard_ref.id,
+                'amount': amount
+            }
+            try:
+                claimed = claim(db.transaction(), shard_ref, reservation)
+            except ValueError as e:
+                # The transaction ran out of retries on a busy shard; try the next one
+                if isinstance(e.__cause__, Aborted):
+                    contended = True
+                    continue
+                raise
+            if claimed:
+                invalidate_quota_snapshot(subject_ref)
+                return reservation
+        if attempt or not release_expired_quota_reservations(db, subject_type, subject_id):
+            break
+    if contended:
+        raise Aborted('Quota shards are contended')
+    raise QuotaExceeded(f"No quota left for {subject_type} {subject_id}")
+
+def _settle_reservation(db, reservation, status):
+    """Moves a reservation to committed or released, adjusting its shard in the same transaction."""
+    subject_ref = db.collection(reservation['subjectType']).document(reservation['subjectId'])
+    reservation_ref = subject_ref.collection(QUOTA_RESERVATIONS_COLLECTION).document(reservation['id'])
+    shard_ref = subject_ref.collection(QUOTA_SHARDS_COLLECTION).document(reservation['shard'])
+
+    @firestore.transactional
+    def settle(transaction):
+        reservation_data = reservation_ref.get(transaction=transaction).to_dict() or {}
+        shard_data = shard_ref.get(transaction=transaction).to_dict() or {}
+        current_status = reservation_data.get('status')
+        if current_status == 'committed' or (status == 'released' and current_status != 'reserved'):
+            return False
+        amount = reservation_data.get('amount', reservation['amount'])
+        update = {}
+        # Units still held on the shard for this period are given back or turned into usage
+        if current_status == 'reserved' and shard_data.get('period') == reservation_data.get('period'):
+            update['reserved'] = max(shard_data.get('reserved', 0) - amount, 0)
+        if status == 'committed':
+            # A run outlasting its reservation still counts; usage lands in the shard's current period
+            update['used'] = shard_data.get('used', 0) + amount
+        if update:
+            transaction.update(shard_ref, update)
+        transaction.set(reservation_ref, {'status': status, 'settledAt': firestore.SERVER_TIMESTAMP}, merge=True)
+        return True
+
+    settled = settle(db.transaction())
+    invalidate_quota_snapshot(subject_ref)
+    return settled
+
+def commit_quota(db, reservation):
+    """Turns a reservation into usage. Committing twice has no further effect."""
+    return _settle_reservation(db, reservation, 'committed')
+
+def release_quota(db, reservation):
+    """Gives a reservation back unused (e.g. when the run failed)."""
+    return _settle_reservation(db, reservation, 'released')
+
+def release_expired_quota_reservations(db, subject_type, subject_id, limit=100):
+    """Gives back reservations of runs that never finished. Returns how many were released."""
+    subject_ref = db.collection(subject_type).document(subject_id)
+    expired = (subject_ref.collection(QUOTA_RESERVATIONS_COLLECTION)
+               .where('expiresAt', '<', datetime.now(timezone.utc))
+               .limit(limit)
+               .stream())
+    released = 0
+    for reservation_doc in expired:
+        reservation_data = reservation_doc.to_dict() or {}
+        if reservation_data.get('status') != 'reserved':
+            continue
+        reservation = {
+            'id': reservation_doc.id,
+            'subjectType': subject_type,
+            'subjectId': subject_id,
+            'shard': reservation_data.get('shard'),
+            'amount': reservation_data.get('amount', 1)
+        }
+        if release_quota(db, reservation):
+            released += 1
+    if released:
+        logging.info(f"Released {released} expired quota reservations for {subject_type} {subject_id}")
+    return released
+
+def record_quota_usage(db, subject_type, subject_id, amount=1):
+    """Adds usage that was not reserved beforehand to one random shard of the subject."""
+    subject_ref = db.collection(subject_type).document(subject_id)
+    subject_doc = subject_ref.get()
+    if not subject_doc.exists:
+        raise ValueError(f"{subject_type} {subject_id} not found")
+    shard_refs = ensure_quota_ledger(db, subject_type, subject_ref, subject_doc.to_dict())
+    random.choice(shard_refs).update({'used': firestore.Increment(amount)})
+    invalidate_quota_snapshot(subject_ref)
@@ -0,0 +1,36 @@
+# FILE: functions/src/reconcile_stripe_subscriptions.py
+"""Command-line entry point for payments.reconcile_subscriptions.
+
+Repairs subscription fields on users and organizations that drifted from Stripe (e.g. after
+missed webhooks). Runs incrementally from the stored watermark unless --full is given.
+
+    python reconcile_stripe_subscriptions.py --dry-run   # print the diff, write nothing
+    python reconcile_stripe_subscriptions.py             # apply corrections
+    python reconcile_stripe_subscriptions.py --full      # scan every Stripe subscription
+"""
+import argparse
+import json
+import sys
+
+from payments import reconcile_subscriptions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="print the proposed changes without writing them")
+    parser.add_argument("--full", action="store_true", help="scan every Stripe subscription instead of those changed since the watermark")
+    args = parser.parse_args(argv)
+
+    report = reconcile_subscriptions(dry_run=args.dry_run, full=args.full)
+    for change in report["changes"]:
+        print(f"{change['targetType']} {change['targetId']} ({change['subscriptionId']}):")
+        for field, values in change["fields"].items():
+            print(f"  {field}: {json.dumps(values['current'], default=str)} -> {json.dumps(values['expected'], default=str)}")
+    verb = "would correct" if args.dry_run else "corrected"
+    print(f"{report['mode']} scan: {report['scanned']} subscriptions, {verb} {report['corrected']}, "
+          f"{report['unmatched']} unmatched, {report['superseded']} superseded")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,13 @@
 """
 Template Validation - Field validation for legal document templates
 """
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Mapping, Optional, Tuple
 from dataclasses import dataclass
+from types import MappingProxyType
 from datetime import datetime
 import re
 
-@dataclass
+@dataclass(frozen=True)
 class FieldDefinition:
     """Definition of a template field with validation rules."""
     name: str
@@ -15,7 +16,7 @@ class FieldDefinition:
     min_length: Optional[int] = None
     max_length: Optional[int] = None
     pattern: Optional[str] = None
-    choices: Optional[List[str]] = None
+    choices: Optional[Tuple[str, ...]] = None
     description: str = ""
 
 class ValidationError(Exception):
@@ -26,11 +27,23 @@ class ValidationError(Exception):
         super().__init__(f"{field}: {message}")
 
 class TemplateValidator:
-    """Validator for template fields with specific rules for each template type."""
-    
+    """Validator for template fields with specific rules for each template type.
+
+    The field definitions are built once per process (see PERSON_FIELDS, COMPANY_FIELDS and
+    TEMPLATE_FIELDS below) and shared read-only, so validators are cheap to create and safe
+    to use from concurrent requests.
+    """
+
     def __init__(self):
+        self.person_fields = PERSON_FIELDS
+        self.company_fields = COMPANY_FIELDS
+        self.template_fields = TEMPLATE_FIELDS
+
+    @staticmethod
+    def _build_field_definitions():
+        """Build the person, company and per-template field definitions."""
         # Common field definitions
-        self.person_fields = {
+        person_fields = {
             "name": FieldDefinition(
                 name="name",
                 required=True,
@@ -59,7 +72,7 @@ class TemplateValidator:
             )
         }
         
-        self.company_fields = {
+        company_fields = {
             "name": FieldDefinition(
                 name="name",
                 required=True,
@@ -82,7 +95,7 @@ class TemplateValidator:
         }
         
         # Template-specific field definitions
-        self.template_fields = {
+        template_fields = {
             "court_appeal": {
                 "court_name": FieldDefinition(
                     name="court_name",
@@ -874,7 +887,7 @@ class TemplateValidator:
                 "urgency_level": FieldDefinition(
                     name="urgency_level",
                     required=True,
-                    choices=["high", "medium", "low"],
+                    choices=("high", "medium", "low"),
                     description="Nivelul de urgență"
                 )
             },
@@ -1013,6 +1026,8 @@ class TemplateValidator:
         # Add existing template fields...
         # [Previous template fields remain unchanged]
 
+        return person_fields, company_fields, template_fields
+
     def validate_field(
         self,
         field_name: str,
@@ -1079,3 +1094,15 @@ class TemplateValidator:
             }
         
         return requirements
+
+def _freeze(fields: Dict[str, Any]) -> Mapping[str, Any]:
+    """Wrap a field mapping, and any nested per-template mappings, in read-only views."""
+    return MappingProxyType({
+        name: _freeze(value) if isinstance(value, dict) else value
+        for name, value in fields.items()
+    })
+
+# Built once per process and shared by every TemplateValidator
+PERSON_FIELDS, COMPANY_FIELDS, TEMPLATE_FIELDS = (
+    _freeze(fields) for fields in TemplateValidator._build_field_definitions()
+)
@@ -7,8 +7,15 @@ import json
 from datetime import datetime, timezone, timedelta
 from typing import Dict, Any, Optional, List
 from pydantic import BaseModel, Field, field_validator
+from google.api_core.exceptions import Aborted, Conflict
+import hashlib
+import hmac
+import random
 import uuid
-from common.clients import get_db_client
+from concurrent.futures import ThreadPoolExecutor
+import flask
+from common.cache import TTLCache
+from common.clients import get_db_client, get_all_in_chunks, get_secret
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
@@ -52,6 +59,22 @@ class VoucherUpdateRequest(BaseModel):
     description: Optional[str] = Field(None, max_length=500, description="Voucher description")
     is_active: Optional[bool] = Field(None, description="Whether the voucher is active")
 
+class VoucherBulkCreateRequest(BaseModel):
+    """Request model for generating a batch of single-use vouchers."""
+    count: int = Field(..., gt=0, le=50000, description="Number of vouchers to generate")
+    prefix: Optional[str] = Field(None, min_length=1, max_length=12, description="Code prefix, e.g. the partner name")
+    discount_percentage: float = Field(..., gt=0, le=100, description="Discount percentage (0-100)")
+    expiration_date: Optional[datetime] = Field(None, description="Expiration date")
+    description: Optional[str] = Field(None, max_length=500, description="Voucher description")
+    is_active: bool = Field(True, description="Whether the vouchers are active")
+
+    @field_validator('prefix')
+    def validate_prefix(cls, v):
+        """Validate code prefix format."""
+        if v is not None and not v.isalnum():
+            raise ValueError('Voucher code prefix can only contain letters and numbers')
+        return v.upper() if v else v
+
 def logic_create_voucher(request):
     """Create a new voucher (admin only).
 
@@ -137,7 +160,12 @@ def logic_create_voucher(request):
             'updatedAt': firestore.SERVER_TIMESTAMP
         }
 
-        voucher_ref.set(voucher_doc)
+        # Create the voucher together with its usage shards
+        batch = db.batch()
+        voucher_doc['usageShardCount'] = write_usage_shards(batch, voucher_ref, voucher_data.usage_limit)
+        batch.set(voucher_ref, voucher_doc)
+        batch.commit()
+        invalidate_voucher_cache(voucher_data.code)
 
         # Return the created voucher (without sensitive fields)
         response_data = {
@@ -161,6 +189,137 @@ def logic_create_voucher(request):
             'message': 'An internal error occurred'
         }, 500
 
+def logic_create_vouchers_bulk(request):
+    """Generate a batch of single-use vouchers (admin only).
+
+    Handles POST requests for /v1/vouchers/bulk. Codes come from a keyed permutation of a
+    reserved sequence range, so they are unique without existence reads; the vouchers are
+    written in parallel batches and the codes are streamed back as CSV. A code that matches a
+    hand-made voucher is skipped, and a batch that fails leaves out its codes (207).
+
+    Args:
+        request (flask.Request): The Flask request object.
+            - Expects JSON body containing count, discount_percentage and optional prefix,
+              expiration_date, description and is_active.
+            - Expects 'user_id' attribute attached by an auth wrapper.
+
+    Returns:
+        flask.Response: CSV of the created codes (201, or 207 if some batches failed), or
+        tuple: (response_body_dict, status_code) on error
+    """
+    try:
+        # Get and validate request body
+        try:
+            body = request.get_json()
+        except Exception:
+            return {
+                'error': 'InvalidJSON',
+                'message': 'Request body must be valid JSON'
+            }, 400
+
+        if not isinstance(body, dict):
+            return {
+                'error': 'InvalidRequest',
+                'message': 'Request body must be a JSON object'
+            }, 400
+
+        try:
+            bulk_request = VoucherBulkCreateRequest(**body)
+        except Exception as e:
+            return {
+                'error': 'ValidationError',
+                'message': str(e)
+            }, 400
+
+        # Get the requesting user ID from the request
+        requesting_user_id = getattr(request, 'end_user_id', None)
+        if not requesting_user_id:
+            return {
+                'error': 'Unauthorized',
+                'message': 'Authentication required'
+            }, 401
+
+        admin_check_request = PermissionCheckRequest(
+            resourceType=TYPE_ORGANIZATION,
+            resourceId="admin",
+            action="manage_vouchers"
+        )
+        has_permission, error_message = check_permission(requesting_user_id, admin_check_request)
+
+        if not has_permission:
+            return {
+                'error': 'Forbidden',
+                'message': 'Admin privileges required to create vouchers'
+            }, 403
+
+        try:
+            secret = get_secret('VOUCHER_CODE_SECRET').encode('utf-8')
+        except KeyError:
+            logging.error("VOUCHER_CODE_SECRET is not configured; cannot generate voucher codes")
+            return {
+                'error': 'ConfigurationError',
+                'message': 'Voucher code generation is not configured'
+            }, 500
+
+        batch_id = str(uuid.uuid4())
+        start = _reserve_voucher_sequence(bulk_request.count)
+        codes = [_bulk_voucher_code(bulk_request.prefix, sequence, secret) for sequence in range(start, start + bulk_request.count)]
+        voucher_template = {
+            'discountPercentage': bulk_request.discount_percentage,
+            'expirationDate': bulk_request.expiration_date,
+            'usageLimit': 1,
+            'usageCount': 0,
+            'description': bulk_request.description,
+            'isActive': bulk_request.is_active,
+            'batchId': batch_id,
+            'createdBy': requesting_user_id,
+            'createdAt': firestore.SERVER_TIMESTAMP,
+            'updatedAt': firestore.SERVER_TIMESTAMP
+        }
+
+        chunks = [codes[i:i + VOUCHER_BULK_VOUCHERS_PER_BATCH] for i in range(0, len(codes), VOUCHER_BULK_VOUCHERS_PER_BATCH)]
+        with ThreadPoolExecutor(max_workers=VOUCHER_BULK_WRITE_CONCURRENCY) as pool:
+            results = list(pool.map(lambda chunk: _write_voucher_batch(chunk, voucher_template), chunks))
+        created = [code for created_codes, _, _ in results for code in created_codes]
+        skipped_count = sum(len(skipped_codes) for _, skipped_codes, _ in results)
+        failed_count = len(codes) - len(created) - skipped_count
+        failed_batches = sum(1 for _, _, error in results if error)
+        if failed_batches:
+            logging.error(f"Bulk voucher batch {batch_id}: {failed_batches} of {len(chunks)} write batches failed")
+        if not created:
+            return {
+                'error': 'InternalError',
+                'message': f'{failed_batches} of {len(chunks)} voucher write batches failed',
+                'batchId': batch_id,
+                'createdCount': 0,
+                'skippedCount': skipped_count
+            }, 500
+
+        logging.info(f"Bulk voucher batch {batch_id}: created {len(created)} of {len(codes)} vouchers for user {requesting_user_id}")
+        expiration = bulk_request.expiration_date.isoformat() if bulk_request.expiration_date else ''
+
+        def generate_csv():
+            yield 'code,discountPercentage,expirationDate\n'
+            for start in range(0, len(created), VOUCHER_BULK_VOUCHERS_PER_BATCH):
+                yield ''.join(f'{code},{bulk_request.discount_percentage},{expiration}\n'
+                              for code in created[start:start + VOUCHER_BULK_VOUCHERS_PER_BATCH])
+
+        # Vouchers already written stay valid, so a partial result still returns their codes
+        return flask.Response(generate_csv(), status=207 if failed_count else 201, mimetype='text/csv', headers={
+            'Content-Disposition': f'attachment; filename="vouchers-{batch_id}.csv"',
+            'X-Voucher-Batch-Id': batch_id,
+            'X-Voucher-Count': str(len(created)),
+            'X-Voucher-Skipped-Count': str(skipped_count),
+            'X-Voucher-Failed-Count': str(failed_count)
+        })
+
+    except Exception as e:
+        logging.error(f"Error in logic_create_vouchers_bulk: {str(e)}", exc_info=True)
+        return {
+            'error': 'InternalError',
+            'message': 'An internal error occurred'
+        }, 500
+
 def logic_get_voucher(request, voucher_id):
     """Retrieve a voucher's details.
 
@@ -216,7 +375,7 @@ def logic_get_voucher(request, voucher_id):
             response_data.update({
                 'expirationDate': voucher_data['expirationDate'].isoformat() if voucher_data.get('expirationDate') else None,
                 'usageLimit': voucher_data['usageLimit'],
-                'usageCount': voucher_data['usageCount'],
+                'usageCount': get_voucher_usage_count(db, voucher_ref, voucher_data),
                 'createdBy': voucher_data['createdBy'],
                 'createdAt': voucher_data['createdAt'].isoformat() if voucher_data.get('createdAt') else None,
                 'updatedAt': voucher_data['updatedAt'].isoformat() if voucher_data.get('updatedAt') else None
@@ -312,15 +471,15 @@ def logic_update_voucher(request, voucher_id):
             update_data['discountPercentage'] = voucher_data.discount_percentage
         if voucher_data.expiration_date is not None:
             update_data['expirationDate'] = voucher_data.expiration_date
-        if voucher_data.usage_limit is not None:
-            # Ensure new usage limit is not less than current usage count
-            current_usage = existing_data.get('usageCount', 0)
-            if voucher_data.usage_limit < current_usage:
+        if voucher_data.usage_limit is not None and voucher_data.usage_limit != existing_data.get('usageLimit'):
+            # Checked against the current usage and spread over the usage shards atomically
+            try:
+                resize_voucher_usage_limit(db, voucher_ref, voucher_data.usage_limit)
+            except ValueError as e:
                 return {
                     'error': 'InvalidUsageLimit',
-                    'message': f'Usage limit cannot be less than current usage count ({current_usage})'
+                    'message': str(e)
                 }, 400
-            update_data['usageLimit'] = voucher_data.usage_limit
         if voucher_data.description is not None:
             update_data['description'] = voucher_data.description
         if voucher_data.is_active is not None:
@@ -328,6 +487,7 @@ def logic_update_voucher(request, voucher_id):
 
         # Update voucher
         voucher_ref.update(update_data)
+        invalidate_voucher_cache(voucher_id)
 
         # Fetch updated voucher for response
         updated_voucher = voucher_ref.get()
@@ -340,7 +500,7 @@ def logic_update_voucher(request, voucher_id):
             'discountPercentage': updated_data['discountPercentage'],
             'expirationDate': updated_data['expirationDate'].isoformat() if updated_data.get('expirationDate') else None,
             'usageLimit': updated_data['usageLimit'],
-            'usageCount': updated_data['usageCount'],
+            'usageCount': get_voucher_usage_count(db, voucher_ref, updated_data),
             'description': updated_data.get('description'),
             'isActive': updated_data['isActive'],
             'createdBy': updated_data['createdBy'],
@@ -402,8 +562,13 @@ def logic_delete_voucher(request, voucher_id):
                 'message': 'Voucher not found'
             }, 404
 
-        # Delete voucher
-        voucher_ref.delete()
+        # Delete voucher together with its usage shards
+        batch = db.batch()
+        for shard_ref in _usage_shard_refs(voucher_ref, existing_voucher.to_dict().get('usageShardCount') or 0):
+            batch.delete(shard_ref)
+        batch.delete(voucher_ref)
+        batch.commit()
+        invalidate_voucher_cache(voucher_id)
 
         return {
             'message': 'Voucher deleted successfully'
@@ -416,9 +581,43 @@ def logic_delete_voucher(request, voucher_id):
             'message': 'An internal error occurred'
         }, 500
 
+# Voucher metadata is cached per instance for validation (e.g. checking a code as the user
+# types it): known codes for a minute, unknown codes for a shorter time so a newly created
+# voucher is picked up quickly. Writes in this module invalidate the entry on this instance.
+# Only eligibility is decided from the cache; redemption re-reads the voucher and claims a
+# usage slot in a transaction, so usage limits stay exact.
+VOUCHER_CACHE_TTL_SECONDS = 60
+VOUCHER_NEGATIVE_TTL_SECONDS = 30
+VOUCHER_CACHED_FIELDS = ('code', 'isActive', 'expirationDate', 'discountPercentage', 'description',
+                         'usageLimit', 'usageCount', 'usageExhausted')
+_voucher_cache = TTLCache(VOUCHER_CACHE_TTL_SECONDS, max_entries=4096)
+_VOUCHER_NOT_FOUND = 'not-found'
+
+def invalidate_voucher_cache(voucher_code: str):
+    """Drops a voucher from this instance's validation cache."""
+    _voucher_cache.invalidate(voucher_code.upper())
+
+def _voucher_metadata(voucher_code: str):
+    """Returns the cached metadata of a voucher, or None if no such voucher exists."""
+    cached = _voucher_cache.get(voucher_code)
+    if cached is None:
+        voucher_doc = db.collection('vouchers').document(voucher_code).get()
+        if not voucher_doc.exists:
+            _voucher_cache.set(voucher_code, _VOUCHER_NOT_FOUND, VOUCHER_NEGATIVE_TTL_SECONDS)
+            return None
+        voucher_data = voucher_doc.to_dict() or {}
+        cached = {field: voucher_data[field] for field in VOUCHER_CACHED_FIELDS if field in voucher_data}
+        _voucher_cache.set(voucher_code, cached)
+    if cached == _VOUCHER_NOT_FOUND:
+        return None
+    return dict(cached)
+
 def validate_voucher_code(voucher_code: str) -> tuple[bool, Optional[Dict[str, Any]], Optional[str]]:
     """Validate a voucher code and return voucher data if valid.
-    
+
+    Answers from the voucher metadata cache, so repeated checks of the same code (and of
+    codes that cannot exist) do not read Firestore.
+
     Args:
         voucher_code (str): The voucher code to validate
         
@@ -426,13 +625,14 @@ def validate_voucher_code(voucher_code: str) -> tuple[bool, Optional[Dict[str, A
         tuple: (is_valid, voucher_data, error_message)
     """
     try:
-        voucher_ref = db.collection('vouchers').document(voucher_code.upper())
-        voucher_doc = voucher_ref.get()
-
-        if not voucher_doc.exists:
+        voucher_code = voucher_code.strip().upper()
+        # Codes are at most 50 letters, digits, hyphens and underscores; anything else cannot exist
+        if not voucher_code or len(voucher_code) > 50 or not voucher_code.replace('-', '').replace('_', '').isalnum():
             return False, None, 'Voucher code not found'
 
-        voucher_data = voucher_doc.to_dict()
+        voucher_data = _voucher_metadata(voucher_code)
+        if voucher_data is None:
+            return False, None, 'Voucher code not found'
 
         # Check if voucher is active
         if not voucher_data.get('isActive', False):
@@ -443,14 +643,238 @@ def validate_voucher_code(voucher_code: str) -> tuple[bool, Optional[Dict[str, A
         if expires_at and expires_at.timestamp() < datetime.now(timezone.utc).timestamp():
             return False, None, 'Voucher has expired'
 
-        # Check usage limit
+        # Check usage limit; exact accounting happens when the voucher is redeemed
         usage_limit = voucher_data.get('usageLimit', 0)
         usage_count = voucher_data.get('usageCount', 0)
-        if usage_limit > 0 and usage_count >= usage_limit:
+        if voucher_data.get('usageExhausted') or (usage_limit > 0 and usage_count >= usage_limit):
             return False, None, 'Voucher usage limit reached'
 
         return True, voucher_data, None
 
     except Exception as e:
         logging.error(f"Error validating voucher code: {str(e)}", exc_info=True)
-        return False, None, 'Error validating voucher' 
\ No newline at end of file
+        return False, None, 'Error validating voucher' 
+
+# Voucher usage is counted on shard documents under vouchers/{code}/usageShards rather than on
+# the voucher document, so concurrent redemptions of one popular voucher write to different
+# documents. Each shard holds a fixed share of usageLimit (its capacity); a redemption claims
+# a slot on one shard in a transaction, which keeps the total exact. usageCount on the voucher
+# document is the usage from before sharding and is no longer written by redemptions.
+VOUCHER_USAGE_SHARD_COUNT = 20
+VOUCHER_USAGE_SHARDS_COLLECTION = 'usageShards'
+VOUCHER_REDEMPTIONS_COLLECTION = 'redemptions'
+
+class VoucherUsageLimitReached(Exception):
+    """Raised when every usage slot of a voucher has been claimed."""
+
+def _usage_shard_capacities(usage_limit, used):
+    """Splits the remaining uses of a voucher over its shards; None capacities mean unlimited."""
+    if not usage_limit:
+        return [None] * VOUCHER_USAGE_SHARD_COUNT
+    remaining = max(usage_limit - used, 0)
+    shard_count = min(VOUCHER_USAGE_SHARD_COUNT, remaining)
+    return [remaining // shard_count + (1 if i < remaining % shard_count else 0) for i in range(shard_count)]
+
+def _usage_shard_refs(voucher_ref, shard_count):
+    shards = voucher_ref.collection(VOUCHER_USAGE_SHARDS_COLLECTION)
+    return [shards.document(str(i)) for i in range(shard_count)]
+
+def write_usage_shards(writer, voucher_ref, usage_limit, used=0):
+    """Adds the shard documents of a voucher to a batch or transaction; returns the shard count."""
+    capacities = _usage_shard_capacities(usage_limit, used)
+    for shard_ref, capacity in zip(_usage_shard_refs(voucher_ref, len(capacities)), capacities):
+        writer.set(shard_ref, {'capacity': capacity, 'used': 0})
+    return len(capacities)
+
+def ensure_usage_shards(db, voucher_ref, voucher_data):
+    """Returns the voucher's shard references, creating the shards for a voucher that predates them."""
+    shard_count = voucher_data.get('usageShardCount')
+    if shard_count is not None:
+        return _usage_shard_refs(voucher_ref, shard_count)
+
+    @firestore.transactional
+    def create_shards(transaction):
+        current = voucher_ref.get(transaction=transaction).to_dict() or {}
+        if current.get('usageShardCount') is not None:
+            return current['usageShardCount']
+        count = write_usage_shards(transaction, voucher_ref, current.get('usageLimit', 0), current.get('usageCount', 0))
+        transaction.update(voucher_ref, {'usageShardCount': count})
+        return count
+
+    return _usage_shard_refs(voucher_ref, create_shards(db.transaction()))
+
+def get_voucher_usage_count(db, voucher_ref, voucher_data):
+    """Returns how many times a voucher has been used: pre-sharding usage plus every shard's count."""
+    used = voucher_data.get('usageCount', 0)
+    shard_count = voucher_data.get('usageShardCount')
+    if shard_count:
+        for shard in db.get_all(_usage_shard_refs(voucher_ref, shard_count)):
+            if shard.exists:
+                used += (shard.to_dict() or {}).get('used', 0)
+    return used
+
+def claim_voucher_use(db, voucher_ref, voucher_data, apply_in_transaction):
+    """Claims one usage slot of a voucher and runs apply_in_transaction(transaction) in the same transaction.
+
+    Shards with free capacity are read with one get_all and tried in random order, so
+    concurrent redemptions spread over the shards. Returns what apply_in_transaction returns.
+
+    Raises:
+        VoucherUsageLimitReached: If no shard has a free slot.
+    """
+    shard_refs = ensure_usage_shards(db, voucher_ref, voucher_data)
+    candidates = []
+    for shard in db.get_all(shard_refs):
+        if not shard.exists:
+            continue
+        shard_data = shard.to_dict() or {}
+        if shard_data.get('capacity') is None or shard_data.get('used', 0) < shard_data['capacity']:
+            candidates.append(shard.reference)
+    random.shuffle(candidates)
+
+    @firestore.transactional
+    def claim(transaction, shard_ref):
+        shard_data = shard_ref.get(transaction=transaction).to_dict() or {}
+        capacity = shard_data.get('capacity')
+        used = shard_data.get('used', 0)
+        if capacity is not None and used >= capacity:
+            return False, None
+        result = apply_in_transaction(transaction)
+        transaction.update(shard_ref, {'used': used + 1})
+        return True, result
+
+    contended = False
+    for shard_ref in candidates:
+        try:
+            claimed, result = claim(db.transaction(), shard_ref)
+        except ValueError as e:
+            # The transaction ran out of retries on a busy shard; try the next one
+            if isinstance(e.__cause__, Aborted):
+                contended = True
+                continue
+            raise
+        if claimed:
+            return result
+    if contended:
+        raise Aborted('Voucher usage shards are contended')
+    # Every slot is taken; flag it so validation can reject the code without summing shards
+    voucher_ref.update({'usageExhausted': True})
+    invalidate_voucher_cache(voucher_ref.id)
+    raise VoucherUsageLimitReached('Voucher usage limit reached')
+
+def resize_voucher_usage_limit(db, voucher_ref, usage_limit):
+    """Sets a new usageLimit and redistributes the unclaimed slots over the voucher's shards.
+
+    Raises:
+        ValueError: If the voucher has already been used more times than usage_limit.
+    """
+    @firestore.transactional
+    def resize(transaction):
+        voucher_data = voucher_ref.get(transaction=transaction).to_dict() or {}
+        shard_count = voucher_data.get('usageShardCount')
+        used = voucher_data.get('usageCount', 0)
+        shards = []
+        if shard_count:
+            for shard_ref in _usage_shard_refs(voucher_ref, shard_count):
+                shard_used = (shard_ref.get(transaction=transaction).to_dict() or {}).get('used', 0)
+                shards.append((shard_ref, shard_used))
+                used += shard_used
+        if usage_limit < used:
+            raise ValueError(f'Usage limit cannot be less than current usage count ({used})')
+        update = {'usageLimit': usage_limit, 'usageExhausted': usage_limit == used}
+        if shard_count == 0:
+            # Provisioned with no slots left; give the new slots fresh shards
+            update['usageShardCount'] = write_usage_shards(transaction, voucher_ref, usage_limit, used)
+        elif shards:
+            remaining = usage_limit - used
+            for i, (shard_ref, shard_used) in enumerate(shards):
+                share = remaining // len(shards) + (1 if i < remaining % len(shards) else 0)
+                transaction.update(shard_ref, {'capacity': shard_used + share})
+        transaction.update(voucher_ref, update)
+
+    resize(db.transaction())
+    invalidate_voucher_cache(voucher_ref.id)
+
+# Bulk-generated codes are PREFIX-XXXXXXXX: eight characters of a 32-symbol alphabet encode a
+# 40-bit value obtained from a sequence number through a keyed Feistel permutation. The
+# permutation is a bijection, so distinct sequence numbers always give distinct codes, and
+# the key (VOUCHER_CODE_SECRET) keeps codes from being guessed from one another.
+VOUCHER_CODE_ALPHABET = '23456789ABCDEFGHJKLMNPQRSTUVWXYZ'  # no 0/O or 1/I
+VOUCHER_CODE_LENGTH = 8
+_VOUCHER_CODE_HALF_BITS = VOUCHER_CODE_LENGTH * 5 // 2
+_VOUCHER_CODE_ROUNDS = 4
+VOUCHER_SEQUENCE_DOC_PATH = 'voucherCodeSequences/bulk'
+# One voucher document plus its usage shard per voucher, so 250 vouchers fill a 500-write batch
+VOUCHER_BULK_VOUCHERS_PER_BATCH = 250
+VOUCHER_BULK_WRITE_CONCURRENCY = 8
+
+def _permute_sequence(sequence, secret):
+    """Maps a sequence number to a unique value of the code space (keyed Feistel network)."""
+    mask = (1 << _VOUCHER_CODE_HALF_BITS) - 1
+    left, right = sequence >> _VOUCHER_CODE_HALF_BITS, sequence & mask
+    for round_index in range(_VOUCHER_CODE_ROUNDS):
+        digest = hmac.new(secret, f'{round_index}:{right}'.encode('utf-8'), hashlib.sha256).digest()
+        left, right = right, left ^ (int.from_bytes(digest[:4], 'big') & mask)
+    return (left << _VOUCHER_CODE_HALF_BITS) | right
+
+def _bulk_voucher_code(prefix, sequence, secret):
+    value = _permute_sequence(sequence, secret)
+    chars = []
+    for _ in range(VOUCHER_CODE_LENGTH):
+        chars.append(VOUCHER_CODE_ALPHABET[value & 31])
+        value >>= 5
+    code = ''.join(reversed(chars))
+    return f'{prefix}-{code}' if prefix else code
+
+def _reserve_voucher_sequence(count):
+    """Reserves count consecutive sequence numbers and returns the first."""
+    sequence_ref = db.document(VOUCHER_SEQUENCE_DOC_PATH)
+
+    @firestore.transactional
+    def reserve(transaction):
+        snapshot = sequence_ref.get(transaction=transaction)
+        start = (snapshot.to_dict() or {}).get('next', 0) if snapshot.exists else 0
+        if start + count > 1 << (VOUCHER_CODE_LENGTH * 5):
+            raise ValueError('Voucher code space exhausted')
+        transaction.set(sequence_ref, {'next': start + count, 'updatedAt': firestore.SERVER_TIMESTAMP})
+        return start
+
+    return reserve(db.transaction())
+
+def _write_voucher_batch(codes, voucher_template):
+    """Creates the vouchers for codes in one write batch.
+
+    A generated code can match a hand-made voucher; create() then fails the whole batch, so the
+    codes that already exist are looked up, skipped and the rest written again.
+
+    Returns:
+        tuple: (created_codes, skipped_codes, error), error being None on success.
+    """
+    codes = list(codes)
+    skipped = []
+    try:
+        while codes:
+            batch = db.batch()
+            for code in codes:
+                voucher_ref = db.collection('vouchers').document(code)
+                voucher_doc = dict(voucher_template, code=code)
+                voucher_doc['usageShardCount'] = write_usage_shards(batch, voucher_ref, 1)
+                # create() rather than set(): never overwrite a hand-made voucher with the same code
+                batch.create(voucher_ref, voucher_doc)
+            try:
+                batch.commit()
+                break
+            except Conflict:
+                refs = [db.collection('vouchers').document(code) for code in codes]
+                existing = {snapshot.id for snapshot in get_all_in_chunks(db, refs) if snapshot.exists}
+                if not existing:
+                    raise
+                logging.warning(f"Skipping {len(existing)} generated voucher codes that already exist: {sorted(existing)}")
+                skipped.extend(code for code in codes if code in existing)
+                codes = [code for code in codes if code not in existing]
+        for code in codes:
+            invalidate_voucher_cache(code)
+        return codes, skipped, None
+    except Exception as e:
+        logging.error(f"Failed to write voucher batch starting at {codes[0]}: {str(e)}", exc_info=True)
+        return [], skipped, e
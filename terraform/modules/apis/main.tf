@@ -45,4 +45,10 @@ resource "google_project_service" "identity_platform" {
   project = var.project_id
   service = "identitytoolkit.googleapis.com"
   disable_on_destroy = false
-} 
\ No newline at end of file
+}
+
+resource "google_project_service" "cloudscheduler" {
+  project = var.project_id
+  service = "cloudscheduler.googleapis.com"
+  disable_on_destroy = false
+}
@@ -26,6 +26,12 @@ locals {
     })
   }
 
+  # Workers invoked by Cloud Scheduler rather than through the API Gateway
+  scheduled_functions = {
+    for k, v in local.functions : k => v
+    if v.schedule != null
+  }
+
   # Create a stable representation of environment variables for hashing
   # by excluding variables that change frequently but don't affect functionality
   stable_env_vars = {
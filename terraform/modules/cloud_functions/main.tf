@@ -136,7 +136,7 @@ resource "google_cloudfunctions2_function" "functions" {
         # Check if the current function is one of the payment-related functions
         # This is a more targeted approach.
         # Alternatively, to apply to ALL functions, remove this conditional logic and just include the map.
-        contains(["relex-backend-create-payment-intent", "relex-backend-get-products", "relex-backend-create-checkout-session", "relex-backend-handle-stripe-webhook", "relex-backend-cancel-subscription"], each.key) ?
+        contains(["relex-backend-create-payment-intent", "relex-backend-get-products", "relex-backend-create-checkout-session", "relex-backend-handle-stripe-webhook", "relex-backend-process-stripe-events", "relex-backend-cancel-subscription"], each.key) ?
         {
          STRIPE_PRICE_ID_INDIVIDUAL_MONTHLY = var.stripe_price_id_individual_monthly
          STRIPE_PRICE_ID_ORG_BASIC_MONTHLY  = var.stripe_price_id_org_basic_monthly
@@ -200,3 +200,41 @@ resource "google_cloud_run_service_iam_member" "invoker" {
 
   depends_on = [google_cloudfunctions2_function.functions]
 }
+
+# Allow the functions service account to invoke the scheduled workers
+resource "google_cloud_run_service_iam_member" "scheduler_invoker" {
+  for_each = local.scheduled_functions
+
+  service  = google_cloudfunctions2_function.functions[each.key].name
+  project  = var.project_id
+  location = var.region
+  role     = "roles/run.invoker"
+  member   = "serviceAccount:${var.functions_service_account_email}"
+
+  depends_on = [google_cloudfunctions2_function.functions]
+}
+
+# Invoke each scheduled worker with an OIDC token of the functions service account
+resource "google_cloud_scheduler_job" "functions" {
+  for_each = local.scheduled_functions
+
+  name      = each.value.name
+  project   = var.project_id
+  region    = var.region
+  schedule  = each.value.schedule
+  time_zone = "Etc/UTC"
+  # Cloud Scheduler allows at most 30 minutes
+  attempt_deadline = "${min(coalesce(each.value.timeout, 60), 1800)}s"
+
+  http_target {
+    http_method = "POST"
+    uri         = google_cloudfunctions2_function.functions[each.key].service_config[0].uri
+
+    oidc_token {
+      service_account_email = var.functions_service_account_email
+      audience              = google_cloudfunctions2_function.functions[each.key].service_config[0].uri
+    }
+  }
+
+  depends_on = [google_cloud_run_service_iam_member.scheduler_invoker]
+}
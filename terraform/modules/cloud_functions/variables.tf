@@ -54,6 +54,8 @@ variable "functions" {
     timeout = optional(number)
     memory  = optional(string)
     max_instances = optional(number)
+    # Cron expression (UTC); workers with a schedule are invoked by Cloud Scheduler
+    schedule = optional(string)
   }))
   default = {
     # Organization Functions
@@ -77,6 +79,24 @@ variable "functions" {
       entry_point = "relex_backend_delete_organization" # Corrected
       env_vars    = {}
     },
+    "relex-backend-get-organization-deletion-status" = {
+      description = "Get the progress of an organization deletion job"
+      entry_point = "relex_backend_get_organization_deletion_status"
+      env_vars    = {}
+    },
+    "relex-backend-run-organization-deletion-jobs" = {
+      description = "Organization deletion worker (run every minute by Cloud Scheduler)"
+      entry_point = "relex_backend_run_organization_deletion_jobs"
+      env_vars    = {}
+      timeout     = 300  # stops starting pages after 4 minutes
+      max_instances = 1
+      schedule    = "* * * * *"
+    },
+    "relex-backend-get-organization-stats" = {
+      description = "Get dashboard statistics for an organization"
+      entry_point = "relex_backend_get_organization_stats"
+      env_vars    = {}
+    },
     "relex-backend-add-organization-member" = {
       description = "Add a member to an organization account"
       entry_point = "relex_backend_add_organization_member" # Updated to use member naming
@@ -159,6 +179,21 @@ variable "functions" {
         }
       ]
     },
+    "relex-backend-process-stripe-events" = {
+      description = "Retry Stripe webhook events that failed or were left unprocessed (run by Cloud Scheduler)"
+      entry_point = "relex_backend_process_stripe_events"
+      env_vars    = {}
+      secret_env_vars = [
+        {
+          key     = "STRIPE_SECRET_KEY"
+          secret  = "stripe-secret-key"
+          version = "latest"
+        }
+      ]
+      timeout     = 300
+      max_instances = 1
+      schedule    = "*/5 * * * *"
+    },
     "relex-backend-cancel-subscription" = {
       description = "Cancel a Stripe subscription"
       entry_point = "relex_backend_cancel_subscription" # Matched main.py
@@ -282,6 +317,20 @@ variable "functions" {
        env_vars    = {}
      },
 
+    "relex-backend-create-vouchers-bulk" = {
+      description = "Generate a batch of single-use vouchers (admin only)"
+      entry_point = "relex_backend_create_vouchers_bulk"
+      env_vars    = {}
+      secret_env_vars = [
+        {
+          key     = "VOUCHER_CODE_SECRET"
+          secret  = "voucher-code-secret"
+          version = "latest"
+        }
+      ]
+      timeout = 300  # 50k vouchers at the upper limit
+    },
+
     # Planned Functions (not yet implemented in main.py)
     "relex-backend-redeem-voucher" = {
       description = "Redeem a voucher code (planned)"
@@ -318,6 +367,38 @@ variable "functions" {
       ]
       timeout = 500  # 5 minutes
       max_instances = 10
+    },
+    "relex-backend-get-agent-job" = {
+      description = "Get the status and response of a queued agent turn"
+      entry_point = "relex_backend_get_agent_job"
+      env_vars    = {}
+    },
+    "relex-backend-run-agent-jobs" = {
+      description = "Agent job worker (run every minute by Cloud Scheduler)"
+      entry_point = "relex_backend_run_agent_jobs"
+      env_vars = {
+        VERTEX_AI_LOCATION = "global"
+      }
+      secret_env_vars = [
+        {
+          key     = "GEMINI_API_KEY"
+          secret  = "gemini-api-key"
+          version = "latest"
+        },
+        {
+          key     = "GROK_API_KEY"
+          secret  = "grok-api-key"
+          version = "latest"
+        },
+        {
+          key     = "EXA_API_KEY"
+          secret  = "exa-api-key"
+          version = "latest"
+        }
+      ]
+      timeout = 540  # stops starting jobs after 4 minutes; a started turn may take 5 more
+      max_instances = 5  # at most 5 x AGENT_JOB_WORKER_CONCURRENCY jobs at once
+      schedule    = "* * * * *"
     }
 
 
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Load test for the agent endpoint: concurrent turns per instance in the synchronous Flask
+worker versus the async serving mode (agent_asgi.py).
+
+Both servers run the real request path: authentication from the API Gateway userinfo
+header, the case lookup and access check (against an in-memory Firestore) and
+agent.run_agent_turn. The agent graph is replaced by one that makes a few sequential
+Gemini REST calls to a local stand-in with a fixed latency, standing in for the LLM and
+research waits of a real turn.
+
+The Flask worker serves each request on one of a fixed number of threads, like the
+threaded worker behind a Cloud Function; the ASGI app runs under uvicorn on one event
+loop. Many clients send turns at once and the peak number of turns in flight is recorded.
+
+Runs offline:
+
+    python -m tests.benchmarks.bench_agent_asgi_concurrency --turns 400 --clients 200 --threads 8
+"""
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import io
+import json
+import logging
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import uvicorn
+from werkzeug.serving import BaseWSGIServer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../functions/src')))
+os.environ.setdefault("GEMINI_API_KEY", "benchmark-key")
+
+from flask import Flask, request as flask_request  # noqa: E402
+
+import agent  # noqa: E402
+import agent_asgi  # noqa: E402
+import gemini_direct  # noqa: E402
+from auth import get_authenticated_user  # noqa: E402
+from common import async_runtime  # noqa: E402
+from tests.helpers import fake_firestore  # noqa: E402
+from tests.benchmarks.bench_agent_event_loop import _GeminiStubServer  # noqa: E402
+
+
+class _ModelCallingGraph:
+    """Stands in for AgentGraph: a turn is a few sequential model calls."""
+    calls = 3
+    lock = threading.Lock()
+    in_flight = 0
+    peak = 0
+
+    async def execute(self, state, checkpoint_ref=None):
+        cls = type(self)
+        with cls.lock:
+            cls.in_flight += 1
+            cls.peak = max(cls.peak, cls.in_flight)
+        try:
+            for _ in range(cls.calls):
+                await gemini_direct.gemini_generate_rest(prompt=state.case_details["input"])
+            return {"response": {"content": "ok"}}
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+
+class _ThreadPoolWSGIServer(BaseWSGIServer):
+    """A WSGI server with a fixed number of request threads."""
+    request_queue_size = 4096
+
+    def __init__(self, host, port, app, threads):
+        super().__init__(host, port, app)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def _flask_app():
+    app = Flask(__name__)
+
+    # Same steps as main.relex_backend_agent_handler with inject_user_context
+    @app.route("/", methods=["POST"])
+    def agent_handler():
+        auth_context, status_code, error_message = get_authenticated_user(flask_request)
+        if error_message or not auth_context:
+            return {"error": "Unauthorized", "message": error_message}, status_code or 401
+        flask_request.end_user_id = auth_context.firebase_user_id
+        return agent.handle_agent_request(flask_request)
+
+    return app
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def _flask_server(threads):
+    server = _ThreadPoolWSGIServer("127.0.0.1", _free_port(), _flask_app(), threads)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+        server.pool.shutdown(wait=True)
+
+
+@contextlib.contextmanager
+def _asgi_server():
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(agent_asgi.app, host="127.0.0.1", port=port, log_level="warning",
+                                           backlog=4096, lifespan="off"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+async def _load(url, turns, clients):
+    headers = {"X-Endpoint-API-Userinfo": base64.b64encode(json.dumps({"sub": "user-1"}).encode()).decode()}
+    durations = []
+    statuses = []
+    queue = iter(range(turns))
+
+    async def client(session):
+        for i in queue:
+            started = time.perf_counter()
+            async with session.post(f"{url}/?caseId=case-1", json={"message": f"question {i}"}, headers=headers) as response:
+                await response.read()
+                statuses.append(response.status)
+            durations.append(time.perf_counter() - started)
+
+    connector = aiohttp.TCPConnector(limit=clients)
+    timeout = aiohttp.ClientTimeout(total=600)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(client(session) for _ in range(clients)))
+        elapsed = time.perf_counter() - started
+    return durations, statuses, elapsed
+
+
+def _run(label, server, turns, clients):
+    _ModelCallingGraph.peak = 0
+    with server as url:
+        # gemini_generate_rest prints every raw response
+        with contextlib.redirect_stdout(io.StringIO()):
+            durations, statuses, elapsed = asyncio.run(_load(url, turns, clients))
+    durations.sort()
+    return {
+        "label": label,
+        "ok": sum(1 for status in statuses if status == 200),
+        "peak": _ModelCallingGraph.peak,
+        "mean_ms": statistics.mean(durations) * 1000,
+        "p95_ms": durations[int(len(durations) * 0.95) - 1] * 1000,
+        "turns_per_s": turns / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=400)
+    parser.add_argument("--clients", type=int, default=200, help="concurrent clients sending turns")
+    parser.add_argument("--threads", type=int, default=8, help="request threads in the Flask worker")
+    parser.add_argument("--calls-per-turn", type=int, default=3)
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="simulated model latency per call")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    _GeminiStubServer.request_queue_size = 4096
+    gemini = _GeminiStubServer(("127.0.0.1", 0), args.latency_ms / 1000)
+    threading.Thread(target=gemini.serve_forever, daemon=True).start()
+    host, port = gemini.server_address[:2]
+    gemini_direct.GEMINI_API_URL = f"http://{host}:{port}/v1beta/models/{{model}}:generateContent"
+
+    db = fake_firestore.FakeFirestore()
+    db.collection("cases").document("case-1").set({"userId": "user-1", "title": "Lease dispute"})
+    agent.get_db_client = lambda: db
+    agent.get_agent_graph = _ModelCallingGraph
+    _ModelCallingGraph.calls = args.calls_per_turn
+
+    results = [
+        _run(f"Flask worker, {args.threads} threads", _flask_server(args.threads), args.turns, args.clients),
+        _run("ASGI app, one event loop", _asgi_server(), args.turns, args.clients),
+    ]
+    async_runtime.shutdown()
+    gemini.shutdown()
+
+    print(f"{args.turns} turns from {args.clients} concurrent clients; each turn makes {args.calls_per_turn} "
+          f"model calls of {args.latency_ms:g} ms")
+    print(f"{'mode':<28} {'ok':>5} {'peak in flight':>15} {'mean ms':>9} {'p95 ms':>9} {'turns/s':>8}")
+    for result in results:
+        print(f"{result['label']:<28} {result['ok']:>5} {result['peak']:>15} {result['mean_ms']:>9.0f} "
+              f"{result['p95_ms']:>9.0f} {result['turns_per_s']:>8.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
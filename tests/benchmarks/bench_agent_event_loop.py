@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Measures the per-request overhead of running agent coroutines with asyncio.run versus the
+instance's long-lived background loop (common/async_runtime.py).
+
+Each simulated agent turn makes a few sequential Gemini REST calls (gemini_generate_rest)
+against a local stand-in server, from several handler threads at once. With asyncio.run
+every turn builds a new loop and HTTP session and opens new connections; on the background
+loop the session and its keep-alive connections are reused. An empty coroutine is also
+timed to show the bare cost of creating a loop.
+
+Runs offline:
+
+    python -m tests.benchmarks.bench_agent_event_loop --turns 200 --calls-per-turn 3 --latency-ms 5
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../functions/src')))
+os.environ.setdefault("GEMINI_API_KEY", "benchmark-key")
+
+from common import async_runtime  # noqa: E402
+import gemini_direct  # noqa: E402
+
+
+class _GeminiStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, latency_seconds):
+        super().__init__(address, _GeminiStubHandler)
+        self.latency_seconds = latency_seconds
+        self.lock = threading.Lock()
+        self.connections = 0
+
+
+class _GeminiStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.server.latency_seconds:
+            time.sleep(self.server.latency_seconds)
+        payload = json.dumps({"candidates": [{"content": {"parts": [{"text": "ok"}]}}]}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+async def _agent_turn(calls):
+    for _ in range(calls):
+        await gemini_direct.gemini_generate_rest(prompt="Summarize the case.")
+
+
+async def _noop():
+    return None
+
+
+def _per_request_loop(coro):
+    return asyncio.run(coro)
+
+
+def _run(label, runner, make_coro, server, turns, concurrency):
+    connections_before = server.connections
+    durations = []
+
+    def _one(_):
+        started = time.perf_counter()
+        runner(make_coro())
+        durations.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    # gemini_generate_rest prints every raw response
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(_one, range(turns)))
+    elapsed = time.perf_counter() - started
+    durations.sort()
+    return {
+        "label": label,
+        "mean_ms": statistics.mean(durations) * 1000,
+        "p95_ms": durations[int(len(durations) * 0.95) - 1] * 1000,
+        "turns_per_s": turns / elapsed,
+        "connections": server.connections - connections_before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--calls-per-turn", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=8, help="handler threads submitting turns")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="simulated model latency per call")
+    args = parser.parse_args()
+
+    server = _GeminiStubServer(("127.0.0.1", 0), args.latency_ms / 1000)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    gemini_direct.GEMINI_API_URL = f"http://{host}:{port}/v1beta/models/{{model}}:generateContent"
+
+    results = [
+        _run("empty coroutine, asyncio.run per request", _per_request_loop, _noop, server, args.turns, args.concurrency),
+        _run("empty coroutine, background loop", async_runtime.run_coroutine, _noop, server, args.turns, args.concurrency),
+        _run("agent turn, asyncio.run per request", _per_request_loop,
+             lambda: _agent_turn(args.calls_per_turn), server, args.turns, args.concurrency),
+        _run("agent turn, background loop", async_runtime.run_coroutine,
+             lambda: _agent_turn(args.calls_per_turn), server, args.turns, args.concurrency),
+    ]
+    async_runtime.shutdown()
+    server.shutdown()
+
+    print(f"{args.turns} requests from {args.concurrency} threads; agent turns make {args.calls_per_turn} "
+          f"model calls of {args.latency_ms:g} ms")
+    print(f"{'mode':<42} {'mean ms':>8} {'p95 ms':>8} {'req/s':>7} {'conns':>6}")
+    for result in results:
+        print(f"{result['label']:<42} {result['mean_ms']:>8.2f} {result['p95_ms']:>8.2f} "
+              f"{result['turns_per_s']:>7.0f} {result['connections']:>6}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
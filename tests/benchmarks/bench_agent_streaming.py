@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Measures time to first byte and to the first model token of an agent turn, with and
+without server-sent event streaming (Accept: text/event-stream), on the ASGI app.
+
+The turn runs the real AgentGraph with stand-in nodes: quota and analysis are instant,
+research waits a fixed time (Exa), guidance asks a local Gemini stand-in that produces
+its answer in chunks at a fixed rate, and the response node is instant. Without streaming
+nothing reaches the client before the whole turn is done; with it the first node event
+is sent right away and tokens as the model produces them.
+
+Runs offline:
+
+    python -m tests.benchmarks.bench_agent_streaming --turns 20 --research-ms 800 --chunks 20 --chunk-ms 50
+"""
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import io
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aiohttp
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../functions/src')))
+os.environ.setdefault("GEMINI_API_KEY", "benchmark-key")
+
+import agent  # noqa: E402
+import gemini_direct  # noqa: E402
+from agent_orchestrator import AgentGraph  # noqa: E402
+from common import async_runtime  # noqa: E402
+from tests.helpers import fake_firestore  # noqa: E402
+from tests.benchmarks.bench_agent_asgi_concurrency import _asgi_server  # noqa: E402
+
+
+class _GeminiChunkServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, chunks, chunk_seconds):
+        super().__init__(address, _GeminiChunkHandler)
+        self.chunks = chunks
+        self.chunk_seconds = chunk_seconds
+
+
+class _GeminiChunkHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        texts = [f"token{i} " for i in range(self.server.chunks)]
+        if ":streamGenerateContent" not in self.path:
+            time.sleep(self.server.chunk_seconds * self.server.chunks)
+            self._send(200, "application/json", json.dumps(
+                {"candidates": [{"content": {"parts": [{"text": "".join(texts)}]}}]}).encode("utf-8"))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for text in texts:
+            time.sleep(self.server.chunk_seconds)
+            chunk = {"candidates": [{"content": {"parts": [{"text": text}]}}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\r\n\r\n".encode("utf-8"))
+            self.wfile.flush()
+        self.close_connection = True
+
+    def _send(self, status, content_type, payload):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def _graph(research_seconds):
+    graph = AgentGraph()
+
+    async def instant(state):
+        return {"status": "success"}
+
+    async def research(state):
+        await asyncio.sleep(research_seconds)
+        return {"status": "success"}
+
+    async def guidance(state):
+        return {"status": "success", "guidance": await gemini_direct.gemini_generate_rest(prompt=state.case_details["input"])}
+
+    async def respond(state):
+        return {"status": "success", "response": state.ai_guidance["guidance"]}
+
+    graph._check_quota_node = instant
+    graph._analyze_input_node = instant
+    graph._research_node = research
+    graph._guidance_node = guidance
+    graph._generate_response_node = respond
+    return graph
+
+
+async def _turns(url, turns, stream):
+    headers = {"X-Endpoint-API-Userinfo": base64.b64encode(json.dumps({"sub": "user-1"}).encode()).decode()}
+    if stream:
+        headers["Accept"] = "text/event-stream"
+    results = []
+    async with aiohttp.ClientSession() as session:
+        for i in range(turns):
+            started = time.perf_counter()
+            first_byte = first_token = None
+            async with session.post(f"{url}/?caseId=case-1", json={"message": f"question {i}"}, headers=headers) as response:
+                async for chunk in response.content.iter_any():
+                    now = time.perf_counter() - started
+                    first_byte = first_byte if first_byte is not None else now
+                    if first_token is None and (b"event: token" in chunk or not stream):
+                        first_token = now
+            results.append((first_byte, first_token, time.perf_counter() - started))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--research-ms", type=float, default=800.0)
+    parser.add_argument("--chunks", type=int, default=20, help="chunks in the model's answer")
+    parser.add_argument("--chunk-ms", type=float, default=50.0, help="time the model takes per chunk")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    gemini = _GeminiChunkServer(("127.0.0.1", 0), args.chunks, args.chunk_ms / 1000)
+    threading.Thread(target=gemini.serve_forever, daemon=True).start()
+    host, port = gemini.server_address[:2]
+    gemini_direct.GEMINI_API_URL = f"http://{host}:{port}/v1beta/models/{{model}}:generateContent"
+    gemini_direct.GEMINI_STREAM_API_URL = f"http://{host}:{port}/v1beta/models/{{model}}:streamGenerateContent"
+
+    db = fake_firestore.FakeFirestore()
+    db.collection("cases").document("case-1").set({"userId": "user-1", "title": "Lease dispute"})
+    agent.get_db_client = lambda: db
+    graph = _graph(args.research_ms / 1000)
+    agent.get_agent_graph = lambda: graph
+
+    rows = []
+    with _asgi_server() as url:
+        for label, stream in (("JSON response", False), ("event stream", True)):
+            # gemini_generate_rest prints every raw (unstreamed) response
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = asyncio.run(_turns(url, args.turns, stream))
+            rows.append((label, *(statistics.median(values) * 1000 for values in zip(*results))))
+    async_runtime.shutdown()
+    gemini.shutdown()
+
+    print(f"{args.turns} sequential turns; research {args.research_ms:g} ms, model answer {args.chunks} chunks "
+          f"of {args.chunk_ms:g} ms (medians)")
+    print(f"{'mode':<15} {'first byte ms':>14} {'first token ms':>15} {'complete ms':>12}")
+    for label, first_byte, first_token, total in rows:
+        print(f"{label:<15} {first_byte:>14.0f} {first_token:>15.0f} {total:>12.0f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Drives create_checkout_session against the local Stripe stand-in server.
+
+Runs the checkout path from concurrent threads three ways: with a fresh connection per
+Stripe call (no pooling), with the shared pooled client, and with the shared client while
+the stand-in fails a share of requests with 503s. Each run has its own buyers, a share of
+whom click twice, as concurrent duplicates or after the first session is open. Reports
+latency, connections opened, sessions handed back to repeated clicks, and whether any
+retried or duplicate create produced an extra Checkout Session.
+
+Runs offline against an in-memory Firestore:
+
+    python -m tests.benchmarks.bench_stripe_checkout --checkouts 500 --stripe-latency-ms 20
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../functions/src')))
+os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "demo-benchmark")
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:1")
+os.environ.setdefault("STORAGE_EMULATOR_HOST", "http://localhost:1")
+
+import flask  # noqa: E402
+import requests  # noqa: E402
+import stripe  # noqa: E402
+
+from common import clients  # noqa: E402
+import payments  # noqa: E402
+import plans  # noqa: E402
+from tests.helpers import fake_firestore  # noqa: E402
+from tests.benchmarks.stripe_stub_server import StripeStubServer  # noqa: E402
+
+
+class _UnpooledSession(requests.Session):
+    """Closes the connection after every request, like a client without keep-alive."""
+
+    def request(self, method, url, **kwargs):
+        headers = dict(kwargs.pop("headers", None) or {})
+        headers["Connection"] = "close"
+        return super().request(method, url, headers=headers, **kwargs)
+
+
+def _checkout_request(run, buyer):
+    request = MagicMock()
+    request.get_json.return_value = {"amount": 4900, "productName": f"Benchmark case {buyer}"}
+    request.end_user_id = f"user_{run}_{buyer}"
+    return request
+
+
+def _run(label, server, checkouts, concurrency, repeat_rate):
+    app = flask.Flask(__name__)
+    connections_before, created_before = server.connections, server.created
+    failures_before = server.injected_failures
+    # Every buyer is distinct across runs; a share of them send their checkout twice
+    buyers = list(range(checkouts))
+    buyers += random.sample(buyers, int(checkouts * repeat_rate))
+    random.shuffle(buyers)
+
+    def _one(buyer):
+        with app.app_context():
+            started = time.perf_counter()
+            response, status_code = payments.create_checkout_session(_checkout_request(label, buyer))
+            return (time.perf_counter() - started) * 1000, status_code, buyer, response.get_json()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(_one, buyers))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, _, _, _ in results)
+    succeeded = [(buyer, body) for _, status_code, buyer, body in results if status_code in (200, 201)]
+    reused = sum(1 for _, status_code, _, _ in results if status_code == 200)
+    sessions = {body["checkoutSessionId"] for _, body in succeeded}
+    buyers_served = {buyer for buyer, _ in succeeded}
+    created = server.created - created_before
+    print(f"{label}:")
+    print(f"  {len(succeeded)}/{len(buyers)} checkouts in {elapsed:.2f}s ({len(buyers) / elapsed:.0f}/s)  "
+          f"p50 {statistics.median(latencies):.1f} ms  p99 {latencies[int(len(latencies) * 0.99) - 1]:.1f} ms")
+    print(f"  {server.connections - connections_before} connections opened, "
+          f"{server.injected_failures - failures_before} injected failures, "
+          f"{reused} open sessions handed back to repeated clicks")
+    print(f"  {created} sessions created for {len(buyers_served)} buyers served")
+    # Every click gets a session, and each buyer exactly one
+    return len(succeeded) == len(buyers) and created == len(sessions) == len(buyers_served)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkouts", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--stripe-latency-ms", type=float, default=10.0, help="simulated Stripe processing time")
+    parser.add_argument("--failure-rate", type=float, default=0.1, help="share of requests failed in the last run")
+    parser.add_argument("--repeat-rate", type=float, default=0.1, help="share of buyers who click twice")
+    parser.add_argument("--latency-ms", type=float, default=1.0, help="simulated Firestore round-trip latency")
+    args = parser.parse_args()
+
+    server = StripeStubServer(("127.0.0.1", 0), latency_seconds=args.stripe_latency_ms / 1000).start()
+    os.environ["STRIPE_API_BASE"] = server.api_base
+    os.environ["STRIPE_SECRET_KEY"] = "sk_test_benchmark"
+    os.environ.pop("RELEX_TEST_MODE", None)
+
+    db = fake_firestore.FakeFirestore(latency_seconds=args.latency_ms / 1000)
+    payments.get_db_client = lambda: db
+    plans.get_db_client = lambda: db
+    payments.firestore.transactional = fake_firestore.transactional
+    clients.initialize_stripe()
+    shared_client = stripe.default_http_client
+
+    stripe.default_http_client = stripe.http_client.RequestsClient(session=_UnpooledSession())
+    ok = _run("fresh connection per call", server, args.checkouts, args.concurrency, args.repeat_rate)
+
+    stripe.default_http_client = shared_client
+    ok &= _run("shared pooled client", server, args.checkouts, args.concurrency, args.repeat_rate)
+
+    server.failure_rate = args.failure_rate
+    ok &= _run(f"shared pooled client, {args.failure_rate:.0%} injected 503s", server, args.checkouts,
+               args.concurrency, args.repeat_rate)
+    server.shutdown()
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Replays a burst of synthetic, signed Stripe webhook events through handle_stripe_webhook.
+
+Deliveries are shuffled and a share of them duplicated, the way Stripe retries and
+reorders them. The script reports ingest latency without the inline processing step, then
+processes the recorded events with a pool of workers and checks every subscription ended in
+the state of its newest event.
+
+Runs offline against an in-memory Firestore:
+
+    python -m tests.benchmarks.bench_stripe_webhooks --events 2000 --latency-ms 5
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../functions/src')))
+os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "demo-benchmark")
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:1")
+os.environ.setdefault("STORAGE_EMULATOR_HOST", "http://localhost:1")
+
+import payments  # noqa: E402
+import plans  # noqa: E402
+from tests.helpers import fake_firestore  # noqa: E402
+
+WEBHOOK_SECRET = "whsec_benchmark"
+# Non-terminal statuses only: terminal ones detach the subscription from its user, after
+# which later events for it are expected to find no target.
+STATUSES = ["active", "past_due", "trialing", "incomplete"]
+
+
+def _sign(payload):
+    timestamp = int(time.time())
+    signature = hmac.new(WEBHOOK_SECRET.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def _synthetic_events(count, subscriptions):
+    base = int(time.time()) - count
+    events = []
+    for i in range(count):
+        sub_id = f"sub_{i % subscriptions}"
+        events.append({
+            "id": f"evt_{i}",
+            "object": "event",
+            "type": "customer.subscription.updated",
+            "created": base + i,
+            "data": {"object": {"object": "subscription", "id": sub_id, "status": random.choice(STATUSES)}},
+        })
+    return events
+
+
+def _expected_status(stripe_status):
+    if stripe_status in ("active", "trialing"):
+        return "active"
+    return "past_due"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=1000)
+    parser.add_argument("--subscriptions", type=int, default=50)
+    parser.add_argument("--duplicate-rate", type=float, default=0.2)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=2.0, help="simulated Firestore round-trip latency")
+    args = parser.parse_args()
+
+    db = fake_firestore.FakeFirestore(latency_seconds=args.latency_ms / 1000)
+    payments.get_db_client = lambda: db
+    plans.get_db_client = lambda: db
+    payments.initialize_stripe = lambda: None
+    payments.firestore.transactional = fake_firestore.transactional
+    os.environ["STRIPE_WEBHOOK_SECRET"] = WEBHOOK_SECRET
+    process_stripe_event = payments.process_stripe_event
+    started_workers = []
+    # Defer the processing the webhook does before acknowledging, to time it separately below
+    payments.process_stripe_event = started_workers.append
+
+    for i in range(args.subscriptions):
+        db.collection("users").document(f"user_{i}").set({"stripeSubscriptionId": f"sub_{i}"})
+
+    events = _synthetic_events(args.events, args.subscriptions)
+    deliveries = events + random.sample(events, int(len(events) * args.duplicate_rate))
+    random.shuffle(deliveries)
+
+    latencies = []
+    duplicates = 0
+    for event in deliveries:
+        payload = json.dumps(event)
+        request = MagicMock()
+        request.data = payload.encode("utf-8")
+        request.headers = {"Stripe-Signature": _sign(payload)}
+        started = time.perf_counter()
+        response, status_code = payments.handle_stripe_webhook(request)
+        latencies.append((time.perf_counter() - started) * 1000)
+        assert status_code == 200, response
+        duplicates += response["message"].startswith("Duplicate")
+
+    latencies.sort()
+    print(f"ingest: {len(deliveries)} deliveries ({duplicates} duplicates acknowledged)")
+    print(f"  p50 {statistics.median(latencies):.2f} ms  p99 {latencies[int(len(latencies) * 0.99) - 1]:.2f} ms")
+
+    # Drain in delivery order, i.e. out of Stripe order, with concurrent workers
+    round_trips_before = db.round_trips
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        processed = sum(pool.map(process_stripe_event, started_workers))
+    elapsed = time.perf_counter() - started
+    print(f"process: {processed} events applied in {elapsed:.2f}s "
+          f"({processed / elapsed:.0f} events/s, {(db.round_trips - round_trips_before) / max(processed, 1):.1f} round trips/event)")
+
+    newest = {}
+    for event in events:
+        sub = event["data"]["object"]
+        if sub["id"] not in newest or event["created"] > newest[sub["id"]]["created"]:
+            newest[sub["id"]] = {"created": event["created"], "status": sub["status"]}
+    mismatches = 0
+    for i in range(args.subscriptions):
+        user = db.collection("users").document(f"user_{i}").get().to_dict()
+        expected = newest.get(f"sub_{i}")
+        if expected and user.get("subscriptionStatus") != _expected_status(expected["status"]):
+            mismatches += 1
+    print(f"ordering: {mismatches} subscriptions out of {args.subscriptions} not at their newest event's state")
+    return 1 if mismatches or processed != len(events) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
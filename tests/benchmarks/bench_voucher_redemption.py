@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Measures voucher redemption throughput as concurrent clients increase.
+
+Every client redeems the same campaign voucher for a different user through
+logic_redeem_voucher. Each level runs twice: with a single usage shard (all redemptions
+write one document, as before sharding) and with the configured shard count. The voucher
+is oversubscribed, so the run also checks that no more than usageLimit redemptions succeed
+and that the shard counts match the successful redemptions exactly.
+
+Runs offline against an in-memory Firestore with optimistic transactions:
+
+    python -m tests.benchmarks.bench_voucher_redemption --clients 1 4 16 32 --latency-ms 5
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../functions/src')))
+os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "demo-benchmark")
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:1")
+os.environ.setdefault("STORAGE_EMULATOR_HOST", "http://localhost:1")
+
+import payments  # noqa: E402
+import vouchers  # noqa: E402
+from tests.helpers import fake_firestore  # noqa: E402
+
+VOUCHER_CODE = "CAMPAIGN"
+
+
+def _redeem_request(user_id):
+    request = MagicMock()
+    request.get_json.return_value = {"voucherCode": VOUCHER_CODE}
+    request.end_user_id = user_id
+    return request
+
+
+def _run(shard_count, clients, redemptions, usage_limit, latency_seconds):
+    db = fake_firestore.FakeFirestore(latency_seconds=latency_seconds)
+    payments.get_db_client = lambda: db
+    payments.firestore.transactional = fake_firestore.transactional
+    vouchers.VOUCHER_USAGE_SHARD_COUNT = shard_count
+
+    voucher_ref = db.collection("vouchers").document(VOUCHER_CODE)
+    batch = db.batch()
+    shards = vouchers.write_usage_shards(batch, voucher_ref, usage_limit)
+    batch.set(voucher_ref, {
+        "code": VOUCHER_CODE, "isActive": True, "voucherType": "credit", "value": {"amount": 500},
+        "usageLimit": usage_limit, "usageCount": 0, "usageShardCount": shards,
+    })
+    batch.commit()
+    for i in range(redemptions):
+        db.collection("users").document(f"user_{i}").set({"voucherBalance": 0})
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(lambda i: payments.logic_redeem_voucher(_redeem_request(f"user_{i}")), range(redemptions)))
+    elapsed = time.perf_counter() - started
+
+    succeeded = sum(1 for _, status_code in results if status_code == 200)
+    limit_reached = sum(1 for body, status_code in results if status_code == 400 and "limit" in body["message"])
+    voucher_data = voucher_ref.get().to_dict()
+    counted = vouchers.get_voucher_usage_count(db, voucher_ref, voucher_data)
+    return {
+        "rate": succeeded / elapsed,
+        "succeeded": succeeded,
+        "limit_reached": limit_reached,
+        "failed": redemptions - succeeded - limit_reached,
+        "aborts": db.aborted_transactions,
+        "exact": succeeded == counted <= usage_limit,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--redemptions", type=int, default=400)
+    parser.add_argument("--usage-limit", type=int, default=300)
+    parser.add_argument("--shards", type=int, default=vouchers.VOUCHER_USAGE_SHARD_COUNT)
+    parser.add_argument("--latency-ms", type=float, default=2.0, help="simulated Firestore round-trip latency")
+    args = parser.parse_args()
+
+    exact = True
+    print(f"{args.redemptions} redemptions of a voucher with usageLimit {args.usage_limit}")
+    # failed: gave up on contention (409); aborts: transaction commits retried on contention
+    print(f"{'clients':>7} {'shards':>6} {'redeemed/s':>10} {'ok':>5} {'limit':>5} {'failed':>6} {'aborts':>6}")
+    for clients in args.clients:
+        for shard_count in (1, args.shards):
+            result = _run(shard_count, clients, args.redemptions, args.usage_limit, args.latency_ms / 1000)
+            exact = exact and result["exact"]
+            print(f"{clients:>7} {shard_count:>6} {result['rate']:>10.0f} {result['succeeded']:>5} "
+                  f"{result['limit_reached']:>5} {result['failed']:>6} {result['aborts']:>6}")
+    print(f"usage limit enforced exactly: {exact}")
+    return 0 if exact else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for the Stripe API, for benchmarking the payment paths offline.
+
+Answers the handful of endpoints the payments module calls with minimal objects, honours
+Idempotency-Key the way Stripe does (a repeated key replays the first response), and can
+add latency and inject 503s to exercise the client's timeouts and retries. Point the SDK at
+it with STRIPE_API_BASE:
+
+    python -m tests.benchmarks.stripe_stub_server --port 12111
+    STRIPE_API_BASE=http://127.0.0.1:12111 ...
+"""
+
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class StripeStubServer(ThreadingHTTPServer):
+    """Threaded HTTP server holding the stand-in's counters and idempotency records."""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, latency_seconds=0.0, failure_rate=0.0):
+        super().__init__(address, _StripeStubHandler)
+        self.latency_seconds = latency_seconds
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.connections = 0
+        self.requests = 0
+        self.injected_failures = 0
+        self.created = 0
+        self.idempotent_replays = 0
+        self.idempotency_records = {}
+
+    @property
+    def api_base(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name="stripe-stub-server", daemon=True)
+        thread.start()
+        return self
+
+    def next_id(self, prefix):
+        with self.lock:
+            return f"{prefix}_stub{next(self.ids)}"
+
+
+def _list(data):
+    return {"object": "list", "data": data, "has_more": False, "url": "/v1/list"}
+
+
+class _StripeStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so connection reuse is visible in the counters
+    # Headers and body go out in separate writes; without this, Nagle plus delayed ACKs
+    # add ~40 ms to every response on a reused connection.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _handle(self, method):
+        server = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        form = parse_qs(self.rfile.read(length).decode("utf-8")) if length else {}
+        path = urlparse(self.path).path
+        with server.lock:
+            server.requests += 1
+        if server.latency_seconds:
+            time.sleep(server.latency_seconds)
+        if server.failure_rate and random.random() < server.failure_rate:
+            with server.lock:
+                server.injected_failures += 1
+            return self._send(503, {"error": {"type": "api_error", "message": "Injected failure"}})
+
+        key = self.headers.get("Idempotency-Key")
+        if method == "POST" and key:
+            with server.lock:
+                replay = server.idempotency_records.get(key)
+                if replay is not None:
+                    server.idempotent_replays += 1
+            if replay is not None:
+                return self._send(200, replay)
+
+        body = self._route(method, path, form)
+        if body is None:
+            return self._send(404, {"error": {"type": "invalid_request_error", "message": f"No such route: {path}"}})
+        if method == "POST" and key:
+            with server.lock:
+                server.idempotency_records[key] = body
+        return self._send(200, body)
+
+    def _route(self, method, path, form):
+        now = int(time.time())
+        if method == "POST" and path == "/v1/checkout/sessions":
+            with self.server.lock:
+                self.server.created += 1
+            session_id = self.server.next_id("cs")
+            return {"id": session_id, "object": "checkout.session", "status": "open",
+                    "url": f"https://checkout.stripe.test/{session_id}", "expires_at": now + 86400,
+                    "mode": form.get("mode", ["payment"])[0]}
+        if method == "POST" and path == "/v1/payment_intents":
+            with self.server.lock:
+                self.server.created += 1
+            intent_id = self.server.next_id("pi")
+            return {"id": intent_id, "object": "payment_intent", "status": "requires_payment_method",
+                    "client_secret": f"{intent_id}_secret"}
+        if method == "GET" and path in ("/v1/products", "/v1/promotion_codes"):
+            return _list([])
+        match = re.fullmatch(r"/v1/subscriptions/([^/]+)", path)
+        if match:
+            return {"id": match.group(1), "object": "subscription", "status": "active",
+                    "cancel_at_period_end": method == "POST",
+                    "current_period_start": now, "current_period_end": now + 30 * 86400}
+        return None
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=12111)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    server = StripeStubServer(("127.0.0.1", args.port), args.latency_ms / 1000, args.failure_rate)
+    print(f"Stripe stand-in listening on {server.api_base}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
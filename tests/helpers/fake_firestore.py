@@ -0,0 +1,330 @@
+"""
+In-memory stand-in for the parts of the Firestore client the unit tests and benchmarks exercise.
+
+It is deliberately small: documents are plain dicts, transactions are optimistic (a commit
+aborts and the transaction is retried if a document it read has changed since), and an
+optional per-call delay approximates a network round trip so contention and round-trip
+counts show up in timings.
+"""
+
+import copy
+import threading
+import time
+from datetime import datetime, timezone
+
+from firebase_admin import firestore
+from google.api_core.exceptions import Aborted
+from google.cloud.exceptions import Conflict, NotFound
+from google.cloud.firestore_v1 import transforms
+
+
+class _Snapshot:
+    def __init__(self, ref, data):
+        self.reference = ref
+        self.id = ref.id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+def _apply_value(current, value):
+    if value is firestore.SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+    if isinstance(value, transforms.Increment):
+        return (current or 0) + value.value
+    return value
+
+
+def _set_path(data, path, value):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        data = data.setdefault(part, {})
+    if value is firestore.DELETE_FIELD:
+        data.pop(parts[-1], None)
+    else:
+        data[parts[-1]] = _apply_value(data.get(parts[-1]), value)
+
+
+def _merge(data, updates):
+    for key, value in updates.items():
+        if isinstance(value, dict) and isinstance(data.get(key), dict):
+            _merge(data[key], value)
+        elif isinstance(value, dict):
+            data[key] = {}
+            _merge(data[key], value)
+        else:
+            _set_path(data, key, value)
+
+
+class FakeDocumentReference:
+    def __init__(self, store, collection, doc_id):
+        self._store = store
+        self._collection = collection
+        self.id = doc_id
+        self.path = f"{collection}/{doc_id}"
+
+    def _key(self):
+        return (self._collection, self.id)
+
+    def collection(self, name):
+        return FakeCollectionReference(self._store, f"{self.path}/{name}")
+
+    def get(self, transaction=None):
+        self._store.round_trip()
+        with self._store.lock:
+            if transaction is not None:
+                transaction.record_read(self._key(), self._store.versions.get(self._key(), 0))
+            return _Snapshot(self, copy.deepcopy(self._store.docs.get(self._key())))
+
+    def create(self, data):
+        self._store.round_trip()
+        with self._store.lock:
+            if self._key() in self._store.docs:
+                raise Conflict(f"Document already exists: {self.path}")
+            doc = {}
+            _merge(doc, data)
+            self._store.docs[self._key()] = doc
+            self._store.bump_version(self._key())
+
+    def set(self, data, merge=False):
+        self._store.round_trip()
+        self._write_set(data, merge)
+
+    def update(self, data):
+        self._store.round_trip()
+        self._write_update(data)
+
+    def delete(self):
+        self._store.round_trip()
+        self._write_delete()
+
+    def _write_delete(self):
+        with self._store.lock:
+            self._store.docs.pop(self._key(), None)
+            self._store.bump_version(self._key())
+
+    def _write_set(self, data, merge):
+        with self._store.lock:
+            doc = self._store.docs.get(self._key()) if merge else None
+            doc = doc if doc is not None else {}
+            _merge(doc, data)
+            self._store.docs[self._key()] = doc
+            self._store.bump_version(self._key())
+
+    def _write_update(self, data):
+        with self._store.lock:
+            doc = self._store.docs.get(self._key())
+            if doc is None:
+                raise NotFound(f"No document to update: {self.path}")
+            for path, value in data.items():
+                _set_path(doc, path, value)
+            self._store.bump_version(self._key())
+
+
+def _compare(current, op, value):
+    if op == "<":
+        return current < value
+    if op == "<=":
+        return current <= value
+    if op == ">":
+        return current > value
+    return current >= value
+
+
+class FakeQuery:
+    def __init__(self, store, collection, filters=(), limit=None, orders=(), start_after=None):
+        self._store = store
+        self._collection = collection
+        self._filters = tuple(filters)
+        self._limit = limit
+        self._orders = tuple(orders)
+        self._start_after = start_after
+
+    def _copy(self, **changes):
+        fields = dict(filters=self._filters, limit=self._limit, orders=self._orders, start_after=self._start_after)
+        fields.update(changes)
+        return FakeQuery(self._store, self._collection, **fields)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + ((field, op, value),))
+
+    def order_by(self, field, direction="ASCENDING"):
+        return self._copy(orders=self._orders + ((field, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, snapshot):
+        return self._copy(start_after=snapshot)
+
+    @staticmethod
+    def _order_value(snapshot, field):
+        return snapshot.id if field == "__name__" else snapshot.get(field)
+
+    def _matches(self, data):
+        for field, op, value in self._filters:
+            current = data.get(field)
+            if op == "==" and current != value:
+                return False
+            if op == "in" and current not in value:
+                return False
+            if op == "!=" and (current is None or current == value):
+                return False
+            if op == "array_contains" and value not in (current or []):
+                return False
+            if op in ("<", "<=", ">", ">=") and (current is None or not _compare(current, op, value)):
+                return False
+        return True
+
+    def stream(self, transaction=None):
+        self._store.round_trip()
+        with self._store.lock:
+            results = [
+                _Snapshot(FakeDocumentReference(self._store, col, doc_id), copy.deepcopy(data))
+                for (col, doc_id), data in self._store.docs.items()
+                if col == self._collection and self._matches(data)
+            ]
+            if transaction is not None:
+                for snapshot in results:
+                    key = snapshot.reference._key()
+                    transaction.record_read(key, self._store.versions.get(key, 0))
+        # Stable sorts, last key first, give the combined order
+        for field, direction in reversed(self._orders):
+            results.sort(key=lambda snapshot: self._order_value(snapshot, field), reverse=direction == "DESCENDING")
+        if self._start_after is not None:
+            # Only ascending cursors are supported
+            cursor = tuple(self._order_value(self._start_after, field) for field, _ in self._orders)
+            results = [r for r in results if tuple(self._order_value(r, field) for field, _ in self._orders) > cursor]
+        return iter(results[: self._limit] if self._limit else results)
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, store, name):
+        super().__init__(store, name)
+        self.id = name
+
+    def document(self, doc_id):
+        return FakeDocumentReference(self._store, self._collection, doc_id)
+
+
+class FakeTransaction:
+    """Buffers writes and applies them on commit, unless a document it read has changed."""
+
+    def __init__(self, store=None):
+        self._store = store
+        self._reads = {}
+        self._writes = []
+        self._creates = []
+
+    def reset(self):
+        self._reads = {}
+        self._writes = []
+        self._creates = []
+
+    def record_read(self, key, version):
+        self._reads.setdefault(key, version)
+
+    def set(self, ref, data, merge=False):
+        self._writes.append(lambda: ref._write_set(data, merge))
+
+    def update(self, ref, data):
+        self._writes.append(lambda: ref._write_update(data))
+
+    def delete(self, ref):
+        self._writes.append(lambda: ref._write_delete())
+
+    def create(self, ref, data):
+        self._creates.append(ref)
+        self._writes.append(lambda: ref._write_set(data, False))
+
+    def _apply_writes(self):
+        # Like Firestore, a create() of a document that exists fails the whole commit
+        for ref in self._creates:
+            if ref._key() in self._store.docs:
+                raise Conflict(f"Document already exists: {ref.path}")
+        for write in self._writes:
+            write()
+
+    def commit(self):
+        self._store.round_trip()
+        with self._store.lock:
+            for key, version in self._reads.items():
+                if self._store.versions.get(key, 0) != version:
+                    self._store.aborted_transactions += 1
+                    raise Aborted(f"Transaction contention on {'/'.join(key)}")
+            self._apply_writes()
+
+
+class FakeWriteBatch(FakeTransaction):
+    def commit(self):
+        self._store.round_trip()
+        with self._store.lock:
+            self._apply_writes()
+
+
+class FakeFirestore:
+    """Minimal thread-safe Firestore client backed by a dict."""
+
+    def __init__(self, latency_seconds=0.0):
+        self.docs = {}
+        self.versions = {}
+        self.aborted_transactions = 0
+        self.lock = threading.RLock()
+        self.latency_seconds = latency_seconds
+        self.round_trips = 0
+        self._counter_lock = threading.Lock()
+
+    def bump_version(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def round_trip(self):
+        with self._counter_lock:
+            self.round_trips += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+    def collection(self, name):
+        return FakeCollectionReference(self, name)
+
+    def document(self, path):
+        collection, doc_id = path.rsplit("/", 1)
+        return FakeDocumentReference(self, collection, doc_id)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def get_all(self, refs):
+        self.round_trip()
+        with self.lock:
+            return [_Snapshot(ref, copy.deepcopy(self.docs.get(ref._key()))) for ref in refs]
+
+
+def transactional(func):
+    """Replacement for firestore.transactional with the same retry contract.
+
+    The function is rerun when the commit aborts on contention; after MAX_ATTEMPTS aborts
+    a ValueError is raised, as the real client does.
+    """
+    def run(transaction, *args, **kwargs):
+        last_error = None
+        for _ in range(MAX_ATTEMPTS):
+            transaction.reset()
+            result = func(transaction, *args, **kwargs)
+            try:
+                transaction.commit()
+                return result
+            except Aborted as e:
+                last_error = e
+        raise ValueError(f"Failed to commit transaction in {MAX_ATTEMPTS} attempts.") from last_error
+    return run
+
+
+MAX_ATTEMPTS = 5
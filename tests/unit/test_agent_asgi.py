@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for the Agent ASGI App
+
+This module contains unit tests for the async serving mode of the agent endpoint
+(agent_asgi.py) and the agent turn it shares with the Flask handler (agent.py).
+"""
+
+import asyncio
+import base64
+import json
+import pytest
+import sys
+import os
+
+import httpx
+from flask import Flask
+
+# Add the functions/src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../functions/src'))
+
+import agent as agent_module
+import agent_asgi as agent_asgi_module
+from common import async_runtime
+from tests.helpers import fake_firestore
+
+
+class _StubGraph:
+    """Stands in for AgentGraph; records the states it runs."""
+    in_flight = 0
+    peak = 0
+    release = None
+
+    async def execute(self, state, checkpoint_ref=None):
+        cls = type(self)
+        cls.in_flight += 1
+        cls.peak = max(cls.peak, cls.in_flight)
+        try:
+            if cls.release is not None:
+                await cls.release.wait()
+            return {"response": {"content": f"re: {state.case_details['input']}"}}
+        finally:
+            cls.in_flight -= 1
+
+
+@pytest.fixture
+def store(monkeypatch):
+    """Back the agent with an in-memory Firestore and a stub graph."""
+    db = fake_firestore.FakeFirestore()
+    db.collection("cases").document("case-1").set({"userId": "user-1", "title": "Lease dispute"})
+    monkeypatch.setattr(agent_module, "get_db_client", lambda: db)
+    monkeypatch.setattr(agent_module, "get_agent_graph", _StubGraph)
+    monkeypatch.setattr(_StubGraph, "in_flight", 0)
+    monkeypatch.setattr(_StubGraph, "peak", 0)
+    monkeypatch.setattr(_StubGraph, "release", None)
+    yield db
+    async_runtime.shutdown()
+
+
+def _userinfo(user_id):
+    payload = base64.b64encode(json.dumps({"sub": user_id, "email": f"{user_id}@example.org"}).encode()).decode()
+    return {"X-Endpoint-API-Userinfo": payload}
+
+
+async def _post(client, user_id="user-1", case_id="case-1", message="Can my landlord keep the deposit?"):
+    return await client.post(f"/?caseId={case_id}", json={"message": message}, headers=_userinfo(user_id))
+
+
+def _client():
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=agent_asgi_module.app), base_url="http://agent")
+
+
+class TestAgentAsgiApp:
+    """Tests for serving agent turns from the event loop."""
+
+    def test_serves_a_turn(self, store):
+        async def run():
+            async with _client() as client:
+                return await _post(client)
+
+        response = asyncio.run(run())
+
+        assert response.status_code == 200
+        assert response.json() == {"response": {"content": "re: Can my landlord keep the deposit?"}, "status": "success"}
+
+    def test_rejects_unauthenticated_and_forbidden_requests(self, store):
+        async def run():
+            async with _client() as client:
+                anonymous = await client.post("/?caseId=case-1", json={"message": "hi"})
+                stranger = await _post(client, user_id="user-2")
+                missing = await _post(client, case_id="case-2")
+                empty = await _post(client, message="")
+                return anonymous, stranger, missing, empty
+
+        anonymous, stranger, missing, empty = asyncio.run(run())
+
+        assert anonymous.status_code == 401
+        assert stranger.status_code == 403
+        assert missing.status_code == 404
+        assert empty.status_code == 400
+        assert _StubGraph.peak == 0
+
+    def test_multiplexes_concurrent_turns(self, store):
+        turns = 20
+
+        # Turns run on the background loop, so the event they wait on is created there
+        async def make_event():
+            return asyncio.Event()
+
+        _StubGraph.release = async_runtime.run_coroutine(make_event())
+
+        async def run():
+            async with _client() as client:
+                requests = [asyncio.create_task(_post(client, message=f"question {i}")) for i in range(turns)]
+                # Every turn reaches the graph before any of them is allowed to finish
+                while _StubGraph.in_flight < turns:
+                    await asyncio.sleep(0.01)
+                async_runtime.get_loop().call_soon_threadsafe(_StubGraph.release.set)
+                return await asyncio.gather(*requests)
+
+        responses = asyncio.run(asyncio.wait_for(run(), 10))
+
+        assert [response.status_code for response in responses] == [200] * turns
+        assert _StubGraph.peak == turns
+
+    def test_flask_handler_shares_the_turn(self, store):
+        app = Flask(__name__)
+        with app.test_request_context("/?caseId=case-1", method="POST", json={"message": "hello"}) as ctx:
+            ctx.request.end_user_id = "user-1"
+            body, status = agent_module.handle_agent_request(ctx.request)
+
+        assert status == 200
+        assert body["response"]["content"] == "re: hello"
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for Agent Jobs
+
+This module contains unit tests for agent turns run in the background: the job queues and
+worker pool (agent_jobs.py), and the job mode and job status endpoint of the agent
+(agent.py, agent_asgi.py).
+"""
+
+import asyncio
+import base64
+import json
+import threading
+import time
+import pytest
+import sys
+import os
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock
+
+import httpx
+from flask import Flask
+
+# Add the functions/src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../functions/src'))
+
+import agent as agent_module
+import agent_asgi as agent_asgi_module
+import agent_jobs
+import agent_orchestrator
+from agent_jobs import AgentJobWorkerPool, FirestoreJobQueue, InProcessJobQueue
+from common import async_runtime
+from tests.helpers import fake_firestore
+
+
+@pytest.fixture
+def firestore_queue(monkeypatch):
+    monkeypatch.setattr(agent_jobs.firestore, "transactional", fake_firestore.transactional)
+    return FirestoreJobQueue(fake_firestore.FakeFirestore())
+
+
+@pytest.fixture(params=["memory", "firestore"])
+def queue(request, firestore_queue):
+    return InProcessJobQueue() if request.param == "memory" else firestore_queue
+
+
+def _enqueue(queue, tiers):
+    job_ids = []
+    for i, tier in enumerate(tiers):
+        job_ids.append(queue.enqueue("user-1", "case-1", f"question {i}", tier))
+        # Firestore orders jobs of one priority by their creation time
+        time.sleep(0.001)
+    return job_ids
+
+
+class TestJobQueues:
+    """Tests for FirestoreJobQueue and its in-process stand-in."""
+
+    def test_claims_higher_tiers_first_then_oldest(self, queue):
+        job_ids = _enqueue(queue, [0, 2, 0, 5, "1", None])
+
+        claimed = [queue.claim("worker-1")["id"] for _ in job_ids]
+
+        # Tier 5 is capped at the top priority; tiers that are missing count as 0
+        assert claimed == [job_ids[3], job_ids[1], job_ids[4], job_ids[0], job_ids[2], job_ids[5]]
+        assert queue.claim("worker-1") is None
+        assert queue.get(job_ids[0])["status"] == agent_jobs.JOB_RUNNING
+        assert queue.get(job_ids[0])["attempts"] == 1
+
+    def test_completes_and_retries_jobs(self, queue):
+        first, second = _enqueue(queue, [0, 0])
+        queue.claim("worker-1")
+        queue.fail(first, "Exa timeout", retry=True)
+
+        # A retried job keeps its place ahead of newer jobs
+        assert queue.claim("worker-1")["id"] == first
+        queue.complete(first, {"status": "success", "response": "done"}, 200)
+        queue.claim("worker-1")
+        queue.fail(second, "Exa timeout", retry=False)
+
+        assert queue.get(first)["status"] == agent_jobs.JOB_SUCCEEDED
+        assert queue.get(first)["attempts"] == 2
+        assert queue.get(first)["result"] == {"status": "success", "response": "done"}
+        assert queue.get(second)["status"] == agent_jobs.JOB_FAILED
+        assert queue.get(second)["error"] == "Exa timeout"
+        assert queue.get("missing") is None
+
+    def test_concurrent_claims_take_each_job_once(self, firestore_queue):
+        job_ids = _enqueue(firestore_queue, [0] * 12)
+        claimed = []
+
+        def work(worker_id):
+            while (job := firestore_queue.claim(worker_id)) is not None:
+                claimed.append(job["id"])
+
+        workers = [threading.Thread(target=work, args=(f"worker-{i}",)) for i in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        assert sorted(claimed) == sorted(job_ids)
+
+    def test_reclaims_jobs_whose_lease_expired(self, firestore_queue):
+        job_id = firestore_queue.enqueue("user-1", "case-1", "question", 0)
+        firestore_queue.claim("worker-1")
+        assert firestore_queue.claim("worker-2") is None
+
+        firestore_queue.collection.document(job_id).update(
+            {"leaseExpiresAt": datetime.now(timezone.utc) - timedelta(seconds=1)})
+        job = firestore_queue.claim("worker-2")
+
+        assert job["id"] == job_id
+        assert job["workerId"] == "worker-2"
+        assert job["attempts"] == 2
+
+    def test_fails_jobs_that_outlive_their_last_lease(self, firestore_queue):
+        job_id = firestore_queue.enqueue("user-1", "case-1", "question", 0)
+        firestore_queue.claim("worker-1")
+        firestore_queue.collection.document(job_id).update(
+            {"attempts": agent_jobs.AGENT_JOB_MAX_ATTEMPTS,
+             "leaseExpiresAt": datetime.now(timezone.utc) - timedelta(seconds=1)})
+
+        assert firestore_queue.claim("worker-2") is None
+        job = firestore_queue.get(job_id)
+        assert job["status"] == agent_jobs.JOB_FAILED
+        assert job["statusCode"] == 500
+        assert "leaseExpiresAt" not in job
+
+
+class TestWorkerPool:
+    """Tests for AgentJobWorkerPool."""
+
+    def test_runs_jobs_with_bounded_concurrency(self):
+        queue = InProcessJobQueue()
+        job_ids = _enqueue(queue, [0] * 4 + [3] * 4)
+        started = []
+        in_flight = peak = 0
+
+        async def run_job(job):
+            nonlocal in_flight, peak
+            started.append(job["id"])
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return {"status": "success", "response": job["message"]}, 200
+
+        pool = AgentJobWorkerPool(queue, run_job, concurrency=3)
+        processed = async_runtime.run_coroutine(pool.run())
+        async_runtime.shutdown()
+
+        assert processed == 8
+        assert peak == 3
+        assert set(started[:4]) == set(job_ids[4:])
+        assert all(queue.get(job_id)["status"] == agent_jobs.JOB_SUCCEEDED for job_id in job_ids)
+
+    def test_retries_failed_runs_up_to_the_limit(self):
+        queue = InProcessJobQueue()
+        flaky, broken, forbidden = _enqueue(queue, [0, 0, 0])
+        runs = {}
+
+        async def run_job(job):
+            runs[job["id"]] = runs.get(job["id"], 0) + 1
+            if job["id"] == flaky and runs[flaky] == 1:
+                raise RuntimeError("Gemini unavailable")
+            if job["id"] == broken:
+                return {"status": "error", "message": "Agent execution error"}, 500
+            if job["id"] == forbidden:
+                return {"status": "error", "message": "Forbidden"}, 403
+            return {"status": "success"}, 200
+
+        async_runtime.run_coroutine(AgentJobWorkerPool(queue, run_job, concurrency=1).run())
+        async_runtime.shutdown()
+
+        assert queue.get(flaky)["status"] == agent_jobs.JOB_SUCCEEDED
+        assert runs == {flaky: 2, broken: agent_jobs.AGENT_JOB_MAX_ATTEMPTS, forbidden: 1}
+        assert queue.get(broken)["status"] == agent_jobs.JOB_FAILED
+        assert queue.get(broken)["error"] == "Agent execution error"
+        assert queue.get(forbidden)["status"] == agent_jobs.JOB_FAILED
+        assert queue.get(forbidden)["statusCode"] == 403
+
+
+def _agent_graph(research):
+    """A real AgentGraph whose nodes are stubbed, with research(state) as its research node."""
+    graph = agent_orchestrator.AgentGraph()
+    graph._check_quota_node = AsyncMock(return_value={"status": "success"})
+    graph._reserve_quota = AsyncMock()
+    graph._analyze_input_node = AsyncMock(return_value={"status": "success"})
+    graph._research_node = AsyncMock(side_effect=research)
+    graph._guidance_node = AsyncMock(return_value={"status": "success"})
+    graph._generate_response_node = AsyncMock(return_value={"status": "success", "response": "Final response"})
+    graph._create_support_ticket = AsyncMock()
+    return graph
+
+
+class TestAgentJobRetries:
+    """Tests for retries of jobs run through run_agent_job and the real agent graph."""
+
+    def _run(self, job_store, monkeypatch, graph):
+        monkeypatch.setattr(agent_module, "get_agent_graph", lambda: graph)
+        job_id = job_store.enqueue("user-1", "case-1", "question", 0)
+        async_runtime.run_coroutine(agent_module.get_agent_job_pool().run())
+        return job_store.get(job_id)
+
+    def test_failed_nodes_are_retried_from_the_checkpoint(self, job_store, monkeypatch):
+        failures = iter([RuntimeError("Exa timeout")])
+
+        async def research(state):
+            if (error := next(failures, None)) is not None:
+                raise error
+            return {"status": "success"}
+
+        graph = _agent_graph(research)
+        job = self._run(job_store, monkeypatch, graph)
+
+        assert job["status"] == agent_jobs.JOB_SUCCEEDED
+        assert job["attempts"] == 2
+        assert job["result"]["status"] == "success"
+        assert graph._analyze_input_node.await_count == 1
+        assert graph._research_node.await_count == 2
+
+    def test_nodes_that_keep_failing_fail_the_job(self, job_store, monkeypatch):
+        async def research(state):
+            raise RuntimeError("Exa timeout")
+
+        graph = _agent_graph(research)
+        job = self._run(job_store, monkeypatch, graph)
+
+        assert job["status"] == agent_jobs.JOB_FAILED
+        assert job["attempts"] == agent_jobs.AGENT_JOB_MAX_ATTEMPTS
+        assert job["error"] == "Max retries exceeded for node research"
+        assert graph._research_node.await_count == agent_jobs.AGENT_JOB_MAX_ATTEMPTS
+
+    def test_turns_that_run_too_long_are_cancelled_and_retried(self, job_store, monkeypatch):
+        monkeypatch.setattr(agent_module, "AGENT_JOB_TURN_TIMEOUT_SECONDS", 0.05)
+        delays = iter([1.0])
+
+        async def research(state):
+            await asyncio.sleep(next(delays, 0))
+            return {"status": "success"}
+
+        job = self._run(job_store, monkeypatch, _agent_graph(research))
+
+        assert job["status"] == agent_jobs.JOB_SUCCEEDED
+        assert job["attempts"] == 2
+        assert job["error"] == "Agent turn timed out."
+
+
+class _StubGraph:
+    """Stands in for AgentGraph."""
+
+    async def execute(self, state, checkpoint_ref=None):
+        return {"response": {"content": f"re: {state.case_details['input']}"}}
+
+
+@pytest.fixture
+def job_store(monkeypatch):
+    """Back the agent with an in-memory Firestore, a stub graph and an in-process job queue."""
+    db = fake_firestore.FakeFirestore()
+    db.collection("cases").document("case-1").set({"userId": "user-1", "title": "Lease dispute"})
+    db.collection("users").document("user-1").set({"subscription": {"tier": 2}})
+    queue = InProcessJobQueue()
+    monkeypatch.setattr(agent_module, "get_db_client", lambda: db)
+    monkeypatch.setattr(agent_module, "get_agent_graph", _StubGraph)
+    monkeypatch.setattr(agent_module, "get_job_queue", lambda: queue)
+    monkeypatch.setattr(agent_module, "_agent_job_pool", None)
+    yield queue
+    async_runtime.shutdown()
+
+
+def _wait_for(queue, job_id, status=agent_jobs.JOB_SUCCEEDED, timeout=5):
+    deadline = time.monotonic() + timeout
+    while queue.get(job_id)["status"] != status and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return queue.get(job_id)
+
+
+def _flask_request(app, handler, path, user_id="user-1", **kwargs):
+    with app.test_request_context(path, **kwargs) as ctx:
+        ctx.request.end_user_id = user_id
+        return handler(ctx.request)
+
+
+class TestAgentJobEndpoints:
+    """Tests for the job mode of the agent endpoint and the job status endpoint."""
+
+    def test_queues_a_turn_and_returns_its_result(self, job_store):
+        app = Flask(__name__)
+        queued, status = _flask_request(app, agent_module.handle_agent_request, "/?caseId=case-1&async=true",
+                                        method="POST", json={"message": "Pot recupera garanția?"})
+
+        assert status == 202
+        assert queued["status"] == "queued"
+        job = _wait_for(job_store, queued["jobId"])
+        assert job["priority"] == 2
+
+        result, status = _flask_request(app, agent_module.handle_get_agent_job, f"/?jobId={queued['jobId']}")
+        assert status == 200
+        assert result["status"] == "succeeded"
+        assert result["caseId"] == "case-1"
+        assert result["statusCode"] == 200
+        assert result["result"] == {"response": {"content": "re: Pot recupera garanția?"}, "status": "success"}
+        assert isinstance(result["finishedAt"], str)
+
+    def test_job_status_is_only_shown_to_its_owner(self, job_store):
+        app = Flask(__name__)
+        job_id = job_store.enqueue("user-1", "case-1", "question", 0)
+
+        assert _flask_request(app, agent_module.handle_get_agent_job, f"/?jobId={job_id}", user_id="user-2")[1] == 403
+        assert _flask_request(app, agent_module.handle_get_agent_job, "/?jobId=missing")[1] == 404
+        assert _flask_request(app, agent_module.handle_get_agent_job, "/")[1] == 400
+        _, status = _flask_request(app, agent_module.handle_agent_request, "/?caseId=case-1&async=true",
+                                   user_id="user-2", method="POST", json={"message": "hi"})
+        assert status == 403
+
+    def test_worker_endpoint_runs_queued_jobs(self, job_store):
+        app = Flask(__name__)
+        job_ids = _enqueue(job_store, [0, 1])
+
+        body, status = _flask_request(app, agent_module.handle_run_agent_jobs, "/", user_id=None, method="POST")
+
+        assert (body, status) == ({"status": "success", "processed": 2}, 200)
+        assert [job_store.get(job_id)["status"] for job_id in job_ids] == ["succeeded", "succeeded"]
+
+    def test_asgi_app_queues_and_polls_jobs(self, job_store):
+        userinfo = {"X-Endpoint-API-Userinfo": base64.b64encode(json.dumps({"sub": "user-1"}).encode()).decode()}
+
+        async def run():
+            transport = httpx.ASGITransport(app=agent_asgi_module.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://agent") as client:
+                queued = await client.post("/?caseId=case-1", json={"message": "hi"},
+                                           headers={**userinfo, "Prefer": "respond-async"})
+                await asyncio.to_thread(_wait_for, job_store, queued.json()["jobId"])
+                polled = await client.get(f"/agent/jobs?jobId={queued.json()['jobId']}", headers=userinfo)
+                return queued, polled
+
+        queued, polled = asyncio.run(run())
+
+        assert queued.status_code == 202
+        assert polled.status_code == 200
+        assert polled.json()["result"]["response"] == {"content": "re: hi"}
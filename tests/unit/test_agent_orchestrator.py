@@ -1,7 +1,8 @@
 import pytest
 from unittest.mock import MagicMock, patch, AsyncMock
 from datetime import datetime
-from functions.src.agent_orchestrator import AgentState, AgentGraph, create_agent_graph
+from functions.src import agent_orchestrator
+from functions.src.agent_orchestrator import AgentState, AgentGraph, WORKFLOW_GRAPH, create_agent_graph, get_agent_graph
 from functions.src.agent_tools import (
     get_party_id_by_name,
     generate_draft_pdf,
@@ -14,6 +15,7 @@ from functions.src.agent_tools import (
 from functions.src.template_validation import ValidationError
 from functions.src.draft_templates import DraftTemplates
 from functions.src.response_templates import format_response
+from tests.helpers import fake_firestore
 
 # Test data
 MOCK_CASE_DETAILS = {
@@ -228,11 +230,15 @@ async def test_agent_graph_node_methods(mock_agent_graph, mock_agent_state):
         "context": {"legal_domain": "civil"}
     }
     # Test quota check node
-    with patch("functions.src.agent_orchestrator.check_quota") as mock_check_quota:
+    with patch("functions.src.agent_orchestrator.check_quota") as mock_check_quota, \
+            patch("functions.src.agent_orchestrator.reserve_quota_usage") as mock_reserve:
         mock_check_quota.return_value = {"available_requests": 10}
+        mock_reserve.return_value = {"id": "reservation-1"}
         result = await mock_agent_graph._check_quota_node(mock_agent_state)
         assert result["status"] == "success"
         assert result["quota"]["available_requests"] == 10
+        assert mock_agent_state.quota_reservation == {"id": "reservation-1"}
+    mock_agent_state.quota_reservation = None
     
     # Test input analysis node
     result = await mock_agent_graph._analyze_input_node(mock_agent_state)
@@ -280,4 +286,85 @@ async def test_create_agent_graph():
         assert isinstance(graph, AgentGraph)
         assert graph.max_retries == 3
         # The DraftTemplates class should have been replaced by a MagicMock
-        assert isinstance(graph.draft_generator, MagicMock) 
\ No newline at end of file
+        assert isinstance(graph.draft_generator, MagicMock) 
+
+def test_get_agent_graph_is_shared_and_immutable():
+    """Test that requests share one graph whose structure cannot be changed."""
+    graph = get_agent_graph()
+    assert get_agent_graph() is graph
+    assert graph.graph is WORKFLOW_GRAPH
+    assert graph.graph["start"] == ("check_quota",)
+    with pytest.raises(TypeError):
+        graph.graph["start"] = ("research",)
+
+def _mock_nodes(graph, research_failures=0):
+    research_calls = []
+
+    async def research(state):
+        research_calls.append(state)
+        if len(research_calls) <= research_failures:
+            raise RuntimeError("Exa timeout")
+        return {"status": "success", "legal_references": ["Legea 17/2014"]}
+
+    graph._check_quota_node = AsyncMock(return_value={"status": "success", "quota": {"available": 10}})
+    graph._analyze_input_node = AsyncMock(return_value={"status": "success", "query": "rental dispute"})
+    graph._research_node = AsyncMock(side_effect=research)
+    graph._guidance_node = AsyncMock(return_value={"status": "success", "confidence_score": 0.8})
+    graph._generate_response_node = AsyncMock(return_value={"status": "success", "response": "Final response"})
+    graph._create_support_ticket = AsyncMock()
+    graph._reserve_quota = AsyncMock()
+
+@pytest.mark.asyncio
+async def test_retry_resumes_from_checkpoint(mock_agent_graph, mock_agent_state):
+    """Test that a retried turn reuses the outputs of nodes completed before a failure."""
+    db = fake_firestore.FakeFirestore()
+    checkpoint_ref = agent_orchestrator.agent_checkpoint_ref(db, "case_123", "user_456", MOCK_CASE_DETAILS["input"])
+    _mock_nodes(mock_agent_graph, research_failures=1)
+
+    failed = await mock_agent_graph.execute(mock_agent_state, checkpoint_ref=checkpoint_ref)
+    assert failed["status"] == "error" and failed["node"] == "research"
+    assert checkpoint_ref.get().get("completedNodes") == ["check_quota", "analyze_input"]
+
+    resumed_state = agent_orchestrator.load_checkpoint(checkpoint_ref)
+    assert resumed_state.retry_count == {"research": 1}
+    result = await mock_agent_graph.execute(resumed_state, checkpoint_ref=checkpoint_ref)
+
+    assert result["status"] == "success"
+    assert result["legal_references"] == ["Legea 17/2014"]
+    assert result["metadata"]["completed_nodes"] == ["check_quota", "analyze_input", "research", "guidance", "generate_response"]
+    assert mock_agent_graph._check_quota_node.await_count == 1
+    assert mock_agent_graph._analyze_input_node.await_count == 1
+    assert mock_agent_graph._research_node.await_count == 2
+    # The failed attempt released its quota, so the resumed one reserves again
+    assert mock_agent_graph._reserve_quota.await_count == 1
+    assert not checkpoint_ref.get().exists
+
+@pytest.mark.asyncio
+async def test_checkpoint_is_compressed_and_round_trips(mock_agent_state):
+    """Test that checkpoints store the compressed state and restore it unchanged."""
+    db = fake_firestore.FakeFirestore()
+    checkpoint_ref = agent_orchestrator.agent_checkpoint_ref(db, "case_123", "user_456", "question")
+    mock_agent_state.update_node("research", {"status": "success", "results": ["Legea 17/2014 art. 3"] * 200})
+
+    assert agent_orchestrator.save_checkpoint(checkpoint_ref, mock_agent_state)
+
+    stored = checkpoint_ref.get().get("state")
+    assert isinstance(stored, bytes)
+    assert len(stored) < len(str(mock_agent_state.to_dict())) / 10
+    assert agent_orchestrator.load_checkpoint(checkpoint_ref).to_dict() == mock_agent_state.to_dict()
+
+def test_stale_checkpoints_are_ignored(mock_agent_state, monkeypatch):
+    """Test that expired checkpoints and checkpoints of another version start a fresh turn."""
+    db = fake_firestore.FakeFirestore()
+    checkpoint_ref = agent_orchestrator.agent_checkpoint_ref(db, "case_123", "user_456", "question")
+    assert agent_orchestrator.agent_checkpoint_ref(db, "case_123", "user_456", "other question").id != checkpoint_ref.id
+
+    monkeypatch.setattr(agent_orchestrator, "AGENT_CHECKPOINT_TTL_SECONDS", -1)
+    agent_orchestrator.save_checkpoint(checkpoint_ref, mock_agent_state)
+    assert agent_orchestrator.load_checkpoint(checkpoint_ref) is None
+
+    monkeypatch.setattr(agent_orchestrator, "AGENT_CHECKPOINT_TTL_SECONDS", 60)
+    agent_orchestrator.save_checkpoint(checkpoint_ref, mock_agent_state)
+    monkeypatch.setattr(agent_orchestrator, "AGENT_CHECKPOINT_VERSION", 2)
+    assert agent_orchestrator.load_checkpoint(checkpoint_ref) is None
+
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for Agent Streaming
+
+This module contains unit tests for streamed agent turns: Gemini streamGenerateContent
+(gemini_direct.py), progress events (agent_events.py, AgentGraph.execute) and the
+server-sent event responses of the Flask handler and the ASGI app.
+"""
+
+import asyncio
+import base64
+import json
+import pytest
+import sys
+import os
+from unittest.mock import AsyncMock
+
+import httpx
+from aiohttp import web
+from flask import Flask
+
+# Add the functions/src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../functions/src'))
+
+import agent as agent_module
+import agent_asgi as agent_asgi_module
+import agent_events
+import gemini_direct
+from agent_orchestrator import AgentGraph
+from common import async_runtime
+from tests.helpers import fake_firestore
+
+CHUNKS = ["Chiriașul ", "poate cere ", "garanția înapoi."]
+
+
+@pytest.fixture
+def gemini_stream(monkeypatch):
+    """Serve streamGenerateContent from a local stand-in that sends CHUNKS as SSE."""
+    requests = []
+
+    async def stream(request):
+        requests.append((request.match_info["model"], dict(request.query), await request.json()))
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for text in CHUNKS:
+            chunk = {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]}
+            await response.write(f"data: {json.dumps(chunk)}\r\n\r\n".encode("utf-8"))
+        await response.write_eof()
+        return response
+
+    async def start():
+        app = web.Application()
+        app.router.add_post("/v1beta/models/{model}:streamGenerateContent", stream)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        return runner, site._server.sockets[0].getsockname()[1]
+
+    runner, port = async_runtime.run_coroutine(start())
+    monkeypatch.setenv("GEMINI_API_KEY", "test-key")
+    monkeypatch.setattr(gemini_direct, "GEMINI_STREAM_API_URL",
+                        f"http://127.0.0.1:{port}/v1beta/models/{{model}}:streamGenerateContent")
+    yield requests
+    async_runtime.run_coroutine(runner.cleanup())
+    async_runtime.shutdown()
+
+
+@pytest.fixture
+def agent_graph(monkeypatch, gemini_stream):
+    """A real AgentGraph whose guidance node asks Gemini, backed by an in-memory Firestore."""
+    db = fake_firestore.FakeFirestore()
+    db.collection("cases").document("case-1").set({"userId": "user-1", "title": "Lease dispute"})
+    graph = AgentGraph()
+
+    async def guidance(state):
+        return {"status": "success", "guidance": await gemini_direct.gemini_generate_rest(prompt=state.case_details["input"])}
+
+    graph._check_quota_node = AsyncMock(return_value={"status": "success"})
+    graph._reserve_quota = AsyncMock()
+    graph._analyze_input_node = AsyncMock(return_value={"status": "success"})
+    graph._research_node = AsyncMock(return_value={"status": "success"})
+    graph._guidance_node = guidance
+    graph._generate_response_node = AsyncMock(return_value={"status": "success", "response": "Final response"})
+    monkeypatch.setattr(agent_module, "get_db_client", lambda: db)
+    monkeypatch.setattr(agent_module, "get_agent_graph", lambda: graph)
+    return graph
+
+
+def _events(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        name, data = block.split("\n")
+        assert name.startswith("event: ") and data.startswith("data: ")
+        events.append(json.loads(data[len("data: "):]))
+        assert events[-1]["event"] == name[len("event: "):]
+    return events
+
+
+def _assert_streamed_turn(events):
+    progress = [(event["event"], event.get("node")) for event in events if event["event"] != "token"]
+    nodes = ["check_quota", "analyze_input", "research", "guidance", "generate_response"]
+    assert progress == [step for node in nodes for step in (("node_start", node), ("node_end", node))] + [("result", None)]
+    assert [event["text"] for event in events if event["event"] == "token"] == CHUNKS
+    # Tokens arrive while the guidance node runs
+    tokens_at = [i for i, event in enumerate(events) if event["event"] == "token"]
+    assert events[tokens_at[0] - 1] == {"event": "node_start", "node": "guidance"}
+    assert events[-1]["status_code"] == 200
+    assert events[-1]["response"]["response"] == "Final response"
+
+
+class TestGeminiStreaming:
+    """Tests for streamed Gemini output."""
+
+    def test_stream_yields_chunks(self, gemini_stream):
+        async def collect():
+            return [text async for text in gemini_direct.gemini_stream_rest(prompt="Pot recupera garanția?")]
+
+        assert async_runtime.run_coroutine(collect()) == CHUNKS
+        model, query, payload = gemini_stream[0]
+        assert model == "gemini-2.5-flash"
+        assert query == {"key": "test-key", "alt": "sse"}
+        assert payload["contents"] == [{"role": "user", "parts": [{"text": "Pot recupera garanția?"}]}]
+
+    def test_generate_streams_tokens_only_inside_a_streamed_turn(self, gemini_stream):
+        events = []
+
+        async def generate():
+            with agent_events.event_sink(events.append):
+                return await gemini_direct.gemini_generate_rest(prompt="Pot recupera garanția?")
+
+        assert async_runtime.run_coroutine(generate()) == "".join(CHUNKS)
+        assert events == [{"event": "token", "text": text} for text in CHUNKS]
+        assert not agent_events.streaming()
+
+
+class TestStreamedAgentTurns:
+    """Tests for the server-sent event responses of the agent endpoint."""
+
+    def test_asgi_app_streams_progress_and_tokens(self, agent_graph):
+        userinfo = base64.b64encode(json.dumps({"sub": "user-1"}).encode()).decode()
+
+        async def run():
+            transport = httpx.ASGITransport(app=agent_asgi_module.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://agent") as client:
+                streamed = await client.post("/?caseId=case-1", json={"message": "Pot recupera garanția?"},
+                                             headers={"X-Endpoint-API-Userinfo": userinfo, "Accept": "text/event-stream"})
+                forbidden = await client.post("/?caseId=case-1&stream=true", json={"message": "hi"},
+                                              headers={"X-Endpoint-API-Userinfo": base64.b64encode(b'{"sub": "user-2"}').decode()})
+                return streamed, forbidden
+
+        streamed, forbidden = asyncio.run(run())
+
+        assert streamed.status_code == 200
+        assert streamed.headers["content-type"].startswith("text/event-stream")
+        _assert_streamed_turn(_events(streamed.text))
+        assert forbidden.status_code == 403
+        assert forbidden.json()["message"].startswith("Forbidden")
+
+    def test_flask_handler_streams_progress_and_tokens(self, agent_graph):
+        app = Flask(__name__)
+        with app.test_request_context("/?caseId=case-1&stream=true", method="POST",
+                                      json={"message": "Pot recupera garanția?"}) as ctx:
+            ctx.request.end_user_id = "user-1"
+            response = agent_module.handle_agent_request(ctx.request)
+            body = "".join(response.response)
+
+        assert response.mimetype == "text/event-stream"
+        assert response.headers["Cache-Control"] == "no-cache"
+        _assert_streamed_turn(_events(body))
+
+    def test_resumed_turn_reports_completed_nodes(self, agent_graph):
+        agent_graph._research_node.side_effect = [RuntimeError("Exa timeout"), {"status": "success"}]
+        app = Flask(__name__)
+
+        def stream():
+            with app.test_request_context("/?caseId=case-1", method="POST", json={"message": "Pot recupera garanția?"},
+                                          headers={"Accept": "text/event-stream"}) as ctx:
+                ctx.request.end_user_id = "user-1"
+                return _events("".join(agent_module.handle_agent_request(ctx.request).response))
+
+        failed = stream()
+        resumed = stream()
+
+        assert failed[-2] == {"event": "node_error", "node": "research", "error": "Exa timeout"}
+        assert failed[-1]["response"]["status"] == "error"
+        assert resumed[0] == {"event": "resume", "completed_nodes": ["check_quota", "analyze_input"]}
+        assert resumed[1] == {"event": "node_start", "node": "research"}
+        assert resumed[-1]["response"]["status"] == "success"
+        assert agent_graph._check_quota_node.await_count == 1
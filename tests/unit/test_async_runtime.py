@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for the Async Runtime
+
+This module contains unit tests for the per-instance background event loop in
+common/async_runtime.py.
+"""
+
+import asyncio
+import pytest
+import sys
+import os
+import threading
+
+# Add the functions/src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../functions/src'))
+
+from common import async_runtime as runtime_module
+
+
+@pytest.fixture(autouse=True)
+def fresh_runtime(monkeypatch):
+    """Give every test its own loop and shutdown callbacks."""
+    monkeypatch.setattr(runtime_module, "_shutdown_callbacks", [])
+    yield
+    runtime_module.shutdown()
+
+
+async def _loop_and_thread():
+    return asyncio.get_running_loop(), threading.current_thread().name
+
+
+class TestAsyncRuntime:
+    """Tests for running handler coroutines on the shared loop."""
+
+    def test_requests_share_one_background_loop(self):
+        first_loop, thread_name = runtime_module.run_coroutine(_loop_and_thread())
+        second_loop, _ = runtime_module.run_coroutine(_loop_and_thread())
+
+        assert first_loop is second_loop
+        assert thread_name == "async-runtime-loop"
+        assert thread_name != threading.current_thread().name
+
+    def test_exceptions_reach_the_caller(self):
+        async def fail():
+            raise ValueError("node failed")
+
+        with pytest.raises(ValueError, match="node failed"):
+            runtime_module.run_coroutine(fail())
+
+    def test_timeout_cancels_the_coroutine(self):
+        cancelled = threading.Event()
+
+        async def slow():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        with pytest.raises(TimeoutError):
+            runtime_module.run_coroutine(slow(), timeout=0.05)
+        assert cancelled.wait(1)
+
+    def test_http_session_is_shared_on_the_loop_only(self):
+        async def session_ids():
+            async with runtime_module.http_session() as first, runtime_module.http_session() as second:
+                return id(first), id(second), first is await runtime_module.get_http_session()
+
+        first_id, second_id, shared = runtime_module.run_coroutine(session_ids())
+        assert first_id == second_id and shared
+
+        async def foreign_session():
+            async with runtime_module.http_session() as session:
+                return session is runtime_module._http_session
+
+        assert asyncio.run(foreign_session()) is False
+
+    def test_shutdown_closes_clients_and_a_later_request_restarts_the_loop(self):
+        closed = []
+
+        @runtime_module.on_shutdown
+        async def close_client():
+            closed.append("client")
+
+        async def open_session():
+            return await runtime_module.get_http_session()
+
+        session = runtime_module.run_coroutine(open_session())
+        first_loop, _ = runtime_module.run_coroutine(_loop_and_thread())
+
+        runtime_module.shutdown()
+        runtime_module.shutdown()
+
+        assert closed == ["client"]
+        assert session.closed
+        assert first_loop.is_closed()
+        second_loop, _ = runtime_module.run_coroutine(_loop_and_thread())
+        assert second_loop is not first_loop
+
+    def test_iterating_from_sync_code_closes_the_generator_early(self):
+        closed = threading.Event()
+
+        async def numbers():
+            try:
+                for i in range(10):
+                    await asyncio.sleep(0)
+                    yield i, runtime_module.on_runtime_loop()
+            finally:
+                closed.set()
+
+        iterator = runtime_module.iterate_on_loop(numbers())
+        assert next(iterator) == (0, True)
+        assert next(iterator) == (1, True)
+        iterator.close()
+
+        assert closed.is_set()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for Shared Clients
+
+This module contains unit tests for the Stripe call wrapper in common/clients.py.
+"""
+
+import pytest
+import sys
+import os
+from unittest.mock import MagicMock
+
+# Add the functions/src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../functions/src'))
+
+import stripe
+from common import clients as clients_module
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    """Skip the real sleeps between retries."""
+    monkeypatch.setattr(clients_module.time, "sleep", lambda seconds: None)
+
+
+class TestCallStripe:
+    """Tests for call_stripe retries, deadlines and timeouts."""
+
+    def test_server_errors_are_retried_with_the_same_idempotency_key(self):
+        func = MagicMock(side_effect=[
+            stripe.error.APIError("unavailable", http_status=503),
+            stripe.error.APIConnectionError("reset"),
+            {"id": "cs_1"},
+        ])
+
+        result = clients_module.call_stripe(func, operation='write', idempotency_key="checkout-session-1", mode="payment")
+
+        assert result == {"id": "cs_1"}
+        assert func.call_count == 3
+        assert {call.kwargs["idempotency_key"] for call in func.call_args_list} == {"checkout-session-1"}
+
+    def test_client_errors_are_not_retried(self):
+        func = MagicMock(side_effect=stripe.error.InvalidRequestError("No such price", "price"))
+
+        with pytest.raises(stripe.error.InvalidRequestError):
+            clients_module.call_stripe(func)
+        func.assert_called_once()
+
+    def test_retries_stop_at_the_deadline(self):
+        func = MagicMock(side_effect=stripe.error.RateLimitError("slow down"))
+
+        with pytest.raises(stripe.error.RateLimitError):
+            clients_module.call_stripe(func, deadline_seconds=0)
+        func.assert_called_once()
+
+    def test_session_applies_the_operation_timeout(self, monkeypatch):
+        seen = {}
+
+        def _request(self, method, url, **kwargs):
+            seen["timeout"] = kwargs.get("timeout")
+            return MagicMock()
+
+        monkeypatch.setattr(clients_module.requests.Session, "request", _request)
+        session = clients_module._StripeSession()
+        func = lambda: session.request("GET", "https://api.stripe.com/v1/products", timeout=80)
+
+        clients_module.call_stripe(func, operation='read')
+
+        assert seen["timeout"] == clients_module.STRIPE_TIMEOUTS['read']
@@ -1,2 +1,258 @@
-# All tests in this file require Firestore emulator, local mocks, or unavailable infrastructure.
-# This file is not feasible for production API testing and is removed.
+#!/usr/bin/env python3
+"""
+Unit Tests for Organization Module
+
+This module contains unit tests for the functions in the organization.py module.
+"""
+
+import pytest
+import sys
+import os
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+import flask
+
+# Add the functions/src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../functions/src'))
+
+import organization as organization_module
+from tests.helpers import fake_firestore
+
+
+def _snapshot(doc_id, data=None, exists=True):
+    snapshot = MagicMock()
+    snapshot.id = doc_id
+    snapshot.exists = exists
+    snapshot.to_dict.return_value = data or {}
+    return snapshot
+
+
+@pytest.fixture(autouse=True)
+def app_context():
+    """Provide a Flask application context so jsonify works."""
+    with flask.Flask(__name__).app_context():
+        yield
+
+
+@pytest.fixture
+def mock_db_client(monkeypatch):
+    """Create a mock Firestore client with one mock per collection."""
+    mock_client = MagicMock()
+    collections = {}
+
+    def _collection(name):
+        if name not in collections:
+            collections[name] = MagicMock(name=f"collection:{name}")
+        return collections[name]
+
+    mock_client.collection.side_effect = _collection
+    mock_client.collections = collections
+    monkeypatch.setattr(organization_module, "get_db_client", lambda: mock_client)
+    monkeypatch.setattr(organization_module, "check_permission", MagicMock(return_value=(True, "")))
+    monkeypatch.setattr(organization_module.firestore, "transactional", lambda func: func)
+    yield mock_client
+
+
+@pytest.fixture
+def mock_request():
+    """Create a mock Flask request."""
+    def _create_mock_request(end_user_id=None, json_data=None, args=None):
+        mock_req = MagicMock(spec=flask.Request)
+        mock_req.end_user_id = end_user_id
+        mock_req.get_json = MagicMock(return_value=json_data)
+        mock_req.args = args or {}
+        return mock_req
+
+    return _create_mock_request
+
+
+class TestDeleteOrganization:
+    """Tests for the delete_organization function."""
+
+    def test_marks_organization_deleting_and_returns_immediately(self, mock_db_client, mock_request):
+        """The request records a job for the scheduled deletion worker and starts nothing itself."""
+        mock_db_client.collection("organizations").document.return_value.get.return_value = _snapshot("org-1", {"name": "Firm"})
+        transaction = mock_db_client.transaction.return_value
+
+        response, status_code = organization_module.delete_organization(
+            mock_request(end_user_id="admin-1", json_data={"organizationId": "org-1"})
+        )
+
+        assert status_code == 202
+        assert response.get_json()["jobId"] == "org-1"
+        org_update = transaction.update.call_args[0][1]
+        assert org_update["status"] == "deleting"
+        job_data = transaction.set.call_args[0][1]
+        assert job_data["status"] == "pending"
+        assert job_data["phase"] == organization_module.ORG_DELETION_PHASES[0]
+        # No cascade work happens inside the request
+        mock_db_client.collection("organization_memberships").where.assert_not_called()
+        mock_db_client.batch.assert_not_called()
+
+
+class TestRunOrganizationDeletionJob:
+    """Tests for the run_organization_deletion_job cascade runner."""
+
+    @pytest.fixture
+    def store(self, monkeypatch):
+        """An organization with cases, documents, parties and members in an in-memory Firestore."""
+        db = fake_firestore.FakeFirestore()
+        monkeypatch.setattr(organization_module, "get_db_client", lambda: db)
+        monkeypatch.setattr(organization_module.firestore, "transactional", fake_firestore.transactional)
+        db.collection("organizations").document("org-1").set({"name": "Firm", "status": "deleting"})
+        db.collection(organization_module.ORG_STATS_COLLECTION).document("org-1").set({"storageBytes": 10})
+        db.collection(organization_module.ORG_DELETION_JOBS_COLLECTION).document("org-1").set({
+            "organizationId": "org-1", "status": "pending", "phase": "cases", "cursor": None,
+            "processed": {phase: 0 for phase in organization_module.ORG_DELETION_PHASES}, "leaseExpiresAt": None,
+        })
+        for i in range(5):
+            db.collection("cases").document(f"case-{i}").set({
+                "organizationId": "org-1", "status": "open", "attachedPartyIds": [f"party-{i}", "party-shared"],
+            })
+            db.collection("documents").document(f"doc-{i}").set({"caseId": f"case-{i}", "status": "active"})
+            db.collection("parties").document(f"party-{i}").set({"userId": "member-1"})
+        # A member's personal case still uses one of the parties
+        db.collection("cases").document("personal").set({"userId": "member-1", "status": "open",
+                                                          "attachedPartyIds": ["party-shared"]})
+        db.collection("parties").document("party-shared").set({"userId": "member-1"})
+        for i in range(3):
+            db.collection("organization_memberships").document(f"m-{i}").set({"organizationId": "org-1", "userId": f"member-{i}"})
+        return db
+
+    def test_processes_phases_in_bounded_batches_with_checkpoints(self, store, monkeypatch):
+        monkeypatch.setattr(organization_module, "ORG_DELETION_BATCH_SIZE", 2)
+        monkeypatch.setattr(organization_module, "ORG_DELETION_CASE_PAGE_SIZE", 2)
+        batch_sizes = []
+        original_commit = fake_firestore.FakeWriteBatch.commit
+
+        def commit(batch):
+            batch_sizes.append(len(batch._writes))
+            return original_commit(batch)
+
+        monkeypatch.setattr(fake_firestore.FakeWriteBatch, "commit", commit)
+
+        assert organization_module.run_organization_deletion_job("org-1") is True
+
+        # Every batch stays within the configured size plus its checkpoint write
+        assert max(batch_sizes) <= 3
+        assert all(store.collection("cases").document(f"case-{i}").get().get("status") == "deleted" for i in range(5))
+        assert all(store.collection("documents").document(f"doc-{i}").get().get("status") == "deleted" for i in range(5))
+        assert not any(store.collection("parties").document(f"party-{i}").get().exists for i in range(5))
+        assert store.collection("parties").document("party-shared").get().exists
+        assert list(store.collection("organization_memberships").stream()) == []
+        assert not store.collection("organizations").document("org-1").get().exists
+        job = store.collection(organization_module.ORG_DELETION_JOBS_COLLECTION).document("org-1").get().to_dict()
+        assert job["status"] == "completed"
+        assert job["processed"] == {"cases": 5, "documents": 5, "parties": 5, "memberships": 3}
+
+    def test_pauses_at_the_deadline_and_resumes_from_the_checkpoint(self, store, monkeypatch):
+        monkeypatch.setattr(organization_module, "ORG_DELETION_BATCH_SIZE", 2)
+        clock = iter([0.0])
+        monkeypatch.setattr(organization_module.time, "monotonic", lambda: next(clock, 100.0))
+
+        assert organization_module.run_organization_deletion_job("org-1", deadline=50.0) is False
+
+        job_ref = store.collection(organization_module.ORG_DELETION_JOBS_COLLECTION).document("org-1")
+        job = job_ref.get().to_dict()
+        assert (job["status"], job["phase"], job["cursor"]) == ("pending", "cases", "case-1")
+        assert job["processed"]["cases"] == 2
+
+        monkeypatch.setattr(organization_module.time, "monotonic", lambda: 0.0)
+        completed, remaining = organization_module.run_pending_organization_deletion_jobs(budget_seconds=60)
+
+        assert (completed, remaining) == (1, 0)
+        job = job_ref.get().to_dict()
+        assert job["status"] == "completed"
+        assert job["processed"]["cases"] == 5
+
+    def test_skips_when_another_runner_holds_the_lease(self, store):
+        store.collection(organization_module.ORG_DELETION_JOBS_COLLECTION).document("org-1").update({
+            "status": "running", "leaseExpiresAt": datetime.now(timezone.utc) + timedelta(seconds=60),
+        })
+
+        assert organization_module.run_organization_deletion_job("org-1") is False
+        assert organization_module.run_pending_organization_deletion_jobs() == (0, 0)
+        assert store.collection("cases").document("case-0").get().get("status") == "open"
+
+
+class TestOrganizationStats:
+    """Tests for the incrementally maintained organization stats."""
+
+    def test_case_stats_deltas_for_status_and_assignment_changes(self):
+        created = organization_module.case_stats_deltas({}, {"status": "open"})
+        assert created == {"case_status_deltas": {"open": 1}, "workload_deltas": {}}
+
+        assigned = organization_module.case_stats_deltas(
+            {"status": "open", "assignedUserId": "u1"}, {"status": "open", "assignedUserId": "u2"}
+        )
+        assert assigned == {"case_status_deltas": {}, "workload_deltas": {"u1": -1, "u2": 1}}
+
+        archived = organization_module.case_stats_deltas(
+            {"status": "open", "assignedUserId": "u1"}, {"status": "archived", "assignedUserId": "u1"}
+        )
+        assert archived == {"case_status_deltas": {"open": -1, "archived": 1}, "workload_deltas": {"u1": -1}}
+
+    def test_stats_write_uses_atomic_increments(self, mock_db_client):
+        writer = MagicMock()
+
+        written = organization_module.add_organization_stats_write(
+            writer, "org-1", case_status_deltas={"open": 1}, storage_bytes=2048, document_count=1
+        )
+
+        assert written is True
+        stats_ref, stats_data = writer.set.call_args[0]
+        assert writer.set.call_args[1] == {"merge": True}
+        assert stats_data["casesByStatus"]["open"].value == 1
+        assert stats_data["storageBytes"].value == 2048
+        assert organization_module.add_organization_stats_write(writer, "org-1") is False
+
+    def test_get_organization_stats_reads_one_document(self, mock_db_client, mock_request):
+        mock_db_client.collection("organizations").document.return_value.get.return_value = _snapshot("org-1", {"name": "Firm"})
+        mock_db_client.collection(organization_module.ORG_STATS_COLLECTION).document.return_value.get.return_value = _snapshot("org-1", {
+            "casesByStatus": {"open": 4, "archived": 1, "deleted": 2},
+            "memberWorkloads": {"u1": 3, "u2": 0},
+            "storageBytes": 1024,
+            "documentCount": 2,
+            "rebuiltAt": datetime(2025, 1, 1, tzinfo=timezone.utc),
+        })
+
+        response, status_code = organization_module.get_organization_stats(
+            mock_request(end_user_id="admin-1", args={"organizationId": "org-1"})
+        )
+
+        assert status_code == 200
+        stats = response.get_json()
+        assert stats["totalCases"] == 5
+        assert stats["memberWorkloads"] == {"u1": 3}
+        assert stats["storageBytes"] == 1024
+        mock_db_client.collection("cases").where.assert_not_called()
+
+    def test_partial_stats_are_rebuilt_once_and_keep_later_increments(self, mock_request, monkeypatch):
+        db = fake_firestore.FakeFirestore()
+        monkeypatch.setattr(organization_module, "get_db_client", lambda: db)
+        monkeypatch.setattr(organization_module, "check_permission", MagicMock(return_value=(True, "")))
+        monkeypatch.setattr(organization_module.firestore, "transactional", fake_firestore.transactional)
+        db.collection("organizations").document("org-1").set({"name": "Firm"})
+        for i, status in enumerate(["open", "open", "archived"]):
+            db.collection("cases").document(f"old-{i}").set({"organizationId": "org-1", "status": status, "assignedUserId": "u1"})
+        db.collection("documents").document("doc-1").set({"caseId": "old-0", "fileSize": 100})
+        # The first case created after the rollout leaves a stats document with only its own counts
+        db.collection("cases").document("new-1").set({"organizationId": "org-1", "status": "open"})
+        batch = db.batch()
+        organization_module.add_organization_stats_write(batch, "org-1", case_status_deltas={"open": 1})
+        batch.commit()
+        request = mock_request(end_user_id="admin-1", args={"organizationId": "org-1"})
+
+        stats = organization_module.get_organization_stats(request)[0].get_json()
+
+        assert stats["casesByStatus"] == {"open": 3, "archived": 1}
+        assert stats["memberWorkloads"] == {"u1": 2}
+        assert (stats["storageBytes"], stats["documentCount"]) == (100, 1)
+
+        batch = db.batch()
+        organization_module.add_organization_stats_write(batch, "org-1", case_status_deltas={"open": 1})
+        batch.commit()
+        monkeypatch.setattr(organization_module, "rebuild_organization_stats", MagicMock())
+
+        assert organization_module.get_organization_stats(request)[0].get_json()["casesByStatus"]["open"] == 4
+        organization_module.rebuild_organization_stats.assert_not_called()
@@ -1 +1,275 @@
-# All tests in this file are removed because they depend on the Firestore emulator which is not available in the production environment.
+#!/usr/bin/env python3
+"""
+Unit Tests for Organization Membership Module
+
+This module contains unit tests for the functions in the organization_membership.py module.
+"""
+
+import pytest
+import sys
+import os
+from unittest.mock import MagicMock
+import flask
+
+# Add the functions/src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../functions/src'))
+
+import organization as organization_module
+import organization_membership as membership_module
+from common import clients as clients_module
+from tests.helpers import fake_firestore
+
+
+def _snapshot(doc_id, data, exists=True):
+    snapshot = MagicMock()
+    snapshot.id = doc_id
+    snapshot.exists = exists
+    snapshot.to_dict.return_value = data
+    return snapshot
+
+
+@pytest.fixture(autouse=True)
+def app_context():
+    """Provide a Flask application context so jsonify works."""
+    with flask.Flask(__name__).app_context():
+        yield
+
+
+@pytest.fixture
+def mock_db_client(monkeypatch):
+    """Create a mock Firestore client and patch get_db_client and check_permission."""
+    mock_client = MagicMock()
+    monkeypatch.setattr(membership_module, "get_db_client", lambda: mock_client)
+    monkeypatch.setattr(organization_module, "get_db_client", lambda: mock_client)
+    organization_module._org_summary_cache.clear()
+    monkeypatch.setattr(membership_module, "check_permission", MagicMock(return_value=(True, "")))
+    yield mock_client
+
+
+@pytest.fixture
+def mock_request():
+    """Create a mock Flask request."""
+    def _create_mock_request(end_user_id=None, json_data=None, args=None):
+        mock_req = MagicMock(spec=flask.Request)
+        mock_req.end_user_id = end_user_id
+        mock_req.get_json = MagicMock(return_value=json_data)
+        mock_req.args = args or {}
+        return mock_req
+
+    return _create_mock_request
+
+
+class TestListOrganizationMembers:
+    """Tests for the list_organization_members function."""
+
+    def _setup_members(self, mock_db_client, member_count):
+        memberships = [
+            _snapshot(f"org-1_user-{i}", {
+                "organizationId": "org-1",
+                "userId": f"user-{i}",
+                "role": "administrator" if i == 0 else "staff",
+                "addedBy": "user-0",
+            })
+            for i in range(member_count)
+        ]
+        profiles = {
+            f"user-{i}": _snapshot(f"user-{i}", {"displayName": f"User {i}", "email": f"user{i}@example.com"})
+            for i in range(member_count)
+        }
+
+        mock_db_client.collection.return_value.where.return_value.stream.return_value = iter(memberships)
+
+        def _get_all(refs):
+            return [profiles[ref.id] for ref in refs]
+
+        self.refs = []
+
+        def _document(doc_id):
+            ref = MagicMock()
+            ref.id = doc_id
+            self.refs.append(ref)
+            return ref
+
+        mock_db_client.collection.return_value.document.side_effect = _document
+        mock_db_client.get_all.side_effect = _get_all
+
+    @pytest.mark.parametrize("member_count", [3, 40])
+    def test_profiles_fetched_in_constant_round_trips(self, mock_db_client, mock_request, member_count):
+        """Member profiles are resolved with one get_all per chunk, never one get() per member."""
+        self._setup_members(mock_db_client, member_count)
+
+        response, status_code = membership_module.list_organization_members(
+            mock_request(end_user_id="user-0", args={"organizationId": "org-1"})
+        )
+
+        assert status_code == 200
+        members = response.get_json()["members"]
+        assert len(members) == member_count
+        assert {m["email"] for m in members} == {f"user{i}@example.com" for i in range(member_count)}
+        assert mock_db_client.get_all.call_count == 1
+        # Only the organization existence check goes through a single-document get()
+        assert sum(ref.get.call_count for ref in self.refs) == 1
+
+    def test_profiles_fetched_in_chunks(self, mock_db_client, mock_request, monkeypatch):
+        """Large member lists are split into GET_ALL_CHUNK_SIZE batched reads."""
+        monkeypatch.setattr(clients_module, "GET_ALL_CHUNK_SIZE", 10)
+        self._setup_members(mock_db_client, 25)
+
+        response, status_code = membership_module.list_organization_members(
+            mock_request(end_user_id="user-0", args={"organizationId": "org-1"})
+        )
+
+        assert status_code == 200
+        assert len(response.get_json()["members"]) == 25
+        assert mock_db_client.get_all.call_count == 3
+
+
+class TestListUserOrganizations:
+    """Tests for the list_user_organizations function."""
+
+    def _setup_orgs(self, mock_db_client, org_count):
+        memberships = [
+            _snapshot(f"org-{i}_user-1", {"organizationId": f"org-{i}", "userId": "user-1", "role": "staff"})
+            for i in range(org_count)
+        ]
+        orgs = {
+            f"org-{i}": _snapshot(f"org-{i}", {"name": f"Firm {i}", "description": f"Desc {i}"})
+            for i in range(org_count)
+        }
+
+        def _document(doc_id):
+            ref = MagicMock()
+            ref.id = doc_id
+            return ref
+
+        mock_db_client.collection.return_value.where.return_value.stream.side_effect = lambda: iter(memberships)
+        mock_db_client.collection.return_value.document.side_effect = _document
+        mock_db_client.get_all.side_effect = lambda refs: [orgs[ref.id] for ref in refs]
+        return orgs
+
+    def test_organizations_fetched_with_single_get_all(self, mock_db_client, mock_request):
+        """All organizations are resolved with one batched read."""
+        self._setup_orgs(mock_db_client, 12)
+
+        response, status_code = membership_module.list_user_organizations(mock_request(end_user_id="user-1"))
+
+        assert status_code == 200
+        organizations = response.get_json()["organizations"]
+        assert [o["name"] for o in organizations] == [f"Firm {i}" for i in range(12)]
+        assert mock_db_client.get_all.call_count == 1
+
+    def test_summary_cache_serves_repeat_calls_until_invalidated(self, mock_db_client, mock_request):
+        """Warm calls skip Firestore; invalidation forces a re-read of the changed organization."""
+        orgs = self._setup_orgs(mock_db_client, 3)
+        request = mock_request(end_user_id="user-1")
+
+        membership_module.list_user_organizations(request)
+        membership_module.list_user_organizations(request)
+        assert mock_db_client.get_all.call_count == 1
+
+        orgs["org-1"].to_dict.return_value = {"name": "Renamed", "description": ""}
+        organization_module.invalidate_organization_summary("org-1")
+        response, _ = membership_module.list_user_organizations(request)
+
+        assert mock_db_client.get_all.call_count == 2
+        assert len(mock_db_client.get_all.call_args[0][0]) == 1
+        assert response.get_json()["organizations"][1]["name"] == "Renamed"
+
+
+class TestLastAdministratorGuard:
+    """Tests for the adminCount-based last-administrator protection."""
+
+    @pytest.fixture(autouse=True)
+    def _plain_transactions(self, monkeypatch):
+        monkeypatch.setattr(membership_module.firestore, "transactional", lambda func: func)
+
+    def _setup_member(self, mock_db_client, role, admin_count):
+        member = _snapshot("org-1_user-2", {"organizationId": "org-1", "userId": "user-2", "role": role})
+        member.reference.get.return_value = member
+        mock_db_client.collection.return_value.where.return_value.where.return_value.limit.return_value.stream.return_value = iter([member])
+        org_ref = mock_db_client.collection.return_value.document.return_value
+        org_ref.get.return_value = _snapshot("org-1", {"name": "Firm", "adminCount": admin_count})
+        return member, org_ref
+
+    def test_demoting_last_admin_is_rejected_with_one_read(self, mock_db_client, mock_request):
+        member, _ = self._setup_member(mock_db_client, "administrator", 1)
+        transaction = mock_db_client.transaction.return_value
+
+        response, status_code = membership_module.update_organization_member_role(mock_request(
+            end_user_id="user-1", json_data={"organizationId": "org-1", "userId": "user-2", "newRole": "staff"}
+        ))
+
+        assert status_code == 400
+        assert "last administrator" in response.get_json()["message"]
+        transaction.update.assert_not_called()
+        # The guard reads the counter rather than streaming every administrator membership
+        mock_db_client.collection.return_value.where.return_value.where.return_value.stream.assert_not_called()
+
+    def test_demoting_admin_decrements_admin_count(self, mock_db_client, mock_request):
+        member, org_ref = self._setup_member(mock_db_client, "administrator", 2)
+        transaction = mock_db_client.transaction.return_value
+
+        _, status_code = membership_module.update_organization_member_role(mock_request(
+            end_user_id="user-1", json_data={"organizationId": "org-1", "userId": "user-2", "newRole": "staff"}
+        ))
+
+        assert status_code == 200
+        transaction.update.assert_any_call(org_ref, {"adminCount": 1})
+
+    def test_removing_last_admin_is_rejected(self, mock_db_client, mock_request):
+        self._setup_member(mock_db_client, "administrator", 1)
+        transaction = mock_db_client.transaction.return_value
+
+        response, status_code = membership_module.remove_organization_member(mock_request(
+            end_user_id="user-1", json_data={"organizationId": "org-1", "userId": "user-2"}
+        ))
+
+        assert status_code == 400
+        transaction.delete.assert_not_called()
+
+    def test_missing_counter_falls_back_to_count_aggregation(self, mock_db_client, mock_request):
+        member, org_ref = self._setup_member(mock_db_client, "administrator", None)
+        org_ref.get.return_value.to_dict.return_value = {"name": "Firm"}
+        aggregation = MagicMock()
+        aggregation.value = 3
+        admins_query = mock_db_client.collection.return_value.where.return_value.where.return_value
+        admins_query.count.return_value.get.return_value = [[aggregation]]
+        transaction = mock_db_client.transaction.return_value
+
+        _, status_code = membership_module.remove_organization_member(mock_request(
+            end_user_id="user-1", json_data={"organizationId": "org-1", "userId": "user-2"}
+        ))
+
+        assert status_code == 200
+        transaction.update.assert_any_call(org_ref, {"adminCount": 2})
+        transaction.delete.assert_called_once_with(member.reference)
+
+    def test_concurrent_adds_of_the_same_admin_count_them_once(self, monkeypatch, mock_request):
+        db = fake_firestore.FakeFirestore()
+        db.collection("organizations").document("org-1").set({"name": "Firm", "adminCount": 1})
+        db.collection("users").document("user-2").set({"id": "user-2"})
+        monkeypatch.setattr(membership_module, "get_db_client", lambda: db)
+        monkeypatch.setattr(membership_module.firestore, "transactional", fake_firestore.transactional)
+        monkeypatch.setattr(membership_module, "check_permission", MagicMock(return_value=(True, "")))
+        monkeypatch.setattr(membership_module, "_user_exists", lambda uid: True)
+        add = lambda: membership_module.add_organization_member(mock_request(
+            end_user_id="user-1", json_data={"organizationId": "org-1", "userId": "user-2", "role": "administrator"}
+        ))
+        # The second add runs to completion while the first one is inside its transaction
+        original_get_admin_count = membership_module._get_admin_count
+        calls = []
+        interleaved = []
+
+        def get_admin_count(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                interleaved.append(add())
+            return original_get_admin_count(*args)
+
+        monkeypatch.setattr(membership_module, "_get_admin_count", get_admin_count)
+
+        _, status_code = add()
+
+        assert status_code == 200
+        assert interleaved[0][1] == 200
+        assert db.collection("organizations").document("org-1").get().to_dict()["adminCount"] == 2
@@ -1,2 +1,299 @@
-# All tests in this file fail due to missing mocks, unavailable infrastructure, or dependencies that cannot be satisfied in a production-only environment.
-# This file is not feasible for production API testing and is removed. 
\ No newline at end of file
+#!/usr/bin/env python3
+"""
+Unit Tests for Payments Module
+
+This module contains unit tests for the functions in the payments.py module.
+"""
+
+import pytest
+import sys
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+# Add the functions/src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../functions/src'))
+
+import payments as payments_module
+from tests.helpers import fake_firestore
+
+
+PRODUCTS = {"subscriptions": [{"id": "prod_sub"}], "cases": [{"id": "prod_case", "tier": 1}]}
+
+
+def _snapshot(doc_id, data=None, exists=True):
+    snapshot = MagicMock()
+    snapshot.id = doc_id
+    snapshot.exists = exists
+    snapshot.to_dict.return_value = data or {}
+    return snapshot
+
+
+@pytest.fixture
+def mock_db_client(monkeypatch):
+    """Create a mock Firestore client and patch get_db_client."""
+    mock_client = MagicMock()
+    monkeypatch.setattr(payments_module, "get_db_client", lambda: mock_client)
+    monkeypatch.setattr(payments_module, "initialize_stripe", lambda: None)
+    monkeypatch.setattr(payments_module.firestore, "transactional", lambda func: func)
+    yield mock_client
+
+
+@pytest.fixture
+def product_cache(monkeypatch):
+    """Reset the in-process product cache around each test."""
+    monkeypatch.setattr(payments_module, "_product_cache", {
+        "data": None, "cachedAt": None, "refreshing": False, "nextRefreshAt": 0.0
+    })
+    monkeypatch.setattr(payments_module.stripe, "api_key", "sk_test_unit")
+    return payments_module._product_cache
+
+
+class TestGetProducts:
+    """Tests for the two-tier product cache behind logic_get_products."""
+
+    def test_warm_instance_serves_from_memory(self, mock_db_client, product_cache, monkeypatch):
+        product_cache.update(data=PRODUCTS, cachedAt=datetime.now(timezone.utc))
+        product_list = MagicMock()
+        monkeypatch.setattr(payments_module.stripe.Product, "list", product_list)
+
+        response, status_code = payments_module.logic_get_products(MagicMock())
+
+        assert status_code == 200
+        assert response == PRODUCTS
+        mock_db_client.document.assert_not_called()
+        product_list.assert_not_called()
+
+    def test_stale_memory_is_refreshed_inline_by_one_request(self, mock_db_client, product_cache, monkeypatch):
+        stale_at = datetime.now(timezone.utc) - timedelta(seconds=payments_module.CACHE_TTL + 1)
+        product_cache.update(data=PRODUCTS, cachedAt=stale_at)
+        fresh = {"subscriptions": [], "cases": []}
+        refreshes = []
+
+        def refresh(db):
+            refreshes.append(db)
+            # A request arriving during the refresh is served the stale copy without waiting
+            assert payments_module.logic_get_products(MagicMock()) == (PRODUCTS, 200)
+            payments_module._store_products_in_memory(fresh, datetime.now(timezone.utc))
+            return True
+
+        monkeypatch.setattr(payments_module, "refresh_product_cache", refresh)
+
+        assert payments_module.logic_get_products(MagicMock()) == (fresh, 200)
+        assert payments_module.logic_get_products(MagicMock()) == (fresh, 200)
+        assert refreshes == [mock_db_client]
+        assert product_cache["refreshing"] is False
+
+    def test_failed_refresh_serves_stale_and_backs_off(self, mock_db_client, product_cache, monkeypatch):
+        stale_at = datetime.now(timezone.utc) - timedelta(seconds=payments_module.CACHE_TTL + 1)
+        product_cache.update(data=PRODUCTS, cachedAt=stale_at)
+        refresh = MagicMock(side_effect=RuntimeError("Stripe unavailable"))
+        monkeypatch.setattr(payments_module, "refresh_product_cache", refresh)
+
+        for _ in range(3):
+            assert payments_module.logic_get_products(MagicMock()) == (PRODUCTS, 200)
+
+        # Later requests wait PRODUCT_REFRESH_RETRY_SECONDS before trying again
+        refresh.assert_called_once()
+        assert product_cache["refreshing"] is False
+
+    def test_cold_instance_loads_firestore_tier(self, mock_db_client, product_cache, monkeypatch):
+        mock_db_client.document.return_value.get.return_value = _snapshot(
+            "stripe_products", {"data": PRODUCTS, "cachedAt": datetime.now(timezone.utc)}
+        )
+        product_list = MagicMock()
+        monkeypatch.setattr(payments_module.stripe.Product, "list", product_list)
+
+        payments_module.logic_get_products(MagicMock())
+        response, status_code = payments_module.logic_get_products(MagicMock())
+
+        assert status_code == 200
+        assert response == PRODUCTS
+        assert mock_db_client.document.return_value.get.call_count == 1
+        product_list.assert_not_called()
+
+    def test_refresh_skips_stripe_when_another_instance_holds_the_lease(self, mock_db_client, product_cache, monkeypatch):
+        stale_at = datetime.now(timezone.utc) - timedelta(seconds=payments_module.CACHE_TTL + 1)
+        lease_until = datetime.now(timezone.utc) + timedelta(seconds=30)
+        mock_db_client.document.return_value.get.return_value = _snapshot(
+            "stripe_products", {"data": PRODUCTS, "cachedAt": stale_at, "refreshLeaseExpiresAt": lease_until}
+        )
+        product_list = MagicMock()
+        monkeypatch.setattr(payments_module.stripe.Product, "list", product_list)
+
+        assert payments_module.refresh_product_cache(mock_db_client) is False
+        product_list.assert_not_called()
+        mock_db_client.transaction.return_value.set.assert_not_called()
+
+    def test_refresh_with_lease_rewrites_both_tiers(self, mock_db_client, product_cache, monkeypatch):
+        stale_at = datetime.now(timezone.utc) - timedelta(seconds=payments_module.CACHE_TTL + 1)
+        cache_ref = mock_db_client.document.return_value
+        cache_ref.get.return_value = _snapshot("stripe_products", {"data": PRODUCTS, "cachedAt": stale_at})
+        fresh = {"subscriptions": [], "cases": []}
+        monkeypatch.setattr(payments_module, "_fetch_products_from_stripe", lambda deadline_seconds: fresh)
+
+        assert payments_module.refresh_product_cache(mock_db_client) is True
+
+        assert mock_db_client.transaction.return_value.set.call_args[1] == {"merge": True}
+        assert cache_ref.set.call_args[0][0]["data"] == fresh
+        assert product_cache["data"] == fresh
+
+
+class TestPromotionCodeValidation:
+    """Tests for the cached is_valid_promotion_code lookup."""
+
+    @pytest.fixture(autouse=True)
+    def _fresh_cache(self, monkeypatch):
+        monkeypatch.delenv("RELEX_TEST_MODE", raising=False)
+        monkeypatch.setattr(payments_module, "_promotion_code_cache", payments_module.TTLCache(60))
+
+    def _listing(self, *promos):
+        listing = MagicMock()
+        listing.data = list(promos)
+        return listing
+
+    def test_valid_code_is_looked_up_once(self, monkeypatch):
+        promo_list = MagicMock(return_value=self._listing({"code": "SPRING", "amount_off": 500}))
+        monkeypatch.setattr(payments_module.stripe.PromotionCode, "list", promo_list)
+
+        results = [payments_module.is_valid_promotion_code(code) for code in ("SPRING", "spring", "SPRING")]
+
+        assert all(valid for valid, _, _ in results)
+        promo_list.assert_called_once()
+
+    def test_unknown_code_is_negatively_cached(self, monkeypatch):
+        promo_list = MagicMock(return_value=self._listing())
+        monkeypatch.setattr(payments_module.stripe.PromotionCode, "list", promo_list)
+
+        for _ in range(3):
+            valid, _, message = payments_module.is_valid_promotion_code("NOPE")
+            assert valid is False
+            assert "not found" in message
+
+        promo_list.assert_called_once()
+
+    def test_stripe_errors_are_not_cached(self, monkeypatch):
+        promo_list = MagicMock(side_effect=[RuntimeError("timeout"), self._listing({"code": "SPRING"})])
+        monkeypatch.setattr(payments_module.stripe.PromotionCode, "list", promo_list)
+
+        assert payments_module.is_valid_promotion_code("SPRING")[0] is False
+        assert payments_module.is_valid_promotion_code("SPRING")[0] is True
+
+    def test_concurrent_lookups_share_one_call_and_release_their_lock(self, monkeypatch):
+        release = threading.Event()
+
+        def slow_list(**kwargs):
+            release.wait(1)
+            return self._listing({"code": "SPRING"})
+
+        promo_list = MagicMock(side_effect=slow_list)
+        monkeypatch.setattr(payments_module.stripe.PromotionCode, "list", promo_list)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(payments_module.is_valid_promotion_code("SPRING")))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert [valid for valid, _, _ in results] == [True] * 4
+        promo_list.assert_called_once()
+        assert payments_module._promotion_code_locks == {}
+
+
+class TestCheckoutSessionReuse:
+    """Tests for handing back open checkout sessions to repeated requests."""
+
+    @pytest.fixture
+    def checkout(self, monkeypatch):
+        db = fake_firestore.FakeFirestore()
+        monkeypatch.setattr(payments_module, "get_db_client", lambda: db)
+        monkeypatch.setattr(payments_module, "initialize_stripe", lambda: None)
+        monkeypatch.setattr(payments_module.firestore, "transactional", fake_firestore.transactional)
+        monkeypatch.delenv("RELEX_TEST_MODE", raising=False)
+        monkeypatch.setattr(payments_module.stripe, "api_key", "sk_test_unit")
+        monkeypatch.setattr(payments_module.flask, "jsonify", lambda data: data)
+        sessions = {}
+
+        def _create(idempotency_key=None, **params):
+            # Stripe hands back the first session created with an idempotency key
+            if idempotency_key not in sessions:
+                session_id = f"cs_{len(sessions) + 1}"
+                sessions[idempotency_key] = {"id": session_id, "url": f"https://checkout/{session_id}", "status": "open"}
+            return sessions[idempotency_key]
+
+        create = MagicMock(side_effect=_create)
+        monkeypatch.setattr(payments_module.stripe.checkout.Session, "create", create)
+        request = MagicMock()
+        request.get_json.return_value = {"amount": 4900, "caseId": "case-1"}
+        request.end_user_id = "user-1"
+        create.request = request
+        create.db = db
+        return create
+
+    def test_repeated_request_returns_the_open_session(self, checkout):
+        first, first_status = payments_module.create_checkout_session(checkout.request)
+        second, second_status = payments_module.create_checkout_session(checkout.request)
+
+        assert first_status == 201
+        assert second_status == 200
+        assert second["checkoutSessionId"] == first["checkoutSessionId"] == "cs_1"
+        assert second["reused"] is True
+        checkout.assert_called_once()
+
+    def test_concurrent_duplicates_share_a_stripe_idempotency_key(self, checkout):
+        responses = []
+        create = checkout.side_effect
+
+        def _create_with_a_duplicate_in_flight(**kwargs):
+            # The duplicate arrives while the first request is still waiting on Stripe
+            if checkout.call_count == 1:
+                responses.append(payments_module.create_checkout_session(checkout.request))
+            return create(**kwargs)
+
+        checkout.side_effect = _create_with_a_duplicate_in_flight
+        first, _ = payments_module.create_checkout_session(checkout.request)
+
+        keys = {call.kwargs["idempotency_key"] for call in checkout.call_args_list}
+        assert len(keys) == 1
+        assert responses[0][0]["checkoutSessionId"] == first["checkoutSessionId"] == "cs_1"
+
+    @pytest.mark.parametrize("change", [
+        {"promotionCode": "SPRING"}, {"currency": "ron"}, {"productName": "Appeal review"},
+        {"successUrl": "https://relex.ro/done"}, {"metadata": {"source": "dashboard"}},
+    ])
+    def test_different_purchase_creates_a_new_session(self, checkout, monkeypatch, change):
+        monkeypatch.setattr(payments_module, "is_valid_promotion_code", lambda code: (True, None, None))
+        payments_module.create_checkout_session(checkout.request)
+        checkout.request.get_json.return_value = {"amount": 4900, "caseId": "case-1", **change}
+
+        response, status_code = payments_module.create_checkout_session(checkout.request)
+
+        assert status_code == 201
+        assert response["checkoutSessionId"] == "cs_2"
+
+    def test_inactive_catalogue_plan_is_rejected(self, checkout, monkeypatch):
+        monkeypatch.setattr(payments_module, "get_plan", lambda plan_id: {
+            "id": plan_id, "stripePriceId": "price_old", "interval": "month", "isActive": False,
+        })
+        checkout.request.get_json.return_value = {"planId": "legacy_monthly"}
+
+        response, status_code = payments_module.create_checkout_session(checkout.request)
+
+        assert status_code == 400
+        assert "legacy_monthly" in response["message"]
+        checkout.assert_not_called()
+
+    def test_buying_again_after_completion_gets_a_new_session(self, checkout):
+        payments_module.create_checkout_session(checkout.request)
+        request_key = checkout.call_args.kwargs["metadata"]["requestKey"]
+
+        payments_module._forget_checkout_session(checkout.db, {"id": "cs_1", "metadata": {"requestKey": request_key}})
+        response, status_code = payments_module.create_checkout_session(checkout.request)
+
+        assert status_code == 201
+        assert response["checkoutSessionId"] == "cs_2"
+        first_key, second_key = (call.kwargs["idempotency_key"] for call in checkout.call_args_list)
+        assert first_key != second_key
@@ -1,2 +1,425 @@
-# All tests in this file require Stripe emulator, Firestore emulator, or unavailable infrastructure.
-# This file is not feasible for production API testing and is removed.
+#!/usr/bin/env python3
+"""
+Unit Tests for Stripe Webhook Handling
+
+This module contains unit tests for the webhook ingest and event processing in payments.py.
+"""
+
+import json
+import pytest
+import sys
+import os
+from unittest.mock import MagicMock
+
+from google.cloud.exceptions import Conflict
+
+# Add the functions/src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../functions/src'))
+
+import payments as payments_module
+from tests.helpers import fake_firestore
+
+
+def _snapshot(doc_id, data=None, exists=True):
+    snapshot = MagicMock()
+    snapshot.id = doc_id
+    snapshot.exists = exists
+    snapshot.to_dict.return_value = data or {}
+    return snapshot
+
+
+def _event(event_id="evt_1", event_type="invoice.payment_failed", created=1700000000, obj=None):
+    return {
+        "id": event_id,
+        "object": "event",
+        "type": event_type,
+        "created": created,
+        "data": {"object": obj or {"object": "invoice", "id": "in_1", "subscription": "sub_1"}},
+    }
+
+
+@pytest.fixture
+def mock_db_client(monkeypatch):
+    """Create a mock Firestore client with one mock per collection."""
+    mock_client = MagicMock()
+    collections = {}
+
+    def _collection(name):
+        if name not in collections:
+            collections[name] = MagicMock(name=f"collection:{name}")
+        return collections[name]
+
+    mock_client.collection.side_effect = _collection
+    monkeypatch.setattr(payments_module, "get_db_client", lambda: mock_client)
+    monkeypatch.setattr(payments_module, "initialize_stripe", lambda: None)
+    monkeypatch.setattr(payments_module.firestore, "transactional", lambda func: func)
+    yield mock_client
+
+
+@pytest.fixture
+def webhook_request(monkeypatch):
+    """Create a signed-looking webhook request whose signature check is patched to succeed."""
+    monkeypatch.setenv("STRIPE_WEBHOOK_SECRET", "whsec_unit")
+    worker = MagicMock()
+    monkeypatch.setattr(payments_module, "process_stripe_event", worker)
+
+    def _create(event):
+        monkeypatch.setattr(payments_module.stripe.Webhook, "construct_event", lambda payload, sig, secret: event)
+        request = MagicMock()
+        request.data = json.dumps(event).encode("utf-8")
+        request.headers = {"Stripe-Signature": "t=1,v1=sig"}
+        request.worker = worker
+        return request
+
+    return _create
+
+
+class TestWebhookIngest:
+    """Tests for the ingest step of handle_stripe_webhook."""
+
+    def test_records_event_and_processes_it_before_acking(self, mock_db_client, webhook_request):
+        request = webhook_request(_event())
+
+        response, status_code = payments_module.handle_stripe_webhook(request)
+
+        assert status_code == 200
+        assert response["eventId"] == "evt_1"
+        events = mock_db_client.collection(payments_module.STRIPE_EVENTS_COLLECTION)
+        events.document.assert_called_once_with("evt_1")
+        record = events.document.return_value.create.call_args[0][0]
+        assert record["status"] == "pending"
+        assert record["created"] == 1700000000
+        assert json.loads(record["payload"])["type"] == "invoice.payment_failed"
+        request.worker.assert_called_once_with("evt_1")
+
+    def test_duplicate_delivery_is_acknowledged(self, mock_db_client, webhook_request):
+        request = webhook_request(_event())
+        events = mock_db_client.collection(payments_module.STRIPE_EVENTS_COLLECTION)
+        events.document.return_value.create.side_effect = Conflict("already exists")
+
+        response, status_code = payments_module.handle_stripe_webhook(request)
+
+        assert status_code == 200
+        assert "Duplicate" in response["message"]
+
+    def test_record_failure_lets_stripe_retry(self, mock_db_client, webhook_request):
+        request = webhook_request(_event())
+        events = mock_db_client.collection(payments_module.STRIPE_EVENTS_COLLECTION)
+        events.document.return_value.create.side_effect = RuntimeError("unavailable")
+
+        _, status_code = payments_module.handle_stripe_webhook(request)
+
+        assert status_code == 500
+        request.worker.assert_not_called()
+
+
+class TestStripeEventProcessing:
+    """Tests for the event processor and the scheduled drain."""
+
+    def _record(self, mock_db_client, event, status="pending", attempts=0):
+        event_ref = mock_db_client.collection(payments_module.STRIPE_EVENTS_COLLECTION).document.return_value
+        event_ref.get.return_value = _snapshot(event["id"], {
+            "eventId": event["id"], "created": event["created"], "payload": json.dumps(event),
+            "status": status, "attempts": attempts,
+        })
+        return event_ref
+
+    def test_processed_event_is_not_applied_again(self, mock_db_client, monkeypatch):
+        self._record(mock_db_client, _event(), status="processed")
+        apply_event = MagicMock()
+        monkeypatch.setattr(payments_module, "_apply_stripe_event", apply_event)
+
+        assert payments_module.process_stripe_event("evt_1") is False
+        apply_event.assert_not_called()
+
+    def test_event_is_applied_and_marked_processed(self, mock_db_client, monkeypatch):
+        event_ref = self._record(mock_db_client, _event())
+        monkeypatch.setattr(payments_module, "_apply_stripe_event", lambda db, event, subscription_cache: f"Processed {event['type']}")
+
+        assert payments_module.process_stripe_event("evt_1") is True
+        assert event_ref.update.call_args[0][0]["status"] == "processed"
+
+    def test_failure_is_recorded_for_retry(self, mock_db_client, monkeypatch):
+        event_ref = self._record(mock_db_client, _event(), status="failed", attempts=1)
+        monkeypatch.setattr(payments_module, "_apply_stripe_event", MagicMock(side_effect=RuntimeError("boom")))
+
+        assert payments_module.process_stripe_event("evt_1") is False
+        update = event_ref.update.call_args[0][0]
+        assert update["status"] == "failed"
+        assert update["error"] == "boom"
+
+    def test_older_event_does_not_overwrite_newer_state(self, mock_db_client):
+        target_ref = MagicMock()
+        target_ref.get.return_value = _snapshot("user-1", {"stripeEventCreatedByField": {"subscriptionStatus": 1700000100}})
+        transaction = mock_db_client.transaction.return_value
+
+        applied = payments_module._apply_subscription_update(
+            mock_db_client, target_ref, {"subscriptionStatus": "past_due"}, 1700000000
+        )
+
+        assert applied == []
+        transaction.update.assert_not_called()
+
+    def test_newer_event_records_its_timestamp_per_field(self, mock_db_client):
+        target_ref = MagicMock()
+        target_ref.get.return_value = _snapshot("user-1", {"stripeEventCreatedByField": {"subscriptionStatus": 1700000000}})
+        transaction = mock_db_client.transaction.return_value
+
+        applied = payments_module._apply_subscription_update(
+            mock_db_client, target_ref, {"subscriptionStatus": "active"}, 1700000100
+        )
+
+        assert applied == ["subscriptionStatus"]
+        transaction.update.assert_called_once_with(
+            target_ref, {"subscriptionStatus": "active", "stripeEventCreatedByField.subscriptionStatus": 1700000100}
+        )
+
+    @pytest.fixture
+    def store(self, monkeypatch):
+        db = fake_firestore.FakeFirestore()
+        monkeypatch.setattr(payments_module, "get_db_client", lambda: db)
+        monkeypatch.setattr(payments_module, "initialize_stripe", lambda: None)
+        monkeypatch.setattr(payments_module.firestore, "transactional", fake_firestore.transactional)
+        monkeypatch.setattr(payments_module, "get_plan", lambda plan_id: {"caseQuotaTotal": 5})
+        db.collection("users").document("user-1").set({
+            "stripeSubscriptionId": "sub_1", "subscriptionPlanId": "individual_monthly", "caseQuotaUsed": 4,
+        })
+        db.collection(payments_module.STRIPE_SUBSCRIPTIONS_COLLECTION).document("sub_1").set(
+            {"targetType": "user", "targetId": "user-1"}
+        )
+        return db
+
+    def test_late_invoice_still_resets_quota_after_newer_status_change(self, store):
+        failed = _event("evt_2", "invoice.payment_failed", created=1700000200)
+        paid = _event("evt_1", "invoice.paid", created=1700000100, obj={
+            "object": "invoice", "id": "in_1", "subscription": "sub_1",
+            "lines": {"data": [{"type": "subscription", "period": {"start": 1700000000, "end": 1702592000}}]},
+        })
+
+        for event in (failed, paid):
+            payments_module._apply_stripe_event(store, payments_module.stripe.Event.construct_from(event, None))
+
+        user = store.collection("users").document("user-1").get().to_dict()
+        assert user["subscriptionStatus"] == "past_due"
+        assert user["caseQuotaUsed"] == 0
+        assert user["billingCycleEnd"].timestamp() == 1702592000
+        assert user["stripeEventCreatedByField"]["caseQuotaUsed"] == 1700000100
+
+    def test_drain_processes_the_oldest_events_first(self, store, monkeypatch):
+        for event_id, created, status in (("evt_new", 300, "pending"), ("evt_old", 100, "failed"),
+                                          ("evt_mid", 200, "pending"), ("evt_done", 50, "processed")):
+            store.collection(payments_module.STRIPE_EVENTS_COLLECTION).document(event_id).set({
+                "eventId": event_id, "created": created, "status": status,
+            })
+        processed = []
+        monkeypatch.setattr(payments_module, "process_stripe_event",
+                            lambda event_id, subscription_cache: processed.append(event_id) or True)
+
+        assert payments_module.process_pending_stripe_events(limit=2) == 2
+        assert processed == ["evt_old", "evt_mid"]
+
+        body, status_code = payments_module.process_stripe_events(MagicMock())
+        assert (body, status_code) == ({"success": True, "processed": 3}, 200)
+
+
+class TestSubscriptionIndex:
+    """Tests for the stripe_subscriptions index used to resolve webhook targets."""
+
+    def test_target_resolved_with_one_point_read(self, mock_db_client):
+        index = mock_db_client.collection(payments_module.STRIPE_SUBSCRIPTIONS_COLLECTION)
+        index.document.return_value.get.return_value = _snapshot(
+            "sub_1", {"targetType": "organization", "targetId": "org-1"}
+        )
+
+        assert payments_module._find_subscription_target(mock_db_client, "sub_1") == ("organization", "org-1")
+        mock_db_client.collection("organizations").where.assert_not_called()
+        mock_db_client.collection("users").where.assert_not_called()
+
+    def test_unindexed_subscription_is_found_once_and_indexed(self, mock_db_client):
+        index = mock_db_client.collection(payments_module.STRIPE_SUBSCRIPTIONS_COLLECTION)
+        index.document.return_value.get.return_value = _snapshot("sub_1", exists=False)
+        mock_db_client.collection("organizations").where.return_value.limit.return_value.stream.return_value = iter([])
+        mock_db_client.collection("users").where.return_value.limit.return_value.stream.return_value = iter([_snapshot("user-1")])
+
+        assert payments_module._find_subscription_target(mock_db_client, "sub_1") == ("user", "user-1")
+        index_data = index.document.return_value.set.call_args[0][0]
+        assert index_data["targetType"] == "user"
+        assert index_data["targetId"] == "user-1"
+
+    def test_deleted_subscription_is_removed_from_index(self, mock_db_client, monkeypatch):
+        index = mock_db_client.collection(payments_module.STRIPE_SUBSCRIPTIONS_COLLECTION)
+        index.document.return_value.get.return_value = _snapshot("sub_1", {"targetType": "user", "targetId": "user-1"})
+        monkeypatch.setattr(payments_module, "_apply_subscription_update", MagicMock(return_value=True))
+        event = payments_module.stripe.Event.construct_from(
+            _event(event_type="customer.subscription.deleted", obj={"object": "subscription", "id": "sub_1"}), None
+        )
+
+        payments_module._apply_stripe_event(mock_db_client, event)
+
+        target_ref = payments_module._apply_subscription_update.call_args[0][1]
+        assert target_ref is mock_db_client.collection("users").document.return_value
+        index.document.return_value.delete.assert_called_once()
+
+
+class TestPayloadFirstProcessing:
+    """Tests that webhook processing uses event payloads before calling Stripe."""
+
+    @pytest.fixture
+    def indexed_user(self, mock_db_client, monkeypatch):
+        index = mock_db_client.collection(payments_module.STRIPE_SUBSCRIPTIONS_COLLECTION)
+        index.document.return_value.get.return_value = _snapshot("sub_1", {"targetType": "user", "targetId": "user-1"})
+        mock_db_client.collection("users").document.return_value.get.return_value = _snapshot("user-1", {"caseQuotaTotal": 5})
+        monkeypatch.setattr(payments_module, "_apply_subscription_update", MagicMock(return_value=True))
+        retrieve = MagicMock(return_value={"id": "sub_1", "current_period_start": 1700000000, "current_period_end": 1702592000})
+        monkeypatch.setattr(payments_module.stripe.Subscription, "retrieve", retrieve)
+        return retrieve
+
+    def _invoice_event(self, lines=None):
+        invoice = {"object": "invoice", "id": "in_1", "subscription": "sub_1", "lines": {"data": lines or []}}
+        return payments_module.stripe.Event.construct_from(_event(event_type="invoice.paid", obj=invoice), None)
+
+    def test_invoice_period_read_from_payload(self, mock_db_client, indexed_user):
+        event = self._invoice_event([{"type": "subscription", "period": {"start": 1700000000, "end": 1702592000}}])
+
+        payments_module._apply_stripe_event(mock_db_client, event, {})
+
+        indexed_user.assert_not_called()
+        update = payments_module._apply_subscription_update.call_args[0][2]
+        assert update["billingCycleStart"].timestamp() == 1700000000
+        assert update["billingCycleEnd"].timestamp() == 1702592000
+
+    def test_missing_period_fetched_once_per_batch(self, mock_db_client, indexed_user):
+        subscription_cache = {}
+
+        payments_module._apply_stripe_event(mock_db_client, self._invoice_event(), subscription_cache)
+        payments_module._apply_stripe_event(mock_db_client, self._invoice_event(), subscription_cache)
+
+        indexed_user.assert_called_once_with("sub_1")
+        update = payments_module._apply_subscription_update.call_args[0][2]
+        assert update["billingCycleEnd"].timestamp() == 1702592000
+
+    def test_subscription_updated_reads_item_level_period(self, mock_db_client, indexed_user):
+        subscription = {
+            "object": "subscription", "id": "sub_1", "status": "active",
+            "items": {"data": [{"current_period_start": 1700000000, "current_period_end": 1702592000}]},
+        }
+        event = payments_module.stripe.Event.construct_from(
+            _event(event_type="customer.subscription.updated", obj=subscription), None
+        )
+
+        payments_module._apply_stripe_event(mock_db_client, event, {})
+
+        indexed_user.assert_not_called()
+        update = payments_module._apply_subscription_update.call_args[0][2]
+        assert update["subscriptionStatus"] == "active"
+        assert update["billingCycleEnd"].timestamp() == 1702592000
+
+
+class TestSubscriptionReconciliation:
+    """Tests for the bulk Stripe-to-Firestore subscription reconciliation."""
+
+    @pytest.fixture
+    def store(self, monkeypatch):
+        db = fake_firestore.FakeFirestore()
+        monkeypatch.setattr(payments_module, "get_db_client", lambda: db)
+        monkeypatch.setattr(payments_module, "initialize_stripe", lambda: None)
+        monkeypatch.setattr(payments_module, "get_plan_by_price_id", lambda price_id: {
+            "price_ind": {"id": "individual_monthly", "caseQuotaTotal": 5},
+        }.get(price_id))
+        db.collection("users").document("user-1").set({
+            "stripeSubscriptionId": "sub_1", "subscriptionStatus": "past_due", "subscriptionPlanId": "individual_monthly",
+            "caseQuotaTotal": 5,
+        })
+        db.collection("users").document("user-2").set({
+            "stripeSubscriptionId": "sub_2", "subscriptionStatus": "active", "caseQuotaTotal": 5, "caseQuotaUsed": 1,
+        })
+        for sub_id, user_id in (("sub_1", "user-1"), ("sub_2", "user-2")):
+            db.collection(payments_module.STRIPE_SUBSCRIPTIONS_COLLECTION).document(sub_id).set(
+                {"targetType": "user", "targetId": user_id}
+            )
+        return db
+
+    def _stripe_subscriptions(self, monkeypatch, subscriptions):
+        listing = MagicMock()
+        listing.auto_paging_iter.return_value = iter(subscriptions)
+        subscription_list = MagicMock(return_value=listing)
+        monkeypatch.setattr(payments_module.stripe.Subscription, "list", subscription_list)
+        return subscription_list
+
+    def _subscriptions(self):
+        return [
+            {"id": "sub_1", "status": "active", "current_period_start": 1700000000, "current_period_end": 1702592000,
+             "items": {"data": [{"price": {"id": "price_ind"}}]}},
+            {"id": "sub_2", "status": "canceled"},
+        ]
+
+    def test_dry_run_reports_the_diff_without_writing(self, store, monkeypatch):
+        self._stripe_subscriptions(monkeypatch, self._subscriptions())
+        before = {key: dict(value) for key, value in store.docs.items()}
+
+        report = payments_module.reconcile_subscriptions(dry_run=True)
+
+        assert report["mode"] == "full"
+        assert report["corrected"] == 2
+        fields = {change["targetId"]: change["fields"] for change in report["changes"]}
+        assert fields["user-1"]["subscriptionStatus"] == {"current": "past_due", "expected": "active"}
+        assert fields["user-2"]["stripeSubscriptionId"] == {"current": "sub_2", "expected": None}
+        assert store.docs == before
+
+    def test_corrections_are_applied_and_watermark_stored(self, store, monkeypatch):
+        self._stripe_subscriptions(monkeypatch, self._subscriptions())
+
+        payments_module.reconcile_subscriptions()
+
+        user_1 = store.collection("users").document("user-1").get().to_dict()
+        assert user_1["subscriptionStatus"] == "active"
+        assert user_1["billingCycleEnd"].timestamp() == 1702592000
+        assert "stripeEventCreatedByField" not in user_1
+        user_2 = store.collection("users").document("user-2").get().to_dict()
+        assert user_2["subscriptionStatus"] == "inactive"
+        assert "stripeSubscriptionId" not in user_2
+        assert not store.collection(payments_module.STRIPE_SUBSCRIPTIONS_COLLECTION).document("sub_2").get().exists
+        assert store.document(payments_module.RECONCILIATION_DOC_PATH).get().to_dict()["watermark"] > 0
+
+    def test_webhook_created_before_the_scan_still_applies(self, store, monkeypatch):
+        self._stripe_subscriptions(monkeypatch, self._subscriptions())
+        monkeypatch.setattr(payments_module, "get_plan", lambda plan_id: {"caseQuotaTotal": 5})
+        monkeypatch.setattr(payments_module.firestore, "transactional", fake_firestore.transactional)
+        store.collection("users").document("user-1").update({"caseQuotaUsed": 3})
+        invoice_paid = _event(event_type="invoice.paid", created=int(payments_module.time.time()) - 60, obj={
+            "object": "invoice", "id": "in_1", "subscription": "sub_1",
+            "lines": {"data": [{"type": "subscription", "period": {"start": 1700000000, "end": 1702592000}}]},
+        })
+
+        payments_module.reconcile_subscriptions()
+        payments_module._apply_stripe_event(store, payments_module.stripe.Event.construct_from(invoice_paid, None))
+
+        assert store.collection("users").document("user-1").get().to_dict()["caseQuotaUsed"] == 0
+
+    def test_incremental_run_uses_newest_event_since_watermark(self, store, monkeypatch):
+        store.document(payments_module.RECONCILIATION_DOC_PATH).set({"watermark": int(payments_module.time.time()) - 3600})
+        subscription_list = self._stripe_subscriptions(monkeypatch, [])
+        events = MagicMock()
+        events.auto_paging_iter.return_value = iter([
+            {"data": {"object": {"id": "sub_1", "status": "past_due"}}},
+            {"data": {"object": {"id": "sub_1", "status": "active"}}},
+        ])
+        monkeypatch.setattr(payments_module.stripe.Event, "list", MagicMock(return_value=events))
+
+        report = payments_module.reconcile_subscriptions()
+
+        assert report["mode"] == "incremental"
+        assert report["scanned"] == 1
+        subscription_list.assert_not_called()
+        assert store.collection("users").document("user-1").get().to_dict()["subscriptionStatus"] == "past_due"
+
+    def test_target_linked_to_another_subscription_is_left_alone(self, store, monkeypatch):
+        store.collection(payments_module.STRIPE_SUBSCRIPTIONS_COLLECTION).document("sub_old").set(
+            {"targetType": "user", "targetId": "user-1"}
+        )
+        self._stripe_subscriptions(monkeypatch, [{"id": "sub_old", "status": "canceled"}])
+
+        report = payments_module.reconcile_subscriptions()
+
+        assert report["superseded"] == 1
+        assert store.collection("users").document("user-1").get().to_dict()["stripeSubscriptionId"] == "sub_1"
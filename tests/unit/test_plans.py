@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for Plans Module
+
+This module contains unit tests for the in-process plan catalogue in plans.py.
+"""
+
+import pytest
+import sys
+import os
+from unittest.mock import MagicMock
+
+# Add the functions/src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../functions/src'))
+
+import plans as plans_module
+
+
+def _snapshot(doc_id, data):
+    snapshot = MagicMock()
+    snapshot.id = doc_id
+    snapshot.exists = True
+    snapshot.to_dict.return_value = data
+    return snapshot
+
+
+@pytest.fixture
+def mock_db_client(monkeypatch):
+    """Create a mock Firestore client holding two plans and reset the catalogue."""
+    mock_client = MagicMock()
+    plans = [
+        _snapshot("individual_monthly", {"caseQuotaTotal": 5, "stripePriceId": "price_ind"}),
+        _snapshot("org_basic_monthly", {"caseQuotaTotal": 20, "stripePriceId": "price_org"}),
+    ]
+    mock_client.collection.return_value.stream.side_effect = lambda: iter(plans)
+    mock_client.plans = plans
+    monkeypatch.setattr(plans_module, "get_db_client", lambda: mock_client)
+    monkeypatch.setattr(plans_module, "_last_loaded_at", 0.0)
+    plans_module.invalidate_plan_catalogue()
+    yield mock_client
+    plans_module.invalidate_plan_catalogue()
+
+
+class TestPlanCatalogue:
+    """Tests for plan lookups by ID and by Stripe price ID."""
+
+    def test_lookups_share_one_load(self, mock_db_client):
+        assert plans_module.get_plan("individual_monthly")["caseQuotaTotal"] == 5
+        assert plans_module.get_plan_by_price_id("price_org")["id"] == "org_basic_monthly"
+        assert plans_module.get_plan("org_basic_monthly")["stripePriceId"] == "price_org"
+
+        assert mock_db_client.collection.return_value.stream.call_count == 1
+
+    def test_miss_reloads_at_most_once_per_interval(self, mock_db_client, monkeypatch):
+        plans_module.get_plan("individual_monthly")
+        monkeypatch.setattr(plans_module, "_last_loaded_at", 0.0)
+        mock_db_client.plans.append(_snapshot("new_plan", {"caseQuotaTotal": 50}))
+
+        assert plans_module.get_plan("new_plan")["caseQuotaTotal"] == 50
+        assert plans_module.get_plan("missing") is None
+        assert plans_module.get_plan("missing") is None
+
+        # The initial load plus one reload for the first miss; later misses hit the interval
+        assert mock_db_client.collection.return_value.stream.call_count == 2
+
+    def test_invalidate_forces_reload(self, mock_db_client):
+        plans_module.get_plan("individual_monthly")
+        mock_db_client.plans[0].to_dict.return_value = {"caseQuotaTotal": 8, "stripePriceId": "price_ind"}
+
+        plans_module.invalidate_plan_catalogue()
+
+        assert plans_module.get_plan_by_price_id("price_ind")["caseQuotaTotal"] == 8
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for the Quota Ledger
+
+This module contains unit tests for the sharded quota ledger in quota.py and its use by
+agent_tools.check_quota and agent_tools.update_quota_usage.
+"""
+
+import asyncio
+import pytest
+import sys
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock
+
+# Add the functions/src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../functions/src'))
+
+import agent as agent_module
+import agent_orchestrator as agent_orchestrator_module
+import agent_tools as agent_tools_module
+import payments as payments_module
+import quota as quota_module
+from tests.helpers import fake_firestore
+
+
+@pytest.fixture
+def store(monkeypatch):
+    """Back the quota ledger with an in-memory Firestore."""
+    db = fake_firestore.FakeFirestore()
+    monkeypatch.setattr(agent_tools_module, "get_db", lambda: db)
+    monkeypatch.setattr(quota_module.firestore, "transactional", fake_firestore.transactional)
+    monkeypatch.setattr(quota_module, "QUOTA_SHARD_COUNT", 4)
+    monkeypatch.setattr(quota_module, "_quota_usage_cache", quota_module.TTLCache(60))
+    monkeypatch.setattr(quota_module, "_quota_snapshot_cache", quota_module.TTLCache(60))
+    return db
+
+
+def _user(store, user_id="user-1", quota_limit=5, quota_used=0, period=datetime(2026, 10, 1, tzinfo=timezone.utc)):
+    user_ref = store.collection("users").document(user_id)
+    user_ref.set({
+        "subscription": {"quota_limit": quota_limit, "quota_used": quota_used, "tier": 1},
+        "billingCycleStart": period,
+    })
+    return user_ref
+
+
+def _usage(store, user_ref):
+    return quota_module.get_quota_usage(store, "users", user_ref, user_ref.get().to_dict())
+
+
+class TestQuotaLedger:
+    """Tests for reservations against the sharded quota ledger."""
+
+    def test_reservations_stop_exactly_at_the_limit(self, store):
+        user_ref = _user(store, quota_limit=5, quota_used=2)
+
+        reservations = [quota_module.reserve_quota(store, "users", "user-1") for _ in range(3)]
+        with pytest.raises(quota_module.QuotaExceeded):
+            quota_module.reserve_quota(store, "users", "user-1")
+
+        assert len({reservation["id"] for reservation in reservations}) == 3
+        assert _usage(store, user_ref) == (2, 3)
+
+    def test_concurrent_reservations_never_exceed_the_limit(self, store):
+        user_ref = _user(store, quota_limit=10)
+
+        def reserve(_):
+            try:
+                return quota_module.reserve_quota(store, "users", "user-1")
+            except (quota_module.QuotaExceeded, quota_module.Aborted):
+                return None
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(reserve, range(30)))
+
+        reserved = sum(1 for reservation in results if reservation)
+        assert reserved <= 10
+        assert _usage(store, user_ref) == (0, reserved)
+
+    def test_commit_and_release_settle_the_reservation_once(self, store):
+        user_ref = _user(store, quota_limit=2)
+        first = quota_module.reserve_quota(store, "users", "user-1")
+        second = quota_module.reserve_quota(store, "users", "user-1")
+
+        assert quota_module.commit_quota(store, first) is True
+        assert quota_module.commit_quota(store, first) is False
+        assert quota_module.release_quota(store, second) is True
+
+        assert _usage(store, user_ref) == (1, 0)
+        quota_module.reserve_quota(store, "users", "user-1")
+        with pytest.raises(quota_module.QuotaExceeded):
+            quota_module.reserve_quota(store, "users", "user-1")
+
+    def test_expired_reservations_are_given_back(self, store, monkeypatch):
+        _user(store, quota_limit=1)
+        monkeypatch.setattr(quota_module, "QUOTA_RESERVATION_TTL_SECONDS", -1)
+        abandoned = quota_module.reserve_quota(store, "users", "user-1")
+
+        replacement = quota_module.reserve_quota(store, "users", "user-1")
+
+        assert replacement["id"] != abandoned["id"]
+        assert quota_module.release_quota(store, abandoned) is False
+
+    def test_renewal_and_limit_changes_reprovision_the_shards(self, store):
+        user_ref = _user(store, quota_limit=2)
+        for _ in range(2):
+            quota_module.commit_quota(store, quota_module.reserve_quota(store, "users", "user-1"))
+
+        user_ref.update({"subscription.quota_limit": 3})
+        quota_module.reserve_quota(store, "users", "user-1")
+        assert _usage(store, user_ref) == (2, 1)
+
+        user_ref.update({"billingCycleStart": datetime(2026, 11, 1, tzinfo=timezone.utc)})
+        assert _usage(store, user_ref) == (0, 0)
+        for _ in range(3):
+            quota_module.reserve_quota(store, "users", "user-1")
+        with pytest.raises(quota_module.QuotaExceeded):
+            quota_module.reserve_quota(store, "users", "user-1")
+
+
+class TestAgentQuotaTools:
+    """Tests for the agent quota tools on top of the ledger."""
+
+    def test_check_quota_counts_usage_and_reservations(self, store):
+        _user(store, quota_limit=5, quota_used=1)
+        reservation = asyncio.run(agent_tools_module.reserve_quota_usage("user-1"))
+        asyncio.run(agent_tools_module.update_quota_usage("user-1", reservation=reservation))
+        asyncio.run(agent_tools_module.reserve_quota_usage("user-1"))
+
+        result = asyncio.run(agent_tools_module.check_quota("user-1"))
+
+        assert result["quota_used"] == 2
+        assert result["quota_reserved"] == 1
+        assert result["available_requests"] == 2
+
+    def test_organization_runs_reserve_the_organization_quota(self, store):
+        _user(store, quota_limit=0)
+        org_ref = store.collection("organizations").document("org-1")
+        org_ref.set({"quota_limit": 1, "quota_used": 0})
+
+        reservation = asyncio.run(agent_tools_module.reserve_quota_usage("user-1", "org-1"))
+        with pytest.raises(quota_module.QuotaExceeded):
+            asyncio.run(agent_tools_module.reserve_quota_usage("user-1", "org-1"))
+        asyncio.run(agent_tools_module.update_quota_usage("user-1", "org-1", reservation=reservation))
+
+        assert quota_module.get_quota_usage(store, "organizations", org_ref, org_ref.get().to_dict()) == (1, 0)
+        user_ref = store.collection("users").document("user-1")
+        assert _usage(store, user_ref) == (1, 0)
+
+    def test_agent_turns_release_quota_unless_they_complete(self, store):
+        user_ref = _user(store, quota_limit=1)
+        graph = agent_orchestrator_module.AgentGraph()
+        graph._analyze_input_node = AsyncMock(side_effect=[RuntimeError("Gemini unavailable"),
+                                                          {"status": "success"}])
+        graph._research_node = AsyncMock(return_value={"status": "success"})
+        graph._guidance_node = AsyncMock(return_value={"status": "success"})
+        graph._generate_response_node = AsyncMock(return_value={"status": "success"})
+        state = agent_orchestrator_module.AgentState(case_id="case-1", user_id="user-1",
+                                                     case_details={"input": "question"}, user_info={})
+
+        failed = asyncio.run(graph.execute(state))
+        assert failed["status"] == "error"
+        assert state.quota_reservation is None
+        assert _usage(store, user_ref) == (0, 0)
+
+        # The retried turn skips the quota check but holds quota again, and commits it
+        result = asyncio.run(graph.execute(state))
+        assert result["status"] == "success"
+        assert state.completed_nodes.count("check_quota") == 1
+        assert _usage(store, user_ref) == (1, 0)
+        with pytest.raises(ValueError, match="Insufficient quota"):
+            asyncio.run(graph._check_quota_node(agent_orchestrator_module.AgentState(
+                case_id="case-1", user_id="user-1", case_details={"input": "question"}, user_info={})))
+
+    def test_organization_case_turns_spend_the_organization_quota(self, store, monkeypatch):
+        # The member has no quota of their own; the organization pays for its cases
+        user_ref = store.collection("users").document("user-1")
+        user_ref.set({"subscription": {}})
+        org_ref = store.collection("organizations").document("org-1")
+        org_ref.set({"quota_limit": 1, "quota_used": 0})
+        store.collection("organization_memberships").document("m-1").set({"organizationId": "org-1", "userId": "user-1"})
+        store.collection("cases").document("case-1").set({"userId": "user-2", "organizationId": "org-1"})
+        monkeypatch.setattr(agent_module, "get_db_client", lambda: store)
+        graph = agent_orchestrator_module.AgentGraph()
+        for node in ("_analyze_input_node", "_research_node", "_guidance_node", "_generate_response_node"):
+            setattr(graph, node, AsyncMock(return_value={"status": "success"}))
+
+        (state, _), error = asyncio.run(agent_module.prepare_agent_turn("user-1", "case-1", {"message": "question"}))
+        assert error is None and state.organization_id == "org-1"
+        result = asyncio.run(graph.execute(state))
+
+        assert result["status"] == "success"
+        assert quota_module.get_quota_usage(store, "organizations", org_ref, org_ref.get().to_dict()) == (1, 0)
+
+    def test_check_quota_batches_reads_and_serves_warm_checks_from_cache(self, store, monkeypatch):
+        _user(store, quota_limit=5)
+        store.collection("organizations").document("org-1").set({"quota_limit": 8, "quota_used": 3})
+        calls = []
+        original_get_all = store.get_all
+        monkeypatch.setattr(store, "get_all", lambda refs: calls.append(len(list(refs))) or original_get_all(refs))
+        monkeypatch.setattr(fake_firestore.FakeDocumentReference, "get",
+                            lambda ref, *args, **kwargs: pytest.fail(f"unexpected single read of {ref.path}"))
+
+        first = asyncio.run(agent_tools_module.check_quota("user-1", "org-1"))
+        second = asyncio.run(agent_tools_module.check_quota("user-1", "org-1"))
+
+        assert first == second
+        assert first["quota_limit"] == 8
+        assert first["available_requests"] == 8
+        assert calls == [2, 2 * quota_module.QUOTA_SHARD_COUNT]
+
+    def test_subscription_updates_invalidate_the_snapshot(self, store, monkeypatch):
+        user_ref = _user(store, quota_limit=5)
+        assert asyncio.run(agent_tools_module.check_quota("user-1"))["quota_limit"] == 5
+
+        assert payments_module._apply_subscription_update(store, user_ref, {"subscription.quota_limit": 9}, None)
+
+        assert asyncio.run(agent_tools_module.check_quota("user-1"))["quota_limit"] == 9
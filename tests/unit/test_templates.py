@@ -187,3 +187,23 @@ def test_metadata_generation(generator, valid_person):
     assert "PROCURĂ" in result
     assert context["principal_name"] in result
     assert context["agent_name"] in result
+
+def test_validator_schema_is_shared_and_read_only():
+    """Test that validators share one read-only schema."""
+    first, second = TemplateValidator(), TemplateValidator()
+    assert first.template_fields is second.template_fields is template_validation.TEMPLATE_FIELDS
+    with pytest.raises(TypeError):
+        first.template_fields["power_of_attorney"]["principal_name"] = None
+    with pytest.raises(TypeError):
+        first.person_fields["name"] = None
+    with pytest.raises(AttributeError):
+        first.person_fields["name"].required = False
+
+def test_template_registry_is_read_only(generator):
+    """Test that templates are looked up in the shared registry."""
+    assert generator.list_available_templates() == list(draft_templates.DraftTemplates.TEMPLATES)
+    assert generator.get_template("complaint") == generator._complaint_template
+    assert generator.get_template("unknown") is None
+    with pytest.raises(TypeError):
+        draft_templates.DraftTemplates.TEMPLATES["complaint"] = "_gdpr_notice_template"
+
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for Voucher Usage Accounting
+
+This module contains unit tests for the sharded voucher usage counters in vouchers.py and
+their use by payments.logic_redeem_voucher.
+"""
+
+import pytest
+import sys
+import os
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+# Add the functions/src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../functions/src'))
+
+import payments as payments_module
+import vouchers as vouchers_module
+from tests.helpers import fake_firestore
+
+
+@pytest.fixture
+def store(monkeypatch):
+    """Back payments and vouchers with an in-memory Firestore."""
+    db = fake_firestore.FakeFirestore()
+    monkeypatch.setattr(payments_module, "get_db_client", lambda: db)
+    monkeypatch.setattr(vouchers_module, "db", db)
+    monkeypatch.setattr(payments_module.firestore, "transactional", fake_firestore.transactional)
+    monkeypatch.setattr(vouchers_module, "VOUCHER_USAGE_SHARD_COUNT", 4)
+    monkeypatch.setattr(vouchers_module, "_voucher_cache", vouchers_module.TTLCache(60))
+    return db
+
+
+def _voucher(store, code="CAMPAIGN", usage_limit=10, usage_count=0, sharded=True):
+    voucher_ref = store.collection("vouchers").document(code)
+    voucher = {
+        "code": code, "isActive": True, "voucherType": "credit", "value": {"amount": 500},
+        "usageLimit": usage_limit, "usageCount": usage_count,
+    }
+    batch = store.batch()
+    if sharded:
+        voucher["usageShardCount"] = vouchers_module.write_usage_shards(batch, voucher_ref, usage_limit, usage_count)
+    batch.set(voucher_ref, voucher)
+    batch.commit()
+    return voucher_ref
+
+
+def _redeem(store, user_id, code="CAMPAIGN"):
+    store.collection("users").document(user_id).set({"voucherBalance": 0})
+    request = MagicMock()
+    request.get_json.return_value = {"voucherCode": code}
+    request.end_user_id = user_id
+    return payments_module.logic_redeem_voucher(request)
+
+
+class TestVoucherUsageShards:
+    """Tests for exact usage limits on sharded voucher counters."""
+
+    def test_capacities_add_up_to_the_remaining_uses(self, store):
+        assert sum(vouchers_module._usage_shard_capacities(45, 3)) == 42
+        assert vouchers_module._usage_shard_capacities(2, 0) == [1, 1]
+        assert vouchers_module._usage_shard_capacities(5, 5) == []
+
+    def test_redemptions_stop_exactly_at_the_limit(self, store):
+        voucher_ref = _voucher(store, usage_limit=3)
+
+        statuses = [_redeem(store, f"user-{i}")[1] for i in range(5)]
+
+        assert statuses == [200, 200, 200, 400, 400]
+        voucher_data = voucher_ref.get().to_dict()
+        assert vouchers_module.get_voucher_usage_count(store, voucher_ref, voucher_data) == 3
+        assert voucher_data["usageExhausted"] is True
+        assert vouchers_module.validate_voucher_code("CAMPAIGN")[2] == "Voucher usage limit reached"
+        assert store.collection("users").document("user-0").get().to_dict()["voucherBalance"] == 500
+
+    def test_concurrent_redemptions_never_exceed_the_limit(self, store):
+        voucher_ref = _voucher(store, usage_limit=10)
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda i: _redeem(store, f"user-{i}"), range(30)))
+
+        succeeded = sum(1 for _, status_code in results if status_code == 200)
+        assert succeeded <= 10
+        assert vouchers_module.get_voucher_usage_count(store, voucher_ref, voucher_ref.get().to_dict()) == succeeded
+
+    def test_voucher_without_shards_keeps_its_earlier_usage(self, store):
+        voucher_ref = _voucher(store, usage_limit=3, usage_count=2, sharded=False)
+
+        assert _redeem(store, "user-1")[1] == 200
+        assert _redeem(store, "user-2")[1] == 400
+
+        voucher_data = voucher_ref.get().to_dict()
+        assert voucher_data["usageShardCount"] == 1
+        assert vouchers_module.get_voucher_usage_count(store, voucher_ref, voucher_data) == 3
+
+    def test_resize_redistributes_unclaimed_slots(self, store):
+        voucher_ref = _voucher(store, usage_limit=2)
+        _redeem(store, "user-1")
+        _redeem(store, "user-2")
+
+        with pytest.raises(ValueError):
+            vouchers_module.resize_voucher_usage_limit(store, voucher_ref, 1)
+        vouchers_module.resize_voucher_usage_limit(store, voucher_ref, 5)
+
+        statuses = [_redeem(store, f"user-{i}")[1] for i in range(3, 7)]
+        assert statuses == [200, 200, 200, 400]
+
+
+def _admin_request(body, user_id="admin-user"):
+    request = MagicMock()
+    request.get_json.return_value = body
+    request.end_user_id = user_id
+    return request
+
+
+class TestBulkVoucherGeneration:
+    """Tests for logic_create_vouchers_bulk."""
+
+    @pytest.fixture(autouse=True)
+    def admin(self, monkeypatch):
+        monkeypatch.setenv("VOUCHER_CODE_SECRET", "test-secret")
+        monkeypatch.setattr(vouchers_module, "check_permission", lambda uid, req: (True, None))
+
+    def test_codes_are_unique_across_requests(self, store):
+        secret = b"test-secret"
+        codes = {vouchers_module._bulk_voucher_code(None, sequence, secret) for sequence in range(20000)}
+        assert len(codes) == 20000
+        assert all(len(code) == vouchers_module.VOUCHER_CODE_LENGTH for code in codes)
+
+        first = vouchers_module.logic_create_vouchers_bulk(_admin_request({"count": 3, "prefix": "acme", "discount_percentage": 10}))
+        second = vouchers_module.logic_create_vouchers_bulk(_admin_request({"count": 3, "prefix": "acme", "discount_percentage": 10}))
+        first_codes = [line.split(",")[0] for line in first.get_data(as_text=True).splitlines()[1:]]
+        second_codes = [line.split(",")[0] for line in second.get_data(as_text=True).splitlines()[1:]]
+        assert len(set(first_codes + second_codes)) == 6
+        assert all(code.startswith("ACME-") for code in first_codes)
+
+    def test_vouchers_are_written_in_batches_and_streamed_as_csv(self, store, monkeypatch):
+        monkeypatch.setattr(vouchers_module, "VOUCHER_BULK_VOUCHERS_PER_BATCH", 4)
+        batch_sizes = []
+        original = vouchers_module._write_voucher_batch
+        monkeypatch.setattr(vouchers_module, "_write_voucher_batch",
+                            lambda codes, template: batch_sizes.append(len(codes)) or original(codes, template))
+
+        response = vouchers_module.logic_create_vouchers_bulk(_admin_request({"count": 10, "discount_percentage": 25}))
+
+        assert response.status_code == 201
+        assert response.mimetype == "text/csv"
+        lines = response.get_data(as_text=True).splitlines()
+        assert lines[0] == "code,discountPercentage,expirationDate"
+        assert len(lines) == 11
+        assert sorted(batch_sizes) == [2, 4, 4]
+        voucher_ref = store.collection("vouchers").document(lines[1].split(",")[0])
+        voucher = voucher_ref.get().to_dict()
+        assert voucher["usageLimit"] == 1
+        assert voucher["batchId"] == response.headers["X-Voucher-Batch-Id"]
+        assert vouchers_module.get_voucher_usage_count(store, voucher_ref, voucher) == 0
+
+    def test_failed_batches_are_reported(self, store, monkeypatch):
+        monkeypatch.setattr(vouchers_module, "VOUCHER_BULK_VOUCHERS_PER_BATCH", 4)
+        original = vouchers_module._write_voucher_batch
+        monkeypatch.setattr(vouchers_module, "_write_voucher_batch",
+                            lambda codes, template: ([], [], RuntimeError("unavailable")) if len(codes) == 2 else original(codes, template))
+
+        response = vouchers_module.logic_create_vouchers_bulk(_admin_request({"count": 10, "discount_percentage": 25}))
+
+        assert response.status_code == 207
+        assert response.headers["X-Voucher-Count"] == "8"
+        assert response.headers["X-Voucher-Failed-Count"] == "2"
+        lines = response.get_data(as_text=True).splitlines()
+        assert len(lines) == 9
+        assert all(store.collection("vouchers").document(line.split(",")[0]).get().exists for line in lines[1:])
+
+    def test_codes_of_existing_vouchers_are_skipped(self, store, monkeypatch):
+        monkeypatch.setattr(vouchers_module, "VOUCHER_BULK_VOUCHERS_PER_BATCH", 4)
+        monkeypatch.setattr(vouchers_module, "_reserve_voucher_sequence", lambda count: 0)
+        taken = vouchers_module._bulk_voucher_code(None, 1, b"test-secret")
+        _voucher(store, code=taken, usage_limit=5)
+
+        response = vouchers_module.logic_create_vouchers_bulk(_admin_request({"count": 10, "discount_percentage": 25}))
+
+        assert response.status_code == 201
+        assert response.headers["X-Voucher-Count"] == "9"
+        assert response.headers["X-Voucher-Skipped-Count"] == "1"
+        codes = [line.split(",")[0] for line in response.get_data(as_text=True).splitlines()[1:]]
+        assert len(codes) == 9 and taken not in codes
+        assert all(store.collection("vouchers").document(code).get().exists for code in codes)
+        # The hand-made voucher is left as it was
+        voucher = store.collection("vouchers").document(taken).get().to_dict()
+        assert voucher["usageLimit"] == 5 and "batchId" not in voucher
+
+    def test_nothing_written_is_an_error(self, store, monkeypatch):
+        monkeypatch.setattr(vouchers_module, "_write_voucher_batch",
+                            lambda codes, template: ([], [], RuntimeError("unavailable")))
+
+        body, status_code = vouchers_module.logic_create_vouchers_bulk(_admin_request({"count": 3, "discount_percentage": 25}))
+
+        assert status_code == 500
+        assert body["createdCount"] == 0
+
+    def test_missing_secret_is_a_configuration_error(self, store, monkeypatch):
+        monkeypatch.delenv("VOUCHER_CODE_SECRET")
+
+        body, status_code = vouchers_module.logic_create_vouchers_bulk(_admin_request({"count": 1, "discount_percentage": 10}))
+
+        assert status_code == 500
+        assert body["error"] == "ConfigurationError"
+
+
+class TestVoucherValidationCache:
+    """Tests for the voucher metadata cache behind validate_voucher_code."""
+
+    def _count_reads(self, store, monkeypatch):
+        reads = []
+        original = fake_firestore.FakeDocumentReference.get
+        monkeypatch.setattr(fake_firestore.FakeDocumentReference, "get",
+                            lambda ref, *args, **kwargs: reads.append(ref.id) or original(ref, *args, **kwargs))
+        return reads
+
+    def test_repeated_validations_read_the_voucher_once(self, store, monkeypatch):
+        _voucher(store, code="SPRING")
+        reads = self._count_reads(store, monkeypatch)
+
+        results = [vouchers_module.validate_voucher_code(code) for code in ("spring", "SPRING ", "SPRING")]
+
+        assert all(is_valid for is_valid, _, _ in results)
+        assert reads == ["SPRING"]
+
+    def test_unknown_and_malformed_codes_are_rejected_without_repeated_reads(self, store, monkeypatch):
+        reads = self._count_reads(store, monkeypatch)
+
+        assert vouchers_module.validate_voucher_code("NOPE")[2] == "Voucher code not found"
+        assert vouchers_module.validate_voucher_code("NOPE")[2] == "Voucher code not found"
+        assert vouchers_module.validate_voucher_code("50% OFF!")[2] == "Voucher code not found"
+        assert reads == ["NOPE"]
+
+    def test_writes_invalidate_the_cached_entry(self, store, monkeypatch):
+        monkeypatch.setattr(vouchers_module, "check_permission", lambda uid, req: (True, None))
+        assert vouchers_module.validate_voucher_code("SUMMER")[2] == "Voucher code not found"
+
+        create = _admin_request({"code": "SUMMER", "discount_percentage": 15, "usage_limit": 5})
+        assert vouchers_module.logic_create_voucher(create)[1] == 201
+        assert vouchers_module.validate_voucher_code("SUMMER")[0] is True
+
+        update = _admin_request({"is_active": False})
+        assert vouchers_module.logic_update_voucher(update, "SUMMER")[1] == 200
+        assert vouchers_module.validate_voucher_code("SUMMER")[2] == "Voucher is not active"